@@ -0,0 +1,198 @@
+/**
+ * 多进程吞吐基准：分别以 1、2、4… 个工作进程启动服务，混合压测两类请求
+ *   - generate: 把模拟的上游流式响应（含 base64 图片）分块喂给 aiService.processStreamBuffer，
+ *               走真实的 JSON 扫描、base64 解码、写缓存和缩略图，代表 CPU 密集阶段
+ *   - image:    通过缓存索引查找并返回已缓存图片，代表其他用户的轻量请求
+ * 输出各进程数下的总吞吐和 image 请求延迟（CPU 密集请求是否拖慢其他人）
+ *
+ * 用法: node bench/cluster-throughput.js [--workers 1,2,4] [--seconds 10] [--connections 32] [--size 512] [--images 2000] [--mix 10]
+ * --size 为每张生成图片的 KB 数，--images 为预置的缓存图片数，--mix 为每 N 个请求中有 1 个 generate
+ */
+const http = require('http');
+const fs = require('fs');
+const os = require('os');
+const path = require('path');
+const { fork } = require('child_process');
+
+const arg = (name, fallback) => {
+  const i = process.argv.indexOf(`--${name}`);
+  return i !== -1 ? process.argv[i + 1] : fallback;
+};
+const WORKERS = String(arg('workers', [1, 2, 4].filter(n => n <= Math.max(1, os.availableParallelism())).join(','))).split(',').map(Number);
+const SECONDS = Number(arg('seconds', 10));
+const CONNECTIONS = Number(arg('connections', 32));
+const SIZE_KB = Number(arg('size', 512));
+const IMAGES = Number(arg('images', 2000));
+const MIX = Number(arg('mix', 10));
+const CHUNK_BYTES = 16 * 1024;
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+// ---------------- 服务端（子进程；多进程时该子进程是 cluster 主进程） ----------------
+function runServer() {
+  const clusterService = require('../services/clusterService');
+  if (clusterService.startPrimary(Number(process.env.BENCH_WORKERS))) return;
+
+  const cacheService = require('../services/cacheService');
+  const aiService = require('../services/aiService');
+  const upstreamBody = JSON.stringify({
+    candidates: [{ content: { parts: [{ inlineData: { mimeType: 'image/png', data: Buffer.alloc(SIZE_KB * 1024, 7).toString('base64') } }] } }]
+  });
+
+  // 与 streamGenerateContent 相同：每收到一块就把累计缓冲交给 processStreamBuffer
+  const generate = async () => {
+    const cacheKeys = [];
+    const pendingTasks = [];
+    let buffer = '';
+    for (let offset = 0; offset < upstreamBody.length; offset += CHUNK_BYTES) {
+      buffer += upstreamBody.slice(offset, offset + CHUNK_BYTES);
+      buffer = aiService.processStreamBuffer(buffer, () => {}, cacheKeys, pendingTasks).remainingBuffer;
+      await new Promise(setImmediate);
+    }
+    await Promise.all(pendingTasks);
+    return cacheKeys[0];
+  };
+
+  const server = http.createServer(async (req, res) => {
+    try {
+      if (req.url === '/generate') {
+        const key = await generate();
+        res.end(JSON.stringify({ key }));
+      } else if (req.url.startsWith('/image/')) {
+        const image = await cacheService.openImage(req.url.slice('/image/'.length));
+        if (!image) {
+          res.statusCode = 404;
+          return res.end();
+        }
+        res.setHeader('Content-Type', image.contentType);
+        image.stream.pipe(res);
+      } else {
+        res.statusCode = 404;
+        res.end();
+      }
+    } catch (error) {
+      res.statusCode = 500;
+      res.end(error.message);
+    }
+  });
+
+  cacheService.ready.then(() => {
+    server.listen(Number(process.env.BENCH_PORT), '127.0.0.1');
+  });
+}
+
+// ---------------- 客户端（主进程） ----------------
+function seedCache(dir) {
+  const imageDir = path.join(dir, 'images');
+  fs.mkdirSync(imageDir, { recursive: true });
+  fs.mkdirSync(path.join(dir, 'tables'), { recursive: true });
+  const image = Buffer.alloc(32 * 1024, 1);
+  const keys = [];
+  for (let i = 0; i < IMAGES; i++) {
+    const key = `seed-${i}`;
+    fs.writeFileSync(path.join(imageDir, `${key}.png`), image);
+    keys.push(key);
+  }
+  return keys;
+}
+
+function get(agent, port, pathName, method = 'GET') {
+  return new Promise((resolve) => {
+    const startedAt = process.hrtime.bigint();
+    const req = http.request({ host: '127.0.0.1', port, path: pathName, method, agent }, (res) => {
+      res.resume();
+      res.on('end', () => resolve({ ok: res.statusCode === 200, ms: Number(process.hrtime.bigint() - startedAt) / 1e6 }));
+    });
+    req.on('error', () => resolve({ ok: false, ms: 0 }));
+    req.end();
+  });
+}
+
+async function waitForPort(port, child) {
+  for (let i = 0; i < 200; i++) {
+    if (child.exitCode !== null) throw new Error('服务端启动失败');
+    const ok = await new Promise(resolve => {
+      const req = http.get({ host: '127.0.0.1', port, path: '/ping' }, res => { res.resume(); resolve(true); });
+      req.on('error', () => resolve(false));
+    });
+    if (ok) return;
+    await sleep(100);
+  }
+  throw new Error('等待服务端超时');
+}
+
+const percentile = (values, p) => {
+  if (!values.length) return 0;
+  const sorted = [...values].sort((a, b) => a - b);
+  return sorted[Math.min(sorted.length - 1, Math.floor(sorted.length * p / 100))];
+};
+
+async function runWorkers(workers, port) {
+  const cacheDir = fs.mkdtempSync(path.join(os.tmpdir(), 'bench-cluster-'));
+  const keys = seedCache(cacheDir);
+  const child = fork(__filename, ['--server', ...process.argv.slice(2)], {
+    env: { ...process.env, CACHE_DIR: cacheDir, BENCH_PORT: String(port), BENCH_WORKERS: String(workers), CLUSTER_WORKERS: String(workers) },
+    stdio: ['ignore', 'ignore', 'inherit', 'ipc']
+  });
+  await waitForPort(port, child);
+  // 多进程时等每个工作进程都建好索引
+  await sleep(workers > 1 ? 1000 : 0);
+
+  const agent = new http.Agent({ keepAlive: true, maxSockets: CONNECTIONS });
+  const result = { workers, generate: [], image: [], errors: 0 };
+  const deadline = Date.now() + SECONDS * 1000;
+  let seq = 0;
+
+  const loop = async () => {
+    while (Date.now() < deadline) {
+      const n = seq++;
+      const isGenerate = n % MIX === 0;
+      const { ok, ms } = isGenerate
+        ? await get(agent, port, '/generate', 'POST')
+        : await get(agent, port, `/image/${keys[n % keys.length]}`);
+      if (!ok) result.errors++;
+      else (isGenerate ? result.generate : result.image).push(ms);
+    }
+  };
+  await Promise.all(Array.from({ length: CONNECTIONS }, loop));
+
+  agent.destroy();
+  child.kill();
+  await new Promise(resolve => child.once('exit', resolve));
+  fs.rmSync(cacheDir, { recursive: true, force: true });
+  return result;
+}
+
+async function main() {
+  console.log(`多进程吞吐基准: CPU 核数 ${os.availableParallelism()}, ${CONNECTIONS} 并发连接, ${SECONDS}s, generate 图片 ${SIZE_KB}KB, 每 ${MIX} 个请求 1 个 generate, 预置 ${IMAGES} 张缓存图片`);
+  const results = [];
+  let port = 39000;
+  for (const workers of WORKERS) {
+    results.push(await runWorkers(workers, port++));
+  }
+
+  const base = results[0];
+  const total = (r) => (r.generate.length + r.image.length) / SECONDS;
+  console.log('\n进程数  总吞吐(req/s)  相对1进程  generate/s  image p50(ms)  image p99(ms)  generate p50(ms)  错误');
+  for (const r of results) {
+    console.log([
+      String(r.workers).padStart(6),
+      total(r).toFixed(0).padStart(13),
+      (total(r) / total(base)).toFixed(2).padStart(9) + 'x',
+      (r.generate.length / SECONDS).toFixed(1).padStart(10),
+      percentile(r.image, 50).toFixed(1).padStart(13),
+      percentile(r.image, 99).toFixed(1).padStart(13),
+      percentile(r.generate, 50).toFixed(0).padStart(16),
+      String(r.errors).padStart(5)
+    ].join('  '));
+  }
+}
+
+if (process.argv.includes('--server')) {
+  runServer();
+} else {
+  main().catch(error => {
+    console.error(error);
+    process.exit(1);
+  });
+}
@@ -0,0 +1,126 @@
+/**
+ * 冷启动基准：在有 N 个缓存条目（原图 + 缩略图）的目录上测缓存索引就绪时间
+ *   - scan:      没有快照，完整列目录并 stat 每张原图（首次启动 / 快照失效）
+ *   - snapshot:  从索引快照恢复，后台对账
+ *   - snapshot+: 快照之后又新增了一批文件，对账时只 stat 新增部分
+ * 每轮都在新的子进程里测，时间从进程启动算起（含模块加载）；文件系统页缓存是热的
+ *
+ * 用法: node bench/cold-start.js [--entries 100000] [--added 1000] [--runs 3]
+ */
+const fs = require('fs');
+const os = require('os');
+const path = require('path');
+const { fork } = require('child_process');
+
+const arg = (name, fallback) => {
+  const i = process.argv.indexOf(`--${name}`);
+  return i !== -1 ? Number(process.argv[i + 1]) : fallback;
+};
+const ENTRIES = arg('entries', 100000);
+const ADDED = arg('added', 1000);
+const RUNS = arg('runs', 3);
+
+// ---------------- 子进程：加载 cacheService，报告就绪时间 ----------------
+async function runChild() {
+  const cacheService = require('../services/cacheService');
+  await cacheService.ready;
+  const readyMs = process.uptime() * 1000;
+  await cacheService.reconciled;
+  const reconciledMs = process.uptime() * 1000;
+  // 完整扫描后会写快照，等它落盘再退出
+  await cacheService.writeSnapshot();
+  process.send({
+    readyMs,
+    reconciledMs,
+    images: cacheService.images.size,
+    source: cacheService.stats.indexSource,
+    rssMb: process.memoryUsage().rss / 1024 / 1024
+  });
+  process.disconnect();
+}
+
+// ---------------- 主进程 ----------------
+function seed(dir, from, count) {
+  const imageDir = path.join(dir, 'images');
+  fs.mkdirSync(imageDir, { recursive: true });
+  fs.mkdirSync(path.join(dir, 'tables'), { recursive: true });
+  const body = Buffer.alloc(64, 1);
+  for (let i = from; i < from + count; i++) {
+    fs.writeFileSync(path.join(imageDir, `entry-${i}.png`), body);
+    fs.writeFileSync(path.join(imageDir, `entry-${i}_thumb.png`), body);
+  }
+}
+
+function measure(cacheDir) {
+  return new Promise((resolve, reject) => {
+    const child = fork(__filename, ['--child'], {
+      env: { ...process.env, CACHE_DIR: cacheDir, STORAGE_BACKEND: 'fs' },
+      stdio: ['ignore', 'ignore', 'inherit', 'ipc']
+    });
+    child.once('message', resolve);
+    child.once('exit', code => code && reject(new Error(`子进程退出码 ${code}`)));
+  });
+}
+
+const median = (values) => [...values].sort((a, b) => a - b)[Math.floor(values.length / 2)];
+
+async function scenario(name, cacheDir, prepare) {
+  const samples = [];
+  for (let i = 0; i < RUNS; i++) {
+    prepare();
+    samples.push(await measure(cacheDir));
+  }
+  return {
+    name,
+    readyMs: median(samples.map(s => s.readyMs)),
+    reconciledMs: median(samples.map(s => s.reconciledMs)),
+    images: samples[0].images,
+    source: samples[0].source,
+    rssMb: median(samples.map(s => s.rssMb))
+  };
+}
+
+async function main() {
+  const cacheDir = fs.mkdtempSync(path.join(os.tmpdir(), 'bench-cold-start-'));
+  const snapshot = path.join(cacheDir, 'index-snapshot.json');
+  console.log(`冷启动基准: ${ENTRIES} 个缓存条目（${ENTRIES * 2} 个文件），每种情况 ${RUNS} 次取中位数`);
+  const seededAt = Date.now();
+  seed(cacheDir, 0, ENTRIES);
+  console.log(`生成测试数据 ${((Date.now() - seededAt) / 1000).toFixed(1)}s`);
+
+  const results = [];
+  results.push(await scenario('scan', cacheDir, () => fs.rmSync(snapshot, { force: true })));
+  results.push(await scenario('snapshot', cacheDir, () => {}));
+
+  // 快照之后新增文件：每轮先恢复到只含旧条目的快照
+  await measure(cacheDir);
+  const baseSnapshot = fs.readFileSync(snapshot);
+  seed(cacheDir, ENTRIES, ADDED);
+  results.push(await scenario(`snapshot+${ADDED}`, cacheDir, () => fs.writeFileSync(snapshot, baseSnapshot)));
+
+  console.log(`快照大小 ${(fs.statSync(snapshot).size / 1024 / 1024).toFixed(1)}MB`);
+  console.log('\n情况              索引来源   就绪(ms)   对账完成(ms)   条目数   RSS(MB)');
+  for (const r of results) {
+    console.log([
+      r.name.padEnd(16),
+      r.source.padEnd(8),
+      r.readyMs.toFixed(0).padStart(8),
+      r.reconciledMs.toFixed(0).padStart(13),
+      String(r.images).padStart(8),
+      r.rssMb.toFixed(0).padStart(8)
+    ].join('  '));
+  }
+  fs.rmSync(cacheDir, { recursive: true, force: true });
+}
+
+if (process.argv.includes('--child')) {
+  runChild().catch(error => {
+    console.error(error);
+    process.exit(1);
+  });
+} else {
+  main().catch(error => {
+    console.error(error);
+    process.exit(1);
+  });
+}
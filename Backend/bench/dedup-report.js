@@ -0,0 +1,163 @@
+/**
+ * 去重报告：按内容哈希统计缓存目录里的原图和表格，给出重复文件数、逻辑字节数与实际存储字节数
+ *   - 旧布局 images/<key><ext>、tables/<key><ext>：每个文件算一次存储
+ *   - 新布局 blobs/<hash><ext> + refs/<key>.json：每个 blob 只存一次
+ * 报告按内容分组，列出重复最多的几组，用于评估迁移到按内容存储能省多少空间
+ *
+ * --migrate 把旧布局迁移到新布局（只支持本地文件存储，需先停止服务）：
+ *   原图 / 表格移动到 blobs/，内容重复的直接删除；旧缩略图和 derived/ 下按 key 命名的派生图删除（按需重建）；
+ *   写入 refs/<key>.json（创建时间取原文件修改时间），最后删除索引快照，下次启动时重新扫描
+ *
+ * 用法: node bench/dedup-report.js [--dir ./cache] [--top 10] [--migrate]
+ */
+const crypto = require('crypto');
+const fs = require('fs-extra');
+const path = require('path');
+
+const arg = (name, fallback) => {
+  const i = process.argv.indexOf(`--${name}`);
+  return i !== -1 ? process.argv[i + 1] : fallback;
+};
+const CACHE_DIR = path.resolve(arg('dir', process.env.CACHE_DIR || './cache'));
+const TOP = Number(arg('top', 10));
+const MIGRATE = process.argv.includes('--migrate');
+
+// 与 cacheService 保持一致
+const IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.webp'];
+const TABLE_EXTENSIONS = ['.csv', '.xlsx'];
+const SNAPSHOT = process.env.CACHE_INDEX_SNAPSHOT || 'index-snapshot.json';
+
+async function hashFile(file) {
+  const hash = crypto.createHash('sha256');
+  for await (const chunk of fs.createReadStream(file)) hash.update(chunk);
+  return hash.digest('hex').slice(0, 32);
+}
+
+async function listDir(dir) {
+  return (await fs.pathExists(dir)) ? fs.readdir(dir) : [];
+}
+
+/**
+ * 旧布局里的原图和表格：[{ type, key, file, ext, size, mtimeMs, hash }]
+ */
+async function scanLegacy() {
+  const items = [];
+  for (const [type, dir, extensions] of [['image', 'images', IMAGE_EXTENSIONS], ['table', 'tables', TABLE_EXTENSIONS]]) {
+    for (const file of await listDir(path.join(CACHE_DIR, dir))) {
+      const ext = path.extname(file).toLowerCase();
+      const key = path.basename(file, path.extname(file));
+      if (!extensions.includes(ext) || key.endsWith('_thumb')) continue;
+      const full = path.join(CACHE_DIR, dir, file);
+      const stats = await fs.stat(full);
+      items.push({ type, key, file: `${dir}/${file}`, ext, size: stats.size, mtimeMs: stats.mtimeMs, hash: await hashFile(full) });
+    }
+  }
+  return items;
+}
+
+/**
+ * 新布局里的引用：[{ type, key, file, size, hash }]，blob 文件名就是哈希
+ */
+async function scanRefs() {
+  const items = [];
+  for (const file of await listDir(path.join(CACHE_DIR, 'refs'))) {
+    if (!file.endsWith('.json')) continue;
+    try {
+      const ref = await fs.readJson(path.join(CACHE_DIR, 'refs', file));
+      items.push({ type: ref.type, key: path.basename(file, '.json'), file: `blobs/${ref.file}`, size: ref.size, hash: ref.blob });
+    } catch {
+      console.warn(`⚠️ 无法解析引用 refs/${file}，跳过`);
+    }
+  }
+  return items;
+}
+
+function report(legacy, refs) {
+  const groups = new Map();
+  for (const item of [...legacy, ...refs]) {
+    const group = groups.get(item.hash) || { hash: item.hash, size: item.size, type: item.type, keys: [], legacy: 0 };
+    group.keys.push(item.key);
+    if (item.file.startsWith('blobs/')) group.blob = true;
+    else group.legacy++;
+    groups.set(item.hash, group);
+  }
+
+  const logical = [...legacy, ...refs].reduce((sum, item) => sum + item.size, 0);
+  // 当前存储：旧文件各算一份，blob 每个算一份
+  const stored = legacy.reduce((sum, item) => sum + item.size, 0)
+    + [...groups.values()].filter(group => group.blob).reduce((sum, group) => sum + group.size, 0);
+  const deduplicated = [...groups.values()].reduce((sum, group) => sum + group.size, 0);
+  const mb = (bytes) => `${(bytes / 1024 / 1024).toFixed(2)} MB`;
+
+  console.log(`去重报告: ${CACHE_DIR}\n`);
+  console.log(`  文件 / 引用           ${legacy.length} 个旧文件 + ${refs.length} 个引用`);
+  console.log(`  不同内容              ${groups.size}`);
+  console.log(`  逻辑字节数            ${mb(logical)}`);
+  console.log(`  当前存储              ${mb(stored)}`);
+  console.log(`  全部按内容存储后      ${mb(deduplicated)}  (去重比 ${(logical / (deduplicated || 1)).toFixed(2)}x，可再省 ${mb(stored - deduplicated)})`);
+
+  const duplicates = [...groups.values()].filter(group => group.keys.length > 1)
+    .sort((a, b) => (b.keys.length - 1) * b.size - (a.keys.length - 1) * a.size);
+  if (!duplicates.length) {
+    console.log('\n没有内容重复的文件');
+    return;
+  }
+  console.log(`\n重复最多的 ${Math.min(TOP, duplicates.length)} 组（共 ${duplicates.length} 组）:`);
+  console.log('哈希                               类型     大小(KB)   key 数   重复字节(KB)');
+  for (const group of duplicates.slice(0, TOP)) {
+    console.log([
+      group.hash.padEnd(33),
+      group.type.padEnd(6),
+      (group.size / 1024).toFixed(0).padStart(9),
+      String(group.keys.length).padStart(7),
+      (((group.keys.length - 1) * group.size) / 1024).toFixed(0).padStart(13)
+    ].join('  '));
+  }
+}
+
+async function migrate(legacy) {
+  const blobsDir = path.join(CACHE_DIR, 'blobs');
+  const refsDir = path.join(CACHE_DIR, 'refs');
+  await fs.ensureDir(blobsDir);
+  await fs.ensureDir(refsDir);
+  const derived = await listDir(path.join(CACHE_DIR, 'derived'));
+  let moved = 0;
+  let removed = 0;
+
+  for (const item of legacy) {
+    const file = `${item.hash}${item.ext}`;
+    const source = path.join(CACHE_DIR, item.file);
+    if (await fs.pathExists(path.join(blobsDir, file))) {
+      await fs.remove(source);
+      removed++;
+    } else {
+      await fs.move(source, path.join(blobsDir, file));
+      moved++;
+    }
+    const ref = { type: item.type, blob: item.hash, file, size: item.size, createdAt: item.mtimeMs, kind: null, paper: null };
+    await fs.writeJson(path.join(refsDir, `${item.key}.json`), ref);
+
+    if (item.type === 'image') {
+      await fs.remove(path.join(CACHE_DIR, 'images', `${item.key}_thumb${path.extname(item.file)}`));
+      for (const name of derived.filter(name => name.startsWith(`${item.key}_`))) {
+        await fs.remove(path.join(CACHE_DIR, 'derived', name));
+      }
+    }
+  }
+  await fs.remove(path.join(CACHE_DIR, SNAPSHOT));
+  console.log(`\n✅ 迁移完成: ${moved} 个文件移入 blobs/，${removed} 个重复文件已删除，写入 ${legacy.length} 个引用`);
+  console.log('   缩略图会在下次启动后由 cache_verifier.py --repair 重建');
+}
+
+async function main() {
+  if (!(await fs.pathExists(CACHE_DIR))) throw new Error(`缓存目录不存在: ${CACHE_DIR}`);
+  const legacy = await scanLegacy();
+  const refs = await scanRefs();
+  report(legacy, refs);
+  if (MIGRATE) await migrate(legacy);
+}
+
+main().catch(error => {
+  console.error(error);
+  process.exit(1);
+});
@@ -0,0 +1,135 @@
+/**
+ * 图片流量基准：一次分析里 Streamlit 客户端下载的图片字节数，对比改动前后
+ *   - before: 每张新图到达时重绘全部候选图，每次都带时间戳参数重新下载原图；完成后再重绘一遍（下载按钮用同一份字节）
+ *   - after:  展示用 WebP 派生图，会话内缓存不重复下载；完成后每张原图只取一次给下载按钮
+ * 同时给出派生图的首次生成耗时和命中缓存后的读取耗时
+ *
+ * 图片来源：--images 指定目录时取其中的原图（例如 ./cache/images），否则生成 1024x1024 的合成 PNG
+ *
+ * 用法: node bench/image-bytes.js [--candidates 4] [--width 768] [--quality medium] [--format webp] [--images ./cache/images]
+ */
+const fs = require('fs-extra');
+const os = require('os');
+const path = require('path');
+
+const arg = (name, fallback) => {
+  const i = process.argv.indexOf(`--${name}`);
+  return i !== -1 ? process.argv[i + 1] : fallback;
+};
+const CANDIDATES = Number(arg('candidates', 4));
+const WIDTH = Number(arg('width', 768));
+const QUALITY = arg('quality', 'medium');
+const FORMAT = arg('format', 'webp');
+const IMAGES_DIR = arg('images', null);
+
+// 使用临时缓存目录，不影响正在使用的缓存
+process.env.CACHE_DIR = fs.mkdtempSync(path.join(os.tmpdir(), 'image-bytes-'));
+process.env.STORAGE_BACKEND = 'fs';
+process.env.TRACE_EXPORT = 'none';
+process.env.LOG_LEVEL = process.env.LOG_LEVEL || 'warn';
+
+const sharp = require('sharp');
+const cacheService = require('../services/cacheService');
+const { contentTypeFor } = require('../services/storageService');
+
+/**
+ * 合成插图：渐变背景 + 几个色块 + 轻微噪点，压缩特性接近生图结果（不是纯噪声也不是纯色）
+ */
+async function syntheticImage(seed, size = 1024) {
+  const pixels = Buffer.alloc(size * size * 3);
+  let state = seed * 7919 + 1;
+  const random = () => {
+    state = (state * 1103515245 + 12345) & 0x7fffffff;
+    return state / 0x7fffffff;
+  };
+  const blobs = Array.from({ length: 6 }, () => ({
+    x: random() * size, y: random() * size, r: 80 + random() * 200,
+    color: [random() * 255, random() * 255, random() * 255]
+  }));
+  for (let y = 0; y < size; y++) {
+    for (let x = 0; x < size; x++) {
+      let color = [245 - y / 8, 235 - x / 10, 210 + (x + y) / 40];
+      for (const blob of blobs) {
+        if ((x - blob.x) ** 2 + (y - blob.y) ** 2 < blob.r ** 2) color = blob.color;
+      }
+      const offset = (y * size + x) * 3;
+      for (let c = 0; c < 3; c++) pixels[offset + c] = Math.max(0, Math.min(255, color[c] + (random() - 0.5) * 12));
+    }
+  }
+  return sharp(pixels, { raw: { width: size, height: size, channels: 3 } }).png().toBuffer();
+}
+
+async function loadOriginals() {
+  if (!IMAGES_DIR) {
+    const buffers = await Promise.all(Array.from({ length: CANDIDATES }, (_, i) => syntheticImage(i + 1)));
+    return buffers.map(buffer => ({ buffer, mimeType: 'image/png' }));
+  }
+  const files = (await fs.readdir(IMAGES_DIR))
+    .filter(file => /\.(png|jpe?g|webp)$/i.test(file) && !file.includes('_thumb'))
+    .slice(0, CANDIDATES);
+  if (files.length < CANDIDATES) throw new Error(`${IMAGES_DIR} 里只有 ${files.length} 张原图`);
+  return Promise.all(files.map(async file => ({
+    buffer: await fs.readFile(path.join(IMAGES_DIR, file)),
+    mimeType: contentTypeFor(file)
+  })));
+}
+
+async function readAll(object) {
+  const chunks = [];
+  for await (const chunk of object.stream) chunks.push(chunk);
+  return Buffer.concat(chunks);
+}
+
+async function main() {
+  await cacheService.ready;
+  const originals = await loadOriginals();
+  const variant = cacheService.normalizeVariant({ format: FORMAT, width: WIDTH, quality: QUALITY });
+  console.log(`图片流量基准: ${CANDIDATES} 张候选图，展示版本 ${FORMAT} ${variant.width || 'full'}w q${variant.quality}\n`);
+
+  const rows = [];
+  for (let i = 0; i < originals.length; i++) {
+    const key = `bench-${i}`;
+    await cacheService.saveImage(key, originals[i].buffer, originals[i].mimeType);
+    let startedAt = process.hrtime.bigint();
+    const display = await readAll(await cacheService.openDerivative(key, variant));
+    const createMs = Number(process.hrtime.bigint() - startedAt) / 1e6;
+    startedAt = process.hrtime.bigint();
+    await readAll(await cacheService.openDerivative(key, variant));
+    const cachedMs = Number(process.hrtime.bigint() - startedAt) / 1e6;
+    rows.push({ original: originals[i].buffer.length, display: display.length, createMs, cachedMs });
+  }
+
+  console.log('候选图   原图(KB)   展示版本(KB)   压缩比   首次生成(ms)   命中缓存(ms)');
+  rows.forEach((row, i) => {
+    console.log([
+      String(i + 1).padEnd(6),
+      (row.original / 1024).toFixed(0).padStart(9),
+      (row.display / 1024).toFixed(0).padStart(13),
+      `${(row.original / row.display).toFixed(1)}x`.padStart(8),
+      row.createMs.toFixed(0).padStart(13),
+      row.cachedMs.toFixed(1).padStart(13)
+    ].join('  '));
+  });
+
+  // 改动前：第 i 张图到达时重绘 i 张，完成后再重绘 N 张，全部是原图
+  const originalBytes = rows.map(row => row.original);
+  let before = 0;
+  for (let i = 1; i <= rows.length; i++) before += originalBytes.slice(0, i).reduce((a, b) => a + b, 0);
+  before += originalBytes.reduce((a, b) => a + b, 0);
+  // 改动后：每张展示版本下载一次，完成后每张原图下载一次
+  const after = rows.reduce((sum, row) => sum + row.display + row.original, 0);
+  const displayOnly = rows.reduce((sum, row) => sum + row.display, 0);
+
+  console.log(`\n每次分析的图片下载量:`);
+  console.log(`  改动前            ${(before / 1024).toFixed(0).padStart(8)} KB`);
+  console.log(`  改动后            ${(after / 1024).toFixed(0).padStart(8)} KB  (${(before / after).toFixed(1)}x)`);
+  console.log(`  改动后（未完成）  ${(displayOnly / 1024).toFixed(0).padStart(8)} KB  （生成过程中只下载展示版本）`);
+
+  await fs.remove(process.env.CACHE_DIR);
+  process.exit(0);
+}
+
+main().catch(error => {
+  console.error(error);
+  process.exit(1);
+});
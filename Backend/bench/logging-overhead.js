@@ -0,0 +1,125 @@
+/**
+ * 日志开销基准：stdout 接到一个读得慢的管道（模拟日志采集跟不上）时，
+ * 对比 console.log 与 logger 对事件循环延迟的影响
+ *   - console:  每个模拟请求 3 行 console.log（原图片路由的写法）
+ *   - logger:   同样 3 行走 logger，不采样
+ *   - sampled:  logger + 图片路由 1% 采样（默认配置）
+ * 每种情况在新的子进程里跑，父进程按固定速率读取子进程 stdout
+ *
+ * 用法: node bench/logging-overhead.js [--requests 20000] [--read-kbps 256]
+ */
+const { fork } = require('child_process');
+
+const arg = (name, fallback) => {
+  const i = process.argv.indexOf(`--${name}`);
+  return i !== -1 ? Number(process.argv[i + 1]) : fallback;
+};
+const REQUESTS = arg('requests', 20000);
+const READ_KBPS = arg('read-kbps', 256);
+
+// ---------------- 子进程：模拟请求并记录日志 ----------------
+async function runChild(mode) {
+  const { monitorEventLoopDelay } = require('perf_hooks');
+  const logger = mode === 'console' ? null : require('../services/logger');
+  const delay = monitorEventLoopDelay({ resolution: 1 });
+  delay.enable();
+
+  const request = (i) => new Promise(resolve => {
+    const key = `00000000-0000-4000-8000-${String(i).padStart(12, '0')}`;
+    const handle = () => {
+      if (logger) {
+        logger.info('[Image Request]', { key, size: 'original' });
+        logger.info('Serving image', { key });
+        logger.info('[Image Request] done', { key, status: 200 });
+      } else {
+        console.log(`[Image Request] Key: ${key}, Size: original`);
+        console.log(`Serving image: ${key}`);
+        console.log(`[Image Request] done: ${key} 200`);
+      }
+      setImmediate(resolve);
+    };
+    if (logger) logger.middleware()({ path: `/api/cache/image/${key}`, get: () => undefined }, { set: () => {} }, handle);
+    else handle();
+  });
+
+  const startedAt = Date.now();
+  for (let i = 0; i < REQUESTS; i++) await request(i);
+  const elapsedMs = Date.now() - startedAt;
+  delay.disable();
+  // 测量结束时还没写出的字节：console 积压在 stdout 流里不设上限，logger 有上限、超出丢弃
+  const backlogBytes = logger ? logger.stdout.pendingBytes : process.stdout.writableLength;
+  process.send({
+    backlogKb: backlogBytes / 1024,
+    rssMb: process.memoryUsage().rss / 1024 / 1024,
+    elapsedMs,
+    p99Ms: delay.percentile(99) / 1e6,
+    maxMs: delay.max / 1e6,
+    dropped: logger ? logger.getStats().dropped : 0,
+    sampledOut: logger ? logger.getStats().sampledOut : 0
+  });
+  process.disconnect();
+}
+
+// ---------------- 主进程 ----------------
+function measure(mode, env) {
+  return new Promise((resolve, reject) => {
+    const child = fork(__filename, ['--child', mode, '--requests', String(REQUESTS)], {
+      env: { ...process.env, LOG_FORMAT: 'json', TRACE_EXPORT: 'none', ...env },
+      stdio: ['ignore', 'pipe', 'inherit', 'ipc']
+    });
+    // 按固定速率读 stdout：每 10ms 读一次，读完暂停
+    const perTick = (READ_KBPS * 1024) / 100;
+    let budget = perTick;
+    let throttled = true;
+    child.stdout.on('data', (chunk) => {
+      budget -= chunk.length;
+      if (throttled && budget <= 0) child.stdout.pause();
+    });
+    const timer = setInterval(() => {
+      budget = perTick;
+      child.stdout.resume();
+    }, 10);
+    child.once('message', (result) => {
+      // 测量结束后不再限速，让子进程写完剩余内容退出
+      clearInterval(timer);
+      throttled = false;
+      child.stdout.resume();
+      resolve(result);
+    });
+    child.once('exit', code => code && reject(new Error(`子进程退出码 ${code}`)));
+  });
+}
+
+async function main() {
+  console.log(`日志开销基准: ${REQUESTS} 个模拟图片请求，每个 3 行日志，stdout 读取速率 ${READ_KBPS}KB/s\n`);
+  const results = [
+    ['console', await measure('console', {})],
+    ['logger', await measure('logger', { LOG_SAMPLE_RATES: '' })],
+    ['sampled', await measure('logger', {})]
+  ];
+  console.log('情况        总耗时(ms)   事件循环 P99(ms)   最大(ms)   积压(KB)   RSS(MB)   丢弃行数   采样丢弃');
+  for (const [name, r] of results) {
+    console.log([
+      name.padEnd(10),
+      r.elapsedMs.toFixed(0).padStart(10),
+      r.p99Ms.toFixed(2).padStart(16),
+      r.maxMs.toFixed(1).padStart(9),
+      r.backlogKb.toFixed(0).padStart(9),
+      r.rssMb.toFixed(0).padStart(8),
+      String(r.dropped).padStart(9),
+      String(r.sampledOut).padStart(9)
+    ].join('  '));
+  }
+}
+
+if (process.argv.includes('--child')) {
+  runChild(process.argv[process.argv.indexOf('--child') + 1]).catch(error => {
+    console.error(error);
+    process.exit(1);
+  });
+} else {
+  main().catch(error => {
+    console.error(error);
+    process.exit(1);
+  });
+}
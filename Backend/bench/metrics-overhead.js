@@ -0,0 +1,47 @@
+/**
+ * 指标记录开销基准：测量 observe / inc / startTimer 的单次耗时和 /metrics 渲染耗时
+ * 用来确认指标可以在生产负载下常开
+ *
+ * 用法: node bench/metrics-overhead.js [--ops 2000000]
+ */
+const { performance } = require('perf_hooks');
+const metricsService = require('../services/metricsService');
+
+const arg = (name, fallback) => {
+  const i = process.argv.indexOf(`--${name}`);
+  return i !== -1 ? Number(process.argv[i + 1]) : fallback;
+};
+const OPS = arg('ops', 2000000);
+
+function measure(name, fn) {
+  // 先预热，让 JIT 稳定下来
+  for (let i = 0; i < 10000; i++) fn(i);
+  const startedAt = performance.now();
+  for (let i = 0; i < OPS; i++) fn(i);
+  const ns = (performance.now() - startedAt) * 1e6 / OPS;
+  console.log(`${name.padEnd(40)} ${ns.toFixed(1).padStart(8)} ns/次`);
+  return ns;
+}
+
+async function main() {
+  console.log(`指标开销基准: 每项 ${OPS} 次\n`);
+  const sizes = ['original', 'thumb'];
+  const statuses = [200, 206, 304, 404];
+  const outcomes = ['ok', 'error', 'cancelled'];
+
+  measure('histogram.observe（无标签）', (i) => metricsService.base64Decode.observe(undefined, (i % 1000) / 1e5));
+  measure('histogram.observe（2 个标签）', (i) => metricsService.imageServe.observe({ size: sizes[i & 1], status: statuses[i & 3] }, (i % 1000) / 1e4));
+  measure('counter.inc（2 个标签）', (i) => metricsService.cacheLookups.inc({ kind: 'image', result: i & 1 ? 'hit' : 'miss' }));
+  measure('startTimer + end（1 个标签）', (i) => metricsService.imageTotal.startTimer()({ outcome: outcomes[i % 3] }));
+
+  const renders = 200;
+  const startedAt = performance.now();
+  let size = 0;
+  for (let i = 0; i < renders; i++) size = (await metricsService.render()).length;
+  console.log(`${'render /metrics'.padEnd(40)} ${((performance.now() - startedAt) / renders).toFixed(2).padStart(8)} ms/次 (${(size / 1024).toFixed(1)}KB)`);
+}
+
+main().catch(error => {
+  console.error(error);
+  process.exit(1);
+});
@@ -0,0 +1,173 @@
+/**
+ * 本地 S3 兼容替身（MinIO 风格，路径风格寻址），用于在没有对象存储的环境里测试 STORAGE_BACKEND=s3
+ * 支持 PUT / GET(Range) / HEAD / DELETE / ListObjectsV2，校验 SigV4 签名，对象存放在内存或 --dir 目录
+ *
+ * 用法: node bench/s3-standin.js [--port 9000] [--dir ./s3-data] [--access-key standin] [--secret-key standin-secret]
+ * 配合后端: STORAGE_BACKEND=s3 S3_ENDPOINT=http://127.0.0.1:9000 S3_BUCKET=micro-tomato \
+ *          S3_ACCESS_KEY_ID=standin S3_SECRET_ACCESS_KEY=standin-secret npm start
+ */
+const http = require('http');
+const crypto = require('crypto');
+const fs = require('fs');
+const path = require('path');
+
+const arg = (name, fallback) => {
+  const i = process.argv.indexOf(`--${name}`);
+  return i !== -1 ? process.argv[i + 1] : fallback;
+};
+const PORT = Number(arg('port', 9000));
+const DIR = arg('dir', null);
+const ACCESS_KEY = arg('access-key', 'standin');
+const SECRET_KEY = arg('secret-key', 'standin-secret');
+
+// bucket/key -> { body, contentType, mtime }
+const objects = new Map();
+
+const hmac = (key, data) => crypto.createHmac('sha256', key).update(data).digest();
+const sha256 = (data) => crypto.createHash('sha256').update(data).digest('hex');
+const encode = (value) => encodeURIComponent(value).replace(/[!'()*]/g, c => `%${c.charCodeAt(0).toString(16).toUpperCase()}`);
+const xmlEscape = (value) => value.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+
+function load(id) {
+  if (objects.has(id) || !DIR) return objects.get(id);
+  const file = path.join(DIR, encodeURIComponent(id));
+  if (!fs.existsSync(file)) return undefined;
+  const meta = JSON.parse(fs.readFileSync(`${file}.meta`, 'utf8'));
+  const object = { body: fs.readFileSync(file), contentType: meta.contentType, mtime: new Date(meta.mtime) };
+  objects.set(id, object);
+  return object;
+}
+
+function store(id, object) {
+  objects.set(id, object);
+  if (!DIR) return;
+  const file = path.join(DIR, encodeURIComponent(id));
+  fs.writeFileSync(file, object.body);
+  fs.writeFileSync(`${file}.meta`, JSON.stringify({ contentType: object.contentType, mtime: object.mtime }));
+}
+
+function remove(id) {
+  objects.delete(id);
+  if (DIR) for (const suffix of ['', '.meta']) fs.rmSync(path.join(DIR, encodeURIComponent(id) + suffix), { force: true });
+}
+
+function listIds(bucket) {
+  const ids = new Set([...objects.keys()].filter(id => id.startsWith(`${bucket}/`)));
+  if (DIR) {
+    for (const file of fs.readdirSync(DIR)) {
+      if (file.endsWith('.meta')) continue;
+      const id = decodeURIComponent(file);
+      if (id.startsWith(`${bucket}/`)) ids.add(id);
+    }
+  }
+  return [...ids].sort();
+}
+
+/**
+ * 按请求重新计算 SigV4 签名并比对
+ */
+function verifySignature(req, url, body) {
+  const auth = /^AWS4-HMAC-SHA256 Credential=([^/]+)\/(\d{8})\/([^/]+)\/s3\/aws4_request, SignedHeaders=([^,]+), Signature=([0-9a-f]+)$/.exec(req.headers.authorization || '');
+  if (!auth) return 'missing or malformed Authorization';
+  const [, accessKey, date, region, signedHeaderList, signature] = auth;
+  if (accessKey !== ACCESS_KEY) return 'unknown access key';
+
+  const contentHash = req.headers['x-amz-content-sha256'];
+  if (contentHash !== 'UNSIGNED-PAYLOAD' && contentHash !== sha256(body)) return 'payload hash mismatch';
+
+  const query = [...url.searchParams.entries()]
+    .map(([k, v]) => [encode(k), encode(v)])
+    .sort(([a, av], [b, bv]) => (a < b ? -1 : a > b ? 1 : av < bv ? -1 : 1))
+    .map(([k, v]) => `${k}=${v}`)
+    .join('&');
+  const names = signedHeaderList.split(';');
+  const canonicalRequest = [
+    req.method,
+    url.pathname,
+    query,
+    names.map(name => `${name}:${String(req.headers[name] || '').trim()}\n`).join(''),
+    signedHeaderList,
+    contentHash
+  ].join('\n');
+  const scope = `${date}/${region}/s3/aws4_request`;
+  const stringToSign = ['AWS4-HMAC-SHA256', req.headers['x-amz-date'], scope, sha256(canonicalRequest)].join('\n');
+  const key = hmac(hmac(hmac(hmac(`AWS4${SECRET_KEY}`, date), region), 's3'), 'aws4_request');
+  const expected = crypto.createHmac('sha256', key).update(stringToSign).digest('hex');
+  return expected === signature ? null : 'signature mismatch';
+}
+
+function sendError(res, status, code, message) {
+  res.writeHead(status, { 'Content-Type': 'application/xml' });
+  res.end(`<?xml version="1.0" encoding="UTF-8"?><Error><Code>${code}</Code><Message>${xmlEscape(message)}</Message></Error>`);
+}
+
+function listObjects(res, bucket, url) {
+  const prefix = url.searchParams.get('prefix') || '';
+  const maxKeys = Math.min(1000, parseInt(url.searchParams.get('max-keys'), 10) || 1000);
+  const after = url.searchParams.get('continuation-token') || '';
+  const keys = listIds(bucket)
+    .map(id => id.slice(bucket.length + 1))
+    .filter(key => key.startsWith(prefix) && key > after);
+  const page = keys.slice(0, maxKeys);
+  const truncated = keys.length > page.length;
+  const contents = page.map(key => {
+    const object = load(`${bucket}/${key}`);
+    return `<Contents><Key>${xmlEscape(key)}</Key><LastModified>${object.mtime.toISOString()}</LastModified><Size>${object.body.length}</Size></Contents>`;
+  }).join('');
+  res.writeHead(200, { 'Content-Type': 'application/xml' });
+  res.end(`<?xml version="1.0" encoding="UTF-8"?><ListBucketResult><Name>${xmlEscape(bucket)}</Name><Prefix>${xmlEscape(prefix)}</Prefix>` +
+    `<KeyCount>${page.length}</KeyCount><MaxKeys>${maxKeys}</MaxKeys><IsTruncated>${truncated}</IsTruncated>` +
+    (truncated ? `<NextContinuationToken>${xmlEscape(page[page.length - 1])}</NextContinuationToken>` : '') +
+    `${contents}</ListBucketResult>`);
+}
+
+const server = http.createServer((req, res) => {
+  const chunks = [];
+  req.on('data', chunk => chunks.push(chunk));
+  req.on('end', () => {
+    const body = Buffer.concat(chunks);
+    const url = new URL(req.url, `http://${req.headers.host}`);
+    const problem = verifySignature(req, url, body);
+    if (problem) return sendError(res, 403, 'SignatureDoesNotMatch', problem);
+
+    const [, bucket, ...rest] = url.pathname.split('/');
+    const key = rest.map(decodeURIComponent).join('/');
+    const id = `${decodeURIComponent(bucket)}/${key}`;
+
+    if (!key) {
+      if (req.method === 'GET' && url.searchParams.get('list-type') === '2') return listObjects(res, decodeURIComponent(bucket), url);
+      return sendError(res, 400, 'InvalidRequest', 'unsupported bucket operation');
+    }
+
+    if (req.method === 'PUT') {
+      store(id, { body, contentType: req.headers['content-type'] || 'application/octet-stream', mtime: new Date() });
+      res.writeHead(200, { ETag: `"${crypto.createHash('md5').update(body).digest('hex')}"` });
+      return res.end();
+    }
+    if (req.method === 'DELETE') {
+      remove(id);
+      res.writeHead(204);
+      return res.end();
+    }
+
+    const object = load(id);
+    if (!object) return req.method === 'HEAD' ? (res.writeHead(404), res.end()) : sendError(res, 404, 'NoSuchKey', key);
+    const headers = { 'Content-Type': object.contentType, 'Last-Modified': object.mtime.toUTCString(), 'Accept-Ranges': 'bytes' };
+
+    const range = /^bytes=(\d+)-(\d*)$/.exec(req.headers.range || '');
+    if (range && req.method === 'GET') {
+      const start = parseInt(range[1], 10);
+      const end = Math.min(range[2] ? parseInt(range[2], 10) : object.body.length - 1, object.body.length - 1);
+      if (start >= object.body.length) return sendError(res, 416, 'InvalidRange', 'range not satisfiable');
+      res.writeHead(206, { ...headers, 'Content-Range': `bytes ${start}-${end}/${object.body.length}`, 'Content-Length': end - start + 1 });
+      return res.end(object.body.subarray(start, end + 1));
+    }
+    res.writeHead(200, { ...headers, 'Content-Length': object.body.length });
+    res.end(req.method === 'HEAD' ? undefined : object.body);
+  });
+});
+
+if (DIR) fs.mkdirSync(DIR, { recursive: true });
+server.listen(PORT, '127.0.0.1', () => {
+  console.log(`🪣 S3 替身运行在 http://127.0.0.1:${PORT} (access key: ${ACCESS_KEY}${DIR ? `, 数据目录: ${DIR}` : ', 内存存储'})`);
+});
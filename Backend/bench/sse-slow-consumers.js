@@ -0,0 +1,174 @@
+/**
+ * SSE 慢客户端基准：N 个读得很慢的客户端同时订阅，服务端持续推送事件
+ * 对比直接 res.write（忽略返回值）与 streamService.createSSEResponse（背压 + 积压上限）的每连接内存
+ *
+ * 用法: node bench/sse-slow-consumers.js [--clients 500] [--seconds 30] [--rate 20] [--size 4096] [--read-kbps 2]
+ * 服务端在子进程中运行，内存数据只包含服务端
+ */
+const http = require('http');
+const net = require('net');
+const { fork } = require('child_process');
+
+const arg = (name, fallback) => {
+  const i = process.argv.indexOf(`--${name}`);
+  return i !== -1 ? Number(process.argv[i + 1]) : fallback;
+};
+const CLIENTS = arg('clients', 500);
+const SECONDS = arg('seconds', 30);
+const RATE = arg('rate', 20);
+const SIZE = arg('size', 4096);
+const READ_KBPS = arg('read-kbps', 2);
+
+const mb = (bytes) => (bytes / 1024 / 1024).toFixed(1);
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+// ---------------- 服务端（子进程） ----------------
+function runServer(mode) {
+  const streamService = require('../services/streamService');
+  const payload = 'x'.repeat(SIZE);
+  const connections = new Set();
+  let seq = 0;
+
+  const server = http.createServer((req, res) => {
+    connections.add(res);
+    res.on('close', () => connections.delete(res));
+
+    let send;
+    if (mode === 'raw') {
+      res.writeHead(200, { 'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache' });
+      send = () => res.write(`event: data\ndata: ${JSON.stringify({ seq: seq++, payload })}\n\n`);
+    } else {
+      const sse = streamService.createSSEResponse(res);
+      send = () => sse.send('data', { seq: seq++, payload });
+    }
+    const timer = setInterval(() => {
+      if (res.destroyed) return clearInterval(timer);
+      send();
+    }, 1000 / RATE);
+    res.on('close', () => clearInterval(timer));
+  });
+
+  const report = () => {
+    // raw 模式积压全在 res 的写缓冲里；sse 模式还包括尚未写出的待发事件
+    let buffered = 0;
+    if (mode === 'raw') {
+      for (const res of connections) buffered += res.writableLength;
+    } else {
+      buffered = streamService.getSSEStats().bufferedBytes;
+    }
+    const memory = process.memoryUsage();
+    return {
+      rss: memory.rss,
+      heapUsed: memory.heapUsed,
+      external: memory.external + memory.arrayBuffers,
+      buffered,
+      open: connections.size,
+      dropped: mode === 'raw' ? 0 : streamService.getSSEStats().slowConsumersDropped
+    };
+  };
+
+  process.on('message', (message) => {
+    if (message === 'report') {
+      if (global.gc) global.gc();
+      process.send({ type: 'report', data: report() });
+    }
+  });
+  server.listen(0, '127.0.0.1', () => process.send({ type: 'ready', port: server.address().port }));
+}
+
+// ---------------- 客户端（主进程） ----------------
+function slowClient(port) {
+  return new Promise((resolve) => {
+    const socket = net.connect(port, '127.0.0.1', () => {
+      socket.write('GET /events HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n');
+    });
+    socket.once('readable', () => resolve(socket));
+    socket.on('error', () => {});
+    socket.pause();
+  });
+}
+
+// 每 100ms 最多读 READ_KBPS/10 KB，模拟网络很差或卡住的客户端
+function throttle(sockets) {
+  const bytesPerTick = Math.max(1, Math.round(READ_KBPS * 1024 / 10));
+  return setInterval(() => {
+    for (const socket of sockets) {
+      if (socket.destroyed) continue;
+      socket.read(Math.min(bytesPerTick, socket.readableLength || bytesPerTick));
+    }
+  }, 100);
+}
+
+function request(child, type) {
+  return new Promise(resolve => {
+    const onMessage = (message) => {
+      if (message.type === type) {
+        child.off('message', onMessage);
+        resolve(message.data);
+      }
+    };
+    child.on('message', onMessage);
+    child.send(type);
+  });
+}
+
+async function runMode(mode) {
+  const child = fork(__filename, ['--server', mode, ...process.argv.slice(2)], {
+    execArgv: ['--expose-gc']
+  });
+  const port = await new Promise(resolve => child.on('message', m => m.type === 'ready' && resolve(m.port)));
+  const baseline = await request(child, 'report');
+
+  const sockets = [];
+  for (let i = 0; i < CLIENTS; i += 50) {
+    const batch = await Promise.all(Array.from({ length: Math.min(50, CLIENTS - i) }, () => slowClient(port)));
+    sockets.push(...batch);
+  }
+  const timer = throttle(sockets);
+
+  let peak = baseline;
+  for (let t = 0; t < SECONDS; t++) {
+    await sleep(1000);
+    const sample = await request(child, 'report');
+    if (sample.rss > peak.rss) peak = sample;
+  }
+  const final = await request(child, 'report');
+
+  clearInterval(timer);
+  sockets.forEach(socket => socket.destroy());
+  child.kill();
+
+  return { mode, baseline, peak, final };
+}
+
+async function main() {
+  console.log(`SSE 慢客户端基准: ${CLIENTS} 个客户端, ${SECONDS}s, 每连接 ${RATE} 事件/s × ${SIZE}B, 客户端读取 ${READ_KBPS} KB/s`);
+  const results = [];
+  for (const mode of ['raw', 'sse']) {
+    results.push(await runMode(mode));
+  }
+
+  console.log('\n模式  峰值RSS(MB)  每连接RSS(KB)  结束时积压(MB)  每连接积压(KB)  仍在线  被断开  每连接堆(KB)');
+  for (const { mode, baseline, peak, final } of results) {
+    const perConn = (peak.rss - baseline.rss) / CLIENTS / 1024;
+    console.log([
+      mode.padEnd(4),
+      mb(peak.rss).padStart(11),
+      perConn.toFixed(0).padStart(13),
+      mb(final.buffered).padStart(14),
+      (final.buffered / CLIENTS / 1024).toFixed(0).padStart(14),
+      String(final.open).padStart(7),
+      String(final.dropped).padStart(7),
+      ((final.heapUsed - baseline.heapUsed) / CLIENTS / 1024).toFixed(0).padStart(13)
+    ].join('  '));
+  }
+}
+
+if (process.argv.includes('--server')) {
+  runServer(process.argv[process.argv.indexOf('--server') + 1]);
+} else {
+  main().catch(error => {
+    console.error(error);
+    process.exit(1);
+  });
+}
@@ -0,0 +1,119 @@
+/**
+ * 上游连接复用基准：本地 HTTPS 模拟上游 + 加延迟的 TCP 代理（模拟 RTT）
+ * 对比每次新建 TLS 连接与 httpClient 共享连接池的首字节时间 (TTFB)
+ *
+ * 用法: node bench/upstream-keepalive.js [--papers 20] [--rtt 40]
+ * 每篇论文模拟 1 次分析请求 + 4 个并发生图请求
+ */
+const https = require('https');
+const net = require('net');
+const fs = require('fs');
+const os = require('os');
+const path = require('path');
+const { execFileSync } = require('child_process');
+const httpClient = require('../services/httpClient');
+
+const arg = (name, fallback) => {
+  const i = process.argv.indexOf(`--${name}`);
+  return i !== -1 ? Number(process.argv[i + 1]) : fallback;
+};
+const PAPERS = arg('papers', 20);
+const RTT_MS = arg('rtt', 40);
+const PARALLEL = 4;
+
+function selfSignedCert() {
+  const dir = fs.mkdtempSync(path.join(os.tmpdir(), 'bench-cert-'));
+  const key = path.join(dir, 'key.pem');
+  const cert = path.join(dir, 'cert.pem');
+  execFileSync('openssl', [
+    'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+    '-subj', '/CN=localhost', '-days', '1'
+  ], { stdio: 'ignore' });
+  return { key: fs.readFileSync(key), cert: fs.readFileSync(cert) };
+}
+
+// 每个方向延迟 RTT/2 转发数据
+function latencyProxy(targetPort) {
+  return net.createServer((client) => {
+    const upstream = net.connect(targetPort, '127.0.0.1');
+    const relay = (from, to) => {
+      from.on('data', (data) => setTimeout(() => to.write(data), RTT_MS / 2));
+      from.on('end', () => setTimeout(() => to.end(), RTT_MS / 2));
+      from.on('error', () => to.destroy());
+    };
+    relay(client, upstream);
+    relay(upstream, client);
+  });
+}
+
+function listen(server) {
+  return new Promise(resolve => server.listen(0, '127.0.0.1', () => resolve(server.address().port)));
+}
+
+function timedRequest(url, agent, ca) {
+  return new Promise((resolve, reject) => {
+    const start = process.hrtime.bigint();
+    const req = https.request(url, { method: 'POST', agent, ca }, (res) => {
+      const ttfb = Number(process.hrtime.bigint() - start) / 1e6;
+      res.resume();
+      res.on('end', () => resolve(ttfb));
+    });
+    req.on('error', reject);
+    req.end('{}');
+  });
+}
+
+async function runScenario(name, url, agentFactory, ca) {
+  const samples = [];
+  const started = Date.now();
+  for (let i = 0; i < PAPERS; i++) {
+    samples.push(await timedRequest(url, agentFactory(), ca));
+    const parallel = await Promise.all(
+      Array.from({ length: PARALLEL }, () => timedRequest(url, agentFactory(), ca))
+    );
+    samples.push(...parallel);
+  }
+  samples.sort((a, b) => a - b);
+  const pct = (p) => samples[Math.min(samples.length - 1, Math.floor(samples.length * p))];
+  const mean = samples.reduce((a, b) => a + b, 0) / samples.length;
+  return {
+    scenario: name,
+    requests: samples.length,
+    meanTTFB: mean.toFixed(1),
+    p50: pct(0.5).toFixed(1),
+    p95: pct(0.95).toFixed(1),
+    wallMs: Date.now() - started
+  };
+}
+
+async function main() {
+  const { key, cert } = selfSignedCert();
+  const upstream = https.createServer({ key, cert }, (req, res) => {
+    req.resume();
+    req.on('end', () => {
+      res.setHeader('Content-Type', 'application/json');
+      res.end('{"ok":true}');
+    });
+  });
+  const upstreamPort = await listen(upstream);
+  const proxy = latencyProxy(upstreamPort);
+  const proxyPort = await listen(proxy);
+  const url = `https://localhost:${proxyPort}/v1/chat/completions`;
+
+  console.log(`papers=${PAPERS} rtt=${RTT_MS}ms (1 sequential + ${PARALLEL} parallel requests per paper)`);
+  const results = [
+    await runScenario('fresh connection per call', url, () => new https.Agent({ keepAlive: false }), cert),
+    await runScenario('shared httpClient pool', url, () => httpClient.agentFor(url), cert)
+  ];
+  console.table(results);
+  console.log('pool stats:', JSON.stringify(httpClient.getStats().pools[`https://localhost:${proxyPort}`]));
+
+  proxy.close();
+  upstream.close();
+  process.exit(0);
+}
+
+main().catch((error) => {
+  console.error(error);
+  process.exit(1);
+});
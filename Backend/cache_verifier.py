@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+缓存完整性校验：并发检查缓存索引里的每一张图片
+  - 原图可读（/api/cache/image/<key> 返回 200/206）
+  - 文件头是合法的图片格式，且与响应的 Content-Type 一致
+  - 缩略图存在且可读
+再用 /api/cache/audit 找出存储里的孤儿对象和索引里已丢失的条目，--repair 时调用 /api/cache/repair 修复
+
+每个 key 只读前 32 字节（Range 请求），并发数由 --concurrency 限制
+条目通过 /api/cache/entries 逐页获取，边翻页边校验，不需要先拿到完整列表
+
+用法:
+    python cache_verifier.py                           # 只检查
+    python cache_verifier.py --concurrency 64
+    python cache_verifier.py --repair                  # 检查后修复（不删除孤儿对象）
+    python cache_verifier.py --repair --delete-orphans
+    python cache_verifier.py --kind generated --paper <paper_id> --report report.json
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+API_BASE_URL = "http://localhost:2983"
+# 只读文件头，足够识别格式
+HEADER_BYTES = 32
+PAGE_SIZE = 500
+
+def print_section(title):
+    print(f"\n{'='*60}")
+    print(f"🔍 {title}")
+    print(f"{'='*60}")
+
+def sniff_image(header):
+    """根据文件头识别图片格式，返回 MIME 类型，无法识别返回 None"""
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+class CacheVerifier:
+    """requests 是同步的：每个请求放进线程池执行，asyncio 信号量限制同时进行的请求数"""
+
+    def __init__(self, api_base, concurrency, timeout=10):
+        self.api_base = api_base.rstrip('/')
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.session = requests.Session()
+        # 连接池与并发数一致，所有线程复用长连接
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.problems = []
+        self.checked = 0
+        self.latencies = []
+
+    async def call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    def fetch_page(self, filters, cursor):
+        params = {**filters, 'limit': PAGE_SIZE, 'summary': 'false'}
+        if cursor:
+            params['cursor'] = cursor
+        response = self.session.get(f"{self.api_base}/api/cache/entries", params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def read_header(self, url):
+        """Range 读取前 HEADER_BYTES 字节，返回 (状态码, Content-Type, 文件头)"""
+        response = self.session.get(
+            f"{self.api_base}{url}",
+            headers={'Range': f'bytes=0-{HEADER_BYTES - 1}'},
+            timeout=self.timeout
+        )
+        return response.status_code, response.headers.get('Content-Type', '').split(';')[0].strip(), response.content[:HEADER_BYTES]
+
+    def report(self, entry, problem, detail=''):
+        self.problems.append({'key': entry['key'], 'file': entry.get('file'), 'problem': problem, 'detail': detail})
+
+    async def check_entry(self, entry):
+        started = time.perf_counter()
+        try:
+            status, content_type, header = await self.call(self.read_header, entry['url'])
+            if status == 404:
+                self.report(entry, 'dangling', '索引里有，读取返回 404')
+                return
+            if status not in (200, 206):
+                self.report(entry, 'unreadable', f'HTTP {status}')
+                return
+            sniffed = sniff_image(header)
+            if not sniffed:
+                self.report(entry, 'bad-header', header[:8].hex())
+                return
+            if content_type != sniffed:
+                self.report(entry, 'content-type', f'响应 {content_type}，实际 {sniffed}')
+
+            if not entry.get('thumbnailUrl'):
+                self.report(entry, 'missing-thumbnail', '索引里没有缩略图')
+                return
+            status, _, header = await self.call(self.read_header, entry['thumbnailUrl'])
+            if status not in (200, 206):
+                self.report(entry, 'missing-thumbnail', f'缩略图 HTTP {status}')
+            elif not sniff_image(header):
+                self.report(entry, 'bad-thumbnail', header[:8].hex())
+        except requests.RequestException as e:
+            self.report(entry, 'unreadable', str(e))
+        finally:
+            self.checked += 1
+            self.latencies.append(time.perf_counter() - started)
+
+    async def produce(self, queue, filters, limit):
+        """逐页取条目放进有界队列；队列满时等待，翻页速度跟着校验速度走"""
+        cursor = None
+        produced = 0
+        while True:
+            page = await self.call(self.fetch_page, filters, cursor)
+            for entry in page.get('items', []):
+                if limit and produced >= limit:
+                    return
+                await queue.put(entry)
+                produced += 1
+            cursor = page.get('nextCursor')
+            if not cursor:
+                return
+
+    async def consume(self, queue):
+        while True:
+            entry = await queue.get()
+            try:
+                if entry is None:
+                    return
+                await self.check_entry(entry)
+            finally:
+                queue.task_done()
+
+    async def run_checks(self, filters, limit=None, progress=True):
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self.consume(queue)) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self.report_progress()) if progress else None
+        try:
+            await self.produce(queue, filters, limit)
+        finally:
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            if reporter:
+                reporter.cancel()
+
+    async def report_progress(self, interval=2.0):
+        started = time.perf_counter()
+        while True:
+            await asyncio.sleep(interval)
+            elapsed = time.perf_counter() - started
+            print(f"   ⏳ 已检查 {self.checked} 个 key ({self.checked / elapsed:.0f} keys/s)，发现 {len(self.problems)} 个问题", flush=True)
+
+    def audit(self):
+        response = self.session.get(f"{self.api_base}/api/cache/audit", timeout=max(self.timeout, 60))
+        response.raise_for_status()
+        return response.json()
+
+    def repair(self, dangling, orphans, thumbnails, refs, delete_orphans):
+        response = self.session.post(f"{self.api_base}/api/cache/repair", json={
+            'dangling': dangling,
+            'orphans': orphans,
+            'thumbnails': thumbnails,
+            'refs': refs,
+            'deleteOrphans': delete_orphans
+        }, timeout=max(self.timeout, 300))
+        response.raise_for_status()
+        return response.json()
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+async def verify(api_base=API_BASE_URL, concurrency=32, filters=None, limit=None, repair=False,
+                 delete_orphans=False, progress=True):
+    """校验缓存并返回报告 dict；stream_debug_diagnostic.py 也直接调用这里"""
+    filters = {k: v for k, v in (filters or {}).items() if v is not None}
+    filters.setdefault('kind', 'image')
+    verifier = CacheVerifier(api_base, concurrency)
+    started = time.perf_counter()
+    try:
+        await verifier.run_checks(filters, limit, progress)
+        elapsed = time.perf_counter() - started
+        audit = await verifier.call(verifier.audit)
+
+        report = {
+            'checked': verifier.checked,
+            'elapsedSec': round(elapsed, 3),
+            'keysPerSec': round(verifier.checked / elapsed, 1) if elapsed > 0 else None,
+            'latencyMs': {
+                'p50': round(percentile(verifier.latencies, 0.5) * 1000, 1),
+                'p95': round(percentile(verifier.latencies, 0.95) * 1000, 1),
+                'max': round(max(verifier.latencies, default=0) * 1000, 1)
+            },
+            'concurrency': concurrency,
+            'problems': verifier.problems,
+            'byProblem': dict(Counter(p['problem'] for p in verifier.problems)),
+            'audit': audit,
+            'repair': None
+        }
+
+        if repair:
+            dangling = sorted({p['key'] for p in verifier.problems if p['problem'] == 'dangling'}
+                              | {d['key'] for d in audit['dangling']})
+            thumbnails = sorted({p['key'] for p in verifier.problems if p['problem'] in ('missing-thumbnail', 'bad-thumbnail')}
+                                | set(audit['missingThumbnails']))
+            orphans = [o['name'] for o in audit['orphans']]
+            refs = audit.get('missingRefs', [])
+            report['repair'] = await verifier.call(verifier.repair, dangling, orphans, thumbnails, refs, delete_orphans)
+        return report
+    finally:
+        verifier.executor.shutdown(wait=False)
+        verifier.session.close()
+
+def print_report(report, show=20):
+    print_section("校验结果")
+    print(f"📊 检查 {report['checked']} 个 key，用时 {report['elapsedSec']:.1f}s，"
+          f"吞吐 {report['keysPerSec'] or 0:.0f} keys/s（并发 {report['concurrency']}）")
+    latency = report['latencyMs']
+    print(f"   单个 key 耗时 P50 {latency['p50']}ms / P95 {latency['p95']}ms / 最长 {latency['max']}ms")
+
+    if report['problems']:
+        print(f"\n❌ 发现 {len(report['problems'])} 个问题:")
+        for problem, count in sorted(report['byProblem'].items(), key=lambda kv: -kv[1]):
+            print(f"   {problem:<20} {count}")
+        for item in report['problems'][:show]:
+            print(f"   📄 {item['key']} [{item['problem']}] {item['detail']}")
+        if len(report['problems']) > show:
+            print(f"   ... 还有 {len(report['problems']) - show} 个")
+    else:
+        print("✅ 所有 key 校验通过")
+
+    audit = report['audit']
+    print_section("存储对账")
+    objects = audit['objects']
+    print(f"   存储: {audit['storage']}，索引 {audit['indexed']['images']} 张图片 / {audit['indexed']['tables']} 个表格"
+          f" / {audit['indexed'].get('blobs', 0)} 个内容对象，"
+          f"存储对象 {objects['images']} / {objects['tables']} / {objects.get('blobs', 0)}"
+          f"，引用 {objects.get('refs', 0)}（{audit['elapsedMs']}ms）")
+    print(f"   {'✅' if not audit['dangling'] else '❌'} 索引已丢失的条目: {len(audit['dangling'])}")
+    print(f"   {'✅' if not audit['orphans'] else '⚠️ '} 孤儿对象: {len(audit['orphans'])}")
+    for reason, count in Counter(o['reason'] for o in audit['orphans']).items():
+        print(f"      {reason}: {count}")
+    print(f"   {'✅' if not audit['missingThumbnails'] else '⚠️ '} 缺缩略图: {len(audit['missingThumbnails'])}")
+    print(f"   {'✅' if not audit.get('missingRefs') else '⚠️ '} 缺引用对象: {len(audit.get('missingRefs', []))}")
+
+    if report['repair']:
+        repair = report['repair']
+        print_section("修复结果")
+        print(f"   🗑️  移出索引: {len(repair['unindexed'])}")
+        print(f"   📥 补进索引: {len(repair['adopted'])}")
+        print(f"   🧹 删除孤儿对象: {len(repair['deleted'])}")
+        print(f"   🖼️  重建缩略图: {len(repair['thumbnails'])}")
+        print(f"   🔗 重写引用: {len(repair.get('refs', []))}")
+        if repair['skipped']:
+            print(f"   ⏭️  跳过: {len(repair['skipped'])}（{', '.join(sorted({s['reason'] for s in repair['skipped']}))}）")
+
+def main():
+    parser = argparse.ArgumentParser(description="并发校验缓存完整性")
+    parser.add_argument('--api', default=API_BASE_URL, help="后端地址")
+    parser.add_argument('--concurrency', type=int, default=32, help="同时进行的请求数")
+    parser.add_argument('--kind', choices=['image', 'figure', 'generated'], default='image')
+    parser.add_argument('--paper', help="只检查某篇论文的图片")
+    parser.add_argument('--limit', type=int, help="最多检查多少个 key")
+    parser.add_argument('--repair', action='store_true', help="检查后修复：移出丢失的条目、认领孤儿对象、重建缩略图")
+    parser.add_argument('--delete-orphans', action='store_true', help="修复时删除无法认领的孤儿对象")
+    parser.add_argument('--report', help="把完整报告写入 JSON 文件")
+    args = parser.parse_args()
+
+    print("🚀 缓存完整性校验")
+    print("⏰ 开始时间:", time.strftime("%Y-%m-%d %H:%M:%S"))
+    try:
+        report = asyncio.run(verify(
+            args.api,
+            max(1, args.concurrency),
+            filters={'kind': args.kind, 'paper': args.paper},
+            limit=args.limit,
+            repair=args.repair,
+            delete_orphans=args.delete_orphans
+        ))
+    except requests.RequestException as e:
+        print(f"❌ 无法访问后端: {e}")
+        return 1
+
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n📝 完整报告已写入 {args.report}")
+
+    audit = report['audit']
+    healthy = (not report['problems'] and not audit['dangling'] and not audit['orphans']
+               and not audit['missingThumbnails'] and not audit.get('missingRefs'))
+    return 0 if healthy or args.repair else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,9 @@
+require('dotenv').config();
+const os = require('os');
+const clusterService = require('./services/clusterService');
+
+// 多进程入口：未设置 CLUSTER_WORKERS 时按 CPU 核数 fork 工作进程共享端口；只有 1 个核时与 node server.js 相同
+const workers = process.env.CLUSTER_WORKERS ? undefined : os.availableParallelism();
+if (!clusterService.startPrimary(workers)) {
+  require('./server');
+}
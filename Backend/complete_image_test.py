@@ -64,17 +64,32 @@ def test_cache_directory():
             print(f"   图片目录: {cache_data.get('imagesDir', 'Unknown')}")
             print(f"   文件数量: {cache_data.get('fileCount', 0)}")
             
-            # 显示前几个文件
+            # /api/debug/cache 只带第一页，最近的几个文件就在里面；完整列表用 /api/cache/entries 翻页
             files = cache_data.get('files', [])
             if files:
                 print(f"   最近文件:")
                 for i, file_info in enumerate(files[:3]):
                     size_kb = file_info.get('size', 0) / 1024
-                    modified = file_info.get('modified', 'Unknown')
-                    print(f"     {i+1}. {file_info.get('file')} ({size_kb:.1f}KB, {modified})")
+                    created = file_info.get('createdAt', 'Unknown')
+                    print(f"     {i+1}. {file_info.get('file')} ({size_kb:.1f}KB, {file_info.get('kind')}, {created})")
             
-            if len(files) > 3:
-                print(f"     ... 还有 {len(files) - 3} 个文件")
+            file_count = cache_data.get('fileCount', 0)
+            if file_count > 3:
+                print(f"     ... 还有 {file_count - 3} 个文件")
+            
+            # 逐页走一遍列表，核对条目数与汇总一致
+            walked = 0
+            params = {'limit': 500, 'summary': 'false'}
+            while True:
+                page = requests.get(f"{API_BASE_URL}/api/cache/entries", params=params, timeout=10).json()
+                walked += len(page.get('items', []))
+                if not page.get('nextCursor'):
+                    break
+                params['cursor'] = page['nextCursor']
+            if walked == file_count:
+                print(f"✅ 分页遍历 {walked} 个条目，与汇总一致")
+            else:
+                print(f"⚠️  分页遍历 {walked} 个条目，汇总为 {file_count}（遍历期间有写入或删除）")
                 
             return True
         else:
@@ -5,7 +5,6 @@
 import requests
 import time
 import json
-from pathlib import Path
 
 API_BASE_URL = "http://localhost:2983"
 
@@ -14,17 +13,15 @@ def quick_test_and_fix():
     print("🚀 快速诊断和修复建议")
     print("=" * 50)
     
-    # 1. 检查缓存文件
-    cache_dir = Path("./cache/images")
-    if cache_dir.exists():
-        files = list(cache_dir.glob("*"))
-        if files:
-            print(f"✅ 发现 {len(files)} 个缓存图片文件")
+    # 1. 检查缓存图片（取索引里最新的一张，key 来自接口而不是文件名，不会误把缩略图当原图）
+    try:
+        page = requests.get(f"{API_BASE_URL}/api/cache/entries", params={'kind': 'image', 'limit': 1}, timeout=5).json()
+        entries = page.get('items', [])
+        if entries:
+            print(f"✅ 发现 {page['summary']['count']} 个缓存图片文件")
             
-            # 测试第一个文件的访问
-            first_file = files[0]
-            key = first_file.stem
-            test_url = f"{API_BASE_URL}/api/cache/image/{key}"
+            # 测试最新一张图片的访问
+            test_url = f"{API_BASE_URL}{entries[0]['url']}"
             
             try:
                 response = requests.head(test_url, timeout=5)
@@ -38,19 +35,18 @@ def quick_test_and_fix():
                     
                 else:
                     print(f"❌ 图片URL访问失败: {response.status_code}")
-                    print("🎯 问题在图片路径映射")
+                    print("🎯 缓存索引与存储不一致")
                     print("\n🔧 修复建议:")
-                    print("1. 检查 cacheService.js 的 getImagePath 方法")
-                    print("2. 添加详细的路径映射日志")
-                    print("3. 确保文件名和key的匹配逻辑")
+                    print("1. 运行 python cache_verifier.py 校验全部缓存")
+                    print("2. 运行 python cache_verifier.py --repair 修复")
                     
             except Exception as e:
                 print(f"❌ URL测试异常: {e}")
                 
         else:
-            print("❌ 缓存目录为空")
-    else:
-        print("❌ 缓存目录不存在")
+            print("❌ 缓存中没有图片")
+    except Exception as e:
+        print(f"❌ 无法获取缓存列表: {e}")
     
     # 2. 测试流式响应
     print(f"\n🔍 测试流式响应...")
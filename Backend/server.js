@@ -1,16 +1,32 @@
 require('dotenv').config();
+// 最先加载：替换全局 agent，之后加载的 SDK 也复用连接池
+const httpClient = require('./services/httpClient');
 const express = require('express');
 const cors = require('cors');
 const multer = require('multer');
 const path = require('path');
 const fs = require('fs-extra');
 const { v4: uuidv4 } = require('uuid');
-const { Readable } = require('stream');
+const { Readable, pipeline } = require('stream');
 const AIHUBMIX_API_KEY = process.env.AIHUBMIX_API_KEY;
 
 const pdfService = require('./services/pdfService');
 const cacheService = require('./services/cacheService');
+const exportService = require('./services/exportService');
+const tableService = require('./services/tableService');
+const llmCacheService = require('./services/llmCacheService');
 const aiService = require('./services/aiService');
+const generationService = require('./services/generationService');
+const pipelineService = require('./services/pipelineService');
+const streamService = require('./services/streamService');
+const generationScheduler = require('./services/generationScheduler');
+const resilience = require('./services/resilience');
+const deadlineService = require('./services/deadline');
+const clusterService = require('./services/clusterService');
+const readinessService = require('./services/readinessService');
+const metricsService = require('./services/metricsService');
+const tracingService = require('./services/tracingService');
+const logger = require('./services/logger');
 
 const app = express();
 const PORT = process.env.PORT || 2983;
@@ -25,6 +41,10 @@ app.use(cors());
 app.use(express.json());
 app.use(express.urlencoded({ extended: true, limit: '10mb' }));
 app.use(express.static('public'));
+// 静态资源之后挂载：每个 API 请求一个 span，沿用客户端 traceparent 里的 trace id
+app.use(tracingService.middleware());
+// 请求 id 与按路由的日志采样
+app.use(logger.middleware());
 
 // 配置 Multer 用于文件上传
 const storage = multer.diskStorage({
@@ -49,71 +69,265 @@ const upload = multer({
   }
 });
 
+// 接收上传的 PDF，并记录 multer 接收耗时（含写入上传目录）
+function receivePdf(req, res, next) {
+  const end = metricsService.uploadReceive.startTimer({ route: req.path });
+  // multer 在请求流的事件里回调，绑定回请求 span，后续处理才能挂在这条链路上
+  upload.single('pdf')(req, res, tracingService.bind((err) => {
+    end({ outcome: err ? 'error' : 'ok' });
+    next(err);
+  }));
+}
+
 // 路由
 app.get('/', (req, res) => {
   res.sendFile(path.join(__dirname, 'public', 'index.html'));
 });
 
 // 提取 PDF 文本、表格和图片
-app.post('/api/extract', upload.single('pdf'), async (req, res) => {
+// 表单字段 stream=true 时以 SSE 推送：metadata → summary(增量) → prompt → authors → keywords → complete
+app.post('/api/extract', receivePdf, async (req, res) => {
+    if (!req.file) {
+        return res.status(400).json({ error: '请上传 PDF 文件' });
+    }
+    if (req.body.stream === 'true') {
+        return extractStream(req, res);
+    }
+
+    const deadline = deadlineService.fromRequest(req);
     try {
         const filePath = req.file.path;
-        const result = await pdfService.extractPDF(filePath);
-
-        let fullText = "";
-        if (result.elements && Array.isArray(result.elements)) {
-            fullText = result.elements
-                .filter(el => el.Text || el.text)
-                .map(el => el.Text || el.text)
-                .join('\n');
-        }
-        const textForAI = fullText.length > 100 ? fullText : (result.text || "");
+        // ocr: 'auto'（默认，按文档判断）| 'always' | 'never'
+        const result = await pdfService.ingestPDF(filePath, { ocr: req.body.ocr, deadline });
+        const textForAI = pipelineService.collectPaperText(result);
 
         // 💡 关键唯一性修改：调用专门的文本分析方法，而不是生图方法
-        let finalSummary = "（未生成总结）";
-        let finalPrompt = "";
-        let finalAuthors = [];
-        let finalKeywords = [];
+        let analysis = aiService.parseAnalysis('');
 
         if (textForAI && textForAI.length > 0) {
             // 只进行文本处理
-            const aiRawResponse = await aiService.generateAcademicPrompt(textForAI);
-            const parts = aiRawResponse.split('###');
-            
-            if (parts.length >= 2) {
-                finalSummary = parts[0].replace(/Summary:/i, '').trim();
-                finalPrompt = parts[1].replace(/Prompt:/i, '').trim();
-            }
-            if (parts.length >= 3) {
-                const authorsStr = parts[2].replace(/Authors:/i, '').trim();
-                finalAuthors = authorsStr.split(/,|，/).map(s => s.trim()).filter(s => s);
-            }
-            if (parts.length >= 4) {
-                const keywordsStr = parts[3].replace(/Keywords:/i, '').trim();
-                finalKeywords = keywordsStr.split(/,|，/).map(s => s.trim()).filter(s => s);
-            }
+            // 传入结构化元素，由 aiService 按章节挑选内容
+            const aiRawResponse = await aiService.generateAcademicPrompt({
+                elements: result.elements,
+                text: textForAI
+            }, { deadline });
+            analysis = aiService.parseAnalysis(aiRawResponse);
         }
 
         await fs.unlink(filePath);
 
         // 返回 JSON，其中 generatedPrompt 将由前端交给第二个接口
         res.json({
-            text: finalSummary, 
-            generatedPrompt: finalPrompt,
+            text: analysis.summary, 
+            generatedPrompt: analysis.prompt,
             metadata: {
                 ...result.metadata,
                 title: result.metadata?.title || req.file.originalname,
-                authors: finalAuthors,
-                keywords: finalKeywords
+                authors: analysis.authors,
+                keywords: analysis.keywords
             }
         });
     } catch (error) {
-        res.status(500).json({ error: error.message });
+        res.status(error.code === 'DEADLINE_EXCEEDED' ? 504 : 500).json({ error: error.message, code: error.code });
+    } finally {
+        deadline.clear();
+    }
+});
+
+// 调度参数：X-Client-Id 用于按客户端公平排队，X-Priority: batch 表示批量任务
+function schedulingOptions(req) {
+    return {
+        clientId: req.get('X-Client-Id') || req.ip,
+        priority: req.get('X-Priority') === 'batch' ? 'batch' : 'interactive'
+    };
+}
+
+// 生图参数：candidates（候选数量）、modality（IMAGE | TEXT_AND_IMAGE）、hedge（对冲请求）
+function generationOptions(req) {
+    return aiService.generationOptions(req.body || {});
+}
+
+// 生图队列放不下时直接返回 429 + Retry-After
+function rejectIfQueueFull(res, slots) {
+    const rejection = generationScheduler.admissionCheck(slots);
+    if (!rejection) return false;
+    const retryAfter = Math.ceil(rejection.retryAfterMs / 1000);
+    res.setHeader('Retry-After', String(retryAfter));
+    res.status(429).json({ error: '生图队列已满，请稍后重试', retryAfter });
+    return true;
+}
+
+// 客户端在响应结束前断开时中止，信号一路传到上游请求
+function abortOnDisconnect(res) {
+    const controller = new AbortController();
+    res.on('close', () => {
+        if (!res.writableEnded) controller.abort();
+    });
+    return controller.signal;
+}
+
+// 上游熔断期间直接返回 503 + Retry-After，不再排队等超时
+function rejectIfCircuitOpen(res, endpoint) {
+    const retryAfterMs = resilience.openFor(endpoint);
+    if (!retryAfterMs) return false;
+    const retryAfter = Math.ceil(retryAfterMs / 1000);
+    res.setHeader('Retry-After', String(retryAfter));
+    res.status(503).json({ error: '生图服务暂时不可用，请稍后重试', retryAfter });
+    return true;
+}
+
+// 请求上下文：X-Request-Timeout-Ms 给出的截止时间，以及在客户端断开或截止时间到达时中止的信号
+function requestContext(req, res) {
+    const deadline = deadlineService.fromRequest(req);
+    const signal = AbortSignal.any([abortOnDisconnect(res), deadline.signal]);
+    res.on('close', () => deadline.clear());
+    return { deadline, signal };
+}
+
+/**
+ * 解析单段 Range 请求头（bytes=a- / bytes=a-b），多段和后缀形式按整体返回处理
+ */
+function parseRange(header) {
+    const match = /^bytes=(\d+)-(\d*)$/.exec(header || '');
+    if (!match) return {};
+    const start = parseInt(match[1], 10);
+    const end = match[2] ? parseInt(match[2], 10) : undefined;
+    return end === undefined || end >= start ? { start, end } : {};
+}
+
+/**
+ * 下载文件名：只保留字母数字和 . _ -，download=1 / true 时用 key
+ */
+function downloadName(requested, key) {
+    const name = ['1', 'true'].includes(requested) ? key : String(requested).replace(/[^\w.-]/g, '_').slice(0, 100);
+    return path.basename(name, path.extname(name)) || key;
+}
+
+/**
+ * 把缓存对象从所在存储流式返回：支持 Range 和 ETag / Last-Modified 条件请求
+ * open(range) 打开对象，不存在时返回 null（此时返回 false，由调用方处理 404）
+ */
+async function sendStorageObject(req, res, open, headers = {}) {
+    const range = parseRange(req.get('Range'));
+    const object = await open(range);
+    if (!object) return false;
+
+    const etag = `W/"${object.size.toString(16)}-${Math.floor(object.mtimeMs).toString(16)}"`;
+    const lastModified = new Date(object.mtimeMs).toUTCString();
+    res.set({
+        'Content-Type': object.contentType,
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': lastModified,
+        ...headers
+    });
+
+    if (req.get('If-None-Match') === etag || (!req.get('If-None-Match') && req.get('If-Modified-Since') === lastModified)) {
+        object.stream.destroy();
+        res.status(304).end();
+        return true;
+    }
+    if (range.start !== undefined && range.start >= object.size) {
+        object.stream.destroy();
+        res.status(416).set('Content-Range', `bytes */${object.size}`).end();
+        return true;
+    }
+
+    if (range.start !== undefined) {
+        const end = Math.min(range.end ?? object.size - 1, object.size - 1);
+        res.status(206).set({
+            'Content-Range': `bytes ${range.start}-${end}/${object.size}`,
+            'Content-Length': end - range.start + 1
+        });
+    } else {
+        res.set('Content-Length', object.size);
+    }
+    // 客户端断开时销毁存储读取流（远程存储会中止对应的下载）
+    pipeline(object.stream, res, () => {});
+    return true;
+}
+
+// 所有 SSE 接口共用 streamService 的传输层（背压、积压上限、心跳、合并写）
+function startSSE(res) {
+    const sse = streamService.createSSEResponse(res);
+    sse.send('connected', { status: 'connected' });
+    return sse;
+}
+
+async function extractStream(req, res) {
+    const filePath = req.file.path;
+    const { deadline, signal } = requestContext(req, res);
+    const sse = startSSE(res);
+
+    try {
+        const result = await pipelineService.run(filePath, {
+            ocr: req.body.ocr,
+            fileName: req.file.originalname,
+            scheduling: schedulingOptions(req),
+            generation: generationOptions(req),
+            signal,
+            deadline
+        }, (event, data) => {
+            if (event !== 'stage') sse.send(event, data);
+        });
+        const { imageCount, ...response } = result;
+        sse.send('complete', response);
+    } catch (error) {
+        sse.send('error', { error: error.message, code: error.code });
+    } finally {
+        await fs.remove(filePath);
+        sse.end();
+    }
+}
+
+// 单请求流水线：上传 PDF，同一条 SSE 流里依次返回
+// stage / metadata / summary / prompt / authors / keywords / analysis / image / complete
+app.post('/api/pipeline', receivePdf, async (req, res) => {
+    if (!req.file) {
+        return res.status(400).json({ error: '请上传 PDF 文件' });
+    }
+
+    const filePath = req.file.path;
+    const generation = generationOptions(req);
+    if (rejectIfQueueFull(res, generation.candidates)) {
+        await fs.remove(filePath);
+        return;
+    }
+    const { deadline, signal } = requestContext(req, res);
+    const sse = startSSE(res);
+
+    try {
+        // 排队状态只需最新一条，积压时可以合并
+        const result = await pipelineService.run(filePath, {
+            ocr: req.body.ocr,
+            fileName: req.file.originalname,
+            includeImages: true,
+            scheduling: schedulingOptions(req),
+            generation,
+            signal,
+            deadline
+        }, (event, data) => sse.send(event, data, { replace: event === 'queue' }));
+
+        // 截止时间到达时生图已被取消，已产出的图片照常保留
+        if (deadline.expired()) {
+            sse.send('error', { error: '请求已超过截止时间，部分图片未生成', code: 'DEADLINE_EXCEEDED' });
+        }
+
+        sse.send('complete', {
+            status: 'complete',
+            generationId: result.generationId,
+            imageCount: result.imageCount
+        });
+    } catch (error) {
+        sse.send('error', { error: error.message, code: error.code, fatal: true });
+    } finally {
+        await fs.remove(filePath);
+        sse.end();
     }
 });
 
 // OCR PDF 文件
-app.post('/api/ocr', upload.single('pdf'), async (req, res) => {
+app.post('/api/ocr', receivePdf, async (req, res) => {
   try {
     if (!req.file) {
       return res.status(400).json({ error: '请上传 PDF 文件' });
@@ -127,7 +341,7 @@ app.post('/api/ocr', upload.single('pdf'), async (req, res) => {
     
     res.json(result);
   } catch (error) {
-    console.error('OCR 失败:', error);
+    logger.error('❌ OCR 失败', error);
     res.status(500).json({ 
       error: 'OCR 失败', 
       message: error.message 
@@ -135,46 +349,71 @@ app.post('/api/ocr', upload.single('pdf'), async (req, res) => {
   }
 });
 
-// 修复后的图片获取路由 - 合并重复的路由
+/**
+ * 按 Accept 请求头选派生图格式：只认明确列出的 image/avif、image/webp（image/* 不代表能解码），
+ * q 值高的优先，相同时选 WebP（编码快得多）；都不接受时返回 null
+ */
+function negotiateImageFormat(accept) {
+    let best = null;
+    for (const part of (accept || '').split(',')) {
+        const [type, ...params] = part.trim().toLowerCase().split(';');
+        const format = { 'image/webp': 'webp', 'image/avif': 'avif' }[type.trim()];
+        if (!format) continue;
+        const q = params.map(param => param.trim()).find(param => param.startsWith('q='));
+        const weight = q ? parseFloat(q.slice(2)) : 1;
+        if (!(weight > 0)) continue;
+        if (!best || weight > best.weight || (weight === best.weight && format === 'webp')) best = { format, weight };
+    }
+    return best ? best.format : null;
+}
+
+// 图片获取：原图、缩略图（size=thumb），或 WebP / AVIF 派生图
+// 派生图参数：format（auto 按 Accept 协商，默认 / webp / avif / original）、width（像素，取档）、quality（low / medium / high 或 1-100）
+// 不带这三个参数时总是返回原图，下载按钮据此拿到原始文件
+// ?download=<文件名> 时作为附件下载原图（扩展名按存储的原图补上），前端直接给浏览器这个链接，不经过 Streamlit 进程
 app.get('/api/cache/image/:key', async (req, res) => {
+  const { size = 'original', format, width, quality, download } = req.query;
+  const wantsVariant = !download && size !== 'thumb' && format !== 'original' && Boolean(format || width || quality);
+  const end = metricsService.imageServe.startTimer({ size: size === 'thumb' ? 'thumb' : wantsVariant ? 'variant' : 'original' });
+  // 到响应写完（或客户端断开）为止
+  res.on('close', () => end({ status: res.statusCode }));
   try {
     const { key } = req.params;
-    const { size = 'original' } = req.query;
-    
-    console.log(`[Image Request] Key: ${key}, Size: ${size}`);
     
-    const imagePath = cacheService.getImagePath(key, size);
-    
-    if (!imagePath) {
-      console.log(`[Image Request] Image not found for key: ${key}`);
-      return res.status(404).json({ error: 'Image not found', key });
-    }
-
-    // 检查文件是否存在
-    if (!fs.existsSync(imagePath)) {
-      console.log(`[Image Request] File does not exist: ${imagePath}`);
-      return res.status(404).json({ error: 'Image file not found on disk', key });
+    logger.debug('[Image Request]', { key, size, format, width, quality });
+
+    let variant = null;
+    if (wantsVariant) {
+      const negotiated = !format || format === 'auto';
+      // 同一 URL 的响应随 Accept 变化，告诉中间缓存按 Accept 分开存
+      if (negotiated) res.set('Vary', 'Accept');
+      const chosen = negotiated ? negotiateImageFormat(req.get('Accept')) : format;
+      if (chosen) variant = cacheService.normalizeVariant({ format: chosen, width, quality });
     }
 
-    // 根据文件扩展名设置Content-Type
-    const ext = path.extname(imagePath).toLowerCase();
-    const mimeTypes = {
-      '.png': 'image/png',
-      '.jpg': 'image/jpeg',
-      '.jpeg': 'image/jpeg',
-      '.gif': 'image/gif',
-      '.webp': 'image/webp'
-    };
-
-    res.setHeader('Content-Type', mimeTypes[ext] || 'image/png');
-    res.setHeader('Cache-Control', 'public, max-age=3600');
-    res.setHeader('Access-Control-Allow-Origin', '*');
+    // 从持有该对象的存储（本地目录或对象存储）流式读取
+    const served = await sendStorageObject(req, res, async (range) => {
+      if (!variant) {
+        const object = await cacheService.openImage(key, size, range);
+        if (object && download) res.attachment(`${downloadName(download, key)}${path.extname(object.file)}`);
+        return object;
+      }
+      const object = await cacheService.openDerivative(key, variant, range);
+      if (object) res.set('X-Image-Variant', object.variant || 'original');
+      return object;
+    }, {
+      'Cache-Control': 'public, max-age=3600',
+      'Access-Control-Allow-Origin': '*'
+    });
     
-    console.log(`[Image Request] Serving image: ${imagePath}`);
-    res.sendFile(path.resolve(imagePath));
+    if (!served) {
+      logger.info('[Image Request] Image not found', { key, size });
+      return res.status(404).json({ error: 'Image not found', key });
+    }
   } catch (error) {
-    console.error('Get image error:', error);
-    res.status(500).json({ error: 'Failed to get image', message: error.message });
+    if (error.code === 'INVALID_VARIANT') return res.status(400).json({ error: error.message });
+    logger.error('❌ Get image error', error);
+    if (!res.headersSent) res.status(500).json({ error: 'Failed to get image', message: error.message });
   }
 });
 
@@ -182,26 +421,103 @@ app.get('/api/cache/image/:key', async (req, res) => {
 app.get('/api/cache/table/:key', async (req, res) => {
   try {
     const { key } = req.params;
-    const tablePath = cacheService.getTablePath(key);
+    const served = await sendStorageObject(req, res, async () => {
+      const table = await cacheService.openTable(key);
+      // xlsx 作为附件下载，csv 直接返回
+      if (table && path.extname(table.file) === '.xlsx') res.attachment(table.file);
+      return table;
+    });
     
-    if (!tablePath) {
+    if (!served) {
       return res.status(404).json({ error: '表格不存在' });
     }
-    
-    const ext = path.extname(tablePath).toLowerCase();
-    if (ext === '.csv') {
-      res.setHeader('Content-Type', 'text/csv');
-      res.sendFile(tablePath);
-    } else {
-      res.download(tablePath);
+  } catch (error) {
+    logger.error('❌ 获取表格失败', error);
+    if (!res.headersSent) res.status(500).json({ error: '获取表格失败' });
+  }
+});
+
+// 表格预览：?offset=0&limit=50&columns=列名或列号（逗号分隔；列名里有逗号时重复 columns 参数，每个参数一列）
+// 按行索引从最近的检查点读起，只解析窗口内的行；XLSX 第一次预览时转成 CSV。
+// 响应是 JSON：{ key, format, columns, totalRows, offset, limit, nextOffset, rows }，rows 边读边写出
+app.get('/api/cache/table/:key/rows', async (req, res) => {
+  try {
+    const { offset, limit, columns: requested } = req.query;
+    const columns = requested === undefined ? null
+      : (Array.isArray(requested) ? requested : String(requested).split(',')).map(String).filter(Boolean);
+    const preview = await tableService.preview(req.params.key, { offset, limit, columns });
+    if (!preview) return res.status(404).json({ error: '表格不存在' });
+
+    const { rows, ...window } = preview;
+    res.set({
+      'Content-Type': 'application/json; charset=utf-8',
+      'X-Total-Rows': String(window.totalRows),
+      'Cache-Control': 'public, max-age=3600',
+      'Access-Control-Allow-Origin': '*'
+    });
+    res.write(`${JSON.stringify(window).slice(0, -1)},"rows":[`);
+    let first = true;
+    for await (const row of rows) {
+      if (res.destroyed) break;
+      // 写缓冲满时等客户端读走，慢客户端不会让整个窗口堆在内存里
+      if (!res.write(`${first ? '' : ','}${JSON.stringify(row)}`)) await new Promise(resolve => res.once('drain', resolve).once('close', resolve));
+      first = false;
+    }
+    res.end(']}');
+  } catch (error) {
+    if (error.code === 'INVALID_WINDOW' || error.code === 'INVALID_COLUMNS') {
+      return res.status(400).json({ error: error.message, columns: error.columns });
     }
+    if (error.code === 'TABLE_UNREADABLE') return res.status(422).json({ error: error.message });
+    logger.error('❌ 表格预览失败', error);
+    // 已经开始写出时只能断开，客户端收到的是不完整的 JSON
+    if (!res.headersSent) res.status(500).json({ error: '表格预览失败' });
+    else res.destroy(error);
+  }
+});
+
+// 打包导出：?paper=<论文 id> 或 ?generation=<生图任务 id>，ZIP 里是候选图、论文插图、表格和 metadata.json
+// 边读存储边发送，不落临时文件；包的字节是确定的，支持 Range / If-Range 断点续传
+app.get('/api/export', async (req, res) => {
+  try {
+    const { paper, generation } = req.query;
+    if (!paper && !generation) return res.status(400).json({ error: '需要 paper 或 generation 参数' });
+    const plan = exportService.plan({ paper, generation });
+    if (!plan) return res.status(404).json({ error: '没有可导出的内容', paper, generation });
+
+    // If-Range 不匹配说明内容变了，按完整下载返回
+    const ifRange = req.get('If-Range');
+    const range = !ifRange || ifRange === plan.etag ? parseRange(req.get('Range')) : {};
+    res.attachment(plan.filename);
+    res.set({
+      'Content-Type': 'application/zip',
+      'Accept-Ranges': 'bytes',
+      'ETag': plan.etag,
+      'Last-Modified': new Date(plan.lastModified).toUTCString(),
+      'Cache-Control': 'no-cache'
+    });
+    if (range.start !== undefined && range.start >= plan.size) {
+      return res.status(416).set('Content-Range', `bytes */${plan.size}`).end();
+    }
+
+    const start = range.start ?? 0;
+    const end = Math.min(range.end ?? plan.size - 1, plan.size - 1);
+    if (range.start !== undefined) res.status(206).set('Content-Range', `bytes ${start}-${end}/${plan.size}`);
+    res.set('Content-Length', end - start + 1);
+    if (req.method === 'HEAD') return res.end();
+
+    // 客户端断开时停止读取存储；导出中途出错（对象被删除）只能断开连接，客户端可以凭 ETag 续传或重新下载
+    pipeline(exportService.stream(plan, { start, end }), res, (error) => {
+      if (error && error.code !== 'ERR_STREAM_PREMATURE_CLOSE') logger.warn('⚠️ 导出中断', { filename: plan.filename, error });
+    });
   } catch (error) {
-    console.error('获取表格失败:', error);
-    res.status(500).json({ error: '获取表格失败' });
+    if (error.code === 'EXPORT_TOO_LARGE') return res.status(413).json({ error: error.message });
+    logger.error('❌ 导出失败', error);
+    if (!res.headersSent) res.status(500).json({ error: '导出失败' });
   }
 });
 
-// 健康检查
+// 健康检查（存活探针：进程在响应即可）
 app.get('/api/health', (req, res) => {
   res.json({ 
     status: 'ok', 
@@ -210,41 +526,70 @@ app.get('/api/health', (req, res) => {
   });
 });
 
+// 就绪探针：缓存索引、sharp 等必需项完成前返回 503，负载均衡据此决定是否转发流量
+app.get('/api/ready', (req, res) => {
+  const status = readinessService.getStatus();
+  res.status(status.ready ? 200 : 503).json(status);
+});
+
+// Prometheus 指标（文本格式）；多进程模式下为所有工作进程的合计
+app.get('/metrics', async (req, res) => {
+  if (!metricsService.enabled) return res.status(404).json({ error: 'metrics disabled' });
+  try {
+    res.type('text/plain; version=0.0.4; charset=utf-8').send(await metricsService.render());
+  } catch (error) {
+    logger.error('❌ Metrics error', error);
+    res.status(500).json({ error: 'Failed to render metrics' });
+  }
+});
+
+// 查询一条链路的全部 span（trace id 来自响应头 X-Trace-Id 或客户端生成的 traceparent）
+app.get('/api/traces/:traceId', async (req, res) => {
+  try {
+    const spans = await tracingService.getTrace(req.params.traceId.toLowerCase());
+    if (!spans) return res.status(404).json({ error: 'Trace not found' });
+    res.json({ traceId: req.params.traceId.toLowerCase(), spans });
+  } catch (error) {
+    logger.error('❌ Trace error', error);
+    res.status(500).json({ error: 'Failed to load trace' });
+  }
+});
+
+// 旧的调试接口：保留原有字段，只返回汇总和第一页，完整列表用 /api/cache/entries 翻页
 app.get('/api/debug/cache', (req, res) => {
   try {
-    const cacheDir = process.env.CACHE_DIR || './cache';
-    const imagesDir = path.join(cacheDir, 'images');
-    
-    if (!fs.existsSync(cacheDir)) {
-      return res.json({ 
-        error: 'Cache directory does not exist',
-        cacheDir,
-        imagesDir 
-      });
-    }
-    
-    const files = fs.readdirSync(imagesDir);
-    const fileStats = files.map(file => {
-      const filePath = path.join(imagesDir, file);
-      const stats = fs.statSync(filePath);
-      return {
-        file,
-        size: stats.size,
-        modified: stats.mtime
-      };
-    });
-    
+    const summary = cacheService.summarizeEntries();
+    const { items, nextCursor } = cacheService.listEntries({ limit: req.query.limit });
+
     res.json({
-      cacheDir,
-      imagesDir,
-      fileCount: files.length,
-      files: fileStats
+      cacheDir: cacheService.cacheDir,
+      imagesDir: cacheService.imageDir,
+      fileCount: summary.count,
+      files: items,
+      nextCursor,
+      summary
     });
   } catch (error) {
     res.status(500).json({ error: error.message });
   }
 });
 
+// 最近的日志（内存环形缓冲，多进程模式下合并所有工作进程）
+// 查询参数：level 最低级别，requestId / traceId 精确匹配，q 消息子串，since 时间（ISO 或毫秒时间戳），limit 条数
+app.get('/api/debug/logs', async (req, res) => {
+  try {
+    const { level, requestId, traceId, q } = req.query;
+    const since = req.query.since
+      ? new Date(/^\d+$/.test(req.query.since) ? Number(req.query.since) : req.query.since).toISOString()
+      : undefined;
+    const limit = Math.min(Math.max(parseInt(req.query.limit, 10) || 200, 1), 5000);
+    const entries = await logger.query({ level, requestId, traceId, q, since, limit });
+    res.json({ entries, stats: logger.getStats() });
+  } catch (error) {
+    res.status(400).json({ error: error.message });
+  }
+});
+
 // 错误处理中间件
 app.use((err, req, res, next) => {
   if (err instanceof multer.MulterError) {
@@ -254,7 +599,7 @@ app.use((err, req, res, next) => {
     return res.status(400).json({ error: err.message });
   }
   
-  console.error('服务器错误:', err);
+  logger.error('❌ 服务器错误', { path: req.path, error: err });
   res.status(500).json({ error: '服务器内部错误' });
 });
 
@@ -268,36 +613,59 @@ app.use((err, req, res, next) => {
  * 支持：论文文本 -> 自动 Prompt 优化 -> 流式生图
  */
 app.post('/api/generate/stream', async (req, res) => {
-    const requestId = uuidv4().substring(0, 8);
     try {
-        const { paperText } = req.body; // 此时 paperText 已经是优化过的 Prompt
+        // paperText 是已经优化过的 Prompt；generationId 指向 /api/extract 流式分析时提前启动的任务
+        const { paperText, generationId } = req.body;
+        const attaching = generationId && generationService.has(generationId);
+        const generation = generationOptions(req);
+        const resultGenerationId = attaching ? generationId : uuidv4();
+
+        // 新任务需要准入检查，订阅已有任务不占新槽位
+        if (!attaching && (rejectIfCircuitOpen(res, 'image') || rejectIfQueueFull(res, generation.candidates))) return;
+
+        // 客户端断开（清空会话、重跑、关闭页面）或截止时间到达时取消上游生图
+        const { deadline, signal } = requestContext(req, res);
 
-        res.setHeader('Content-Type', 'text/event-stream');
-        res.setHeader('Cache-Control', 'no-cache');
-        res.setHeader('Access-Control-Allow-Origin', '*');
-        
-        res.write('event: connected\n');
-        res.write(`data: ${JSON.stringify({ status: 'connected' })}\n\n`);
+        const sse = startSSE(res);
 
-        // 💡 调用并发生图逻辑，内部屏蔽思考文本
-        const result = await aiService.generateFromPaper(paperText, (chunk) => {
+        const forward = (chunk) => {
+            if (signal.aborted) return;
             if (chunk.type === 'image') {
-                res.write('event: image\n');
-                res.write(`data: ${JSON.stringify({
+                sse.send('image', {
                     key: chunk.key,
                     url: `/api/cache/image/${chunk.key}`
-                })}\n\n`);
+                });
+            } else if (chunk.type === 'queue') {
+                sse.send('queue', { waiting: chunk.waiting, position: chunk.position, etaMs: chunk.etaMs }, { replace: true });
             } else if (chunk.type === 'error') {
-                res.write('event: error\n');
-                res.write(`data: ${JSON.stringify({ error: chunk.error })}\n\n`);
+                sse.send('error', { error: chunk.error });
             }
-        });
+        };
+
+        if (attaching) {
+            // 订阅已在运行的任务，先回放已生成的图片
+            await generationService.attach(generationId, forward, { signal });
+        } else {
+            // 💡 调用并发生图逻辑，内部屏蔽思考文本
+            // paperId 来自 /api/extract 返回的 metadata，用于缓存列表按论文筛选；
+            // 直接生图没有任务 id，这里分配一个，完成时返回给客户端用于打包导出
+            await aiService.generateFromPaper(paperText, forward, { ...schedulingOptions(req), ...generation, paper: req.body.paperId, generation: resultGenerationId, signal, deadline });
+        }
+        if (signal.aborted) {
+            if (!deadline.expired()) {
+                logger.info('客户端已断开，生图已取消');
+                return;
+            }
+            logger.warn('超过截止时间，生图已停止');
+            sse.send('error', { error: '请求已超过截止时间，部分图片未生成', code: 'DEADLINE_EXCEEDED' });
+        }
 
-        res.write('event: complete\n');
-        res.write(`data: ${JSON.stringify({ status: 'complete' })}\n\n`);
-        res.end();
+        sse.send('complete', { status: 'complete', generationId: resultGenerationId });
+        sse.end();
     } catch (error) {
+        logger.error('❌ 流式生图失败', error);
         if (!res.headersSent) res.status(500).end();
+        else res.end();
     }
 });
 
@@ -328,7 +696,7 @@ app.post('/api/generate/batch', async (req, res) => {
 
     res.json(result);
   } catch (error) {
-    console.error('Batch generation error:', error);
+    logger.error('❌ Batch generation error', error);
     res.status(500).json({ 
       error: 'Generation failed', 
       message: error.message 
@@ -336,11 +704,34 @@ app.post('/api/generate/batch', async (req, res) => {
   }
 });
 
+// 分页列出缓存条目，来自内存索引
+// 查询参数：kind（image / figure / generated / table）、paper、generation、minAge / maxAge（秒）、minSize / maxSize（字节）、
+// order（desc 默认 / asc）、cursor（上一页返回的 nextCursor）、limit；第一页或 summary=true 时附带汇总
+app.get('/api/cache/entries', (req, res) => {
+  try {
+    const { kind, paper, generation, minAge, maxAge, minSize, maxSize, order, cursor, limit } = req.query;
+    const filter = { kind, paper, generation, minAge, maxAge, minSize, maxSize };
+    const page = cacheService.listEntries({ ...filter, order, cursor, limit });
+    const withSummary = req.query.summary !== undefined ? req.query.summary === 'true' : !cursor;
+
+    res.json({
+      ...page,
+      summary: withSummary ? cacheService.summarizeEntries(filter) : undefined
+    });
+  } catch (error) {
+    if (error.code === 'INVALID_FILTER' || error.code === 'INVALID_CURSOR') {
+      return res.status(400).json({ error: error.message });
+    }
+    logger.error('❌ List cache entries error', error);
+    res.status(500).json({ error: 'Failed to list cache entries' });
+  }
+});
+
 // 获取缓存信息
 app.get('/api/cache/info/:key', async (req, res) => {
   try {
     const { key } = req.params;
-    const info = cacheService.getImageInfo(key);
+    const info = await cacheService.getImageInfo(key);
     
     if (!info) {
       return res.status(404).json({ error: 'Image not found in cache' });
@@ -348,7 +739,7 @@ app.get('/api/cache/info/:key', async (req, res) => {
 
     res.json(info);
   } catch (error) {
-    console.error('Get cache info error:', error);
+    logger.error('❌ Get cache info error', error);
     res.status(500).json({ error: 'Failed to get cache info' });
   }
 });
@@ -366,15 +757,41 @@ app.post('/api/cache/cleanup', async (req, res) => {
       freedSpace: result.freedSpace
     });
   } catch (error) {
-    console.error('Cache cleanup error:', error);
+    logger.error('❌ Cache cleanup error', error);
     res.status(500).json({ error: 'Cache cleanup failed' });
   }
 });
 
+// 对照存储列表检查缓存索引：索引里有但对象已丢失的、存储里有但索引不认识的、缺缩略图的
+app.get('/api/cache/audit', async (req, res) => {
+  try {
+    res.json(await cacheService.auditStorage());
+  } catch (error) {
+    logger.error('❌ Cache audit error', error);
+    res.status(500).json({ error: 'Cache audit failed' });
+  }
+});
+
+// 按检查结果修复：{ dangling: [key], orphans: [对象名], thumbnails: [key], refs: [key], deleteOrphans }
+app.post('/api/cache/repair', async (req, res) => {
+  try {
+    const { dangling, orphans, thumbnails, refs, deleteOrphans = false } = req.body || {};
+    const lists = [dangling, orphans, thumbnails, refs];
+    if (lists.some(list => list !== undefined && (!Array.isArray(list) || list.some(item => typeof item !== 'string')))) {
+      return res.status(400).json({ error: 'dangling / orphans / thumbnails / refs 必须是字符串数组' });
+    }
+    res.json(await cacheService.repair({ dangling, orphans, thumbnails, refs, deleteOrphans: deleteOrphans === true }));
+  } catch (error) {
+    logger.error('❌ Cache repair error', error);
+    res.status(500).json({ error: 'Cache repair failed' });
+  }
+});
+
 // 获取系统状态
 app.get('/api/status', async (req, res) => {
   try {
     const cacheStats = cacheService.getStats();
+    const llmCacheStats = llmCacheService.getStats();
     const systemStats = {
       uptime: process.uptime(),
       memory: process.memoryUsage(),
@@ -386,10 +803,22 @@ app.get('/api/status', async (req, res) => {
     res.json({
       system: systemStats,
       cache: cacheStats,
+      llmCache: llmCacheStats,
+      upstream: httpClient.getStats(),
+      resilience: resilience.getStats(),
+      sse: streamService.getSSEStats(),
+      generation: { ...generationScheduler.getStats(), ...aiService.getGenerationStats() },
+      // 多进程模式下以上数据只属于处理本次请求的工作进程
+      cluster: clusterService.getStats(),
+      readiness: readinessService.getStatus(),
+      tracing: tracingService.getStats(),
+      logging: logger.getStats(),
+      export: exportService.getStats(),
+      tables: tableService.getStats(),
       timestamp: new Date().toISOString()
     });
   } catch (error) {
-    console.error('Status error:', error);
+    logger.error('❌ Status error', error);
     res.status(500).json({ error: 'Failed to get status' });
   }
 });
@@ -403,12 +832,20 @@ app.use((req, res) => {
   });
 });
 
-app.listen(PORT, () => {
-  console.log(`服务器运行在 http://localhost:${PORT}`);
-  console.log(`上传目录: ${process.env.UPLOAD_DIR || './uploads'}`);
-  console.log(`缓存目录: ${process.env.CACHE_DIR || './cache'}`);
-  console.log(`🚀 AI Image Generator running on http://localhost:${PORT}`);
-  console.log(`📁 Cache directory: ${process.env.CACHE_DIR || './cache'}`);
-  console.log(`📁 Upload directory: ${process.env.UPLOAD_DIR || './uploads'}`);
-  console.log(`🔑 API Key configured: ${process.env.AIHUBMIX_API_KEY ? 'Yes' : 'No'}`);
+// 启动工作放在后台，不阻塞监听端口；/api/ready 反映完成情况
+readinessService.track('cacheIndex', cacheService.ready);
+if (cacheService.storage.ready) readinessService.track('storageTier', cacheService.storage.ready, { required: false });
+
+const listening = new Promise(resolve => app.listen(PORT, resolve));
+readinessService.track('listening', listening);
+// 加载原生模块、预热上游连接都在开始监听之后进行
+readinessService.track('sharp', listening.then(() => cacheService.preloadSharp()));
+readinessService.track('adobe', listening.then(() => pdfService.warmup()), { required: false });
+readinessService.track('upstream', listening.then(() => aiService.warmup()), { required: false });
+
+listening.then(() => {
+  logger.info(`🚀 AI Image Generator running on http://localhost:${PORT}`, { port: Number(PORT) });
+  logger.info(`📁 Cache directory: ${process.env.CACHE_DIR || './cache'}`);
+  logger.info(`📁 Upload directory: ${process.env.UPLOAD_DIR || './uploads'}`);
+  logger.info(`🔑 API Key configured: ${process.env.AIHUBMIX_API_KEY ? 'Yes' : 'No'}`);
 });
\ No newline at end of file
@@ -1,93 +1,717 @@
-const axios = require('axios');
+const httpClient = require('./httpClient');
+const crypto = require('crypto');
 const { v4: uuidv4 } = require('uuid');
 const cacheService = require('./cacheService');
+const sectionService = require('./sectionService');
+const llmCacheService = require('./llmCacheService');
+const generationScheduler = require('./generationScheduler');
+const resilience = require('./resilience');
+const deadlineService = require('./deadline');
+const metricsService = require('./metricsService');
+const tracingService = require('./tracingService');
+const logger = require('./logger');
+
+const ANALYSIS_SYSTEM_PROMPT = `你是一个专业学术科研助手。请分析论文正文，输出以下4个部分，每个部分之间严格用 "###" 分隔，内容不要包含编号：
+Summary: 详细学术摘要(200-400字)。
+Prompt: 一段高质量英文生图指令(Subject + Style + Rendering)。
+Authors: 作者列表，仅逗号分隔。
+Keywords: 5个核心关键词，仅逗号分隔。`;
+
+const ANALYSIS_MODEL = "deepseek-chat";
+const ANALYSIS_TEMPERATURE = 0.7;
+
+// 分析失败时的兜底输出
+const ANALYSIS_FALLBACK = "Summary: 失败###Prompt: A futuristic sci-fi lab###Authors: Unkown###Keywords: Error";
+
+// 分析输出各段的顺序与标签（以 "###" 分隔）
+const ANALYSIS_SECTIONS = ['summary', 'prompt', 'authors', 'keywords'];
+const ANALYSIS_LABELS = ['Summary:', 'Prompt:', 'Authors:', 'Keywords:'];
+
+const MAP_SYSTEM_PROMPT = `你是一个专业学术科研助手。下面是一篇论文的部分章节，请提炼要点(不超过300字)：研究问题、方法、关键数值结果和结论。只依据原文，不要编造。`;
+
+// 送给分析模型的 token 预算（估算值）
+const ANALYSIS_TOKEN_BUDGET = parseInt(process.env.ANALYSIS_TOKEN_BUDGET, 10) || 12000;
+const ANALYSIS_FRONT_TOKENS = 1500;
+const ANALYSIS_CHUNK_TOKENS = parseInt(process.env.ANALYSIS_CHUNK_TOKENS, 10) || 6000;
+const ANALYSIS_MAX_CHUNKS = parseInt(process.env.ANALYSIS_MAX_CHUNKS, 10) || 8;
+const ANALYSIS_MAP_CONCURRENCY = parseInt(process.env.ANALYSIS_MAP_CONCURRENCY, 10) || 4;
+
+// 提示词版本：模板或选段参数变化时自动变化，旧缓存随之失效
+const ANALYSIS_PROMPT_VERSION = crypto
+  .createHash('sha256')
+  .update(JSON.stringify([
+    ANALYSIS_SYSTEM_PROMPT, MAP_SYSTEM_PROMPT,
+    ANALYSIS_TOKEN_BUDGET, ANALYSIS_FRONT_TOKENS, ANALYSIS_CHUNK_TOKENS, ANALYSIS_MAX_CHUNKS
+  ]))
+  .digest('hex')
+  .substring(0, 12);
+
+// 生图候选数量：默认值与单次请求上限
+const GENERATION_CANDIDATES = parseInt(process.env.GENERATION_CANDIDATES, 10) || 4;
+const GENERATION_MAX_CANDIDATES = parseInt(process.env.GENERATION_MAX_CANDIDATES, 10) || 8;
+// IMAGE 只要图片，上游不必生成会被丢弃的文本；TEXT_AND_IMAGE 为原先的图文混合输出
+const GENERATION_MODALITIES = ['IMAGE', 'TEXT_AND_IMAGE'];
+const GENERATION_MODALITY = GENERATION_MODALITIES.includes(process.env.GENERATION_MODALITY)
+  ? process.env.GENERATION_MODALITY
+  : 'IMAGE';
+
+// 对冲请求：先少发几个任务，某个任务出图慢于历史 P(x) 或失败时再补发，凑够数量后取消其余任务
+const GENERATION_HEDGE = process.env.GENERATION_HEDGE === 'true';
+const GENERATION_HEDGE_PERCENTILE = parseFloat(process.env.GENERATION_HEDGE_PERCENTILE) || 95;
+// 一开始少发的任务数（至少发 1 个）；0 表示一开始就发满 candidates 个，对冲只追加
+const GENERATION_HEDGE_HOLDBACK = process.env.GENERATION_HEDGE_HOLDBACK === undefined ? 1 : parseInt(process.env.GENERATION_HEDGE_HOLDBACK, 10);
+// 每个会话最多比 candidates 多发的任务数
+const GENERATION_HEDGE_MAX_EXTRA = parseInt(process.env.GENERATION_HEDGE_MAX_EXTRA, 10) || 2;
+// 样本不足时的对冲阈值
+const GENERATION_HEDGE_DEFAULT_MS = parseInt(process.env.GENERATION_HEDGE_DEFAULT_MS, 10) || 45000;
+const GENERATION_HEDGE_MIN_SAMPLES = 10;
+const GENERATION_LATENCY_WINDOW = 200;
 
 class AIService {
   constructor() {
+    // 最近若干次任务的出图耗时（ms），用于计算对冲阈值
+    this.imageLatencies = [];
+    // callsHeldBack：一开始少发、最后也没用上的任务数（前面的任务已凑够图片）
+    this.hedgeStats = { hedgedSessions: 0, hedgesLaunched: 0, stragglersCancelled: 0, callsHeldBack: 0 };
+
     this.apiKey = process.env.AIHUBMIX_API_KEY;
     this.baseURL = 'https://aihubmix.com/gemini/v1beta/models/gemini-3-pro-image-preview:streamGenerateContent';
     this.llmBaseURL = 'https://api.aihubmix.com/v1';
     
     if (!this.apiKey) {
-      console.warn('⚠️ AIHUBMIX_API_KEY not set. AI features will not work.');
+      logger.warn('⚠️ AIHUBMIX_API_KEY not set. AI features will not work.');
+    }
+  }
+
+  // Phase 1: 文本分析
+  async generateAcademicPrompt(paper, { deadline = deadlineService.none() } = {}) {
+    logger.info("🚀 [Phase 1] AI 学术分析开始...");
+    if (!this.apiKey) throw new Error('API Key missing');
+
+    const cacheKey = this.analysisCacheKey(paper);
+    const cached = await llmCacheService.get(cacheKey);
+    if (cached) {
+        logger.info("♻️ [Phase 1] 命中分析缓存");
+        tracingService.current()?.addEvent('analysis_cache_hit');
+        return cached;
+    }
+
+    try {
+        const { content: paperContent, partial } = await this.prepareAnalysisInput(paper, { deadline });
+        const content = await this.chatCompletion([
+            { role: "system", content: ANALYSIS_SYSTEM_PROMPT },
+            { role: "user", content: `论文内容：${paperContent}` }
+        ], { temperature: ANALYSIS_TEMPERATURE, deadline });
+        // 有分块摘要失败时结果只基于部分正文，不按全文缓存
+        if (!partial) await this.cacheAnalysis(cacheKey, content);
+        return content;
+    } catch (error) {
+        if (error.code === 'DEADLINE_EXCEEDED') throw error;
+        logger.error("❌ [Phase 1] 失败", error);
+        return ANALYSIS_FALLBACK;
     }
   }
 
-  // Phase 1: 文本分析 (保持不变)
-  async generateAcademicPrompt(paperText) {
-    console.log("🚀 [Phase 1] AI 学术分析开始...");
+  /**
+   * 流式文本分析：边接收边按 "###" 切段
+   * onEvent 收到 { type: 'section-delta', section, content } 和段落结束时的
+   * { type: 'section', section, content }，返回完整原始输出
+   */
+  async streamAcademicAnalysis(paper, onEvent, { signal, deadline = deadlineService.none() } = {}) {
+    logger.info("🚀 [Phase 1] AI 学术分析开始 (流式)...");
     if (!this.apiKey) throw new Error('API Key missing');
 
+    const parser = this.createSectionParser(onEvent);
+    let raw = '';
+    let endLlm = null;
+    let span = null;
+    let partial = false;
+
+    const cacheKey = this.analysisCacheKey(paper);
+    const cached = await llmCacheService.get(cacheKey);
+    if (cached) {
+        logger.info("♻️ [Phase 1] 命中分析缓存");
+        tracingService.current()?.addEvent('analysis_cache_hit');
+        parser.push(cached);
+        parser.end();
+        return cached;
+    }
+
     try {
-        const response = await axios.post(`${this.llmBaseURL}/chat/completions`, {
-            model: "deepseek-chat", 
+        const input = await this.prepareAnalysisInput(paper, { signal, deadline });
+        const paperContent = input.content;
+        partial = input.partial;
+        deadline.check('analysis');
+        endLlm = metricsService.llm.startTimer({ mode: 'stream' });
+        span = tracingService.startSpan('llm.stream', { model: ANALYSIS_MODEL });
+        // 重试只覆盖建立流之前的失败，已开始输出后不再重发
+        const response = await tracingService.run(span, () => resilience.execute('llm', () => httpClient.post(`${this.llmBaseURL}/chat/completions`, {
+            model: ANALYSIS_MODEL,
             messages: [
-                { 
-                    role: "system", 
-                    content: `你是一个专业学术科研助手。请分析论文正文，输出以下4个部分，每个部分之间严格用 "###" 分隔，内容不要包含编号：
-Summary: 详细学术摘要(200-400字)。
-Prompt: 一段高质量英文生图指令(Subject + Style + Rendering)。
-Authors: 作者列表，仅逗号分隔。
-Keywords: 5个核心关键词，仅逗号分隔。` 
-                },
-                { role: "user", content: `论文内容：${paperText.substring(0, 50000)}` }
+                { role: "system", content: ANALYSIS_SYSTEM_PROMPT },
+                { role: "user", content: `论文内容：${paperContent}` }
             ],
-            temperature: 0.7
+            temperature: ANALYSIS_TEMPERATURE,
+            stream: true
         }, {
             headers: { 'Authorization': `Bearer ${this.apiKey}` },
-            timeout: 60000 
+            responseType: 'stream',
+            timeout: deadline.timeout(60000),
+            signal
+        }), { signal, deadline }));
+
+        await new Promise((resolve, reject) => {
+            if (signal) {
+                signal.addEventListener('abort', () => {
+                    response.data.destroy();
+                    reject(new Error('分析请求已取消'));
+                }, { once: true });
+            }
+            let buffer = '';
+            response.data.setEncoding('utf8');
+            // 绑定到调用方的上下文：分段回调里启动的生图要挂在本次请求的链路下，而不是复用连接的上下文
+            response.data.on('data', tracingService.bind((chunk) => {
+                if (!raw) span.addEvent('first_byte');
+                buffer += chunk;
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+
+                for (const line of lines) {
+                    const trimmed = line.trim();
+                    if (!trimmed.startsWith('data:')) continue;
+                    const payload = trimmed.slice(5).trim();
+                    if (payload === '[DONE]') continue;
+                    try {
+                        const delta = JSON.parse(payload).choices?.[0]?.delta?.content;
+                        if (delta) {
+                            raw += delta;
+                            parser.push(delta);
+                        }
+                    } catch (e) {
+                        // 忽略不完整或非 JSON 的行
+                    }
+                }
+            }));
+            response.data.on('end', resolve);
+            response.data.on('error', reject);
         });
-        return response.data.choices[0].message.content.trim();
+        endLlm({ outcome: 'ok' });
+        span.end({ chars: raw.length });
+        if (!partial) await this.cacheAnalysis(cacheKey, raw.trim());
     } catch (error) {
-        console.error("❌ [Phase 1] 失败:", error.message);
-        return "Summary: 失败###Prompt: A futuristic sci-fi lab###Authors: Unkown###Keywords: Error";
+        if (endLlm) endLlm({ outcome: signal?.aborted ? 'cancelled' : 'error' });
+        span?.fail(error).end({ chars: raw.length });
+        // 客户端已断开或超过截止时间：不缓存、不兜底，直接结束
+        if (signal?.aborted || error.code === 'DEADLINE_EXCEEDED') throw error;
+        logger.error("❌ [Phase 1] 流式分析失败", error);
+        if (!raw) {
+            raw = ANALYSIS_FALLBACK;
+            parser.push(raw);
+        }
     }
+
+    parser.end();
+    return raw.trim();
+  }
+
+  /**
+   * 分析缓存键：基于全文（而非选段结果），不必先跑 map 阶段就能查缓存
+   */
+  analysisCacheKey(paper) {
+    let text = typeof paper === 'string' ? paper : (paper.text || '');
+    if (typeof paper === 'object' && paper.elements?.length) {
+        text = paper.elements.filter(el => el.text).map(el => el.text).join('\n');
+    }
+    return llmCacheService.makeKey({
+        text,
+        model: ANALYSIS_MODEL,
+        temperature: ANALYSIS_TEMPERATURE,
+        promptVersion: ANALYSIS_PROMPT_VERSION
+    });
+  }
+
+  /**
+   * 只缓存格式完整的成功响应；兜底输出不经过这里
+   */
+  async cacheAnalysis(cacheKey, content) {
+    if (!content || !this.parseAnalysis(content).prompt) return;
+    await llmCacheService.set(cacheKey, content, {
+        model: ANALYSIS_MODEL,
+        temperature: ANALYSIS_TEMPERATURE,
+        promptVersion: ANALYSIS_PROMPT_VERSION
+    });
+  }
+
+  /**
+   * 增量解析 "###" 分段输出；"###" 可能被拆在两个 chunk 之间，末尾的 '#' 先暂存
+   */
+  createSectionParser(onEvent) {
+    let index = 0;
+    let pending = '';
+    let content = '';
+    let emitted = 0;
+
+    const sectionName = () => ANALYSIS_SECTIONS[index] || `extra${index}`;
+
+    // 去掉段首标签；标签还没收全时返回 null 等待更多数据
+    const cleanContent = (final) => {
+        const label = ANALYSIS_LABELS[index];
+        const trimmed = content.trimStart();
+        if (!final && label && trimmed.length < label.length &&
+            label.toLowerCase().startsWith(trimmed.toLowerCase())) {
+            return null;
+        }
+        const stripped = label
+            ? trimmed.replace(new RegExp(`^${label}\\s*`, 'i'), '')
+            : trimmed;
+        return stripped;
+    };
+
+    const emitDelta = (final) => {
+        const clean = cleanContent(final);
+        if (clean === null || clean.length <= emitted) return;
+        onEvent({ type: 'section-delta', section: sectionName(), content: clean.slice(emitted) });
+        emitted = clean.length;
+    };
+
+    const closeSection = () => {
+        emitDelta(true);
+        onEvent({ type: 'section', section: sectionName(), content: (cleanContent(true) || '').trim() });
+        index++;
+        content = '';
+        emitted = 0;
+    };
+
+    return {
+        push: (text) => {
+            pending += text;
+            let separator = pending.indexOf('###');
+            while (separator !== -1) {
+                content += pending.slice(0, separator);
+                closeSection();
+                pending = pending.slice(separator + 3);
+                separator = pending.indexOf('###');
+            }
+            let hold = 0;
+            while (hold < 2 && pending[pending.length - 1 - hold] === '#') hold++;
+            content += pending.slice(0, pending.length - hold);
+            pending = pending.slice(pending.length - hold);
+            emitDelta(false);
+        },
+        end: () => {
+            content += pending;
+            pending = '';
+            if (content.trim() || index === 0) closeSection();
+        }
+    };
+  }
+
+  /**
+   * 把分析输出解析为 { summary, prompt, authors, keywords }
+   */
+  parseAnalysis(raw) {
+    const result = { summary: '（未生成总结）', prompt: '', authors: [], keywords: [] };
+    const parts = (raw || '').split('###');
+
+    if (parts.length >= 2) {
+        result.summary = parts[0].replace(/Summary:/i, '').trim();
+        result.prompt = parts[1].replace(/Prompt:/i, '').trim();
+    }
+    if (parts.length >= 3) {
+        result.authors = this.splitList(parts[2].replace(/Authors:/i, '').trim());
+    }
+    if (parts.length >= 4) {
+        result.keywords = this.splitList(parts[3].replace(/Keywords:/i, '').trim());
+    }
+    return result;
+  }
+
+  splitList(str) {
+    return (str || '').split(/,|，/).map(s => s.trim()).filter(s => s);
+  }
+
+  /**
+   * 构建送给 LLM 的论文内容
+   * paper: 纯文本，或 { elements, text }（elements 来自 processExtractResult）
+   * 高价值章节在预算内直接发送；超出预算时分块并发摘要后再归并
+   * 返回 { content, partial }：partial 为 true 表示有分块摘要失败，内容只覆盖部分正文，结果不能按全文缓存
+   */
+  async prepareAnalysisInput(paper, { signal, deadline = deadlineService.none() } = {}) {
+    const text = typeof paper === 'string' ? paper : (paper.text || '');
+    let index = typeof paper === 'object' && paper.elements?.length
+        ? sectionService.buildSectionIndex(paper.elements)
+        : null;
+    if (!index || index.usefulTokens < 50) {
+        index = sectionService.buildSectionIndexFromText(text);
+    }
+
+    if (index.usefulTokens <= ANALYSIS_TOKEN_BUDGET) {
+        return { content: sectionService.renderSections(sectionService.selectSections(index, ANALYSIS_TOKEN_BUDGET)), partial: false };
+    }
+
+    // 长论文：标题/作者段原样保留，正文按章节优先级取够 map 预算后分块
+    let frontSections = index.sections.filter(s => s.kind === 'front');
+    let bodySections = index.sections.filter(s => s.kind !== 'front');
+    if (!bodySections.some(s => !s.skip) && frontSections.length) {
+        // 识别不出章节标题时全文都在前置部分：开头 ANALYSIS_FRONT_TOKENS 作为前置部分，其余作为正文分块
+        const { head, rest } = sectionService.splitSection(frontSections[0], ANALYSIS_FRONT_TOKENS);
+        frontSections = [head];
+        bodySections = rest ? [rest] : [];
+    }
+    const front = sectionService.selectSections({ sections: frontSections }, ANALYSIS_FRONT_TOKENS);
+    const body = sectionService.selectSections({ sections: bodySections }, ANALYSIS_CHUNK_TOKENS * ANALYSIS_MAX_CHUNKS);
+    const chunks = sectionService.chunkSections(body, ANALYSIS_CHUNK_TOKENS);
+    logger.info(`🧩 [Phase 1] 长论文 (~${index.usefulTokens} tokens)，分 ${chunks.length} 块并发摘要`, { tokens: index.usefulTokens, chunks: chunks.length });
+
+    const notes = await tracingService.withSpan('llm.map', { chunks: chunks.length, tokens: index.usefulTokens }, () =>
+        this.mapWithConcurrency(chunks, ANALYSIS_MAP_CONCURRENCY, (chunk) =>
+            this.chatCompletion([
+                { role: "system", content: MAP_SYSTEM_PROMPT },
+                { role: "user", content: chunk }
+            ], { temperature: 0.3, maxTokens: 800, signal, deadline })
+        )
+    );
+    const validNotes = notes.filter(Boolean);
+    if (validNotes.length === 0) throw new Error('所有分块摘要均失败');
+    const partial = validNotes.length < notes.length;
+    if (partial) logger.warn(`⚠️ [Phase 1] ${notes.length - validNotes.length}/${notes.length} 块摘要失败，本次分析结果不缓存`);
+
+    return {
+        content: [
+            sectionService.renderSections(front),
+            ...validNotes.map((note, i) => `## 要点 ${i + 1}\n${note}`)
+        ].join('\n\n'),
+        partial
+    };
+  }
+
+  /**
+   * 限制并发地处理数组，单项失败返回 null
+   */
+  async mapWithConcurrency(items, concurrency, fn) {
+    const results = new Array(items.length).fill(null);
+    let next = 0;
+    const worker = async () => {
+        while (next < items.length) {
+            const i = next++;
+            try {
+                results[i] = await fn(items[i], i);
+            } catch (error) {
+                logger.error(`❌ 分块 ${i} 失败`, { chunk: i, error });
+            }
+        }
+    };
+    await Promise.all(Array.from({ length: Math.min(concurrency, items.length) }, worker));
+    return results;
+  }
+
+  async chatCompletion(messages, { temperature = 0.7, maxTokens, signal, deadline = deadlineService.none() } = {}) {
+    deadline.check('llm');
+    const endLlm = metricsService.llm.startTimer({ mode: 'complete' });
+    return tracingService.withSpan('llm.chat', { model: ANALYSIS_MODEL }, async () => {
+        try {
+            const response = await resilience.execute('llm', () => httpClient.post(`${this.llmBaseURL}/chat/completions`, {
+                model: ANALYSIS_MODEL,
+                messages,
+                temperature,
+                ...(maxTokens ? { max_tokens: maxTokens } : {})
+            }, {
+                headers: { 'Authorization': `Bearer ${this.apiKey}` },
+                timeout: deadline.timeout(60000),
+                signal
+            }), { signal, deadline });
+            endLlm({ outcome: 'ok' });
+            return response.data.choices[0].message.content.trim();
+        } catch (error) {
+            endLlm({ outcome: signal?.aborted ? 'cancelled' : 'error' });
+            throw error;
+        }
+    });
+  }
+
+  /**
+   * 规范化生图参数：{ candidates, modality, hedge }，可直接传入请求体
+   */
+  generationOptions({ candidates, modality, hedge } = {}) {
+    const count = parseInt(candidates, 10);
+    return {
+      candidates: Math.min(GENERATION_MAX_CANDIDATES, Math.max(1, Number.isNaN(count) ? GENERATION_CANDIDATES : count)),
+      modality: GENERATION_MODALITIES.includes(modality) ? modality : GENERATION_MODALITY,
+      hedge: hedge === undefined || hedge === null ? GENERATION_HEDGE : (hedge === true || hedge === 'true')
+    };
+  }
+
+  recordImageLatency(ms) {
+    this.imageLatencies.push(ms);
+    if (this.imageLatencies.length > GENERATION_LATENCY_WINDOW) this.imageLatencies.shift();
+  }
+
+  /**
+   * 最近出图耗时的第 p 百分位；样本不足时返回 fallbackMs
+   */
+  imageLatencyPercentile(p, fallbackMs) {
+    if (this.imageLatencies.length < GENERATION_HEDGE_MIN_SAMPLES) return fallbackMs;
+    const sorted = [...this.imageLatencies].sort((a, b) => a - b);
+    const index = Math.min(sorted.length - 1, Math.ceil(sorted.length * p / 100) - 1);
+    return sorted[Math.max(0, index)];
+  }
+
+  /**
+   * 对冲阈值：最近出图耗时的 P(GENERATION_HEDGE_PERCENTILE)
+   */
+  hedgeThresholdMs() {
+    return this.imageLatencyPercentile(GENERATION_HEDGE_PERCENTILE, GENERATION_HEDGE_DEFAULT_MS);
+  }
+
+  getGenerationStats() {
+    return {
+      defaultCandidates: GENERATION_CANDIDATES,
+      maxCandidates: GENERATION_MAX_CANDIDATES,
+      modality: GENERATION_MODALITY,
+      hedge: GENERATION_HEDGE,
+      hedgePercentile: GENERATION_HEDGE_PERCENTILE,
+      hedgeHoldback: GENERATION_HEDGE_HOLDBACK,
+      hedgeThresholdMs: Math.round(this.hedgeThresholdMs()),
+      latencySamples: this.imageLatencies.length,
+      ...this.hedgeStats
+    };
+  }
+
+  /**
+   * 启动后预热到生图和分析上游的 keep-alive 连接，第一个用户请求不用再做 TLS 握手
+   */
+  async warmup() {
+    if (!this.apiKey) throw new Error('未配置 AIHUBMIX_API_KEY');
+    await Promise.all([httpClient.warm(this.baseURL), httpClient.warm(this.llmBaseURL)]);
   }
 
   // Phase 2: 核心工作流
-async generateFromPaper(paperText, onChunk) {
-    // 拦截器：只允许图片和错误流出，绝对屏蔽文本
+  // options: { clientId, priority, signal, deadline, candidates, modality, hedge, paper, generation }
+async generateFromPaper(paperText, onChunk, options = {}) {
+    // paper: 所属论文 id，generation: 生图任务 id，写进缓存索引供缓存列表筛选和打包导出
+    const { clientId, priority, signal, paper, generation, deadline = deadlineService.none() } = options;
+    const { candidates, modality, hedge } = this.generationOptions(options);
+    // 整个会话一个 span，每个并行任务（含对冲追加的）各一个子 span
+    const session = tracingService.startSpan('generation.session', { candidates, modality, hedge });
+    // 取消时按"预计占用时长 - 已运行时长"估算省下的上游时间
+    const expectedMs = generationScheduler.avgHoldMs;
+    let upstreamMsSaved = 0;
+
+    // 会话内部的中止信号：客户端断开，或对冲模式已凑够图片时取消剩余任务
+    const controller = new AbortController();
+    const onClientAbort = () => controller.abort();
+    if (signal) {
+        if (signal.aborted) controller.abort();
+        else signal.addEventListener('abort', onClientAbort, { once: true });
+    }
+    const sessionSignal = controller.signal;
+
+    const allKeys = [];
+    // 拦截器：只允许图片、错误和排队状态流出，绝对屏蔽文本
     const wrappedOnChunk = (chunk) => {
-        if (chunk.type === 'image' || chunk.type === 'error') {
+        if (chunk.type === 'image') {
+            // 对冲模式下多出来的图片不再推送
+            if (hedge && allKeys.length >= candidates) return;
+            allKeys.push(chunk.key);
+            onChunk(chunk);
+            if (hedge && allKeys.length >= candidates) controller.abort();
+        } else if (chunk.type === 'error' || chunk.type === 'queue') {
             onChunk(chunk);
         }
     };
 
-    // 并发启动 4 个生成任务
-    const tasks = Array(4).fill(0).map((_, i) => 
-        this.streamGenerateContent({
-            prompt: paperText, // 这里的 paperText 是 Stage 1 生成的精炼 Prompt
-            modality: 'TEXT_AND_IMAGE',
-            aspectRatio: '1:1',
-            imageSize: '1k'
-        }, wrappedOnChunk).catch(err => {
-            console.error(`Task ${i} 失败:`, err.message);
+    // 各任务的排队状态，汇总成一个 queue 事件
+    const queueState = new Map();
+    const reportQueue = () => {
+        const waiting = [...queueState.values()];
+        wrappedOnChunk({
+            type: 'queue',
+            waiting: waiting.length,
+            position: waiting.length ? Math.min(...waiting.map(s => s.position)) : 0,
+            etaMs: waiting.length ? Math.min(...waiting.map(s => s.etaMs)) : 0
+        });
+    };
+
+    // 剩余时间不够一次典型出图（P50）时不再发起新任务
+    const minImageMs = this.imageLatencyPercentile(50, 0);
+    let deadlineReported = false;
+
+    // 每个任务先向全局调度器申请槽位，再发起上游流式请求
+    const running = new Map();
+    let stopTopUp = false;
+    // 所有已发出任务的状态：index -> { startedAt, gotImage, hedged, done }
+    const states = new Map();
+    const runTask = (i, state) => tracingService.run(session, () => tracingService.withSpan('generation.task', { index: i, extra: i >= candidates }, async (taskSpan) => {
+        let release;
+        try {
+            release = await tracingService.withSpan('generation.queue', { priority }, () => generationScheduler.acquire({
+                clientId,
+                priority,
+                signal: sessionSignal,
+                onQueue: (queued) => {
+                    queueState.set(i, queued);
+                    reportQueue();
+                }
+            }));
+            if (queueState.delete(i)) reportQueue();
+            deadline.check('image', minImageMs);
+            state.startedAt = Date.now();
+            running.set(i, state);
+            return await this.streamGenerateContent({
+                prompt: paperText, // 这里的 paperText 是 Stage 1 生成的精炼 Prompt
+                modality,
+                aspectRatio: '1:1',
+                imageSize: '1k',
+                paper,
+                generation,
+                deadline
+            }, (chunk) => {
+                if (chunk.type === 'image' && !state.gotImage) {
+                    state.gotImage = true;
+                    this.recordImageLatency(Date.now() - state.startedAt);
+                }
+                wrappedOnChunk(chunk);
+            }, sessionSignal);
+        } catch (err) {
+            if (sessionSignal.aborted) taskSpan.setAttributes({ cancelled: true });
+            else taskSpan.fail(err);
+            if (signal?.aborted) {
+                upstreamMsSaved += Math.max(0, expectedMs - (state.startedAt ? Date.now() - state.startedAt : 0));
+                return { success: false, cancelled: true };
+            }
+            if (sessionSignal.aborted) {
+                // 对冲已凑够数量，剩余任务作为掉队者取消
+                if (!state.gotImage) this.hedgeStats.stragglersCancelled++;
+                return { success: false, cancelled: true };
+            }
+            if (err.code === 'DEADLINE_EXCEEDED') {
+                // 同一会话只提示一次
+                if (!deadlineReported) wrappedOnChunk({ type: 'error', error: '剩余时间不足，已停止生成更多候选图' });
+                deadlineReported = true;
+                stopTopUp = true;
+                return { success: false };
+            }
+            logger.error(`❌ [Phase 2] Task ${i} 失败`, { task: i, error: err });
+            if (err.code === 'QUEUE_FULL' || err.code === 'CIRCUIT_OPEN') {
+                wrappedOnChunk({ type: 'error', error: err.message });
+                // 排队已满或熔断时补发也会失败，不再补
+                stopTopUp = true;
+            }
             return { success: false };
-        })
-    );
+        } finally {
+            running.delete(i);
+            state.done = true;
+            // 已出图的任务计入平均占用时长；中途取消或未真正开始的不计
+            if (release) release({ cancelled: !state.startedAt || (sessionSignal.aborted && !state.gotImage) });
+            taskSpan.setAttributes({ gotImage: state.gotImage });
+            // 先释放槽位再补发，补发的任务可以直接用上这个槽位
+            if (hedge) topUp(`任务 ${i} 结束`);
+        }
+    }));
+
+    const tasks = [];
+    // 对冲模式先发 candidates - GENERATION_HEDGE_HOLDBACK 个，整个会话最多发 candidates + GENERATION_HEDGE_MAX_EXTRA 个
+    const initial = hedge ? Math.max(1, candidates - GENERATION_HEDGE_HOLDBACK) : candidates;
+    const maxTasks = hedge ? candidates + GENERATION_HEDGE_MAX_EXTRA : candidates;
+    const launch = () => {
+        if (sessionSignal.aborted || allKeys.length >= candidates || states.size >= maxTasks) return false;
+        const i = states.size;
+        const state = { startedAt: null, gotImage: false, hedged: false, done: false };
+        states.set(i, state);
+        tasks.push(runTask(i, state));
+        return true;
+    };
+    // 补发：已出的图加上还有希望出图的任务（未出图、未结束、没被判定为慢）不够 candidates 时补上差额
+    // 一开始少发的任务在这里发出：前面的任务出图后结束、某个任务失败，或者慢于阈值时
+    const topUp = (reason) => {
+        if (stopTopUp) return;
+        let hopeful = 0;
+        for (const state of states.values()) if (!state.done && !state.gotImage && !state.hedged) hopeful++;
+        while (allKeys.length + hopeful < candidates && launch()) {
+            hopeful++;
+            // 只有超出 candidates 的才算额外花费的对冲请求
+            if (states.size > candidates) {
+                this.hedgeStats.hedgesLaunched++;
+                if (states.size === candidates + 1) this.hedgeStats.hedgedSessions++;
+            }
+            logger.info(`🪁 [Phase 2] 补发任务 #${states.size - 1}: ${reason}`, { tasks: states.size, images: allKeys.length });
+        }
+    };
+
+    for (let i = 0; i < initial; i++) launch();
 
-    const results = await Promise.all(tasks);
-    const allKeys = results.flatMap(r => r.cacheKeys || []);
+    // 对冲：仍在排队时不补发；运行中的任务超过阈值还没出图，就不再指望它，按差额补发
+    let hedgeTimer = null;
+    if (hedge) {
+        const threshold = this.hedgeThresholdMs();
+        hedgeTimer = setInterval(() => {
+            if (queueState.size > 0) return;
+            for (const [i, state] of running) {
+                if (!state.gotImage && !state.hedged && Date.now() - state.startedAt > threshold) {
+                    state.hedged = true;
+                    topUp(`任务 ${i} 超过 P${GENERATION_HEDGE_PERCENTILE} (${Math.round(threshold)}ms) 仍未出图`);
+                }
+            }
+        }, Math.min(1000, threshold));
+        hedgeTimer.unref();
+    }
+
+    // 对冲任务可能在等待期间追加，直到没有新任务为止
+    let settled = 0;
+    while (settled < tasks.length) {
+        const count = tasks.length;
+        await Promise.all(tasks.slice(settled, count));
+        settled = count;
+    }
+    clearInterval(hedgeTimer);
+    if (signal) signal.removeEventListener('abort', onClientAbort);
+    if (hedge && states.size < candidates) this.hedgeStats.callsHeldBack += candidates - states.size;
+    session.end({ images: allKeys.length, tasks: states.size, extras: Math.max(0, states.size - candidates), cancelled: Boolean(signal?.aborted) });
+
+    if (signal?.aborted) {
+        generationScheduler.recordCancellation(upstreamMsSaved);
+        logger.info(`🛑 [Phase 2] 生图已取消，约节省 ${(upstreamMsSaved / 1000).toFixed(1)}s 上游时间`, { upstreamMsSaved });
+        return { success: false, cancelled: true, cacheKeys: allKeys, upstreamMsSaved };
+    }
     return { success: true, cacheKeys: allKeys };
 }
 
   // Phase 3: 底层流式生成 (关键修复区域)
-  async streamGenerateContent(options, onChunk) {
+  // signal 中止时断开上游连接、丢弃未解析的 buffer，不再保存后续图片
+  streamGenerateContent(options, onChunk, signal) {
+    return tracingService.withSpan('image.stream', { modality: options.modality }, (span) => this.streamImage(options, onChunk, signal, span));
+  }
+
+  async streamImage(options, onChunk, signal, span) {
     if (!this.apiKey) throw new Error('API Key Config Missing');
 
-    const { prompt, modality, aspectRatio, imageSize } = options;
+    const { prompt, modality, aspectRatio, imageSize, paper, generation, deadline = deadlineService.none() } = options;
+    const meta = { kind: 'generated', paper, generation };
 
     const requestBody = {
       contents: [{ role: 'user', parts: [{ text: prompt }] }],
       generationConfig: {
-        responseModalities: ['TEXT', 'IMAGE'],
+        responseModalities: modality === 'IMAGE' ? ['IMAGE'] : ['TEXT', 'IMAGE'],
         imageConfig: { aspectRatio, imageSize }
       }
     };
 
+    // 总耗时从发起请求算起（含重试），到流结束、图片全部保存为止
+    const endImage = metricsService.imageTotal.startTimer();
+    const endTtfb = metricsService.imageTtfb.startTimer();
+    let firstByte = true;
+    let finished = false;
+    const finish = (outcome) => {
+      if (finished) return;
+      finished = true;
+      endImage({ outcome: signal?.aborted ? 'cancelled' : outcome });
+      span.setAttributes({ outcome: signal?.aborted ? 'cancelled' : outcome });
+    };
+
     try {
-      console.log("🎨 [Phase 2] 发起生图请求...");
-      const response = await axios({
+      logger.debug("🎨 [Phase 2] 发起生图请求...");
+      // 重试只覆盖建立流之前的失败（连接错误、429/5xx），熔断时直接失败
+      const response = await resilience.execute('image', () => httpClient.request({
         method: 'POST',
         url: this.baseURL,
         headers: {
@@ -97,8 +721,9 @@ async generateFromPaper(paperText, onChunk) {
         },
         data: requestBody,
         responseType: 'stream',
-        timeout: 300000 
-      });
+        timeout: deadline.timeout(300000),
+        signal
+      }), { signal, deadline });
 
       return new Promise((resolve, reject) => {
         let buffer = '';
@@ -109,25 +734,45 @@ async generateFromPaper(paperText, onChunk) {
         // 💡 关键修复：任务队列，用于追踪所有未完成的异步操作（如保存图片）
         const pendingTasks = [];
 
-        response.data.on('data', (chunk) => {
+        const onAbort = () => {
+          buffer = '';
+          response.data.destroy();
+          finish('cancelled');
+          reject(new Error('生图请求已取消'));
+        };
+        if (signal) signal.addEventListener('abort', onAbort, { once: true });
+        const cleanup = () => {
+          if (signal) signal.removeEventListener('abort', onAbort);
+        };
+
+        // 处理函数绑定到本 span：连接池里的 socket 带着建立它的那次请求的上下文
+        response.data.on('data', tracingService.bind((chunk) => {
+          if (firstByte) {
+            firstByte = false;
+            endTtfb();
+            span.addEvent('first_byte');
+          }
+          if (signal?.aborted) return;
           chunkCount++;
           buffer += chunk.toString();
           
           // 传递 pendingTasks 数组进去，让内部把异步任务推入队列
-          const processed = this.processStreamBuffer(buffer, onChunk, cacheKeys, pendingTasks);
+          const processed = this.processStreamBuffer(buffer, onChunk, cacheKeys, pendingTasks, signal, meta);
           
           if (processed.text) {
             responseText += processed.text;
             onChunk({ type: 'text', content: processed.text });
           }
           buffer = processed.remainingBuffer;
-        });
+        }));
 
-        response.data.on('end', async () => {
+        response.data.on('end', tracingService.bind(async () => {
+          cleanup();
+          if (signal?.aborted) return;
           try {
             // 处理残留 Buffer
             if (buffer.trim()) {
-              const processed = this.processStreamBuffer(buffer, onChunk, cacheKeys, pendingTasks);
+              const processed = this.processStreamBuffer(buffer, onChunk, cacheKeys, pendingTasks, signal, meta);
               if (processed.text) {
                  responseText += processed.text;
                  onChunk({ type: 'text', content: processed.text });
@@ -136,7 +781,7 @@ async generateFromPaper(paperText, onChunk) {
               const finalData = this.tryParseCompleteJSON(buffer);
               if (finalData) {
                  // 处理完整响应中的图片
-                 const task = this.processCompleteResponse(finalData, cacheKeys, onChunk);
+                 const task = this.processCompleteResponse(finalData, cacheKeys, onChunk, signal, meta);
                  pendingTasks.push(task);
               }
             }
@@ -144,32 +789,40 @@ async generateFromPaper(paperText, onChunk) {
             // 💡 关键等待：必须等待所有图片保存任务完成！
             // 之前的 Bug 就是因为没等这一步，直接 resolve 了，导致图片事件没发出去
             if (pendingTasks.length > 0) {
-                console.log(`⏳ 等待 ${pendingTasks.length} 个图片保存任务完成...`);
+                logger.debug(`⏳ 等待 ${pendingTasks.length} 个图片保存任务完成...`);
                 await Promise.all(pendingTasks);
-                console.log(`✅ 所有图片保存完毕`);
+                logger.debug(`✅ 所有图片保存完毕`);
             }
 
             // 发送完成信号
             onChunk({ type: 'completion', success: true, imageCount: cacheKeys.length });
+            finish('ok');
             resolve({ text: responseText, cacheKeys, success: true });
 
           } catch (error) {
+            finish('error');
             reject(new Error(`Final processing error: ${error.message}`));
           }
-        });
+        }));
 
-        response.data.on('error', (err) => reject(err));
+        response.data.on('error', (err) => {
+          cleanup();
+          finish('error');
+          reject(err);
+        });
       });
       
     } catch (error) {
-      if (error.response) console.error("API Error Data:", error.response.data);
+      finish('error');
+      // 流式请求的 response.data 是上游流，只记状态码
+      if (error.response) logger.error("❌ [Phase 2] 生图上游返回错误", error);
       throw error;
     }
   }
 
   // --- 辅助方法 (增加 pendingTasks 支持) ---
 
-  processStreamBuffer(buffer, onChunk, cacheKeys, pendingTasks) {
+  processStreamBuffer(buffer, onChunk, cacheKeys, pendingTasks, signal, meta) {
     let remainingBuffer = buffer;
     let extractedText = '';
     
@@ -199,12 +852,13 @@ async generateFromPaper(paperText, onChunk) {
           
           if (content.imageData) {
             // 💡 这是一个异步任务，把它推入队列
-            const task = this.handleImageData(content.imageData, cacheKeys)
+            const task = this.handleImageData(content.imageData, cacheKeys, signal, meta)
               .then(imageKey => {
-                console.log(`📸 图片保存成功 (Async): ${imageKey}`);
+                if (!imageKey) return;
+                logger.debug(`📸 图片保存成功 (Async): ${imageKey}`);
                 onChunk({ type: 'image', key: imageKey, timestamp: new Date().toISOString() });
               })
-              .catch(err => console.error("图片保存失败:", err));
+              .catch(err => logger.error("❌ 图片保存失败", err));
             
             if (pendingTasks) pendingTasks.push(task);
           }
@@ -239,7 +893,7 @@ async generateFromPaper(paperText, onChunk) {
     return result;
   }
 
-  async processCompleteResponse(data, cacheKeys, onChunk) {
+  async processCompleteResponse(data, cacheKeys, onChunk, signal, meta) {
     // 递归查找所有 inlineData
     const findImages = (obj) => {
         if (!obj) return [];
@@ -252,16 +906,20 @@ async generateFromPaper(paperText, onChunk) {
     const images = findImages(data);
     for (const img of images) {
         try {
-            const key = await this.handleImageData(img, cacheKeys);
-            onChunk({ type: 'image', key: key });
-        } catch (e) { console.error(e); }
+            const key = await this.handleImageData(img, cacheKeys, signal, meta);
+            if (key) onChunk({ type: 'image', key: key });
+        } catch (e) { logger.error("❌ 图片保存失败", e); }
     }
   }
 
-  async handleImageData(inlineData, cacheKeys) {
+  // 已取消的会话不再落盘和生成缩略图，返回 null；meta 为缓存索引里的来源信息
+  async handleImageData(inlineData, cacheKeys, signal, meta) {
+    if (signal?.aborted) return null;
+    const endDecode = metricsService.base64Decode.startTimer();
     const buffer = Buffer.from(inlineData.data, 'base64');
+    endDecode();
     const key = uuidv4();
-    await cacheService.saveImage(key, buffer, inlineData.mimeType);
+    await tracingService.withSpan('image.save', { bytes: buffer.length, mimeType: inlineData.mimeType }, () => cacheService.saveImage(key, buffer, inlineData.mimeType, meta));
     cacheKeys.push(key);
     return key;
   }
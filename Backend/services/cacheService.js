@@ -1,7 +1,59 @@
+const crypto = require('crypto');
 const fs = require('fs-extra');
 const path = require('path');
-const sharp = require('sharp');
+const clusterService = require('./clusterService');
+const metricsService = require('./metricsService');
+const logger = require('./logger');
+const { createStorage, contentTypeFor } = require('./storageService');
 
+// 索引快照：启动时直接加载，不再逐个 stat 缓存文件；之后的变化在后台与存储对账
+const CACHE_INDEX_SNAPSHOT = process.env.CACHE_INDEX_SNAPSHOT || 'index-snapshot.json';
+// 索引变化后延迟多久写快照，合并连续写入
+const CACHE_INDEX_SNAPSHOT_DELAY_MS = parseInt(process.env.CACHE_INDEX_SNAPSHOT_DELAY_MS, 10) || 5000;
+// 版本 2 起图片带 kind / paper，表格带大小和时间；版本 3 起条目带 blob（按内容存储）；版本 4 起图片带 generation
+// 旧版本的快照仍可加载，缺的字段留空
+const SNAPSHOT_VERSION = 4;
+// 缓存列表每页最多条数
+const CACHE_LIST_MAX_LIMIT = 1000;
+
+const IMAGE_EXTENSIONS = ['.png', '.jpg', '.gif', '.webp'];
+const LIST_KINDS = ['image', 'figure', 'generated', 'table'];
+const TABLE_EXTENSIONS = ['.csv', '.xlsx'];
+// 派生图（WebP / AVIF）的宽度档位和质量档位：请求参数就近取档，每张图的派生版本数量有上限
+const DERIVATIVE_WIDTHS = (process.env.IMAGE_DERIVATIVE_WIDTHS || '256,512,768,1024')
+  .split(',')
+  .map(width => parseInt(width, 10))
+  .filter(width => width > 0)
+  .sort((a, b) => a - b);
+const DERIVATIVE_QUALITIES = { low: 50, medium: 70, high: 85 };
+const DERIVATIVE_FORMATS = ['webp', 'avif'];
+// AVIF 编码很慢，默认用较低的 effort（0-9）
+const IMAGE_AVIF_EFFORT = parseInt(process.env.IMAGE_AVIF_EFFORT, 10) || 2;
+
+// 按内容存储的对象名：sha256 前 32 位十六进制
+const hashBuffer = (buffer) => crypto.createHash('sha256').update(buffer).digest('hex').slice(0, 32);
+
+// 分页顺序：先按创建时间，再按类型和 key，保证各工作进程给出同样的顺序，游标可以跨进程使用
+const compareListItems = (a, b) => (a.at - b.at) || (a.type < b.type ? -1 : a.type > b.type ? 1 : 0) || (a.key < b.key ? -1 : a.key > b.key ? 1 : 0);
+const encodeCursor = (item) => Buffer.from(JSON.stringify([item.at, item.type, item.key])).toString('base64url');
+const decodeCursor = (cursor) => {
+  try {
+    const [at, type, key] = JSON.parse(Buffer.from(cursor, 'base64url').toString('utf8'));
+    if (typeof at === 'number' && typeof type === 'string' && typeof key === 'string') return { at, type, key };
+  } catch {
+    // 落到下面统一报错
+  }
+  const error = new Error('无效的 cursor');
+  error.code = 'INVALID_CURSOR';
+  throw error;
+};
+
+// sharp 带原生库，加载要几百毫秒，第一次生成缩略图时（或启动后在后台）再加载
+let sharpModule = null;
+const sharp = (...args) => {
+  if (!sharpModule) sharpModule = require('sharp');
+  return sharpModule(...args);
+};
 
 class CacheService {
   constructor() {
@@ -9,41 +61,519 @@ class CacheService {
     this.imageDir = path.join(this.cacheDir, 'images');
     this.tableDir = path.join(this.cacheDir, 'tables');
     
-    // 确保缓存目录存在
+    // 确保缓存目录存在（s3 模式下作为本地读穿透层）
     fs.ensureDirSync(this.imageDir);
     fs.ensureDirSync(this.tableDir);
 
+    // 对象存储，由 STORAGE_BACKEND 选择本地目录或 S3 兼容存储：
+    //   blobs/<hash><ext>、blobs/<hash>_thumb<ext>  按内容存储，同样的字节只存一份，缩略图每个 blob 生成一次
+    //   refs/<key>.json                            key 指向哪个 blob，以及创建时间、kind / paper / generation
+    //   images/<key><ext>、tables/<key><ext>        按内容存储之前写入的旧条目，照常读取
+    this.storage = createStorage(this.cacheDir);
+
+    // 内存索引：key -> { blob, original, thumb, size, birthtimeMs, mtimeMs, kind, paper, generation, derived }，查找不再扫目录
+    // blob 为内容哈希（旧条目为 null），original / thumb 为 blobs/（或 images/）下的文件名
+    // kind 为 figure（论文插图）/ generated（生图结果），paper 为所属论文 id，generation 为生图任务 id（仅生图结果）；
+    // 扫描发现的旧对象这几项为 null
+    // 表格：key -> { blob, file, size, birthtimeMs, mtimeMs, paper }
+    // 多进程模式下各工作进程各建一份，写入/删除通过进程间消息同步，未命中时再回源存储确认
+    // 多节点时其他节点写入的对象同样靠回源找到
+    this.images = new Map();
+    this.tables = new Map();
+    // blob 引用计数：blob 文件名 -> { refs, size, derived }，最后一个引用删除时才删除 blob、缩略图和派生图
+    // 同一 blob 的图片条目共用 derived 数组
+    this.blobs = new Map();
+    // 正在写入的 blob：文件名 -> Promise，同样内容的并发写入只写一次、只生成一次缩略图
+    this.blobWrites = new Map();
+    // 已开始保存、还没写进索引的 blob：文件名 -> 保存数，计入引用数，期间不会被删除
+    this.blobReservations = new Map();
+    // 同一 blob 的写入和删除串行执行：文件名 -> 队尾 Promise
+    this.blobLocks = new Map();
+    this.totalSize = 0;
+    // 分页列表用的顺序：按 (birthtimeMs, 类型, key) 排序；新条目一般追加在末尾，乱序时整体重排
+    // 删除不立即从数组移除，读取时跳过，失效项过多时再重排
+    this.listOrder = [];
+    this.listOrderDirty = false;
+    this.listOrderStale = 0;
+    this.snapshotPath = path.resolve(this.cacheDir, CACHE_INDEX_SNAPSHOT);
+    this.snapshotTimer = null;
+    // 正在生成的派生图：对象名 -> Promise，同一版本的并发请求只编码一次
+    this.derivations = new Map();
     this.stats = {
-      totalImages: 0,
-      totalSize: 0,
-      lastCleanup: null
+      lastCleanup: null,
+      lastUpdated: null,
+      indexSource: null,
+      indexLoadMs: null,
+      reconcileMs: null,
+      indexMisses: 0,
+      storageProbes: 0,
+      dedupHits: 0,
+      derivativeHits: 0,
+      derivativesCreated: 0,
+      derivativeErrors: 0
     };
-    
-    this.updateStats();
+
+    clusterService.on('cache:image', (entry) => this.indexImage(entry.key, entry));
+    clusterService.on('cache:image-delete', ({ key }) => this.unindexImage(key));
+    clusterService.on('cache:derived', ({ key, file }) => this.trackDerivative(key, file));
+    clusterService.on('cache:table', (entry) => this.indexTable(entry.key, entry));
+
+    // ready: 索引可用（来自快照或完整扫描）；reconciled: 与存储对账完成
+    this.reconciled = null;
+    this.ready = this.buildIndex();
+  }
+
+  /**
+   * 启动时建立索引：有快照就直接加载，立即可用，再在后台与存储对账；没有快照才完整扫描
+   * 对账完成前未命中的 key 照常回源存储，不会误报 404
+   */
+  async buildIndex() {
+    const startedAt = Date.now();
+    if (await this.loadSnapshot()) {
+      this.stats.indexSource = 'snapshot';
+      this.stats.indexLoadMs = Date.now() - startedAt;
+      logger.info(`🗂️ 缓存索引从快照恢复: ${this.images.size} 张图片, ${this.tables.size} 个表格 (${this.stats.indexLoadMs}ms)`);
+      this.reconciled = this.scanStorage().then(() => this.scheduleSnapshot());
+      return;
+    }
+
+    await this.scanStorage();
+    this.stats.indexSource = 'scan';
+    this.stats.indexLoadMs = Date.now() - startedAt;
+    this.reconciled = Promise.resolve();
+    await this.writeSnapshot();
+  }
+
+  async loadSnapshot() {
+    try {
+      const snapshot = JSON.parse(await fs.readFile(this.snapshotPath, 'utf8'));
+      if (snapshot.version > SNAPSHOT_VERSION || snapshot.storage !== this.storage.name) return false;
+      for (const [key, original, thumb, size, birthtimeMs, mtimeMs, kind, paper, derived, blob, generation] of snapshot.images) {
+        this.indexImage(key, { original, thumb, size, birthtimeMs, mtimeMs, kind, paper, derived, blob, generation }, { snapshot: false });
+      }
+      for (const [key, file, size, birthtimeMs, mtimeMs, paper, blob] of snapshot.tables) {
+        this.indexTable(key, { file, size, birthtimeMs, mtimeMs, paper, blob }, { snapshot: false });
+      }
+      this.stats.lastUpdated = snapshot.savedAt;
+      return true;
+    } catch (error) {
+      if (error.code !== 'ENOENT') logger.warn('⚠️ 缓存索引快照无法读取，改为完整扫描', error);
+      return false;
+    }
+  }
+
+  /**
+   * 原子写入快照（先写临时文件再改名），多个工作进程同时写也不会读到半个文件
+   */
+  async writeSnapshot() {
+    clearTimeout(this.snapshotTimer);
+    this.snapshotTimer = null;
+    const images = [];
+    for (const [key, entry] of this.images) {
+      images.push([key, entry.original, entry.thumb, entry.size, entry.birthtimeMs, entry.mtimeMs, entry.kind, entry.paper, entry.derived, entry.blob, entry.generation]);
+    }
+    const tables = [];
+    for (const [key, entry] of this.tables) {
+      tables.push([key, entry.file, entry.size, entry.birthtimeMs, entry.mtimeMs, entry.paper, entry.blob]);
+    }
+    const snapshot = {
+      version: SNAPSHOT_VERSION,
+      storage: this.storage.name,
+      savedAt: new Date().toISOString(),
+      images,
+      tables
+    };
+    const tmpPath = `${this.snapshotPath}.${process.pid}.tmp`;
+    try {
+      await fs.writeFile(tmpPath, JSON.stringify(snapshot));
+      await fs.rename(tmpPath, this.snapshotPath);
+    } catch (error) {
+      logger.warn('⚠️ 缓存索引快照写入失败', error);
+      await fs.remove(tmpPath).catch(() => {});
+    }
+  }
+
+  scheduleSnapshot() {
+    if (this.snapshotTimer) return;
+    this.snapshotTimer = setTimeout(() => this.writeSnapshot(), CACHE_INDEX_SNAPSHOT_DELAY_MS);
+    this.snapshotTimer.unref();
+  }
+
+  /**
+   * 后台预加载 sharp，首个缩略图不用等原生库加载
+   */
+  preloadSharp() {
+    return new Promise((resolve, reject) => setImmediate(() => {
+      try {
+        if (!sharpModule) sharpModule = require('sharp');
+        resolve();
+      } catch (error) {
+        reject(error);
+      }
+    }));
+  }
+
+  /**
+   * 列出存储并与索引对账：补上索引里没有的对象，去掉存储里已不存在的条目
+   * 对象名列表不带元数据时（本地目录），只对新增的对象 stat；扫描开始后写入的条目以写入时的信息为准
+   */
+  async scanStorage() {
+    const startedAt = Date.now();
+    try {
+      const [imageObjects, tableObjects, refObjects] = await Promise.all([
+        this.storage.list('images', { stat: false }),
+        this.storage.list('tables', { stat: false }),
+        this.storage.list('refs', { stat: false })
+      ]);
+      const scanned = new Map();
+
+      // 按内容存储的条目：索引里没有的引用才读取（有快照时只有快照之后写入的）
+      const refKeys = new Set();
+      for (const object of refObjects) {
+        const file = path.posix.basename(object.name);
+        if (!file.endsWith('.json')) continue;
+        const key = file.slice(0, -'.json'.length);
+        refKeys.add(key);
+        if (this.images.get(key)?.blob || this.tables.get(key)?.blob) continue;
+        await this.indexRef(key);
+      }
+
+      for (const object of imageObjects) {
+        const file = path.posix.basename(object.name);
+        const parsed = this.parseImageFile(file);
+        if (!parsed) continue;
+        const entry = scanned.get(parsed.key) || { key: parsed.key, thumb: null };
+        if (parsed.thumb) {
+          entry.thumb = file;
+        } else {
+          entry.original = file;
+          entry.object = object;
+        }
+        scanned.set(parsed.key, entry);
+      }
+
+      for (const entry of scanned.values()) {
+        if (!entry.original) continue;
+        const known = this.images.get(entry.key);
+        if (known?.blob) continue;
+        if (known && known.original === entry.original) {
+          known.thumb = entry.thumb;
+          continue;
+        }
+        const stats = entry.object.mtimeMs !== undefined ? entry.object : await this.storage.stat(`images/${entry.original}`);
+        if (stats) this.indexImage(entry.key, { ...stats, original: entry.original, thumb: entry.thumb });
+      }
+      for (const [key, entry] of this.images) {
+        if (!(entry.blob ? refKeys : scanned).has(key) && entry.mtimeMs < startedAt) this.unindexImage(key);
+      }
+
+      const tableKeys = new Set();
+      for (const object of tableObjects) {
+        const file = path.posix.basename(object.name);
+        const ext = path.extname(file).toLowerCase();
+        const key = path.basename(file, ext);
+        if (!TABLE_EXTENSIONS.includes(ext)) continue;
+        tableKeys.add(key);
+        if (this.tables.get(key)?.blob || this.tables.get(key)?.file === file) continue;
+        const stats = object.mtimeMs !== undefined ? object : await this.storage.stat(object.name);
+        if (stats) this.indexTable(key, { ...stats, file });
+      }
+      for (const [key, entry] of this.tables) {
+        if (!(entry.blob ? refKeys : tableKeys).has(key) && entry.mtimeMs < startedAt) this.unindexTable(key);
+      }
+
+      this.stats.lastUpdated = new Date().toISOString();
+      this.stats.reconcileMs = Date.now() - startedAt;
+      logger.info(`🗂️ 缓存索引就绪: ${this.images.size} 张图片, ${this.tables.size} 个表格 (${this.stats.reconcileMs}ms)`);
+    } catch (error) {
+      logger.error('❌ 缓存索引构建失败', error);
+    }
+  }
+
+  /**
+   * 解析图片文件名：`${key}${ext}` 或 `${key}_thumb${ext}`
+   */
+  parseImageFile(file) {
+    const ext = path.extname(file).toLowerCase();
+    if (!IMAGE_EXTENSIONS.includes(ext) && ext !== '.jpeg') return null;
+    const base = path.basename(file, path.extname(file));
+    if (base.endsWith('_thumb')) return { key: base.slice(0, -'_thumb'.length), thumb: true };
+    return { key: base, thumb: false };
   }
 
-/**
-   * 保存图片到缓存
+  indexImage(key, entry, { snapshot = true } = {}) {
+    const previous = this.images.get(key);
+    if (previous) {
+      this.totalSize -= previous.size || 0;
+      if (previous.blob) this.dropBlobRef(previous.original);
+    }
+    const next = {
+      blob: entry.blob || null,
+      original: entry.original,
+      thumb: entry.thumb || null,
+      size: entry.size || 0,
+      birthtimeMs: entry.birthtimeMs || entry.mtimeMs || Date.now(),
+      mtimeMs: entry.mtimeMs || Date.now(),
+      // 重新索引（对账、回源）时没有这几项，沿用已知的
+      kind: entry.kind || previous?.kind || null,
+      paper: entry.paper || previous?.paper || null,
+      generation: entry.generation || previous?.generation || null,
+      // 已生成的派生图文件名（derived/ 下），删除原图时一并删除
+      derived: entry.derived || previous?.derived || []
+    };
+    if (next.blob) next.derived = this.retainBlob(next.original, next.size, next.derived);
+    this.images.set(key, next);
+    this.totalSize += next.size;
+    this.trackListOrder('image', key, previous, next);
+    if (snapshot) this.scheduleSnapshot();
+    return next;
+  }
+
+  unindexImage(key) {
+    const previous = this.images.get(key);
+    if (!previous) return null;
+    this.totalSize -= previous.size || 0;
+    if (previous.blob) this.dropBlobRef(previous.original);
+    this.images.delete(key);
+    this.listOrderStale++;
+    this.scheduleSnapshot();
+    return previous;
+  }
+
+  indexTable(key, entry, { snapshot = true } = {}) {
+    const previous = this.tables.get(key);
+    if (previous?.blob) this.dropBlobRef(previous.file);
+    const next = {
+      blob: entry.blob || null,
+      file: entry.file,
+      size: entry.size || 0,
+      birthtimeMs: entry.birthtimeMs || entry.mtimeMs || Date.now(),
+      mtimeMs: entry.mtimeMs || Date.now(),
+      paper: entry.paper || previous?.paper || null
+    };
+    if (next.blob) this.retainBlob(next.file, next.size, []);
+    this.tables.set(key, next);
+    this.trackListOrder('table', key, previous, next);
+    if (snapshot) this.scheduleSnapshot();
+    return next;
+  }
+
+  unindexTable(key) {
+    const previous = this.tables.get(key);
+    if (!previous) return null;
+    if (previous.blob) this.dropBlobRef(previous.file);
+    this.tables.delete(key);
+    this.listOrderStale++;
+    this.scheduleSnapshot();
+    return previous;
+  }
+
+  retainBlob(file, size, derived) {
+    let blob = this.blobs.get(file);
+    if (!blob) {
+      blob = { refs: 0, size, derived: [] };
+      this.blobs.set(file, blob);
+    }
+    blob.refs++;
+    for (const item of derived) if (!blob.derived.includes(item)) blob.derived.push(item);
+    return blob.derived;
+  }
+
+  dropBlobRef(file) {
+    const blob = this.blobs.get(file);
+    if (!blob) return;
+    if (--blob.refs <= 0) this.blobs.delete(file);
+  }
+
+  /**
+   * 引用数：索引里的引用加上正在保存的
+   */
+  blobRefs(file) {
+    return (this.blobs.get(file)?.refs || 0) + (this.blobReservations.get(file) || 0);
+  }
+
+  /**
+   * 占用同时登记到主进程（多进程模式），其他工作进程删除前能看到
    */
-  async saveImage(key, buffer, mimeType = 'image/png') {
+  reserveBlob(file) {
+    this.blobReservations.set(file, (this.blobReservations.get(file) || 0) + 1);
+    clusterService.reserve(`blob:${file}`);
+  }
+
+  unreserveBlob(file) {
+    const count = (this.blobReservations.get(file) || 0) - 1;
+    if (count > 0) this.blobReservations.set(file, count);
+    else this.blobReservations.delete(file);
+    clusterService.unreserve(`blob:${file}`);
+  }
+
+  /**
+   * 按 blob 串行执行：写入时的「已存在」判断和删除时的「没有引用」判断都在锁里做，
+   * 删除和同样内容的保存同时发生时，不会出现保存判定为已存在、随后文件被删的情况
+   * 多进程模式下再取主进程上的同名锁，task(reserved) 的 reserved 为其他工作进程正在保存的数量；
+   * 保存方先广播再撤销占用，所以 reserved 为 0 时它们保存的条目已在本进程索引里
+   */
+  withBlobLock(file, task) {
+    const current = (this.blobLocks.get(file) || Promise.resolve()).then(async () => {
+      const { release, reserved } = await clusterService.lock(`blob:${file}`);
+      try {
+        return await task(reserved);
+      } finally {
+        release();
+      }
+    });
+    const tail = current.catch(() => {});
+    this.blobLocks.set(file, tail);
+    tail.then(() => {
+      if (this.blobLocks.get(file) === tail) this.blobLocks.delete(file);
+    });
+    return current;
+  }
+
+  /**
+   * 条目对应的存储对象名：按内容存储的条目在 blobs/ 下（多个 key 共用），旧条目在 images/、tables/ 下
+   */
+  imageObject(entry, file = entry.original) {
+    return `${entry.blob ? 'blobs' : 'images'}/${file}`;
+  }
+
+  tableObject(entry) {
+    return `${entry.blob ? 'blobs' : 'tables'}/${entry.file}`;
+  }
+
+  /**
+   * 按内容哈希存储：同样的字节只写一次；thumbnail 为 true 时每个 blob 只生成一次缩略图
+   * 返回 { blob, file, thumb, deduplicated }；调用时即占用该 blob（见 blobReservations），
+   * 成功后由调用方在写入索引后调用 unreserveBlob(file)，失败时这里释放
+   */
+  storeBlob(buffer, extension, options) {
+    const blob = hashBuffer(buffer);
+    const file = `${blob}${extension}`;
+    this.reserveBlob(file);
+    return this.writeBlob(buffer, blob, extension, options).catch((error) => {
+      this.unreserveBlob(file);
+      throw error;
+    });
+  }
+
+  writeBlob(buffer, blob, extension, { kind, contentType, thumbnail = false }) {
+    const file = `${blob}${extension}`;
+    let pending = this.blobWrites.get(file);
+    if (pending) return pending;
+    pending = this.withBlobLock(file, async () => {
+      // 自己的占用不算：只看索引里已有的引用和存储里的对象
+      const deduplicated = (this.blobs.get(file)?.refs || 0) > 0 || Boolean(await this.storage.stat(`blobs/${file}`));
+      if (deduplicated) this.stats.dedupHits++;
+      else await metricsService.cacheWrite.time({ kind }, this.storage.put(`blobs/${file}`, buffer, { contentType }));
+
+      let thumbnailPath = null;
+      if (thumbnail) {
+        // 已有的 blob 一般已有缩略图，缺失时才生成
+        const existing = `blobs/${blob}_thumb${extension}`;
+        thumbnailPath = deduplicated && await this.storage.stat(existing)
+          ? existing
+          : await this.generateThumbnail(`blobs/${blob}`, buffer, extension);
+      }
+      return { blob, file, thumb: thumbnailPath ? path.posix.basename(thumbnailPath) : null, deduplicated };
+    }).finally(() => this.blobWrites.delete(file));
+    this.blobWrites.set(file, pending);
+    return pending;
+  }
+
+  /**
+   * 写引用对象：索引丢失（没有快照的冷启动）或其他节点未命中时据此恢复 key -> blob
+   */
+  writeRef(key, type, entry) {
+    const ref = {
+      type,
+      blob: entry.blob,
+      file: type === 'table' ? entry.file : entry.original,
+      size: entry.size,
+      createdAt: entry.birthtimeMs,
+      kind: entry.kind || null,
+      paper: entry.paper || null,
+      generation: entry.generation || null
+    };
+    return this.storage.put(`refs/${key}.json`, Buffer.from(JSON.stringify(ref)), { contentType: 'application/json' });
+  }
+
+  /**
+   * 读取 refs/<key>.json 并写入索引，返回索引条目；引用不存在或无法解析时返回 null
+   * 缩略图按约定命名，存储里没有时取缩略图返回 404，由校验脚本发现并修复
+   */
+  async indexRef(key) {
+    if (!key || key !== path.basename(key)) return null;
+    const buffer = await this.readObject(`refs/${key}.json`);
+    if (!buffer) return null;
+    let ref;
+    try {
+      ref = JSON.parse(buffer.toString('utf8'));
+    } catch {
+      logger.warn('⚠️ 引用对象无法解析', { key });
+      return null;
+    }
+    const entry = { blob: ref.blob, size: ref.size, birthtimeMs: ref.createdAt, mtimeMs: ref.createdAt, paper: ref.paper };
+    if (ref.type === 'table') return this.indexTable(key, { ...entry, file: ref.file });
+    const ext = path.extname(ref.file);
+    return this.indexImage(key, { ...entry, original: ref.file, thumb: `${ref.blob}_thumb${ext}`, kind: ref.kind, generation: ref.generation });
+  }
+
+  /**
+   * 维护分页顺序：新条目排在末尾时直接追加（最常见：刚写入的图片），否则标记重排
+   */
+  trackListOrder(type, key, previous, next) {
+    if (previous) {
+      if (previous.birthtimeMs !== next.birthtimeMs) this.listOrderDirty = true;
+      return;
+    }
+    const item = { at: next.birthtimeMs, type, key };
+    const last = this.listOrder[this.listOrder.length - 1];
+    if (last && compareListItems(last, item) > 0) this.listOrderDirty = true;
+    this.listOrder.push(item);
+  }
+
+  /**
+   * 保存图片到缓存：key 只是指向内容 blob 的引用，同样的图片（重复解析同一篇论文、不同论文里相同的插图）只存一份
+   * meta: { kind: 'figure' | 'generated', paper, generation }，用于缓存列表按来源、论文和生图任务筛选
+   */
+  async saveImage(key, buffer, mimeType = 'image/png', meta = {}) {
     const extension = this.getExtensionFromMimeType(mimeType);
-    const originalPath = path.join(this.imageDir, `${key}${extension}`);
-    
-    // 保存原始图片
-    await fs.writeFile(originalPath, buffer);
-    
-    // 生成缩略图
-    await this.generateThumbnail(key, buffer, extension);
-    
-    // 更新统计信息
-    await this.updateStats();
+    const { blob, file, thumb, deduplicated } = await this.storeBlob(buffer, extension, {
+      kind: 'image',
+      contentType: mimeType,
+      thumbnail: true
+    });
+
+    const now = Date.now();
+    const entry = {
+      key,
+      blob,
+      original: file,
+      thumb,
+      size: buffer.length,
+      birthtimeMs: now,
+      mtimeMs: now,
+      kind: meta.kind || null,
+      paper: meta.paper || null,
+      generation: meta.generation || null
+    };
+    try {
+      await metricsService.cacheWrite.time({ kind: 'ref' }, this.writeRef(key, 'image', entry));
+      // 更新索引并通知其他工作进程
+      this.indexImage(key, entry);
+      clusterService.broadcast('cache:image', entry);
+    } finally {
+      // 写进索引、通知其他进程后引用计数接管，之前一直占用着 blob
+      this.unreserveBlob(file);
+    }
     
     return {
       key,
-      originalPath,
-      thumbnailPath: path.join(this.imageDir, `${key}_thumb${extension}`),
+      originalPath: `blobs/${file}`,
+      thumbnailPath: thumb ? `blobs/${thumb}` : null,
       size: buffer.length,
       mimeType,
+      deduplicated,
       createdAt: new Date().toISOString()
     };
   }
@@ -65,78 +595,429 @@ class CacheService {
   }
 
   /**
-   * 生成缩略图
+   * 生成缩略图，写到 `${base}_thumb${extension}`（base 如 blobs/<hash>、images/<key>），失败返回 null
    */
-  async generateThumbnail(key, buffer, extension) {
+  async generateThumbnail(base, buffer, extension) {
     try {
-      const thumbnailPath = path.join(this.imageDir, `${key}_thumb${extension}`);
+      const thumbnailPath = `${base}_thumb${extension}`;
       
-      await sharp(buffer)
+      const endThumbnail = metricsService.thumbnail.startTimer();
+      const thumbnail = await sharp(buffer)
         .resize(200, 200, { fit: 'inside' })
-        .toFile(thumbnailPath);
+        .toBuffer();
+      endThumbnail();
+      await metricsService.cacheWrite.time({ kind: 'thumbnail' },
+        this.storage.put(thumbnailPath, thumbnail, { contentType: contentTypeFor(extension) }));
       
       return thumbnailPath;
     } catch (error) {
-      console.warn('Failed to generate thumbnail:', error);
+      logger.warn('⚠️ 缩略图生成失败', error);
       return null;
     }
   }
 
   /**
-   * 获取图片路径
+   * 查找图片索引条目
+   * 先查索引；未命中时回源存储（其他工作进程或节点刚写入）：先读引用对象，再按已知扩展名找旧条目，找到后补进索引
    */
-  getImagePath(key, size = 'original') {
-    const files = fs.readdirSync(this.imageDir);
-    const pattern = size === 'thumb' ? `${key}_thumb.` : `${key}.`;
-    
-    for (const file of files) {
-      if (file.includes(pattern)) {
-        return path.join(this.imageDir, file);
-      }
+  async findImage(key) {
+    const entry = this.images.get(key);
+    metricsService.cacheLookups.inc({ kind: 'image', result: entry ? 'hit' : 'miss' });
+    return entry || this.probeImage(key);
+  }
+
+  async probeImage(key) {
+    this.stats.indexMisses++;
+    // key 来自 URL，拒绝带路径分隔符的输入
+    if (!key || key !== path.basename(key)) return null;
+
+    this.stats.storageProbes++;
+    const fromRef = await this.indexRef(key);
+    // 引用指向表格时同样补进索引，但这里不是图片
+    if (fromRef) return this.images.has(key) ? fromRef : null;
+
+    for (const ext of IMAGE_EXTENSIONS) {
+      this.stats.storageProbes++;
+      const stats = await this.storage.stat(`images/${key}${ext}`);
+      if (!stats) continue;
+      const thumb = `${key}_thumb${ext}`;
+      const hasThumb = Boolean(await this.storage.stat(`images/${thumb}`));
+      return this.indexImage(key, {
+        original: `${key}${ext}`,
+        thumb: hasThumb ? thumb : null,
+        size: stats.size,
+        birthtimeMs: stats.birthtimeMs,
+        mtimeMs: stats.mtimeMs
+      });
     }
-    
     return null;
   }
 
   /**
-   * 获取图片信息
+   * 打开图片读取流（从持有该对象的存储读取），返回 { stream, size, mtimeMs, contentType } 或 null
+   * range: { start, end } 闭区间字节范围
+   * 原图、缩略图见 openImage，WebP / AVIF 派生图见 openDerivative
    */
-  getImageInfo(key) {
-    const originalPath = this.getImagePath(key, 'original');
-    const thumbPath = this.getImagePath(key, 'thumb');
-    
-    if (!originalPath || !fs.existsSync(originalPath)) {
-      return null;
+  async openImage(key, size = 'original', range = {}) {
+    const entry = await this.findImage(key);
+    const file = entry && (size === 'thumb' ? entry.thumb : entry.original);
+    if (!file) return null;
+
+    const object = await this.storage.open(this.imageObject(entry, file), range);
+    if (!object && size !== 'thumb') {
+      // 对象已被外部删除，索引是旧的
+      this.unindexImage(key);
     }
-    
-    const stats = fs.statSync(originalPath);
+    return object && { ...object, file };
+  }
+
+  /**
+   * 把请求参数归到档位：width 向上取最近的宽度档（超过最大档即原尺寸），quality 取 low / medium / high 或最接近的数值档
+   * 参数不合法时抛出 code 为 INVALID_VARIANT 的错误
+   */
+  normalizeVariant({ format, width, quality } = {}) {
+    const invalid = (message) => Object.assign(new Error(message), { code: 'INVALID_VARIANT' });
+    if (!DERIVATIVE_FORMATS.includes(format)) throw invalid(`format 只能是 ${DERIVATIVE_FORMATS.join(' / ')}`);
+
+    let tierWidth = null;
+    if (width !== undefined && width !== '') {
+      const parsed = parseInt(width, 10);
+      if (!(parsed > 0)) throw invalid('width 必须是正整数');
+      tierWidth = DERIVATIVE_WIDTHS.find(tier => tier >= parsed) || null;
+    }
+
+    let tierQuality = DERIVATIVE_QUALITIES.medium;
+    if (quality !== undefined && quality !== '') {
+      if (DERIVATIVE_QUALITIES[quality]) {
+        tierQuality = DERIVATIVE_QUALITIES[quality];
+      } else {
+        const parsed = parseInt(quality, 10);
+        if (!(parsed >= 1 && parsed <= 100)) throw invalid('quality 只能是 low / medium / high 或 1-100');
+        tierQuality = Object.values(DERIVATIVE_QUALITIES)
+          .reduce((best, tier) => (Math.abs(tier - parsed) < Math.abs(best - parsed) ? tier : best));
+      }
+    }
+    return { format, width: tierWidth, quality: tierQuality };
+  }
+
+  /**
+   * 打开 WebP / AVIF 派生图，第一次请求时用 sharp 从原图生成并写入 derived/，之后直接复用
+   * 返回 { stream, size, mtimeMs, contentType, file, variant } 或 null；生成失败时退回原图（variant 为 null）
+   */
+  async openDerivative(key, variant, range = {}) {
+    const entry = await this.findImage(key);
+    if (!entry) return null;
+    const { format, width, quality } = this.normalizeVariant(variant);
+    // 按 blob 命名，内容相同的图片共用派生图
+    const file = `${entry.blob || key}_${width || 'full'}_q${quality}.${format}`;
+    const label = `${format} ${width ? `${width}w` : 'full'} q${quality}`;
+
+    let object = await this.storage.open(`derived/${file}`, range);
+    if (object) {
+      this.stats.derivativeHits++;
+      // 其他节点生成的派生图，记到索引里以便删除原图时一起清理
+      if (!entry.derived.includes(file)) this.trackDerivative(key, file);
+    } else if (await this.createDerivative(key, entry, file, { format, width, quality })) {
+      object = await this.storage.open(`derived/${file}`, range);
+    }
+    if (!object) {
+      const original = await this.openImage(key, 'original', range);
+      return original && { ...original, variant: null };
+    }
+    return { ...object, file, variant: label };
+  }
+
+  createDerivative(key, entry, file, { format, width, quality }) {
+    let pending = this.derivations.get(file);
+    if (pending) return pending;
+    pending = (async () => {
+      try {
+        const buffer = await this.readObject(this.imageObject(entry));
+        if (!buffer) return false;
+        const endTimer = metricsService.derivative.startTimer({ format });
+        let image = sharp(buffer);
+        if (width) image = image.resize({ width, withoutEnlargement: true });
+        const output = await (format === 'avif'
+          ? image.avif({ quality, effort: IMAGE_AVIF_EFFORT })
+          : image.webp({ quality })).toBuffer();
+        endTimer();
+        await metricsService.cacheWrite.time({ kind: 'derived' },
+          this.storage.put(`derived/${file}`, output, { contentType: contentTypeFor(`.${format}`) }));
+        this.trackDerivative(key, file);
+        clusterService.broadcast('cache:derived', { key, file });
+        this.stats.derivativesCreated++;
+        logger.debug('🖼️ 派生图已生成', { key, file, originalBytes: buffer.length, bytes: output.length });
+        return true;
+      } catch (error) {
+        this.stats.derivativeErrors++;
+        logger.warn('⚠️ 派生图生成失败，返回原图', { key, file, error });
+        return false;
+      } finally {
+        this.derivations.delete(file);
+      }
+    })();
+    this.derivations.set(file, pending);
+    return pending;
+  }
+
+  /**
+   * 记下派生图文件名；按内容存储的条目共用 blob 的 derived 数组，对同一 blob 的所有 key 可见
+   */
+  trackDerivative(key, file) {
+    const entry = this.images.get(key);
+    if (!entry || entry.derived.includes(file)) return;
+    entry.derived.push(file);
+    this.scheduleSnapshot();
+  }
+
+  async deleteDerivatives(entry) {
+    for (const file of entry?.derived || []) {
+      await this.storage.delete(`derived/${file}`).catch(() => {});
+    }
+  }
+
+  /**
+   * 把整个对象读进内存，不存在时返回 null
+   */
+  async readObject(name) {
+    const object = await this.storage.open(name);
+    if (!object) return null;
+    const chunks = [];
+    for await (const chunk of object.stream) chunks.push(chunk);
+    return Buffer.concat(chunks);
+  }
+
+  /**
+   * 获取图片信息
+   */
+  async getImageInfo(key) {
+    const entry = await this.findImage(key);
+    if (!entry) return null;
     
     return {
       key,
       originalUrl: `/api/cache/image/${key}`,
-      thumbnailUrl: thumbPath ? `/api/cache/image/${key}?size=thumb` : null,
-      size: stats.size,
-      createdAt: stats.birthtime,
-      modifiedAt: stats.mtime,
-      path: originalPath
+      thumbnailUrl: entry.thumb ? `/api/cache/image/${key}?size=thumb` : null,
+      size: entry.size,
+      createdAt: new Date(entry.birthtimeMs),
+      modifiedAt: new Date(entry.mtimeMs),
+      path: this.imageObject(entry),
+      blob: entry.blob,
+      storage: this.storage.name
+    };
+  }
+
+  /**
+   * 分页列出缓存条目（图片和表格），全部来自内存索引，不访问存储
+   * filter: { kind, paper, generation, minAge, maxAge（秒）, minSize, maxSize（字节）, order: 'desc'（新的在前，默认）| 'asc', cursor, limit }
+   * kind: image（全部图片）| figure | generated | table
+   * 返回 { items, nextCursor }，nextCursor 为 null 表示没有下一页；翻页期间新增或删除条目不会造成重复或遗漏
+   */
+  listEntries(filter = {}) {
+    const match = this.entryFilter(filter);
+    const limit = Math.min(Math.max(parseInt(filter.limit, 10) || 100, 1), CACHE_LIST_MAX_LIMIT);
+    const descending = filter.order !== 'asc';
+    const list = this.sortedListOrder();
+
+    let i = descending ? list.length - 1 : 0;
+    if (filter.cursor) {
+      // 二分定位游标；游标指向的条目已被删除也能接着翻
+      const after = decodeCursor(filter.cursor);
+      let lo = 0;
+      let hi = list.length;
+      while (lo < hi) {
+        const mid = (lo + hi) >> 1;
+        const cmp = compareListItems(list[mid], after);
+        if (cmp < 0 || (!descending && cmp === 0)) lo = mid + 1;
+        else hi = mid;
+      }
+      i = descending ? lo - 1 : lo;
+    }
+
+    const items = [];
+    let last = null;
+    for (; descending ? i >= 0 : i < list.length; i += descending ? -1 : 1) {
+      const item = list[i];
+      const entry = (item.type === 'image' ? this.images : this.tables).get(item.key);
+      // 已删除，或重新索引后时间变了（新位置在重排后的数组里）
+      if (!entry || entry.birthtimeMs !== item.at || !match(item.type, entry)) continue;
+      if (items.length === limit) return { items, nextCursor: encodeCursor(last) };
+      items.push(this.describeEntry(item.type, item.key, entry));
+      last = item;
+    }
+    return { items, nextCursor: null };
+  }
+
+  /**
+   * 按同样的筛选条件汇总：总数、总字节数、按类别统计、涉及的论文数、最早和最新的创建时间
+   */
+  summarizeEntries(filter = {}) {
+    const match = this.entryFilter(filter);
+    const summary = { count: 0, bytes: 0, byKind: {}, papers: 0, oldest: null, newest: null };
+    const papers = new Set();
+    let oldest = Infinity;
+    let newest = -Infinity;
+    const add = (type, entry) => {
+      if (!match(type, entry)) return;
+      const kind = type === 'table' ? 'table' : entry.kind || 'image';
+      const bucket = summary.byKind[kind] || (summary.byKind[kind] = { count: 0, bytes: 0 });
+      bucket.count++;
+      bucket.bytes += entry.size;
+      summary.count++;
+      summary.bytes += entry.size;
+      if (entry.paper) papers.add(entry.paper);
+      if (entry.birthtimeMs < oldest) oldest = entry.birthtimeMs;
+      if (entry.birthtimeMs > newest) newest = entry.birthtimeMs;
+    };
+    for (const entry of this.images.values()) add('image', entry);
+    for (const entry of this.tables.values()) add('table', entry);
+    summary.papers = papers.size;
+    if (summary.count) {
+      summary.oldest = new Date(oldest).toISOString();
+      summary.newest = new Date(newest).toISOString();
+    }
+    return summary;
+  }
+
+  /**
+   * 一篇论文或一次生图的全部条目，供打包导出：{ paper, generation, candidates, figures, tables }，各项为 [key, entry]，按创建时间排序
+   * 只给 generation 时，论文取这次生图结果所属的论文；都找不到时返回 null
+   */
+  exportEntries({ paper = null, generation = null } = {}) {
+    const byTime = ([aKey, a], [bKey, b]) => (a.birthtimeMs - b.birthtimeMs) || (aKey < bKey ? -1 : aKey > bKey ? 1 : 0);
+    const images = [...this.images];
+    const candidates = images
+      .filter(([, entry]) => entry.kind === 'generated' && (generation ? entry.generation === generation : entry.paper === paper))
+      .sort(byTime);
+    const owner = paper || candidates.find(([, entry]) => entry.paper)?.[1].paper || null;
+    const figures = owner ? images.filter(([, entry]) => entry.kind === 'figure' && entry.paper === owner).sort(byTime) : [];
+    const tables = owner ? [...this.tables].filter(([, entry]) => entry.paper === owner).sort(byTime) : [];
+    if (!candidates.length && !figures.length && !tables.length) return null;
+    return { paper: owner, generation, candidates, figures, tables };
+  }
+
+  /**
+   * 把查询参数转成判断函数；参数不合法时抛出 code 为 INVALID_FILTER 的错误
+   */
+  entryFilter({ kind, paper, generation, minAge, maxAge, minSize, maxSize } = {}) {
+    const invalid = (message) => Object.assign(new Error(message), { code: 'INVALID_FILTER' });
+    const number = (value, name) => {
+      if (value === undefined || value === '') return null;
+      const parsed = Number(value);
+      if (!Number.isFinite(parsed) || parsed < 0) throw invalid(`${name} 必须是非负数`);
+      return parsed;
+    };
+    if (kind && !LIST_KINDS.includes(kind)) throw invalid(`kind 只能是 ${LIST_KINDS.join(' / ')}`);
+
+    const now = Date.now();
+    const minAgeSec = number(minAge, 'minAge');
+    const maxAgeSec = number(maxAge, 'maxAge');
+    const createdBefore = minAgeSec === null ? Infinity : now - minAgeSec * 1000;
+    const createdAfter = maxAgeSec === null ? -Infinity : now - maxAgeSec * 1000;
+    const minBytes = number(minSize, 'minSize') ?? 0;
+    const maxBytes = number(maxSize, 'maxSize') ?? Infinity;
+
+    return (type, entry) => {
+      if (kind === 'table' ? type !== 'table' : kind && (type !== 'image' || (kind !== 'image' && entry.kind !== kind))) return false;
+      if (paper && entry.paper !== paper) return false;
+      if (generation && entry.generation !== generation) return false;
+      if (entry.birthtimeMs > createdBefore || entry.birthtimeMs < createdAfter) return false;
+      return entry.size >= minBytes && entry.size <= maxBytes;
     };
   }
 
-  async saveTable(key, buffer, isCSV = true) {
+  describeEntry(type, key, entry) {
+    const base = {
+      key,
+      type,
+      kind: type === 'table' ? 'table' : entry.kind || 'image',
+      paper: entry.paper,
+      generation: entry.generation,
+      blob: entry.blob,
+      size: entry.size,
+      createdAt: new Date(entry.birthtimeMs).toISOString(),
+      modifiedAt: new Date(entry.mtimeMs).toISOString()
+    };
+    if (type === 'table') return { ...base, file: entry.file, url: `/api/cache/table/${key}`, rowsUrl: `/api/cache/table/${key}/rows` };
+    return {
+      ...base,
+      file: entry.original,
+      url: `/api/cache/image/${key}`,
+      thumbnailUrl: entry.thumb ? `/api/cache/image/${key}?size=thumb` : null
+    };
+  }
+
+  /**
+   * 分页顺序数组：乱序插入或失效项过多时整体重排一次，之后的翻页都是二分查找
+   */
+  sortedListOrder() {
+    if (this.listOrderDirty || this.listOrderStale > Math.max(1000, this.listOrder.length / 2)) {
+      const order = [];
+      for (const [key, entry] of this.images) order.push({ at: entry.birthtimeMs, type: 'image', key });
+      for (const [key, entry] of this.tables) order.push({ at: entry.birthtimeMs, type: 'table', key });
+      this.listOrder = order.sort(compareListItems);
+      this.listOrderDirty = false;
+      this.listOrderStale = 0;
+    }
+    return this.listOrder;
+  }
+
+  /**
+   * 保存表格：与图片一样按内容存储，key 为引用
+   */
+  async saveTable(key, buffer, isCSV = true, meta = {}) {
     const extension = isCSV ? '.csv' : '.xlsx';
-    const tablePath = path.join(this.tableDir, `${key}${extension}`);
-    await fs.writeFile(tablePath, buffer);
-    return tablePath;
+    const { blob, file } = await this.storeBlob(buffer, extension, { kind: 'table', contentType: contentTypeFor(extension) });
+    const now = Date.now();
+    const entry = { key, blob, file, size: buffer.length, birthtimeMs: now, mtimeMs: now, paper: meta.paper || null };
+    try {
+      await metricsService.cacheWrite.time({ kind: 'ref' }, this.writeRef(key, 'table', entry));
+      this.indexTable(key, entry);
+      clusterService.broadcast('cache:table', entry);
+    } finally {
+      this.unreserveBlob(file);
+    }
+    return `blobs/${file}`;
   }
 
-  getTablePath(key) {
-    const csvPath = path.join(this.tableDir, `${key}.csv`);
-    const xlsxPath = path.join(this.tableDir, `${key}.xlsx`);
-    
-    if (fs.existsSync(csvPath)) return csvPath;
-    if (fs.existsSync(xlsxPath)) return xlsxPath;
-    
-    return null;
+  /**
+   * 查找表格的索引条目，索引未命中时按引用和旧布局探测存储；不存在时返回 null
+   */
+  async findTable(key) {
+    let entry = this.tables.get(key);
+    metricsService.cacheLookups.inc({ kind: 'table', result: entry ? 'hit' : 'miss' });
+    if (entry) return entry;
+    if (!key || key !== path.basename(key)) return null;
+    this.stats.indexMisses++;
+    this.stats.storageProbes++;
+    await this.indexRef(key);
+    entry = this.tables.get(key);
+    for (const ext of entry ? [] : TABLE_EXTENSIONS) {
+      this.stats.storageProbes++;
+      const stats = await this.storage.stat(`tables/${key}${ext}`);
+      if (stats) return this.indexTable(key, { ...stats, file: `${key}${ext}` });
+    }
+    return entry || null;
+  }
+
+  /**
+   * 表格派生对象（derived/ 下的行索引、XLSX 转换结果）的名字前缀：按 blob 命名，旧条目按 key
+   */
+  tableDerivedId(key, entry) {
+    return entry.blob || `table-${key}`;
+  }
+
+  /**
+   * 打开表格读取流，返回 { stream, size, mtimeMs, contentType, file } 或 null
+   * file 为 `${key}${ext}`（下载时的文件名），不是 blob 的文件名
+   */
+  async openTable(key) {
+    const entry = await this.findTable(key);
+    if (!entry) return null;
+
+    const object = await this.storage.open(this.tableObject(entry));
+    if (!object) this.unindexTable(key);
+    return object && { ...object, file: `${key}${path.extname(entry.file)}` };
   }
 
   /**
@@ -155,64 +1036,63 @@ class CacheService {
   }
 
   /**
-   * 更新缓存统计信息
-   */
-  async updateStats() {
-    try {
-      const files = await fs.readdir(this.imageDir);
-      let totalSize = 0;
-      
-      for (const file of files) {
-        if (!file.includes('_thumb')) { // 不统计缩略图
-          const filePath = path.join(this.imageDir, file);
-          const stats = await fs.stat(filePath);
-          totalSize += stats.size;
-        }
-      }
-      
-      this.stats = {
-        totalImages: files.filter(f => !f.includes('_thumb')).length,
-        totalSize,
-        lastUpdated: new Date().toISOString()
-      };
-    } catch (error) {
-      console.error('Error updating cache stats:', error);
-    }
-  }
-
-  /**
-   * 获取缓存统计
+   * 获取缓存统计（来自索引，不扫描磁盘）
    */
   getStats() {
     return {
+      totalImages: this.images.size,
+      totalTables: this.tables.size,
+      totalSize: this.totalSize,
       ...this.stats,
+      dedup: this.getDedupStats(),
       cacheDir: this.cacheDir,
       imageDir: this.imageDir,
+      storage: this.storage.describe(),
       enabled: process.env.ENABLE_CACHE === 'true'
     };
   }
 
-    /**
+  /**
+   * 去重效果：logicalBytes 为所有 key 的字节数之和，storedBytes 为实际存储的（每个 blob 算一次，旧条目各算各的）
+   * 不含缩略图和派生图
+   */
+  getDedupStats() {
+    let logicalBytes = 0;
+    let legacyBytes = 0;
+    let references = 0;
+    for (const entries of [this.images.values(), this.tables.values()]) {
+      for (const entry of entries) {
+        logicalBytes += entry.size;
+        if (entry.blob) references++;
+        else legacyBytes += entry.size;
+      }
+    }
+    let storedBytes = legacyBytes;
+    for (const blob of this.blobs.values()) storedBytes += blob.size;
+    return {
+      blobs: this.blobs.size,
+      references,
+      logicalBytes,
+      storedBytes,
+      savedBytes: logicalBytes - storedBytes,
+      ratio: storedBytes ? Math.round((logicalBytes / storedBytes) * 1000) / 1000 : 1
+    };
+  }
+
+  /**
    * 删除特定key的图片
+   * 按内容存储的图片删除引用，blob 没有其他 key 引用时才删除 blob、缩略图和派生图
    */
   async deleteImage(key) {
-    const originalPath = this.getImagePath(key, 'original');
-    const thumbPath = this.getImagePath(key, 'thumb');
-    
-    const deleted = [];
-    
-    if (originalPath && fs.existsSync(originalPath)) {
-      await fs.unlink(originalPath);
-      deleted.push('original');
-    }
-    
-    if (thumbPath && fs.existsSync(thumbPath)) {
-      await fs.unlink(thumbPath);
-      deleted.push('thumbnail');
+    const entry = await this.findImage(key);
+    let deleted = [];
+
+    if (entry) {
+      this.unindexImage(key);
+      clusterService.broadcast('cache:image-delete', { key });
+      ({ deleted } = await this.releaseImage(key, entry));
     }
     
-    await this.updateStats();
-    
     return {
       success: deleted.length > 0,
       deleted,
@@ -221,8 +1101,241 @@ class CacheService {
     };
   }
 
+  /**
+   * 删除已移出索引的图片条目的存储对象，返回 { deleted, freed }（freed 为释放的原图字节数）
+   */
+  async releaseImage(key, entry) {
+    const deleted = [];
+    const release = async (reserved = 0) => {
+      // 在 blob 锁里判断：判断之后、删除之前不会有同样内容的保存判定为「已存在」
+      if (entry.blob && this.blobRefs(entry.original) + reserved > 0) return { deleted, freed: 0 };
+      await this.storage.delete(this.imageObject(entry));
+      deleted.push('original');
+      if (entry.thumb) {
+        await this.storage.delete(this.imageObject(entry, entry.thumb));
+        deleted.push('thumbnail');
+      }
+      if (entry.derived.length) {
+        await this.deleteDerivatives(entry);
+        deleted.push('derived');
+      }
+      return { deleted, freed: entry.size };
+    };
+    if (!entry.blob) return release();
+
+    await this.storage.delete(`refs/${key}.json`);
+    deleted.push('reference');
+    return this.withBlobLock(entry.original, release);
+  }
+
+  /**
+   * 表格同理：删除引用，blob 没有其他引用时删除 blob 和预览用的行索引、转换结果
+   */
+  async releaseTable(key, entry) {
+    const release = async (reserved = 0) => {
+      if (entry.blob && this.blobRefs(entry.file) + reserved > 0) return;
+      await this.storage.delete(this.tableObject(entry));
+      const id = this.tableDerivedId(key, entry);
+      for (const suffix of ['.rows.json', '.csv']) {
+        await this.storage.delete(`derived/${id}${suffix}`).catch(() => {});
+      }
+    };
+    if (!entry.blob) return release();
+
+    await this.storage.delete(`refs/${key}.json`);
+    return this.withBlobLock(entry.file, release);
+  }
+
+  /**
+   * 对照存储列表检查索引，只报告不修改（修复见 repair）
+   * dangling：索引里有、存储里已没有的条目；orphans：存储里有、索引不认识的对象（包括没有引用的 blob）；
+   * missingThumbnails：原图在但缩略图不存在的图片；missingRefs：按内容存储、但引用对象丢失的 key（重启对账后会消失）
+   * 检查开始后写入的条目不算 dangling
+   */
+  async auditStorage() {
+    const startedAt = Date.now();
+    const prefixes = ['images', 'tables', 'blobs', 'refs'];
+    const listed = await Promise.all(prefixes.map(prefix => this.storage.list(prefix, { stat: false })));
+    const files = Object.fromEntries(prefixes.map((prefix, i) => [prefix, new Set(listed[i].map(object => path.posix.basename(object.name)))]));
+    const has = (name) => files[name.slice(0, name.indexOf('/'))].has(path.posix.basename(name));
+    const report = { dangling: [], orphans: [], missingThumbnails: [], missingRefs: [] };
+
+    for (const [key, entry] of this.images) {
+      if (!has(this.imageObject(entry))) {
+        if (entry.mtimeMs < startedAt) report.dangling.push({ type: 'image', key, file: entry.original });
+        continue;
+      }
+      if (!entry.thumb || !has(this.imageObject(entry, entry.thumb))) report.missingThumbnails.push(key);
+      if (entry.blob && !files.refs.has(`${key}.json`) && entry.mtimeMs < startedAt) report.missingRefs.push(key);
+    }
+    for (const [key, entry] of this.tables) {
+      if (!has(this.tableObject(entry))) {
+        if (entry.mtimeMs < startedAt) report.dangling.push({ type: 'table', key, file: entry.file });
+      } else if (entry.blob && !files.refs.has(`${key}.json`) && entry.mtimeMs < startedAt) {
+        report.missingRefs.push(key);
+      }
+    }
+
+    for (const file of files.images) {
+      const parsed = this.parseImageFile(file);
+      const entry = parsed && this.images.get(parsed.key);
+      let reason = null;
+      if (!parsed) reason = 'unknown-file';
+      else if (parsed.thumb) reason = entry && !entry.blob ? null : 'thumbnail-without-original';
+      else if (!entry) reason = 'unindexed';
+      else if (entry.blob || entry.original !== file) reason = 'duplicate-original';
+      if (reason) report.orphans.push({ name: `images/${file}`, key: parsed?.key || null, reason });
+    }
+    for (const file of files.tables) {
+      const ext = path.extname(file).toLowerCase();
+      const key = path.basename(file, ext);
+      let reason = null;
+      if (!TABLE_EXTENSIONS.includes(ext)) reason = 'unknown-file';
+      else if (this.tables.get(key)?.blob || this.tables.get(key)?.file !== file) reason = 'unindexed';
+      if (reason) report.orphans.push({ name: `tables/${file}`, key, reason });
+    }
+    for (const file of files.blobs) {
+      const parsed = this.parseImageFile(file);
+      // 缩略图看它的原图有没有被引用
+      const original = parsed?.thumb ? [...files.blobs].find(other => other !== file && path.basename(other, path.extname(other)) === parsed.key) : file;
+      if (this.blobRefs(original || file) === 0) {
+        report.orphans.push({ name: `blobs/${file}`, key: null, reason: parsed?.thumb ? 'thumbnail-without-original' : 'unreferenced-blob' });
+      }
+    }
+    for (const file of files.refs) {
+      const key = path.basename(file, '.json');
+      if (!this.images.get(key)?.blob && !this.tables.get(key)?.blob) report.orphans.push({ name: `refs/${file}`, key, reason: 'unindexed' });
+    }
+
+    return {
+      ...report,
+      indexed: { images: this.images.size, tables: this.tables.size, blobs: this.blobs.size },
+      objects: Object.fromEntries(prefixes.map(prefix => [prefix, files[prefix].size])),
+      storage: this.storage.name,
+      elapsedMs: Date.now() - startedAt
+    };
+  }
+
+  /**
+   * 按 auditStorage 的结果修复，每一项执行前都重新确认，避免误删检查之后刚写入的对象
+   * dangling: key 列表，对象确实不存在时移出索引；orphans: 对象名列表，能认领的（unindexed）补进索引，
+   * 其余在 deleteOrphans 为 true 时删除（仍被引用的 blob 不删）；thumbnails: key 列表，从原图重新生成缩略图；
+   * refs: key 列表，按索引重写丢失的引用对象
+   */
+  async repair({ dangling = [], orphans = [], thumbnails = [], refs = [], deleteOrphans = false } = {}) {
+    const result = { unindexed: [], adopted: [], deleted: [], thumbnails: [], refs: [], skipped: [] };
+    const skip = (target, reason) => result.skipped.push({ target, reason });
+
+    for (const key of dangling) {
+      const image = this.images.get(key);
+      const table = this.tables.get(key);
+      if (image) {
+        if (await this.storage.stat(this.imageObject(image))) { skip(key, 'exists'); continue; }
+        this.unindexImage(key);
+        clusterService.broadcast('cache:image-delete', { key });
+        await this.releaseImage(key, image);
+        result.unindexed.push(key);
+      } else if (table) {
+        if (await this.storage.stat(this.tableObject(table))) { skip(key, 'exists'); continue; }
+        this.unindexTable(key);
+        await this.releaseTable(key, table);
+        result.unindexed.push(key);
+      } else {
+        skip(key, 'not-indexed');
+      }
+    }
+
+    for (const name of orphans) {
+      const [dir, file] = name.split('/');
+      const stats = file && ['images', 'tables', 'blobs', 'refs'].includes(dir) ? await this.storage.stat(name) : null;
+      if (!stats) { skip(name, 'missing'); continue; }
+      if (await this.adoptObject(dir, file, stats)) { result.adopted.push(name); continue; }
+      if (!deleteOrphans) { skip(name, 'delete-disabled'); continue; }
+      if (dir === 'blobs') {
+        // 和保存同样内容的写入串行：锁里再确认一次没有引用
+        const removed = await this.withBlobLock(file, async (reserved) => {
+          if (this.blobRefs(file) + reserved > 0) return false;
+          await this.storage.delete(name);
+          return true;
+        });
+        if (!removed) { skip(name, 'referenced'); continue; }
+      } else {
+        await this.storage.delete(name);
+      }
+      result.deleted.push(name);
+    }
+
+    for (const key of thumbnails) {
+      const entry = this.images.get(key);
+      const buffer = entry && await this.readObject(this.imageObject(entry));
+      if (!buffer) { skip(key, 'missing'); continue; }
+      const base = entry.blob ? `blobs/${entry.blob}` : `images/${key}`;
+      const thumbnailPath = await this.generateThumbnail(base, buffer, path.extname(entry.original));
+      if (!thumbnailPath) { skip(key, 'thumbnail-failed'); continue; }
+      // 同一 blob 的其他 key 共用这张缩略图
+      const sharing = entry.blob ? [...this.images].filter(([, other]) => other.original === entry.original) : [[key, entry]];
+      for (const [sharedKey, shared] of sharing) {
+        shared.thumb = path.posix.basename(thumbnailPath);
+        clusterService.broadcast('cache:image', { key: sharedKey, ...shared });
+      }
+      this.scheduleSnapshot();
+      result.thumbnails.push(key);
+    }
+
+    for (const key of refs) {
+      const image = this.images.get(key);
+      const entry = image || this.tables.get(key);
+      if (!entry?.blob) { skip(key, 'not-indexed'); continue; }
+      await this.writeRef(key, image ? 'image' : 'table', entry);
+      result.refs.push(key);
+    }
+
+    if (result.unindexed.length || result.adopted.length || result.deleted.length || result.thumbnails.length || result.refs.length) {
+      logger.info('🩺 缓存修复完成', {
+        unindexed: result.unindexed.length,
+        adopted: result.adopted.length,
+        deleted: result.deleted.length,
+        thumbnails: result.thumbnails.length,
+        refs: result.refs.length
+      });
+    }
+    return result;
+  }
+
+  /**
+   * 把索引不认识的对象补进索引并通知其他工作进程：引用对象、旧的原图或表格
+   * 缩略图、重复原图、blob 本身、无法识别的文件不认领
+   */
+  async adoptObject(dir, file, stats) {
+    if (dir === 'refs') {
+      const key = path.basename(file, '.json');
+      if (this.images.has(key) || this.tables.has(key)) return false;
+      const entry = await this.indexRef(key);
+      if (!entry) return false;
+      clusterService.broadcast(this.images.has(key) ? 'cache:image' : 'cache:table', { key, ...entry });
+      return true;
+    }
+    if (dir === 'images') {
+      const parsed = this.parseImageFile(file);
+      if (!parsed || parsed.thumb || this.images.has(parsed.key)) return false;
+      const thumb = `${parsed.key}_thumb${path.extname(file)}`;
+      const hasThumb = Boolean(await this.storage.stat(`images/${thumb}`));
+      const entry = this.indexImage(parsed.key, { ...stats, original: file, thumb: hasThumb ? thumb : null });
+      clusterService.broadcast('cache:image', { key: parsed.key, ...entry });
+      return true;
+    }
+    if (dir !== 'tables') return false;
+    const ext = path.extname(file).toLowerCase();
+    const key = path.basename(file, ext);
+    if (!TABLE_EXTENSIONS.includes(ext) || this.tables.has(key)) return false;
+    const entry = this.indexTable(key, { ...stats, file });
+    clusterService.broadcast('cache:table', { key, ...entry });
+    return true;
+  }
+
   /**
    * 清理旧文件
+   * 旧条目按 images/ 下文件的修改时间清理；按内容存储的图片按 key 的创建时间清理，blob 在最后一个引用删除时释放
    */
   async cleanupOldFiles(maxAgeHours = 24) {
     const now = Date.now();
@@ -231,22 +1344,44 @@ class CacheService {
     let freedSpace = 0;
     
     try {
-      const files = await fs.readdir(this.imageDir);
+      const objects = await this.storage.list('images');
       
-      for (const file of files) {
-        const filePath = path.join(this.imageDir, file);
-        const stats = await fs.stat(filePath);
+      for (const { name, ...stats } of objects) {
+        const file = path.posix.basename(name);
         
         if (now - stats.mtimeMs > maxAge) {
           const fileSize = stats.size;
-          await fs.unlink(filePath);
+          await this.storage.delete(name);
           
           deletedFiles.push(file);
           freedSpace += fileSize;
+
+          const parsed = this.parseImageFile(file);
+          if (parsed?.thumb && this.images.has(parsed.key)) {
+            this.images.get(parsed.key).thumb = null;
+          } else if (parsed) {
+            const removed = this.unindexImage(parsed.key);
+            if (removed) {
+              await this.deleteDerivatives(removed);
+              clusterService.broadcast('cache:image-delete', { key: parsed.key });
+            }
+          }
+        }
+      }
+
+      const expired = [...this.images].filter(([, entry]) => entry.blob && now - entry.mtimeMs > maxAge);
+      for (const [key, entry] of expired) {
+        this.unindexImage(key);
+        clusterService.broadcast('cache:image-delete', { key });
+        const { freed } = await this.releaseImage(key, entry);
+        deletedFiles.push(`${key}.json`);
+        if (freed) {
+          deletedFiles.push(entry.original);
+          freedSpace += freed;
         }
       }
       
-      await this.updateStats();
+      this.stats.lastCleanup = new Date().toISOString();
       
       return {
         deletedCount: deletedFiles.length,
@@ -256,7 +1391,7 @@ class CacheService {
       };
       
     } catch (error) {
-      console.error('Error during cache cleanup:', error);
+      logger.error('❌ 缓存清理失败', error);
       throw error;
     }
   }
@@ -0,0 +1,280 @@
+const cluster = require('cluster');
+const os = require('os');
+const { EventEmitter } = require('events');
+
+// 工作进程数：默认 1（单进程），auto 表示按可用 CPU 核数
+const CLUSTER_WORKERS = process.env.CLUSTER_WORKERS === 'auto'
+  ? os.availableParallelism()
+  : parseInt(process.env.CLUSTER_WORKERS, 10) || 1;
+// 工作进程异常退出后重启前的等待，避免启动即崩溃时疯狂重启
+const CLUSTER_RESTART_DELAY_MS = parseInt(process.env.CLUSTER_RESTART_DELAY_MS, 10) || 1000;
+
+const CHANNEL = 'micro-tomato';
+// 发给主进程的消息的 to
+const PRIMARY = 'primary';
+
+/**
+ * 多进程模式下的进程间消息
+ * 主进程负责 fork 和转发，工作进程之间通过 broadcast / send 同步缓存索引和生图任务；
+ * 需要全局一致的状态（生图槽位、blob 锁）由主进程持有，工作进程用 toPrimary 申请，主进程用 toWorker / toWorkers 回复
+ * 单进程模式下所有方法都是空操作，业务代码不需要区分两种模式
+ */
+class ClusterService extends EventEmitter {
+  constructor() {
+    super();
+    this.setMaxListeners(0);
+    this.enabled = cluster.isWorker && Boolean(process.env.CLUSTER_WORKER_COUNT);
+    this.workerId = this.enabled ? cluster.worker.id : 0;
+    this.workerCount = this.enabled ? parseInt(process.env.CLUSTER_WORKER_COUNT, 10) : 1;
+    this.stats = { sent: 0, received: 0 };
+    // gather() 发出、还在等回复的请求
+    this.pending = new Map();
+    this.nextRequest = 0;
+    // lock() 发出、还没拿到的锁：请求 id -> resolve
+    this.lockRequests = new Map();
+
+    if (this.enabled) {
+      process.on('message', (message) => {
+        if (!message || message.channel !== CHANNEL) return;
+        this.stats.received++;
+        this.emit(message.type, message.payload, message.from);
+      });
+      this.on('gather:reply', ({ requestId, result }) => this.pending.get(requestId)?.add(result));
+      this.on('lock:granted', ({ id, reserved }) => {
+        const resolve = this.lockRequests.get(id);
+        this.lockRequests.delete(id);
+        if (resolve) resolve(reserved);
+      });
+      this.on('worker:exit', () => {
+        // 已退出的进程不会再回复，正在等待的汇总少等一份
+        for (const request of this.pending.values()) request.expect--;
+        for (const request of [...this.pending.values()]) request.check();
+      });
+    }
+  }
+
+  /**
+   * 发给其他所有工作进程（不含自己）
+   */
+  broadcast(type, payload) {
+    this.post({ type, payload, to: null });
+  }
+
+  /**
+   * 发给指定工作进程
+   */
+  send(to, type, payload) {
+    this.post({ type, payload, to });
+  }
+
+  /**
+   * 发给主进程，主进程上以 type 事件触发（第二个参数为发送方的工作进程 id）
+   */
+  toPrimary(type, payload) {
+    this.post({ type, payload, to: PRIMARY });
+  }
+
+  /**
+   * 主进程发给指定工作进程，进程已退出时忽略
+   */
+  toWorker(workerId, type, payload) {
+    const worker = cluster.workers?.[workerId];
+    if (worker?.isConnected()) worker.send({ channel: CHANNEL, type, payload, to: workerId, from: 0 });
+  }
+
+  /**
+   * 主进程发给所有工作进程
+   */
+  toWorkers(type, payload) {
+    for (const id of Object.keys(cluster.workers || {})) this.toWorker(id, type, payload);
+  }
+
+  post({ type, payload, to }) {
+    if (!this.enabled || !process.connected) return;
+    this.stats.sent++;
+    process.send({ channel: CHANNEL, type, payload, to, from: this.workerId });
+  }
+
+  /**
+   * 向其他所有工作进程发请求并收集回复（对方用 respond 注册处理函数）
+   * 超时或有进程退出时返回已收到的部分；单进程模式下返回空数组
+   */
+  gather(type, payload, timeoutMs) {
+    const expected = this.workerCount - 1;
+    if (!this.enabled || expected <= 0) return Promise.resolve([]);
+
+    const requestId = `${this.workerId}:${++this.nextRequest}`;
+    return new Promise(resolve => {
+      const results = [];
+      const request = {
+        expect: expected,
+        add: (result) => {
+          results.push(result);
+          request.check();
+        },
+        check: () => {
+          if (results.length >= request.expect) done();
+        }
+      };
+      const timer = setTimeout(() => done(), timeoutMs);
+      const done = () => {
+        clearTimeout(timer);
+        this.pending.delete(requestId);
+        resolve(results);
+      };
+      this.pending.set(requestId, request);
+      this.broadcast(`gather:${type}`, { requestId, payload });
+    });
+  }
+
+  /**
+   * 注册 gather(type) 的处理函数，handler(payload) 可以返回 Promise
+   */
+  respond(type, handler) {
+    this.on(`gather:${type}`, async ({ requestId, payload }, from) => {
+      this.send(from, 'gather:reply', { requestId, result: await handler(payload) });
+    });
+  }
+
+  /**
+   * 跨工作进程的命名锁，由主进程按申请顺序发放，返回 { release, reserved }
+   * reserved 为拿到锁时其他工作进程对同名资源的占用数（reserve / unreserve）；
+   * 同一工作进程先发出的消息（例如 broadcast）一定先于之后发给别人的锁送达，所以占用释放前的广播拿锁方都已收到
+   * 单进程模式下立即返回，reserved 为 0
+   */
+  lock(name) {
+    if (!this.enabled) return Promise.resolve({ release: () => {}, reserved: 0 });
+    const id = `${this.workerId}:${++this.nextRequest}`;
+    return new Promise(resolve => {
+      this.lockRequests.set(id, resolve);
+      this.toPrimary('lock:acquire', { name, id });
+    }).then(reserved => ({ reserved, release: () => this.toPrimary('lock:release', { name, id }) }));
+  }
+
+  /**
+   * 在主进程登记 / 撤销对资源的占用，其他工作进程拿锁时可以看到
+   */
+  reserve(name) {
+    this.toPrimary('lock:reserve', { name });
+  }
+
+  unreserve(name) {
+    this.toPrimary('lock:unreserve', { name });
+  }
+
+  /**
+   * 主进程：发放 lock() 的锁、记录各工作进程的占用；工作进程退出时释放它持有的锁和占用
+   */
+  serveLocks() {
+    // name -> { holder: { workerId, id } | null, queue: [{ workerId, id }], reserved: Map(workerId -> 占用数) }
+    const locks = new Map();
+    const get = (name) => {
+      if (!locks.has(name)) locks.set(name, { holder: null, queue: [], reserved: new Map() });
+      return locks.get(name);
+    };
+    const next = (name, lock) => {
+      if (!lock.holder && lock.queue.length) {
+        lock.holder = lock.queue.shift();
+        let reserved = 0;
+        for (const [workerId, count] of lock.reserved) if (workerId !== lock.holder.workerId) reserved += count;
+        this.toWorker(lock.holder.workerId, 'lock:granted', { id: lock.holder.id, reserved });
+      }
+      if (!lock.holder && !lock.reserved.size) locks.delete(name);
+    };
+
+    this.on('lock:acquire', ({ name, id }, from) => {
+      const lock = get(name);
+      lock.queue.push({ workerId: from, id });
+      next(name, lock);
+    });
+    this.on('lock:release', ({ name, id }, from) => {
+      const lock = locks.get(name);
+      if (!lock || lock.holder?.workerId !== from || lock.holder.id !== id) return;
+      lock.holder = null;
+      next(name, lock);
+    });
+    this.on('lock:reserve', ({ name }, from) => {
+      const lock = get(name);
+      lock.reserved.set(from, (lock.reserved.get(from) || 0) + 1);
+    });
+    this.on('lock:unreserve', ({ name }, from) => {
+      const lock = locks.get(name);
+      if (!lock) return;
+      const count = (lock.reserved.get(from) || 0) - 1;
+      if (count > 0) lock.reserved.set(from, count);
+      else lock.reserved.delete(from);
+      next(name, lock);
+    });
+    this.on('worker:exit', ({ workerId }) => {
+      for (const [name, lock] of [...locks]) {
+        lock.reserved.delete(workerId);
+        lock.queue = lock.queue.filter(waiter => waiter.workerId !== workerId);
+        if (lock.holder?.workerId === workerId) lock.holder = null;
+        next(name, lock);
+      }
+    });
+  }
+
+  getStats() {
+    return {
+      enabled: this.enabled,
+      workerId: this.workerId,
+      workers: this.workerCount,
+      pid: process.pid,
+      ...this.stats
+    };
+  }
+
+  /**
+   * 主进程入口：按 CLUSTER_WORKERS fork 工作进程并转发进程间消息
+   * 返回 false 表示不需要多进程，调用方直接在当前进程启动服务
+   */
+  startPrimary(workers = CLUSTER_WORKERS) {
+    if (!cluster.isPrimary || workers <= 1) return false;
+    // 延迟加载：logger 依赖本服务
+    const logger = require('./logger');
+
+    const fork = () => cluster.fork({ CLUSTER_WORKER_COUNT: String(workers) });
+    const relay = (from, message) => {
+      if (!message || message.channel !== CHANNEL) return;
+      if (message.to === PRIMARY) {
+        this.emit(message.type, message.payload, from.id);
+        return;
+      }
+      let delivered = false;
+      for (const worker of Object.values(cluster.workers)) {
+        if (worker.id === from.id || !worker.isConnected()) continue;
+        if (message.to === null || message.to === worker.id) {
+          worker.send(message);
+          delivered = true;
+        }
+      }
+      // 目标进程已退出：告诉发送方，让等待回复的一方收尾
+      if (!delivered && message.to !== null && from.isConnected()) {
+        from.send({ channel: CHANNEL, type: 'worker:exit', payload: { workerId: message.to }, to: from.id, from: message.to });
+      }
+    };
+
+    cluster.on('message', relay);
+    cluster.on('exit', (worker, code, signal) => {
+      // 通知其他工作进程：订阅了该进程生图任务的客户端需要收尾
+      relay(worker, { channel: CHANNEL, type: 'worker:exit', payload: { workerId: worker.id }, to: null, from: worker.id });
+      this.emit('worker:exit', { workerId: worker.id });
+      if (worker.exitedAfterDisconnect) return;
+      logger.warn(`⚠️ 工作进程 ${worker.process.pid} 退出 (${signal || code})，${CLUSTER_RESTART_DELAY_MS}ms 后重启`, { pid: worker.process.pid, code, signal });
+      setTimeout(fork, CLUSTER_RESTART_DELAY_MS);
+    });
+
+    cluster.on('online', (worker) => this.emit('worker:online', { workerId: worker.id }));
+    // 生图槽位由主进程统一分配，上限和排队公平性对所有工作进程是全局的
+    require('./generationScheduler').serveWorkers();
+    // 缓存 blob 的写入和删除跨进程串行（见 cacheService.withBlobLock）
+    this.serveLocks();
+
+    logger.info(`🧵 主进程 ${process.pid} 启动 ${workers} 个工作进程`, { workers });
+    for (let i = 0; i < workers; i++) fork();
+    return true;
+  }
+}
+
+module.exports = new ClusterService();
@@ -0,0 +1,100 @@
+// 客户端给出的截止时间上限
+const REQUEST_MAX_TIMEOUT_MS = parseInt(process.env.REQUEST_MAX_TIMEOUT_MS, 10) || 10 * 60 * 1000;
+// 预留给最后一条事件回传的时间
+const DEADLINE_SAFETY_MS = parseInt(process.env.DEADLINE_SAFETY_MS, 10) || 1000;
+
+class DeadlineExceededError extends Error {
+  constructor(stage) {
+    super(`请求已超过截止时间（${stage}）`);
+    this.code = 'DEADLINE_EXCEEDED';
+    this.stage = stage;
+  }
+}
+
+/**
+ * 一次请求的截止时间
+ * 各阶段用 timeout() 把自己的默认超时收缩到剩余预算，用 race() 等待无法取消的 SDK 调用
+ * 到期时 signal 中止，沿用客户端断开时的取消路径
+ */
+class Deadline {
+  constructor(at) {
+    this.at = at;
+    this.controller = new AbortController();
+    this.signal = this.controller.signal;
+    this.timer = null;
+    if (Number.isFinite(at)) {
+      this.timer = setTimeout(() => this.controller.abort(), Math.max(0, at - Date.now()));
+      this.timer.unref();
+    }
+  }
+
+  get bounded() {
+    return Number.isFinite(this.at);
+  }
+
+  remaining() {
+    return this.bounded ? this.at - Date.now() : Infinity;
+  }
+
+  expired() {
+    return this.remaining() <= 0;
+  }
+
+  /**
+   * 阶段超时：默认值与剩余预算取小
+   */
+  timeout(defaultMs) {
+    if (!this.bounded) return defaultMs;
+    return Math.max(1, Math.min(defaultMs, this.remaining()));
+  }
+
+  /**
+   * 剩余时间不足 minMs 时抛出 DEADLINE_EXCEEDED，不再开始注定完不成的工作
+   */
+  check(stage, minMs = 0) {
+    if (this.remaining() <= minMs) throw new DeadlineExceededError(stage);
+  }
+
+  /**
+   * 等待 promise，截止时间先到则以 DEADLINE_EXCEEDED 拒绝（promise 本身不会被取消）
+   */
+  race(promise, stage) {
+    if (!this.bounded) return promise;
+    return new Promise((resolve, reject) => {
+      const timer = setTimeout(() => reject(new DeadlineExceededError(stage)), Math.max(0, this.remaining()));
+      promise.then(
+        (value) => { clearTimeout(timer); resolve(value); },
+        (error) => { clearTimeout(timer); reject(error); }
+      );
+    });
+  }
+
+  clear() {
+    clearTimeout(this.timer);
+  }
+}
+
+class DeadlineService {
+  /**
+   * 从请求头 X-Request-Timeout-Ms（相对时长，避免客户端与服务器时钟不一致）构造截止时间
+   * 没有该请求头时不设截止时间，各阶段沿用默认超时
+   */
+  fromRequest(req) {
+    const timeoutMs = parseInt(req.get('X-Request-Timeout-Ms'), 10);
+    if (!timeoutMs || timeoutMs <= 0) return this.none();
+    return this.after(Math.min(timeoutMs, REQUEST_MAX_TIMEOUT_MS) - DEADLINE_SAFETY_MS);
+  }
+
+  after(ms) {
+    return new Deadline(Date.now() + ms);
+  }
+
+  none() {
+    return new Deadline(Infinity);
+  }
+}
+
+const deadlineService = new DeadlineService();
+deadlineService.DeadlineExceededError = DeadlineExceededError;
+
+module.exports = deadlineService;
@@ -0,0 +1,277 @@
+const crypto = require('crypto');
+const path = require('path');
+const zlib = require('zlib');
+const { Readable } = require('stream');
+const cacheService = require('./cacheService');
+const logger = require('./logger');
+
+// 记住多少个对象的 CRC32（按 blob 或对象名），续传时跳过的文件不用再读一遍
+const EXPORT_CRC_CACHE_SIZE = parseInt(process.env.EXPORT_CRC_CACHE_SIZE, 10) || 10000;
+// 不写 ZIP64：整个包和条目数超过 ZIP 格式上限时拒绝导出
+const ZIP_MAX_BYTES = 0xffffffff;
+const ZIP_MAX_ENTRIES = 0xffff;
+
+// 通用标志：bit 3 表示 CRC 和大小写在数据后面的数据描述符里，bit 11 表示文件名为 UTF-8
+const ZIP_FLAGS = 0x0808;
+const LOCAL_HEADER_SIZE = 30;
+const DESCRIPTOR_SIZE = 16;
+const CENTRAL_HEADER_SIZE = 46;
+const END_RECORD_SIZE = 22;
+
+/**
+ * ZIP 里的时间是 DOS 格式（2 秒精度）；按 UTC 换算，各节点打出的包字节相同
+ */
+function dosDateTime(ms) {
+  const date = new Date(Math.max(ms, Date.UTC(1980, 0, 1)));
+  return {
+    time: (date.getUTCHours() << 11) | (date.getUTCMinutes() << 5) | (date.getUTCSeconds() >> 1),
+    date: ((date.getUTCFullYear() - 1980) << 9) | ((date.getUTCMonth() + 1) << 5) | date.getUTCDate()
+  };
+}
+
+function localHeader(file) {
+  const header = Buffer.alloc(LOCAL_HEADER_SIZE);
+  header.writeUInt32LE(0x04034b50, 0);
+  header.writeUInt16LE(20, 4);
+  header.writeUInt16LE(ZIP_FLAGS, 6);
+  header.writeUInt16LE(0, 8);
+  header.writeUInt16LE(file.dos.time, 10);
+  header.writeUInt16LE(file.dos.date, 12);
+  // CRC 和大小在数据描述符里，这里留 0
+  header.writeUInt16LE(file.nameBytes.length, 26);
+  return Buffer.concat([header, file.nameBytes]);
+}
+
+function descriptor(file, crc) {
+  const buffer = Buffer.alloc(DESCRIPTOR_SIZE);
+  buffer.writeUInt32LE(0x08074b50, 0);
+  buffer.writeUInt32LE(crc, 4);
+  buffer.writeUInt32LE(file.size, 8);
+  buffer.writeUInt32LE(file.size, 12);
+  return buffer;
+}
+
+function centralDirectory(files, crcs, offset) {
+  const records = files.map((file, i) => {
+    const header = Buffer.alloc(CENTRAL_HEADER_SIZE);
+    header.writeUInt32LE(0x02014b50, 0);
+    header.writeUInt16LE(20, 4);
+    header.writeUInt16LE(20, 6);
+    header.writeUInt16LE(ZIP_FLAGS, 8);
+    header.writeUInt16LE(0, 10);
+    header.writeUInt16LE(file.dos.time, 12);
+    header.writeUInt16LE(file.dos.date, 14);
+    header.writeUInt32LE(crcs[i], 16);
+    header.writeUInt32LE(file.size, 20);
+    header.writeUInt32LE(file.size, 24);
+    header.writeUInt16LE(file.nameBytes.length, 28);
+    header.writeUInt32LE(file.offset, 42);
+    return Buffer.concat([header, file.nameBytes]);
+  });
+  const directory = Buffer.concat(records);
+  const end = Buffer.alloc(END_RECORD_SIZE);
+  end.writeUInt32LE(0x06054b50, 0);
+  end.writeUInt16LE(files.length, 8);
+  end.writeUInt16LE(files.length, 10);
+  end.writeUInt32LE(directory.length, 12);
+  end.writeUInt32LE(offset, 16);
+  return Buffer.concat([directory, end]);
+}
+
+/**
+ * 打包导出：一篇论文（或一次生图）的候选图、论文插图、表格和 metadata.json 打成一个 ZIP，边读存储边发送
+ * 文件不压缩（STORE，图片本身已压缩），包的大小和每个字节在发送前就确定，所以可以带 Content-Length、支持 Range 续传；
+ * CRC 写在每个文件后面的数据描述符里，读数据时顺带计算，不需要先把文件读一遍
+ */
+class ExportService {
+  constructor() {
+    // crcKey -> CRC32，按插入顺序淘汰
+    this.crcs = new Map();
+    this.stats = { exports: 0, resumed: 0, bytesSent: 0, crcReads: 0 };
+  }
+
+  /**
+   * 确定包的内容和布局，没有可导出的条目时返回 null
+   * 返回 { files, size, etag, lastModified, filename }；同样的缓存内容总是得到同样的包（ETag 相同）
+   */
+  plan({ paper = null, generation = null } = {}) {
+    const selected = cacheService.exportEntries({ paper, generation });
+    if (!selected) return null;
+
+    const files = [];
+    const add = (name, type, key, entry, object) => files.push({
+      name,
+      type,
+      key,
+      entry,
+      object,
+      size: entry.size,
+      mtimeMs: entry.birthtimeMs,
+      // 内容相同的 blob 的 CRC 相同；旧条目按对象名加大小和时间区分
+      crcKey: entry.blob ? `blob:${path.posix.basename(object)}` : `${object}:${entry.size}:${entry.mtimeMs}`
+    });
+    const width = String(selected.candidates.length).length;
+    selected.candidates.forEach(([key, entry], i) => {
+      add(`candidates/${String(i + 1).padStart(width, '0')}_${key}${path.extname(entry.original)}`, 'image', key, entry, cacheService.imageObject(entry));
+    });
+    for (const [key, entry] of selected.figures) {
+      add(`figures/${key}${path.extname(entry.original)}`, 'image', key, entry, cacheService.imageObject(entry));
+    }
+    for (const [key, entry] of selected.tables) {
+      add(`tables/${key}${path.extname(entry.file)}`, 'table', key, entry, cacheService.tableObject(entry));
+    }
+
+    const lastModified = Math.max(...files.map(file => file.mtimeMs));
+    const metadata = Buffer.from(JSON.stringify({
+      paper: selected.paper,
+      generation: selected.generation,
+      files: files.map(file => ({
+        path: file.name,
+        key: file.key,
+        type: file.type,
+        kind: file.type === 'table' ? 'table' : file.entry.kind,
+        size: file.size,
+        blob: file.entry.blob,
+        createdAt: new Date(file.entry.birthtimeMs).toISOString()
+      }))
+    }, null, 2));
+    files.push({ name: 'metadata.json', buffer: metadata, size: metadata.length, mtimeMs: lastModified, crc: zlib.crc32(metadata) });
+
+    let offset = 0;
+    for (const file of files) {
+      file.nameBytes = Buffer.from(file.name, 'utf8');
+      file.dos = dosDateTime(file.mtimeMs);
+      file.offset = offset;
+      file.header = localHeader(file);
+      offset += file.header.length + file.size + DESCRIPTOR_SIZE;
+    }
+    const directoryOffset = offset;
+    const directorySize = files.reduce((sum, file) => sum + CENTRAL_HEADER_SIZE + file.nameBytes.length, 0);
+    const size = directoryOffset + directorySize + END_RECORD_SIZE;
+    if (size > ZIP_MAX_BYTES || files.length > ZIP_MAX_ENTRIES) {
+      throw Object.assign(new Error(`导出内容超过 ZIP 上限（${files.length} 个文件，${size} 字节）`), { code: 'EXPORT_TOO_LARGE' });
+    }
+
+    const id = selected.generation || selected.paper;
+    return {
+      files,
+      directoryOffset,
+      size,
+      // metadata.json 列出了每个文件的路径、大小和 blob，内容不变时包的每个字节都不变
+      etag: `"${crypto.createHash('sha1').update(metadata).digest('hex')}"`,
+      lastModified,
+      filename: `${selected.generation ? 'generation' : 'paper'}-${String(id).replace(/[^\w.-]/g, '_')}.zip`
+    };
+  }
+
+  /**
+   * 按字节区间 [start, end] 生成包内容的可读流；数据直接从存储流过，内存占用与包大小无关
+   * 续传时跳过的文件如果 CRC 不在缓存里，要读一遍（不发送）来算出数据描述符和中央目录
+   */
+  stream(plan, { start = 0, end = plan.size - 1 } = {}) {
+    if (start > 0) this.stats.resumed++;
+    this.stats.exports++;
+    const service = this;
+
+    async function* generate() {
+      const startedAt = Date.now();
+      let sent = 0;
+      // 把 [offset, offset + buffer.length) 里落在请求区间内的部分发出去
+      const clip = (buffer, offset) => {
+        const from = Math.max(start - offset, 0);
+        const to = Math.min(end - offset + 1, buffer.length);
+        return from < to ? buffer.subarray(from, to) : null;
+      };
+
+      for (const file of plan.files) {
+        if (file.offset > end) break;
+        const header = clip(file.header, file.offset);
+        if (header) { sent += header.length; yield header; }
+
+        const dataOffset = file.offset + file.header.length;
+        const descriptorOffset = dataOffset + file.size;
+        const wantsData = start < descriptorOffset && end >= dataOffset;
+        const wantsDescriptor = start < descriptorOffset + DESCRIPTOR_SIZE && end >= descriptorOffset;
+        if (wantsData) {
+          for await (const chunk of service.readFile(file, start - dataOffset, end - dataOffset)) {
+            sent += chunk.length;
+            yield chunk;
+          }
+        }
+        if (wantsDescriptor) {
+          const tail = clip(descriptor(file, await service.crcOf(file)), descriptorOffset);
+          sent += tail.length;
+          yield tail;
+        }
+      }
+
+      if (end >= plan.directoryOffset) {
+        const crcs = [];
+        for (const file of plan.files) crcs.push(await service.crcOf(file));
+        const tail = clip(centralDirectory(plan.files, crcs, plan.directoryOffset), plan.directoryOffset);
+        if (tail) { sent += tail.length; yield tail; }
+      }
+
+      service.stats.bytesSent += sent;
+      logger.info('📦 导出完成', { filename: plan.filename, files: plan.files.length, bytes: sent, resumedAt: start || undefined, elapsedMs: Date.now() - startedAt });
+    }
+
+    return Readable.from(generate(), { objectMode: false });
+  }
+
+  /**
+   * 读取文件在 [from, to]（文件内偏移）里的数据；CRC 未知时整个文件读一遍顺带计算，只发出区间内的部分
+   */
+  async *readFile(file, from, to) {
+    from = Math.max(from, 0);
+    to = Math.min(to, file.size - 1);
+    if (file.buffer) {
+      yield file.buffer.subarray(from, to + 1);
+      return;
+    }
+    const known = this.crcs.has(file.crcKey);
+    if (known && from > to) return;
+    const object = await cacheService.storage.open(file.object, known ? { start: from, end: to } : {});
+    if (!object) throw new Error(`导出过程中对象已不存在: ${file.object}`);
+
+    let crc = 0;
+    let position = known ? from : 0;
+    for await (const chunk of object.stream) {
+      if (!known) crc = zlib.crc32(chunk, crc);
+      const slice = chunk.subarray(Math.max(from - position, 0), Math.max(Math.min(to + 1 - position, chunk.length), 0));
+      position += chunk.length;
+      if (slice.length) yield slice;
+    }
+    if (!known) {
+      // 大小对不上说明对象在导出过程中被替换，包已经无法保持一致
+      if (position !== file.size) throw new Error(`对象大小已变化: ${file.object}`);
+      this.stats.crcReads++;
+      this.rememberCrc(file.crcKey, crc);
+    }
+  }
+
+  /**
+   * 文件的 CRC32：缓存里有直接用，否则读一遍对象计算
+   */
+  async crcOf(file) {
+    if (file.crc !== undefined) return file.crc;
+    if (!this.crcs.has(file.crcKey)) {
+      // 区间为空：只读一遍算 CRC，什么都不发出
+      const reader = this.readFile(file, file.size, file.size - 1);
+      while (!(await reader.next()).done);
+    }
+    return this.crcs.get(file.crcKey);
+  }
+
+  rememberCrc(key, crc) {
+    this.crcs.delete(key);
+    this.crcs.set(key, crc);
+    if (this.crcs.size > EXPORT_CRC_CACHE_SIZE) this.crcs.delete(this.crcs.keys().next().value);
+  }
+
+  getStats() {
+    return { ...this.stats, crcCached: this.crcs.size };
+  }
+}
+
+module.exports = new ExportService();
@@ -0,0 +1,400 @@
+const clusterService = require('./clusterService');
+const metricsService = require('./metricsService');
+
+// 全局同时进行的上游生图流上限
+const GENERATION_CONCURRENCY = parseInt(process.env.GENERATION_CONCURRENCY, 10) || 8;
+// 排队上限，超出时直接拒绝（HTTP 429）
+const GENERATION_MAX_QUEUE = parseInt(process.env.GENERATION_MAX_QUEUE, 10) || 64;
+// 没有历史数据时假设一次生图占用槽位的时长
+const GENERATION_ETA_DEFAULT_MS = parseInt(process.env.GENERATION_ETA_DEFAULT_MS, 10) || 60000;
+
+const PRIORITIES = ['interactive', 'batch'];
+
+class QueueCancelledError extends Error {
+  constructor() {
+    super('生图请求已取消');
+    this.code = 'CANCELLED';
+  }
+}
+
+class QueueFullError extends Error {
+  constructor(retryAfterMs) {
+    super('生图队列已满，请稍后重试');
+    this.code = 'QUEUE_FULL';
+    this.retryAfterMs = retryAfterMs;
+  }
+}
+
+/**
+ * 生图准入控制
+ * 全局并发上限；排队时同一优先级内按客户端轮转（公平），interactive 先于 batch
+ * 多进程模式下队列只在主进程（serveWorkers），工作进程的 acquire 经 IPC 向主进程申请，
+ * 上限、排队上限和客户端轮转都是全局的，不会出现一个进程排满返回 429 而其他进程空闲
+ */
+class GenerationScheduler {
+  constructor() {
+    this.concurrency = GENERATION_CONCURRENCY;
+    this.maxQueue = GENERATION_MAX_QUEUE;
+    // 本进程占用的槽位数和排队数（多进程模式下是本工作进程的部分）
+    this.active = 0;
+    // priority -> Map(clientId -> waiter[])，Map 的顺序即轮转顺序
+    this.queues = { interactive: new Map(), batch: new Map() };
+    this.waiting = 0;
+    this.avgHoldMs = GENERATION_ETA_DEFAULT_MS;
+    this.stats = { admitted: 0, queued: 0, rejected: 0, abandoned: 0, cancelledSessions: 0, upstreamMsSaved: 0 };
+    // 主进程上：状态变化时广播给工作进程
+    this.onChange = null;
+    this.changePending = false;
+
+    // 工作进程：向主进程申请的请求 id -> { onQueue, resolve, reject, signal, onAbort, queued }
+    this.remote = clusterService.enabled;
+    this.requests = new Map();
+    this.nextRequest = 0;
+    // 主进程广播的全局状态，准入检查和排队时间估算用
+    this.cluster = this.snapshot();
+    if (this.remote) this.listenPrimary();
+
+    metricsService.gauge('image_streams_active', '占用生图槽位的上游流数', [], () => this.active);
+    metricsService.gauge('image_queue_waiting', '排队等待生图槽位的任务数', [], () => this.waiting);
+  }
+
+  /**
+   * 申请一个生图槽位，返回 release 函数
+   * onQueue({ position, etaMs }) 在排队位置变化时回调
+   * signal 中止时从队列移除并以 CANCELLED 拒绝
+   */
+  acquire({ clientId = 'anonymous', priority = 'interactive', onQueue, signal } = {}) {
+    if (!PRIORITIES.includes(priority)) priority = 'interactive';
+    if (signal?.aborted) return Promise.reject(new QueueCancelledError());
+    if (this.remote) return this.acquireRemote({ clientId, priority, onQueue, signal });
+
+    if (this.active < this.concurrency && this.waiting === 0) {
+      return Promise.resolve(this.grant());
+    }
+    if (this.waiting >= this.maxQueue) {
+      this.stats.rejected++;
+      return Promise.reject(new QueueFullError(this.estimateWait(this.waiting)));
+    }
+
+    return new Promise((resolve, reject) => {
+      const waiter = { clientId, priority, onQueue, resolve, enqueuedAt: Date.now() };
+      const queues = this.queues[priority];
+      if (!queues.has(clientId)) queues.set(clientId, []);
+      queues.get(clientId).push(waiter);
+      this.waiting++;
+      this.stats.queued++;
+      this.changed();
+
+      if (signal) {
+        const onAbort = () => {
+          if (this.remove(waiter)) reject(new QueueCancelledError());
+        };
+        signal.addEventListener('abort', onAbort, { once: true });
+        waiter.resolve = (release) => {
+          signal.removeEventListener('abort', onAbort);
+          resolve(release);
+        };
+      }
+      this.notifyPositions();
+    });
+  }
+
+  /**
+   * 把还在排队的等待者移出队列，已出队返回 false
+   */
+  remove(waiter) {
+    const queues = this.queues[waiter.priority];
+    const list = queues.get(waiter.clientId);
+    const index = list ? list.indexOf(waiter) : -1;
+    if (index === -1) return false;
+
+    list.splice(index, 1);
+    if (!list.length) queues.delete(waiter.clientId);
+    this.waiting--;
+    this.stats.abandoned++;
+    this.notifyPositions();
+    this.changed();
+    return true;
+  }
+
+  /**
+   * 记录一次被取消的生图会话及其省下的上游时间
+   */
+  recordCancellation(savedMs) {
+    this.stats.cancelledSessions++;
+    this.stats.upstreamMsSaved += Math.round(savedMs);
+  }
+
+  /**
+   * 请求入口的准入检查：需要 slots 个槽位时队列是否放得下
+   * 放不下返回 { retryAfterMs }，否则返回 null
+   */
+  admissionCheck(slots = 1) {
+    // 多进程模式下按主进程最近广播的全局状态判断；状态略有滞后，真正排队时主进程仍会按上限拒绝
+    const { active, waiting } = this.remote ? this.cluster : this;
+    const free = Math.max(0, this.concurrency - active);
+    const needQueue = Math.max(0, slots - free);
+    if (waiting + needQueue > this.maxQueue) {
+      this.stats.rejected++;
+      return { retryAfterMs: this.estimateWait(waiting) };
+    }
+    return null;
+  }
+
+  grant() {
+    this.active++;
+    this.stats.admitted++;
+    this.changed();
+    const startedAt = Date.now();
+    let released = false;
+
+    // cancelled 为 true 时不计入平均时长，避免中途取消拉低排队估算
+    return ({ cancelled = false } = {}) => {
+      if (released) return;
+      released = true;
+      this.active--;
+      // 指数滑动平均，用于估算排队时间
+      if (!cancelled) this.avgHoldMs = this.avgHoldMs * 0.8 + (Date.now() - startedAt) * 0.2;
+      this.dispatch();
+      this.changed();
+    };
+  }
+
+  /**
+   * 工作进程：经主进程申请槽位，返回值和本地 acquire 一致
+   * signal 中止时通知主进程移出队列；主进程已分配的槽位在收到时立即归还
+   */
+  acquireRemote({ clientId, priority, onQueue, signal }) {
+    return new Promise((resolve, reject) => {
+      const id = ++this.nextRequest;
+      const request = { onQueue, resolve, reject, signal, onAbort: null, queued: false };
+      if (signal) {
+        request.onAbort = () => clusterService.toPrimary('scheduler:cancel', { id });
+        signal.addEventListener('abort', request.onAbort, { once: true });
+      }
+      this.requests.set(id, request);
+      this.waiting++;
+      clusterService.toPrimary('scheduler:acquire', { id, clientId, priority });
+    });
+  }
+
+  /**
+   * 工作进程：处理主进程的排队位置、分配、拒绝和全局状态消息
+   */
+  listenPrimary() {
+    const take = (id) => {
+      const request = this.requests.get(id);
+      if (!request) return null;
+      this.requests.delete(id);
+      this.waiting--;
+      request.signal?.removeEventListener('abort', request.onAbort);
+      return request;
+    };
+
+    clusterService.on('scheduler:state', (state) => {
+      this.cluster = state;
+      this.avgHoldMs = state.avgHoldMs;
+    });
+    clusterService.on('scheduler:queue', ({ id, position, etaMs }) => {
+      const request = this.requests.get(id);
+      if (!request) return;
+      if (!request.queued) this.stats.queued++;
+      request.queued = true;
+      request.onQueue?.({ position, etaMs });
+    });
+    clusterService.on('scheduler:grant', ({ id }) => {
+      const request = take(id);
+      if (!request || request.signal?.aborted) {
+        // 取消消息和分配消息在路上交错：归还槽位
+        clusterService.toPrimary('scheduler:release', { id, cancelled: true });
+        if (request) {
+          this.stats.abandoned++;
+          request.reject(new QueueCancelledError());
+        }
+        return;
+      }
+      this.active++;
+      this.stats.admitted++;
+      let released = false;
+      request.resolve(({ cancelled = false } = {}) => {
+        if (released) return;
+        released = true;
+        this.active--;
+        clusterService.toPrimary('scheduler:release', { id, cancelled });
+      });
+    });
+    clusterService.on('scheduler:reject', ({ id, code, retryAfterMs }) => {
+      const request = take(id);
+      if (!request) return;
+      if (code === 'QUEUE_FULL') {
+        this.stats.rejected++;
+        request.reject(new QueueFullError(retryAfterMs));
+      } else {
+        this.stats.abandoned++;
+        request.reject(new QueueCancelledError());
+      }
+    });
+  }
+
+  /**
+   * 主进程：替工作进程排队和占用槽位，按"工作进程:请求 id"记录；工作进程退出时移出它的排队、归还它占用的槽位
+   */
+  serveWorkers() {
+    const waiters = new Map();
+    const grants = new Map();
+    const keyOf = (workerId, id) => `${workerId}:${id}`;
+    const ofWorker = (map, workerId) => [...map.keys()].filter(key => key.startsWith(`${workerId}:`));
+
+    clusterService.on('scheduler:acquire', ({ id, clientId, priority }, from) => {
+      const key = keyOf(from, id);
+      const controller = new AbortController();
+      waiters.set(key, controller);
+      this.acquire({
+        clientId,
+        priority,
+        signal: controller.signal,
+        onQueue: (queued) => clusterService.toWorker(from, 'scheduler:queue', { id, ...queued })
+      }).then((release) => {
+        waiters.delete(key);
+        if (controller.signal.aborted) {
+          // 分配和取消同时发生：槽位直接归还
+          release({ cancelled: true });
+          clusterService.toWorker(from, 'scheduler:reject', { id, code: 'CANCELLED' });
+          return;
+        }
+        grants.set(key, release);
+        clusterService.toWorker(from, 'scheduler:grant', { id });
+      }, (error) => {
+        waiters.delete(key);
+        clusterService.toWorker(from, 'scheduler:reject', { id, code: error.code, retryAfterMs: error.retryAfterMs });
+      });
+    });
+    clusterService.on('scheduler:release', ({ id, cancelled }, from) => {
+      const key = keyOf(from, id);
+      const release = grants.get(key);
+      grants.delete(key);
+      if (release) release({ cancelled });
+    });
+    clusterService.on('scheduler:cancel', ({ id }, from) => waiters.get(keyOf(from, id))?.abort());
+    clusterService.on('worker:exit', ({ workerId }) => {
+      for (const key of ofWorker(waiters, workerId)) waiters.get(key).abort();
+      for (const key of ofWorker(grants, workerId)) {
+        const release = grants.get(key);
+        grants.delete(key);
+        release({ cancelled: true });
+      }
+    });
+    clusterService.on('worker:online', ({ workerId }) => clusterService.toWorker(workerId, 'scheduler:state', this.snapshot()));
+    this.onChange = (state) => clusterService.toWorkers('scheduler:state', state);
+  }
+
+  /**
+   * 状态有变化时（同一轮事件循环内合并为一次）通知 onChange
+   */
+  changed() {
+    if (!this.onChange || this.changePending) return;
+    this.changePending = true;
+    setImmediate(() => {
+      this.changePending = false;
+      this.onChange(this.snapshot());
+    });
+  }
+
+  snapshot() {
+    const count = (priority) => [...this.queues[priority].values()].reduce((sum, list) => sum + list.length, 0);
+    return {
+      active: this.active,
+      waiting: this.waiting,
+      waitingByPriority: { interactive: count('interactive'), batch: count('batch') },
+      queuedClients: this.queues.interactive.size + this.queues.batch.size,
+      avgHoldMs: Math.round(this.avgHoldMs)
+    };
+  }
+
+  /**
+   * 取出下一个等待者：先 interactive 再 batch，同一优先级内客户端轮转
+   */
+  nextWaiter() {
+    for (const priority of PRIORITIES) {
+      const queues = this.queues[priority];
+      for (const [clientId, list] of queues) {
+        const waiter = list.shift();
+        // 移到末尾，下一次轮到其他客户端
+        queues.delete(clientId);
+        if (list.length) queues.set(clientId, list);
+        if (waiter) return waiter;
+      }
+    }
+    return null;
+  }
+
+  dispatch() {
+    let granted = false;
+    while (this.active < this.concurrency && this.waiting > 0) {
+      const waiter = this.nextWaiter();
+      if (!waiter) break;
+      this.waiting--;
+      granted = true;
+      waiter.resolve(this.grant());
+    }
+    if (granted) this.notifyPositions();
+  }
+
+  /**
+   * 按实际出队顺序模拟一遍，得到每个等待者前面还有多少任务
+   */
+  dispatchOrder() {
+    const order = [];
+    for (const priority of PRIORITIES) {
+      const lists = [...this.queues[priority].values()].map(list => [...list]);
+      let remaining = lists.reduce((sum, list) => sum + list.length, 0);
+      while (remaining > 0) {
+        for (const list of lists) {
+          if (list.length) {
+            order.push(list.shift());
+            remaining--;
+          }
+        }
+      }
+    }
+    return order;
+  }
+
+  estimateWait(position) {
+    return Math.ceil((position + 1) / this.concurrency) * Math.round(this.avgHoldMs);
+  }
+
+  notifyPositions() {
+    this.dispatchOrder().forEach((waiter, position) => {
+      if (waiter.onQueue && waiter.lastPosition !== position) {
+        waiter.lastPosition = position;
+        waiter.onQueue({ position, etaMs: this.estimateWait(position) });
+      }
+    });
+  }
+
+  getStats() {
+    // 多进程模式下 active / waiting 等是全局值（主进程广播），local 为本工作进程的部分；计数类统计是本进程的
+    const state = this.remote ? this.cluster : this.snapshot();
+    return {
+      scope: this.remote ? 'cluster' : 'process',
+      concurrency: this.concurrency,
+      maxQueue: this.maxQueue,
+      active: state.active,
+      waiting: state.waitingByPriority,
+      queuedClients: state.queuedClients,
+      avgHoldMs: state.avgHoldMs,
+      ...(this.remote ? { local: { active: this.active, waiting: this.waiting } } : {}),
+      ...this.stats,
+      avgUpstreamMsSavedPerCancel: this.stats.cancelledSessions
+        ? Math.round(this.stats.upstreamMsSaved / this.stats.cancelledSessions)
+        : 0
+    };
+  }
+}
+
+const scheduler = new GenerationScheduler();
+scheduler.QueueFullError = QueueFullError;
+scheduler.QueueCancelledError = QueueCancelledError;
+
+module.exports = scheduler;
@@ -0,0 +1,263 @@
+const { EventEmitter } = require('events');
+const { v4: uuidv4 } = require('uuid');
+const aiService = require('./aiService');
+const clusterService = require('./clusterService');
+const metricsService = require('./metricsService');
+const tracingService = require('./tracingService');
+const logger = require('./logger');
+
+// 任务结束后保留多久，供迟到的订阅者回放
+const GENERATION_TTL_MS = parseInt(process.env.GENERATION_TTL_MS, 10) || 10 * 60 * 1000;
+// 提前启动的任务在这段时间内没人订阅就取消（客户端已离开）
+const GENERATION_ORPHAN_TIMEOUT_MS = parseInt(process.env.GENERATION_ORPHAN_TIMEOUT_MS, 10) || 60 * 1000;
+
+/**
+ * 生图任务登记表
+ * 提示词一生成就可以开工，客户端之后再通过 generationId 订阅结果
+ * 多进程模式下任务留在启动它的工作进程，其他进程收到订阅请求时经进程间消息转发事件
+ */
+class GenerationService {
+  constructor() {
+    this.generations = new Map();
+    // 其他工作进程上的任务：generationId -> 所属工作进程
+    this.remote = new Map();
+    // 本进程替其他进程的客户端订阅的任务：subId -> { controller, subscriber }
+    this.relays = new Map();
+    // 本进程客户端订阅的远程任务：subId -> { owner, onChunk, finish }
+    this.remoteSubscriptions = new Map();
+    this.nextSubscription = 0;
+
+    metricsService.gauge('generations_in_flight', '正在运行的生图任务数', [], () => {
+      let running = 0;
+      for (const generation of this.generations.values()) if (generation.status === 'running') running++;
+      return running;
+    });
+
+    clusterService.on('generation:start', ({ id }, from) => this.remote.set(id, from));
+    clusterService.on('generation:expire', ({ id }) => this.remote.delete(id));
+    clusterService.on('generation:cancel', ({ id, reason }) => this.cancel(id, reason));
+    clusterService.on('generation:attach', (message, from) => this.serveRemote(message, from));
+    clusterService.on('generation:detach', ({ subId }) => this.relays.get(subId)?.controller.abort());
+    clusterService.on('generation:chunk', ({ subId, chunk }) => this.remoteSubscriptions.get(subId)?.onChunk(chunk));
+    clusterService.on('generation:done', ({ subId, status }) => this.remoteSubscriptions.get(subId)?.finish(status));
+    clusterService.on('worker:exit', ({ workerId }) => this.forgetWorker(workerId));
+  }
+
+  /**
+   * 启动生图任务，返回 generationId
+   * options: { clientId, priority } 交给全局调度器，{ candidates, modality, hedge } 为生图参数
+   * detached 为 true 表示稍后才会有人订阅，超时无人订阅即取消
+   * deadline 到期时取消任务
+   */
+  start(prompt, options = {}) {
+    const { detached = false, ...generationOptions } = options;
+    // 多进程模式下 id 带上所属工作进程，广播还没送达时其他进程也能找到任务
+    const id = clusterService.enabled ? `w${clusterService.workerId}-${uuidv4()}` : uuidv4();
+    const controller = new AbortController();
+    const generation = {
+      id,
+      prompt,
+      status: 'running',
+      chunks: [],
+      queue: null,
+      emitter: new EventEmitter(),
+      controller,
+      subscribers: 0,
+      orphanTimer: null,
+      createdAt: Date.now(),
+      finishedAt: null,
+      // 发起生图的那条链路；稍后订阅的请求在自己的 span 上记下它，两条链路可以互相找到
+      traceId: tracingService.current()?.traceId || null
+    };
+    generation.emitter.setMaxListeners(0);
+    this.generations.set(id, generation);
+
+    const record = (chunk) => {
+      // 排队状态只保留最新一条，不进入回放历史
+      if (chunk.type === 'queue') {
+        generation.queue = chunk;
+      } else {
+        generation.chunks.push(chunk);
+      }
+      generation.emitter.emit('chunk', chunk);
+    };
+
+    if (generationOptions.deadline) {
+      generationOptions.deadline.signal.addEventListener('abort', () => this.cancel(id, '超过截止时间'), { once: true });
+    }
+
+    if (detached) {
+      generation.orphanTimer = setTimeout(() => {
+        if (generation.subscribers === 0) this.cancel(id, '无人订阅');
+      }, GENERATION_ORPHAN_TIMEOUT_MS);
+      generation.orphanTimer.unref();
+    }
+
+    aiService.generateFromPaper(prompt, record, { ...generationOptions, generation: id, signal: controller.signal })
+      .then(result => {
+        generation.status = result.cancelled ? 'cancelled' : 'complete';
+        generation.result = result;
+      })
+      .catch(error => {
+        generation.status = 'failed';
+        generation.error = error.message;
+        record({ type: 'error', error: error.message });
+      })
+      .finally(() => {
+        clearTimeout(generation.orphanTimer);
+        generation.finishedAt = Date.now();
+        generation.emitter.emit('done');
+        setTimeout(() => {
+          this.generations.delete(id);
+          clusterService.broadcast('generation:expire', { id });
+        }, GENERATION_TTL_MS).unref();
+      });
+
+    clusterService.broadcast('generation:start', { id });
+    logger.info(`🎬 生图任务已启动: ${id}`, { generationId: id });
+    return id;
+  }
+
+  get(id) {
+    return this.generations.get(id) || null;
+  }
+
+  /**
+   * 任务是否存在（本进程或其他工作进程）
+   */
+  has(id) {
+    return this.generations.has(id) || this.ownerOf(id) !== null;
+  }
+
+  /**
+   * 远程任务所属的工作进程，本进程或未知时返回 null
+   */
+  ownerOf(id) {
+    if (this.remote.has(id)) return this.remote.get(id);
+    const match = /^w(\d+)-/.exec(id || '');
+    const owner = match ? Number(match[1]) : null;
+    return owner && owner !== clusterService.workerId && !this.generations.has(id) ? owner : null;
+  }
+
+  /**
+   * 取消仍在运行的任务，中止全部上游请求
+   */
+  cancel(id, reason = '客户端断开') {
+    if (!this.generations.has(id) && this.ownerOf(id) !== null) {
+      clusterService.send(this.ownerOf(id), 'generation:cancel', { id, reason });
+      return true;
+    }
+    const generation = this.get(id);
+    if (!generation || generation.status !== 'running' || generation.controller.signal.aborted) return false;
+    logger.info(`🛑 取消生图任务 ${id}: ${reason}`, { generationId: id });
+    generation.controller.abort();
+    return true;
+  }
+
+  /**
+   * 订阅任务：先回放已产生的事件，再推送后续事件，任务结束时 resolve
+   * signal 中止表示该订阅者断开；最后一个订阅者离开时取消任务
+   */
+  attach(id, onChunk, { signal } = {}) {
+    const generation = this.get(id);
+    if (!generation) return this.ownerOf(id) !== null ? this.attachRemote(id, onChunk, { signal }) : null;
+
+    tracingService.current()?.addEvent('generation.attach', { generationId: id, generationTraceId: generation.traceId, replayed: generation.chunks.length });
+    generation.chunks.forEach(onChunk);
+    if (generation.status !== 'running') return Promise.resolve(generation);
+    if (generation.queue && generation.queue.waiting > 0) onChunk(generation.queue);
+
+    generation.subscribers++;
+    clearTimeout(generation.orphanTimer);
+
+    return new Promise(resolve => {
+      const listener = (chunk) => onChunk(chunk);
+      const detach = () => {
+        generation.emitter.off('chunk', listener);
+        generation.emitter.off('done', onDone);
+        generation.subscribers--;
+      };
+      const onDone = () => {
+        if (signal) signal.removeEventListener('abort', onAbort);
+        detach();
+        resolve(generation);
+      };
+      const onAbort = () => {
+        detach();
+        if (generation.subscribers === 0) this.cancel(id);
+        resolve(generation);
+      };
+
+      generation.emitter.on('chunk', listener);
+      generation.emitter.once('done', onDone);
+      if (signal) {
+        if (signal.aborted) return onAbort();
+        signal.addEventListener('abort', onAbort, { once: true });
+      }
+    });
+  }
+
+  /**
+   * 订阅其他工作进程上的任务，语义与 attach 相同（回放 + 后续事件，断开即退订）
+   */
+  attachRemote(id, onChunk, { signal } = {}) {
+    const owner = this.ownerOf(id);
+    const subId = `${clusterService.workerId}:${++this.nextSubscription}`;
+
+    return new Promise(resolve => {
+      const finish = (status) => {
+        if (!this.remoteSubscriptions.delete(subId)) return;
+        if (status === 'missing') onChunk({ type: 'error', error: '生图任务不存在或已过期' });
+        if (signal) signal.removeEventListener('abort', onAbort);
+        resolve({ id, status });
+      };
+      const onAbort = () => {
+        clusterService.send(owner, 'generation:detach', { subId });
+        finish('detached');
+      };
+
+      this.remoteSubscriptions.set(subId, { owner, onChunk, finish });
+      if (signal) {
+        if (signal.aborted) return onAbort();
+        signal.addEventListener('abort', onAbort, { once: true });
+      }
+      clusterService.send(owner, 'generation:attach', { id, subId });
+    });
+  }
+
+  /**
+   * 任务所在进程：代替其他进程的客户端订阅，把事件转发回去
+   */
+  serveRemote({ id, subId }, subscriber) {
+    const controller = new AbortController();
+    const done = this.attach(id, (chunk) => clusterService.send(subscriber, 'generation:chunk', { subId, chunk }), { signal: controller.signal });
+    if (!done) {
+      clusterService.send(subscriber, 'generation:done', { subId, status: 'missing' });
+      return;
+    }
+    this.relays.set(subId, { controller, subscriber });
+    done.then(generation => {
+      this.relays.delete(subId);
+      if (!controller.signal.aborted) clusterService.send(subscriber, 'generation:done', { subId, status: generation.status });
+    });
+  }
+
+  /**
+   * 工作进程退出：它的任务不再可订阅，正在订阅的客户端收到错误后结束；它的客户端订阅一并退订
+   */
+  forgetWorker(workerId) {
+    for (const [id, owner] of this.remote) {
+      if (owner === workerId) this.remote.delete(id);
+    }
+    for (const subscription of [...this.remoteSubscriptions.values()]) {
+      if (subscription.owner !== workerId) continue;
+      subscription.onChunk({ type: 'error', error: '生图任务所在的工作进程已退出' });
+      subscription.finish('failed');
+    }
+    for (const relay of this.relays.values()) {
+      if (relay.subscriber === workerId) relay.controller.abort();
+    }
+  }
+}
+
+module.exports = new GenerationService();
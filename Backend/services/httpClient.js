@@ -0,0 +1,198 @@
+const http = require('http');
+const https = require('https');
+const axios = require('axios');
+const tracingService = require('./tracingService');
+
+const UPSTREAM_MAX_SOCKETS = parseInt(process.env.UPSTREAM_MAX_SOCKETS, 10) || 16;
+const UPSTREAM_MAX_FREE_SOCKETS = parseInt(process.env.UPSTREAM_MAX_FREE_SOCKETS, 10) || 8;
+const UPSTREAM_IDLE_TIMEOUT_MS = parseInt(process.env.UPSTREAM_IDLE_TIMEOUT_MS, 10) || 60000;
+// 启动预热单个主机的超时
+const UPSTREAM_WARM_TIMEOUT_MS = parseInt(process.env.UPSTREAM_WARM_TIMEOUT_MS, 10) || 5000;
+
+// 单独限制某些主机的连接池大小，例如 "aihubmix.com=8,api.aihubmix.com=4"
+const parseHostList = (value) => (value || '')
+  .split(',')
+  .map(s => s.trim())
+  .filter(Boolean);
+const UPSTREAM_POOL_LIMITS = Object.fromEntries(
+  parseHostList(process.env.UPSTREAM_POOL_LIMITS).map(item => {
+    const [host, limit] = item.split('=');
+    return [host.trim(), parseInt(limit, 10)];
+  })
+);
+// 支持 HTTP/2 的上游主机（axios >= 1.13 的 httpVersion: 2）
+const UPSTREAM_HTTP2_HOSTS = new Set(parseHostList(process.env.UPSTREAM_HTTP2_HOSTS));
+
+/**
+ * 共享的上游 HTTP 客户端
+ * 每个主机一个 keep-alive 连接池，记录新建/复用连接数，所有出站请求都走这里
+ */
+class HttpClient {
+  constructor() {
+    // host -> { agent, requests, newConnections, reusedConnections, errors }
+    this.pools = new Map();
+
+    this.client = axios.create();
+    this.client.interceptors.request.use((config) => {
+      const url = new URL(config.url, config.baseURL);
+      const pool = this.poolFor(url);
+      pool.requests++;
+      // 出站请求记一个 span，并把 traceparent 传给上游；导出链路自身的请求（tracing: false）除外
+      if (config.tracing !== false && tracingService.current()) {
+        const method = (config.method || 'get').toUpperCase();
+        config.span = tracingService.startSpan(`upstream ${method} ${url.host}`, {
+          'http.method': method,
+          'http.url': `${url.origin}${url.pathname}`
+        });
+        config.headers.traceparent = config.span.traceparent;
+      }
+      if (UPSTREAM_HTTP2_HOSTS.has(url.hostname)) {
+        config.httpVersion = 2;
+      } else if (url.protocol === 'https:') {
+        config.httpsAgent = pool.agent;
+      } else {
+        config.httpAgent = pool.agent;
+      }
+      return config;
+    });
+    this.client.interceptors.response.use(
+      (response) => {
+        this.recordReuse(response.request);
+        // 流式响应在收到响应头时结束 span，读取响应体的时间算在调用方的 span 里
+        response.config.span?.end({ 'http.status_code': response.status, 'net.reused_socket': Boolean(response.request?.reusedSocket) });
+        return response;
+      },
+      (error) => {
+        error.config?.span?.fail(error).end({ 'http.status_code': error.response?.status });
+        if (error.config?.url) {
+          const pool = this.pools.get(this.poolKey(new URL(error.config.url, error.config.baseURL)));
+          if (pool) pool.errors++;
+        }
+        if (error.request) this.recordReuse(error.request);
+        return Promise.reject(error);
+      }
+    );
+
+    // Adobe SDK 等第三方库使用全局 agent，同样换成带统计的 keep-alive 池
+    http.globalAgent = this.registerPool('global:http', http, UPSTREAM_MAX_SOCKETS).agent;
+    https.globalAgent = this.registerPool('global:https', https, UPSTREAM_MAX_SOCKETS).agent;
+  }
+
+  poolKey(url) {
+    return `${url.protocol}//${url.host}`;
+  }
+
+  poolFor(url) {
+    const key = this.poolKey(url);
+    if (!this.pools.has(key)) {
+      const limit = UPSTREAM_POOL_LIMITS[url.hostname] || UPSTREAM_MAX_SOCKETS;
+      this.registerPool(key, url.protocol === 'https:' ? https : http, limit);
+    }
+    return this.pools.get(key);
+  }
+
+  /**
+   * 某个 URL 对应的连接池 agent（供原生 http/https 请求使用）
+   */
+  agentFor(url) {
+    return this.poolFor(new URL(url)).agent;
+  }
+
+  registerPool(key, protocol, maxSockets) {
+    const agent = new protocol.Agent({
+      keepAlive: true,
+      keepAliveMsecs: 1000,
+      maxSockets,
+      maxFreeSockets: UPSTREAM_MAX_FREE_SOCKETS,
+      timeout: UPSTREAM_IDLE_TIMEOUT_MS,
+      scheduling: 'lifo'
+    });
+    const pool = {
+      key,
+      agent,
+      maxSockets,
+      requests: 0,
+      newConnections: 0,
+      reusedConnections: 0,
+      errors: 0
+    };
+
+    // 统计新建连接
+    const createConnection = agent.createConnection.bind(agent);
+    agent.createConnection = (...args) => {
+      pool.newConnections++;
+      return createConnection(...args);
+    };
+
+    this.pools.set(key, pool);
+    return pool;
+  }
+
+  recordReuse(request) {
+    if (!request || !request.reusedSocket) return;
+    for (const pool of this.pools.values()) {
+      if (pool.agent === request.agent) {
+        pool.reusedConnections++;
+        return;
+      }
+    }
+  }
+
+  /**
+   * 预热连接：发一个 HEAD 请求完成 DNS/TCP/TLS，连接留在池里供第一次真实请求复用，状态码无所谓
+   * global 为 true 时预热全局 agent（Adobe SDK 等第三方库用的池）
+   */
+  warm(url, { global = false, timeout = UPSTREAM_WARM_TIMEOUT_MS } = {}) {
+    const target = new URL(url);
+    const protocol = target.protocol === 'https:' ? https : http;
+    const agent = global ? protocol.globalAgent : this.agentFor(url);
+    return new Promise((resolve, reject) => {
+      const req = protocol.request(target, { method: 'HEAD', agent, timeout }, (res) => {
+        res.resume();
+        res.on('end', () => resolve(res.statusCode));
+      });
+      req.on('timeout', () => req.destroy(new Error(`预热 ${target.host} 超时`)));
+      req.on('error', reject);
+      req.end();
+    });
+  }
+
+  request(config) {
+    return this.client.request(config);
+  }
+
+  get(url, config) {
+    return this.client.get(url, config);
+  }
+
+  post(url, data, config) {
+    return this.client.post(url, data, config);
+  }
+
+  /**
+   * 连接池统计：请求数、新建/复用连接、当前活跃/空闲/排队
+   */
+  getStats() {
+    const count = (sockets) => Object.values(sockets || {}).reduce((sum, list) => sum + list.length, 0);
+    const pools = {};
+    for (const pool of this.pools.values()) {
+      const { agent, key, ...stats } = pool;
+      const connections = stats.newConnections + stats.reusedConnections;
+      pools[key] = {
+        ...stats,
+        reuseRate: connections ? stats.reusedConnections / connections : 0,
+        active: count(agent.sockets),
+        idle: count(agent.freeSockets),
+        queued: count(agent.requests)
+      };
+    }
+    return {
+      maxSockets: UPSTREAM_MAX_SOCKETS,
+      maxFreeSockets: UPSTREAM_MAX_FREE_SOCKETS,
+      http2Hosts: [...UPSTREAM_HTTP2_HOSTS],
+      pools
+    };
+  }
+}
+
+module.exports = new HttpClient();
@@ -0,0 +1,155 @@
+const crypto = require('crypto');
+const fs = require('fs-extra');
+const path = require('path');
+const metricsService = require('./metricsService');
+const logger = require('./logger');
+
+const LLM_CACHE_TTL_MS = (parseFloat(process.env.LLM_CACHE_TTL_HOURS) || 168) * 60 * 60 * 1000;
+const LLM_CACHE_MAX_ENTRIES = parseInt(process.env.LLM_CACHE_MAX_ENTRIES, 10) || 1000;
+
+/**
+ * LLM 分析结果缓存（持久化到 CACHE_DIR/llm）
+ * 键 = hash(规范化论文文本, 模型, 温度, 提示词版本)，带 TTL、条目上限和命中统计
+ */
+class LLMCacheService {
+  constructor() {
+    this.dir = path.join(process.env.CACHE_DIR || './cache', 'llm');
+    this.enabled = process.env.LLM_CACHE !== 'false';
+    fs.ensureDirSync(this.dir);
+
+    // key -> { createdAt, lastAccess }
+    this.entries = new Map();
+    this.metrics = { hits: 0, misses: 0, writes: 0, evictions: 0, expired: 0 };
+    this.ready = this.loadIndex();
+  }
+
+  async loadIndex() {
+    try {
+      const files = await fs.readdir(this.dir);
+      for (const file of files) {
+        if (!file.endsWith('.json')) continue;
+        const stats = await fs.stat(path.join(this.dir, file));
+        this.entries.set(path.basename(file, '.json'), {
+          createdAt: stats.mtimeMs,
+          lastAccess: stats.mtimeMs
+        });
+      }
+    } catch (error) {
+      logger.error('❌ LLM 缓存索引加载失败', error);
+    }
+  }
+
+  /**
+   * 规范化文本：Unicode 归一、折叠空白，避免换行/空格差异导致未命中
+   */
+  normalize(text) {
+    return (text || '').normalize('NFKC').replace(/\s+/g, ' ').trim();
+  }
+
+  makeKey({ text, model, temperature, promptVersion }) {
+    return crypto
+      .createHash('sha256')
+      .update(JSON.stringify([this.normalize(text), model, temperature, promptVersion]))
+      .digest('hex');
+  }
+
+  filePath(key) {
+    return path.join(this.dir, `${key}.json`);
+  }
+
+  /**
+   * 读取缓存，未命中或已过期返回 null
+   */
+  async get(key) {
+    if (!this.enabled) return null;
+    await this.ready;
+
+    const entry = this.entries.get(key);
+    if (!entry) {
+      this.metrics.misses++;
+      metricsService.cacheLookups.inc({ kind: 'analysis', result: 'miss' });
+      return null;
+    }
+    if (Date.now() - entry.createdAt > LLM_CACHE_TTL_MS) {
+      this.metrics.expired++;
+      this.metrics.misses++;
+      metricsService.cacheLookups.inc({ kind: 'analysis', result: 'miss' });
+      await this.remove(key);
+      return null;
+    }
+
+    try {
+      const data = await fs.readJson(this.filePath(key));
+      entry.lastAccess = Date.now();
+      this.metrics.hits++;
+      metricsService.cacheLookups.inc({ kind: 'analysis', result: 'hit' });
+      return data.content;
+    } catch (error) {
+      this.metrics.misses++;
+      metricsService.cacheLookups.inc({ kind: 'analysis', result: 'miss' });
+      this.entries.delete(key);
+      return null;
+    }
+  }
+
+  /**
+   * 写入缓存（先写临时文件再 rename，避免读到半个文件）
+   */
+  async set(key, content, meta = {}) {
+    if (!this.enabled) return;
+    await this.ready;
+
+    const target = this.filePath(key);
+    const tmp = `${target}.${process.pid}.tmp`;
+    try {
+      await fs.writeJson(tmp, { key, content, ...meta, createdAt: new Date().toISOString() });
+      await fs.rename(tmp, target);
+    } catch (error) {
+      logger.error('❌ LLM 缓存写入失败', error);
+      await fs.remove(tmp);
+      return;
+    }
+
+    const now = Date.now();
+    this.entries.set(key, { createdAt: now, lastAccess: now });
+    this.metrics.writes++;
+    await this.evict();
+  }
+
+  async remove(key) {
+    this.entries.delete(key);
+    await fs.remove(this.filePath(key));
+  }
+
+  /**
+   * 超出条目上限时淘汰最久未访问的条目
+   */
+  async evict() {
+    while (this.entries.size > LLM_CACHE_MAX_ENTRIES) {
+      let oldestKey = null;
+      let oldest = Infinity;
+      for (const [key, entry] of this.entries) {
+        if (entry.lastAccess < oldest) {
+          oldest = entry.lastAccess;
+          oldestKey = key;
+        }
+      }
+      await this.remove(oldestKey);
+      this.metrics.evictions++;
+    }
+  }
+
+  getStats() {
+    const lookups = this.metrics.hits + this.metrics.misses;
+    return {
+      enabled: this.enabled,
+      entries: this.entries.size,
+      maxEntries: LLM_CACHE_MAX_ENTRIES,
+      ttlHours: LLM_CACHE_TTL_MS / 3600000,
+      ...this.metrics,
+      hitRate: lookups ? this.metrics.hits / lookups : 0
+    };
+  }
+}
+
+module.exports = new LLMCacheService();
@@ -0,0 +1,262 @@
+const fs = require('fs');
+const crypto = require('crypto');
+const { AsyncLocalStorage } = require('async_hooks');
+const clusterService = require('./clusterService');
+const tracingService = require('./tracingService');
+
+const LEVELS = { debug: 10, info: 20, warn: 30, error: 40 };
+// 低于该级别的日志直接丢弃（不写出也不进环形缓冲）
+const LOG_LEVEL = LEVELS[process.env.LOG_LEVEL] ? process.env.LOG_LEVEL : 'info';
+// json：每行一个 JSON 对象，便于日志系统采集；pretty：人读的单行格式。默认终端用 pretty，管道用 json
+const LOG_FORMAT = process.env.LOG_FORMAT || (process.stdout.isTTY ? 'pretty' : 'json');
+// 按路由前缀采样：被采样掉的请求不输出 debug / info，warn / error 总是保留
+// 格式 "前缀=比例,前缀=比例"，默认图片路由只留 1%（每个请求都记的话量最大）
+const LOG_SAMPLE_RATES = (process.env.LOG_SAMPLE_RATES ?? '/api/cache/image=0.01')
+  .split(',')
+  .map(item => item.split('='))
+  .filter(([prefix, rate]) => prefix && rate !== undefined && !Number.isNaN(parseFloat(rate)))
+  .map(([prefix, rate]) => ({ prefix: prefix.trim(), rate: parseFloat(rate) }));
+// 环形缓冲保留最近多少条日志，供 /api/debug/logs 查询
+const LOG_BUFFER_SIZE = parseInt(process.env.LOG_BUFFER_SIZE, 10) || 2000;
+// 输出跟不上时最多积压多少字节，超出的日志丢弃（只计数），不让写日志拖住业务
+const LOG_MAX_PENDING_BYTES = parseInt(process.env.LOG_MAX_PENDING_BYTES, 10) || 4 * 1024 * 1024;
+// 多进程模式下查询日志时等待其他工作进程回复的上限
+const LOG_CLUSTER_TIMEOUT_MS = parseInt(process.env.LOG_CLUSTER_TIMEOUT_MS, 10) || 1000;
+
+/**
+ * 异步写出到文件描述符：stdout 接管道时 process.stdout.write 是同步的，会阻塞事件循环
+ * 这里攒批后用 fs.write 交给线程池，同一时刻只有一次写在进行，保证顺序
+ */
+class AsyncWriter {
+  constructor(fd, stats) {
+    this.fd = fd;
+    this.stats = stats;
+    this.chunks = [];
+    this.pendingBytes = 0;
+    this.writing = false;
+  }
+
+  write(line) {
+    if (this.pendingBytes + line.length > LOG_MAX_PENDING_BYTES) {
+      this.stats.dropped++;
+      return false;
+    }
+    this.chunks.push(line);
+    this.pendingBytes += line.length;
+    if (!this.writing) {
+      this.writing = true;
+      setImmediate(() => this.drain());
+    }
+    return true;
+  }
+
+  drain() {
+    if (!this.chunks.length) {
+      this.writing = false;
+      return;
+    }
+    const buffer = Buffer.from(this.chunks.join(''));
+    this.chunks = [];
+    this.pendingBytes = 0;
+    this.writeBuffer(buffer);
+  }
+
+  writeBuffer(buffer) {
+    fs.write(this.fd, buffer, 0, buffer.length, null, (error, written) => {
+      if (error) {
+        // EAGAIN：非阻塞管道暂时写满，稍后重试；其他错误（管道已关闭）丢弃这一批
+        if (error.code === 'EAGAIN') return setTimeout(() => this.writeBuffer(buffer), 10);
+        this.stats.writeErrors++;
+      } else if (written < buffer.length) {
+        return this.writeBuffer(buffer.subarray(written));
+      }
+      this.drain();
+    });
+  }
+
+  /**
+   * 进程退出前同步写出剩余内容
+   */
+  flushSync() {
+    if (!this.chunks.length) return;
+    try {
+      fs.writeSync(this.fd, this.chunks.join(''));
+    } catch {
+      // 退出阶段写不出去也无能为力
+    }
+    this.chunks = [];
+    this.pendingBytes = 0;
+  }
+}
+
+/**
+ * Error 只保留排查需要的字段；axios 错误的 response.data 可能是整段上游流，不输出
+ */
+function serializeError(error) {
+  return {
+    message: error.message,
+    name: error.name !== 'Error' ? error.name : undefined,
+    code: error.code,
+    status: error.response?.status,
+    stack: error.response ? undefined : error.stack?.split('\n').slice(0, 6).join('\n')
+  };
+}
+
+function serializeFields(entry, fields) {
+  for (const key in fields) {
+    const value = fields[key];
+    if (value === undefined) continue;
+    entry[key] = value instanceof Error ? serializeError(value) : value;
+  }
+  return entry;
+}
+
+const pad = (value, width = 2) => String(value).padStart(width, '0');
+
+/**
+ * 结构化日志：级别、请求 id、按路由采样，异步写出
+ * 最近的日志留在内存环形缓冲里，/api/debug/logs 和 Python 诊断脚本直接拉取
+ */
+class Logger {
+  constructor() {
+    this.level = LEVELS[LOG_LEVEL];
+    this.format = LOG_FORMAT;
+    this.storage = new AsyncLocalStorage();
+    this.ring = new Array(LOG_BUFFER_SIZE);
+    this.next = 0;
+    this.seq = 0;
+    this.stats = { written: 0, sampledOut: 0, dropped: 0, writeErrors: 0 };
+    this.counts = { debug: 0, info: 0, warn: 0, error: 0 };
+    // 同一毫秒内的日志共用时间字符串，toISOString 在热路径上占比不小
+    this.lastMs = 0;
+    this.lastTime = '';
+    this.stdout = new AsyncWriter(1, this.stats);
+    this.stderr = new AsyncWriter(2, this.stats);
+
+    process.on('exit', () => {
+      this.stdout.flushSync();
+      this.stderr.flushSync();
+    });
+
+    clusterService.respond('logs', (filter) => this.recent(filter));
+  }
+
+  debug(message, fields) { this.log('debug', message, fields); }
+  info(message, fields) { this.log('info', message, fields); }
+  warn(message, fields) { this.log('warn', message, fields); }
+  error(message, fields) { this.log('error', message, fields); }
+
+  /**
+   * fields 可以直接传 Error，等同于 { error }
+   */
+  log(level, message, fields = {}) {
+    if (LEVELS[level] < this.level) return;
+    const context = this.storage.getStore();
+    if (context && !context.sampled && LEVELS[level] < LEVELS.warn) {
+      this.stats.sampledOut++;
+      return;
+    }
+
+    const now = Date.now();
+    if (now !== this.lastMs) {
+      this.lastMs = now;
+      this.lastTime = new Date(now).toISOString();
+    }
+    const span = tracingService.current();
+    const entry = serializeFields({
+      seq: ++this.seq,
+      time: this.lastTime,
+      level,
+      msg: message,
+      worker: clusterService.workerId,
+      requestId: context?.requestId,
+      traceId: span?.traceId
+    }, fields instanceof Error ? { error: fields } : fields);
+    this.counts[level]++;
+    this.ring[this.next] = entry;
+    this.next = (this.next + 1) % LOG_BUFFER_SIZE;
+
+    const line = this.format === 'json' ? `${JSON.stringify(entry)}\n` : this.pretty(entry);
+    if ((LEVELS[level] >= LEVELS.warn ? this.stderr : this.stdout).write(line)) this.stats.written++;
+  }
+
+  pretty(entry) {
+    const { seq, time, level, msg, worker, requestId, traceId, ...fields } = entry;
+    const date = new Date(time);
+    const clock = `${pad(date.getHours())}:${pad(date.getMinutes())}:${pad(date.getSeconds())}.${pad(date.getMilliseconds(), 3)}`;
+    const tags = [clusterService.enabled ? `w${worker}` : null, requestId].filter(Boolean).map(tag => `[${tag}]`).join('');
+    const extra = Object.keys(fields).length ? ` ${JSON.stringify(fields)}` : '';
+    return `${clock} ${level.toUpperCase().padEnd(5)} ${tags ? `${tags} ` : ''}${msg}${extra}\n`;
+  }
+
+  sampleRate(path) {
+    let match = null;
+    for (const rule of LOG_SAMPLE_RATES) {
+      if (path.startsWith(rule.prefix) && (!match || rule.prefix.length > match.prefix.length)) match = rule;
+    }
+    return match ? match.rate : 1;
+  }
+
+  /**
+   * Express 中间件：分配请求 id（沿用 X-Request-Id），按路由决定本请求的 debug / info 是否输出
+   */
+  middleware() {
+    return (req, res, next) => {
+      const requestId = req.get('X-Request-Id') || crypto.randomBytes(4).toString('hex');
+      req.id = requestId;
+      res.set('X-Request-Id', requestId);
+      const sampled = Math.random() < this.sampleRate(req.path);
+      this.storage.run({ requestId, sampled }, next);
+    };
+  }
+
+  /**
+   * 本进程环形缓冲里的日志，按时间从旧到新
+   * filter: { level（最低级别）, requestId, traceId, q（消息子串）, since（ISO 时间）, limit }
+   */
+  recent({ level, requestId, traceId, q, since, limit = 200 } = {}) {
+    const minLevel = LEVELS[level] || 0;
+    const needle = q ? q.toLowerCase() : null;
+    const result = [];
+    for (let i = 0; i < LOG_BUFFER_SIZE; i++) {
+      const entry = this.ring[(this.next + i) % LOG_BUFFER_SIZE];
+      if (!entry) continue;
+      if (LEVELS[entry.level] < minLevel) continue;
+      if (requestId && entry.requestId !== requestId) continue;
+      if (traceId && entry.traceId !== traceId) continue;
+      if (since && entry.time <= since) continue;
+      if (needle && !entry.msg.toLowerCase().includes(needle)) continue;
+      result.push(entry);
+    }
+    return result.slice(-limit);
+  }
+
+  /**
+   * 所有工作进程的日志合并后按时间排序，取最新 limit 条
+   */
+  async query(filter = {}) {
+    const limit = filter.limit || 200;
+    const remote = await clusterService.gather('logs', filter, LOG_CLUSTER_TIMEOUT_MS);
+    return [this.recent(filter), ...remote]
+      .flat()
+      .sort((a, b) => (a.time < b.time ? -1 : a.time > b.time ? 1 : a.worker - b.worker || a.seq - b.seq))
+      .slice(-limit);
+  }
+
+  getStats() {
+    return {
+      level: LOG_LEVEL,
+      format: this.format,
+      sampleRates: LOG_SAMPLE_RATES,
+      buffered: Math.min(this.seq, LOG_BUFFER_SIZE),
+      bufferSize: LOG_BUFFER_SIZE,
+      counts: { ...this.counts },
+      ...this.stats
+    };
+  }
+}
+
+const logger = new Logger();
+logger.LEVELS = LEVELS;
+
+module.exports = logger;
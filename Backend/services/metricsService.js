@@ -0,0 +1,313 @@
+const { performance, monitorEventLoopDelay } = require('perf_hooks');
+const clusterService = require('./clusterService');
+
+// 设为 false 时所有记录都是空操作，/metrics 返回 404
+const METRICS_ENABLED = process.env.METRICS_ENABLED !== 'false';
+// 多进程模式下 /metrics 汇总其他工作进程的数据，等待回复的上限
+const METRICS_CLUSTER_TIMEOUT_MS = parseInt(process.env.METRICS_CLUSTER_TIMEOUT_MS, 10) || 1000;
+const METRICS_PREFIX = 'micro_tomato_';
+
+// 桶边界（秒）：本地操作（解码、写缓存、缩略图、读图）和上游调用（Adobe、LLM、生图）量级差得多，分两套
+const FAST_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5];
+const SLOW_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300];
+
+const escapeLabel = (value) => String(value).replace(/\\/g, '\\\\').replace(/\n/g, '\\n').replace(/"/g, '\\"');
+const formatValue = (value) => (value === Infinity ? '+Inf' : String(value));
+
+/**
+ * 指标基类：每组标签值一个序列，标签值按 labelNames 顺序拼成键
+ * 记录路径只有一次 Map 查找和几次数值比较，不分配对象（首次出现的标签组合除外）
+ */
+class Metric {
+  constructor(type, name, help, labelNames = []) {
+    this.type = type;
+    this.name = METRICS_PREFIX + name;
+    this.help = help;
+    this.labelNames = labelNames;
+    this.series = new Map();
+  }
+
+  key(labels) {
+    if (this.labelNames.length === 0) return '';
+    if (this.labelNames.length === 1) return String(labels[this.labelNames[0]]);
+    let key = String(labels[this.labelNames[0]]);
+    for (let i = 1; i < this.labelNames.length; i++) key += `\u0001${labels[this.labelNames[i]]}`;
+    return key;
+  }
+
+  seriesFor(labels = {}) {
+    const key = this.key(labels);
+    let series = this.series.get(key);
+    if (!series) {
+      series = this.createSeries(this.labelNames.map(name => String(labels[name] ?? '')));
+      this.series.set(key, series);
+    }
+    return series;
+  }
+
+  labelString(values, extra = '') {
+    const pairs = this.labelNames.map((name, i) => `${name}="${escapeLabel(values[i])}"`);
+    if (extra) pairs.push(extra);
+    return pairs.length ? `{${pairs.join(',')}}` : '';
+  }
+}
+
+class Counter extends Metric {
+  constructor(name, help, labelNames) {
+    super('counter', name, help, labelNames);
+  }
+
+  createSeries(values) {
+    return { values, value: 0 };
+  }
+
+  inc(labels, amount = 1) {
+    if (!METRICS_ENABLED) return;
+    this.seriesFor(labels).value += amount;
+  }
+
+  snapshot() {
+    return [...this.series.values()].map(s => [s.values, s.value]);
+  }
+
+  merge(target, snapshot) {
+    for (const [values, value] of snapshot) {
+      const key = values.join('\u0001');
+      const entry = target.get(key) || { values, value: 0 };
+      entry.value += value;
+      target.set(key, entry);
+    }
+  }
+
+  render(merged) {
+    const lines = [];
+    for (const { values, value } of merged.values()) lines.push(`${this.name}${this.labelString(values)} ${value}`);
+    return lines;
+  }
+}
+
+class Histogram extends Metric {
+  constructor(name, help, labelNames, buckets) {
+    super('histogram', name, help, labelNames);
+    this.buckets = buckets;
+  }
+
+  createSeries(values) {
+    // counts[i] 是落在第 i 个桶（不累加）的次数，最后一格是 +Inf；输出时再累加
+    return { values, counts: new Array(this.buckets.length + 1).fill(0), sum: 0, count: 0 };
+  }
+
+  observe(labels, seconds) {
+    if (!METRICS_ENABLED) return;
+    const series = this.seriesFor(labels);
+    let i = 0;
+    while (i < this.buckets.length && seconds > this.buckets[i]) i++;
+    series.counts[i]++;
+    series.sum += seconds;
+    series.count++;
+  }
+
+  /**
+   * 开始计时，返回结束函数：end(labels) 记录并返回耗时（秒）
+   */
+  startTimer(labels) {
+    const startedAt = performance.now();
+    return (endLabels) => {
+      const seconds = (performance.now() - startedAt) / 1000;
+      this.observe(endLabels ? { ...labels, ...endLabels } : labels, seconds);
+      return seconds;
+    };
+  }
+
+  /**
+   * 记录一个 promise 从现在到完成（成功或失败）的耗时，原样返回该 promise 的结果
+   */
+  time(labels, promise) {
+    if (!METRICS_ENABLED) return promise;
+    const end = this.startTimer(labels);
+    return promise.then(
+      (value) => {
+        end();
+        return value;
+      },
+      (error) => {
+        end();
+        throw error;
+      }
+    );
+  }
+
+  snapshot() {
+    return [...this.series.values()].map(s => [s.values, s.counts, s.sum, s.count]);
+  }
+
+  merge(target, snapshot) {
+    for (const [values, counts, sum, count] of snapshot) {
+      const key = values.join('\u0001');
+      const entry = target.get(key) || { values, counts: new Array(counts.length).fill(0), sum: 0, count: 0 };
+      counts.forEach((n, i) => { entry.counts[i] += n; });
+      entry.sum += sum;
+      entry.count += count;
+      target.set(key, entry);
+    }
+  }
+
+  render(merged) {
+    const lines = [];
+    for (const { values, counts, sum, count } of merged.values()) {
+      let cumulative = 0;
+      [...this.buckets, Infinity].forEach((bound, i) => {
+        cumulative += counts[i];
+        lines.push(`${this.name}_bucket${this.labelString(values, `le="${formatValue(bound)}"`)} ${cumulative}`);
+      });
+      lines.push(`${this.name}_sum${this.labelString(values)} ${sum}`);
+      lines.push(`${this.name}_count${this.labelString(values)} ${count}`);
+    }
+    return lines;
+  }
+}
+
+/**
+ * 采集时才计算的指标（当前在途数、内存等），记录路径零开销
+ * collect() 返回数值，或 [labelValues, value] 数组；多进程汇总时按 aggregate（sum / max）合并
+ */
+class Gauge extends Metric {
+  constructor(name, help, labelNames, collect, aggregate = 'sum') {
+    super('gauge', name, help, labelNames);
+    this.collect = collect;
+    this.aggregate = aggregate;
+  }
+
+  snapshot() {
+    const result = this.collect();
+    return typeof result === 'number' ? [[[], result]] : result;
+  }
+
+  merge(target, snapshot) {
+    for (const [values, value] of snapshot) {
+      const key = values.join('\u0001');
+      const entry = target.get(key);
+      if (!entry) target.set(key, { values, value });
+      else entry.value = this.aggregate === 'max' ? Math.max(entry.value, value) : entry.value + value;
+    }
+  }
+
+  render(merged) {
+    const lines = [];
+    for (const { values, value } of merged.values()) lines.push(`${this.name}${this.labelString(values)} ${value}`);
+    return lines;
+  }
+}
+
+/**
+ * 流水线各阶段的延迟直方图与计数器，以 Prometheus 文本格式从 /metrics 输出
+ * 指标在这里集中定义，各服务直接引用对应字段记录
+ */
+class MetricsService {
+  constructor() {
+    this.enabled = METRICS_ENABLED;
+    this.metrics = [];
+
+    // ---------------- 延迟直方图 ----------------
+    this.uploadReceive = this.histogram('upload_receive_seconds',
+      'multer 接收上传 PDF 的耗时', ['route', 'outcome'], SLOW_BUCKETS);
+    this.adobe = this.histogram('adobe_operation_seconds',
+      'Adobe PDF Services 各步骤耗时（upload / submit / poll / download；task 为 extract / ocr，上传共用）', ['operation', 'task'], SLOW_BUCKETS);
+    this.zipProcess = this.histogram('zip_process_seconds',
+      '解析 Extract 结果 ZIP 并写入图片、表格缓存的耗时', [], SLOW_BUCKETS);
+    this.llm = this.histogram('llm_request_seconds',
+      'LLM 分析请求耗时（stream 为整个流式输出）', ['mode', 'outcome'], SLOW_BUCKETS);
+    this.imageTtfb = this.histogram('image_generation_ttfb_seconds',
+      '生图请求发出到收到上游第一个字节', [], SLOW_BUCKETS);
+    this.imageTotal = this.histogram('image_generation_seconds',
+      '单个生图流从发起到结束的总耗时', ['outcome'], SLOW_BUCKETS);
+    this.base64Decode = this.histogram('base64_decode_seconds',
+      '生图结果 base64 解码耗时', [], FAST_BUCKETS);
+    this.cacheWrite = this.histogram('cache_write_seconds',
+      '写入缓存存储的耗时', ['kind'], FAST_BUCKETS);
+    this.thumbnail = this.histogram('thumbnail_seconds',
+      'sharp 生成缩略图耗时（不含写入）', [], FAST_BUCKETS);
+    this.derivative = this.histogram('image_derivative_seconds',
+      'sharp 生成 WebP / AVIF 派生图耗时（不含读写存储）', ['format'], FAST_BUCKETS);
+    this.imageServe = this.histogram('image_serve_seconds',
+      '/api/cache/image 请求处理到响应结束的耗时', ['size', 'status'], FAST_BUCKETS);
+
+    // ---------------- 计数器 ----------------
+    this.cacheLookups = this.counter('cache_lookups_total',
+      '缓存查找次数（image / table 为内存索引，analysis 为 LLM 分析缓存）', ['kind', 'result']);
+    this.upstreamErrors = this.counter('upstream_errors_total',
+      '上游调用失败次数（每次尝试计一次，reason 为状态码或错误码）', ['endpoint', 'reason']);
+
+    if (this.enabled) {
+      this.eventLoopDelay = monitorEventLoopDelay({ resolution: 20 });
+      this.eventLoopDelay.enable();
+      this.gauge('process_resident_memory_bytes', '常驻内存', [], () => process.memoryUsage.rss());
+      this.gauge('event_loop_delay_p99_seconds', '事件循环延迟 P99（两次采集之间）', [], () => {
+        const p99 = this.eventLoopDelay.percentile(99) / 1e9;
+        this.eventLoopDelay.reset();
+        return p99;
+      }, 'max');
+    }
+
+    clusterService.respond('metrics', () => this.snapshot());
+  }
+
+  histogram(name, help, labelNames, buckets) {
+    const metric = new Histogram(name, help, labelNames, buckets);
+    this.metrics.push(metric);
+    return metric;
+  }
+
+  counter(name, help, labelNames) {
+    const metric = new Counter(name, help, labelNames);
+    this.metrics.push(metric);
+    return metric;
+  }
+
+  /**
+   * 登记采集时计算的指标，例如在途生图数
+   */
+  gauge(name, help, labelNames, collect, aggregate) {
+    if (!this.enabled) return null;
+    const metric = new Gauge(name, help, labelNames, collect, aggregate);
+    this.metrics.push(metric);
+    return metric;
+  }
+
+  snapshot() {
+    return this.metrics.map(metric => {
+      try {
+        return metric.snapshot();
+      } catch (error) {
+        return [];
+      }
+    });
+  }
+
+  /**
+   * 向其他工作进程收集快照；超时或进程退出时用已收到的部分
+   */
+  collectCluster() {
+    return clusterService.gather('metrics', null, METRICS_CLUSTER_TIMEOUT_MS);
+  }
+
+  /**
+   * Prometheus 文本格式；多进程模式下是所有工作进程的合计
+   */
+  async render() {
+    const snapshots = [this.snapshot(), ...await this.collectCluster()];
+    const lines = [];
+    this.metrics.forEach((metric, i) => {
+      const merged = new Map();
+      for (const snapshot of snapshots) {
+        if (snapshot[i]) metric.merge(merged, snapshot[i]);
+      }
+      lines.push(`# HELP ${metric.name} ${metric.help}`);
+      lines.push(`# TYPE ${metric.name} ${metric.type}`);
+      lines.push(...metric.render(merged));
+    });
+    return `${lines.join('\n')}\n`;
+  }
+}
+
+module.exports = new MetricsService();
@@ -1,41 +1,62 @@
-const {
-  ServicePrincipalCredentials,
-  PDFServices,
-  MimeType,
-  ExtractPDFParams,
-  ExtractElementType,
-  ExtractPDFJob,
-  ExtractPDFResult,
-  ExtractRenditionsElementType,
-  OCRJob,
-  OCRParams,
-  OCRSupportedLocale,
-  OCRSupportedType,
-  OCRResult,
-  TableStructureType,
-  SDKError,
-  ServiceUsageError,
-  ServiceApiError
-} = require("@adobe/pdfservices-node-sdk");
 const fs = require("fs-extra");
 const path = require("path");
+const crypto = require("crypto");
 const AdmZip = require("adm-zip");
 const { v4: uuidv4 } = require("uuid");
 const cacheService = require("./cacheService");
+const deadlineService = require("./deadline");
+const httpClient = require("./httpClient");
+const metricsService = require("./metricsService");
+const tracingService = require("./tracingService");
+const logger = require("./logger");
+
+// Adobe 接口所在主机，启动预热时提前建立 TLS 连接
+const PDF_SERVICES_HOST = process.env.PDF_SERVICES_HOST || 'https://pdf-services.adobe.io';
+
+// Adobe SDK 加载很慢，第一次用到时（或启动后在后台预热时）再加载
+let adobeSdk = null;
+const adobe = () => adobeSdk || (adobeSdk = require("@adobe/pdfservices-node-sdk"));
 
 class PDFService {
   constructor() {
-    // 验证环境变量
-    if (!process.env.PDF_SERVICES_CLIENT_ID || !process.env.PDF_SERVICES_CLIENT_SECRET) {
-      throw new Error('请设置 PDF_SERVICES_CLIENT_ID 和 PDF_SERVICES_CLIENT_SECRET 环境变量');
-    }
+    // 缺少凭据不再在加载时抛错（否则整个服务起不来），改为调用时报错，并在就绪检查里体现
+    this.client = null;
+  }
 
-    const credentials = new ServicePrincipalCredentials({
-      clientId: process.env.PDF_SERVICES_CLIENT_ID,
-      clientSecret: process.env.PDF_SERVICES_CLIENT_SECRET
-    });
+  get configured() {
+    return Boolean(process.env.PDF_SERVICES_CLIENT_ID && process.env.PDF_SERVICES_CLIENT_SECRET);
+  }
+
+  /**
+   * Adobe 客户端，第一次访问时加载 SDK 并创建
+   */
+  get pdfServices() {
+    if (!this.client) {
+      // 验证环境变量
+      if (!this.configured) {
+        throw new Error('请设置 PDF_SERVICES_CLIENT_ID 和 PDF_SERVICES_CLIENT_SECRET 环境变量');
+      }
+
+      const { ServicePrincipalCredentials, PDFServices } = adobe();
+      const credentials = new ServicePrincipalCredentials({
+        clientId: process.env.PDF_SERVICES_CLIENT_ID,
+        clientSecret: process.env.PDF_SERVICES_CLIENT_SECRET
+      });
 
-    this.pdfServices = new PDFServices({ credentials });
+      this.client = new PDFServices({ credentials });
+    }
+    return this.client;
+  }
+
+  /**
+   * 启动后在后台预热：加载 SDK、创建客户端，并与 Adobe 建立好 keep-alive 连接
+   * SDK 没有公开单独获取 token 的接口，第一次请求仍会取 token，但省掉了 SDK 加载和 TLS 握手
+   */
+  async warmup() {
+    if (!this.configured) throw new Error('未配置 Adobe PDF Services 凭据');
+    // 访问 getter 即加载 SDK 并创建客户端
+    void this.pdfServices;
+    await httpClient.warm(PDF_SERVICES_HOST, { global: true });
   }
 
   async extractPDF(filePath) {
@@ -43,34 +64,135 @@ class PDFService {
     try {
       // 上传 PDF 文件
       readStream = fs.createReadStream(filePath);
-      const inputAsset = await this.pdfServices.upload({
-        readStream,
-        mimeType: MimeType.PDF
-      });
+      const inputAsset = await this.upload(readStream);
 
-      // 创建提取参数
-      const params = new ExtractPDFParams({
-        elementsToExtract: [ExtractElementType.TEXT, ExtractElementType.TABLES],
-        elementsToExtractRenditions: [ExtractRenditionsElementType.FIGURES, ExtractRenditionsElementType.TABLES],
-        getStylingInfo: true,
-        addCharInfo: true,
-        tableStructureType: TableStructureType.CSV
-      });
-
-      // 创建并提交任务
-      const job = new ExtractPDFJob({ inputAsset, params });
-      const pollingURL = await this.pdfServices.submit({ job });
+      const zipPath = await this.runExtract(inputAsset);
+      try {
+        return await this.processExtractResult(zipPath);
+      } finally {
+        await fs.remove(zipPath);
+      }
       
-      const pdfServicesResponse = await this.pdfServices.getJobResult({
-        pollingURL,
-        resultType: ExtractPDFResult
-      });
+    } catch (err) {
+      this.handleError(err);
+    } finally {
+      readStream?.destroy();
+    }
+  }
 
-      // 获取结果
-      const resultAsset = pdfServicesResponse.result.resource;
-      const streamAsset = await this.pdfServices.getContent({ asset: resultAsset });
+  /**
+   * 统一入口：按文档自动判断是否需要 OCR，只上传一次
+   * options.ocr: 'auto' | 'always' | 'never'
+   * options.deadline: 请求截止时间，Adobe 上传/轮询/下载超过它即放弃等待
+   */
+  async ingestPDF(filePath, options = {}) {
+    const mode = options.ocr || 'auto';
+    const deadline = options.deadline || deadlineService.none();
+    let readStream;
+    const tempZips = [];
+
+    try {
+      // 本地检测与上传同时进行
+      readStream = fs.createReadStream(filePath);
+      const [detection, inputAsset, paperId] = await Promise.all([
+        mode === 'auto'
+          ? tracingService.withSpan('pdf.detect_ocr', {}, async (span) => {
+            const result = await this.detectOCRNeed(filePath);
+            span.setAttributes({ verdict: result.verdict, reason: result.reason });
+            return result;
+          })
+          : { verdict: mode === 'always' ? 'yes' : 'no', reason: 'forced' },
+        deadline.race(this.upload(readStream), 'Adobe 上传'),
+        this.paperId(filePath)
+      ]);
+
+      let zipPath;
+      let applied = false;
+
+      if (detection.verdict === 'no') {
+        zipPath = await this.runExtract(inputAsset, deadline);
+        tempZips.push(zipPath);
+      } else if (detection.verdict === 'yes') {
+        // OCR 结果资产直接作为 Extract 输入，不再下载和重新上传
+        const ocrAsset = await this.runOCR(inputAsset, options);
+        zipPath = await this.runExtract(ocrAsset, deadline);
+        tempZips.push(zipPath);
+        applied = true;
+      } else {
+        // 无法从文件结构判断：先直接 Extract，文本层不够时才提交 OCR
+        // 带文本层的 PDF（多数用了对象流）不会白白花掉一次 OCR 任务
+        const directZip = await this.runExtract(inputAsset, deadline);
+        tempZips.push(directZip);
+        const textLayer = this.assessTextLayer(directZip);
+        detection.textLayer = textLayer;
+
+        if (textLayer.sufficient) {
+          zipPath = directZip;
+        } else {
+          const ocrAsset = await this.runOCR(inputAsset, options);
+          zipPath = await this.runExtract(ocrAsset, deadline);
+          tempZips.push(zipPath);
+          applied = true;
+        }
+      }
+
+      const result = await this.processExtractResult(zipPath, paperId);
+      result.metadata.ocr = { mode, applied, detection };
+      return result;
+
+    } catch (err) {
+      this.handleError(err);
+    } finally {
+      readStream?.destroy();
+      await Promise.all(tempZips.map(p => fs.remove(p)));
+    }
+  }
+
+  /**
+   * Adobe 调用的一个步骤：记录耗时直方图，并在当前链路下记一个 span
+   */
+  step(operation, task, fn) {
+    return tracingService.withSpan(`adobe.${operation}`, { task }, () => metricsService.adobe.time({ operation, task }, fn()));
+  }
+
+  upload(readStream) {
+    return this.step('upload', 'shared', () => this.pdfServices.upload({
+      readStream,
+      mimeType: adobe().MimeType.PDF
+    }));
+  }
+
+  /**
+   * 提交 Extract 任务并把结果 ZIP 下载到 temp/，返回 ZIP 路径
+   */
+  async runExtract(inputAsset, deadline = deadlineService.none()) {
+    const {
+      ExtractPDFParams, ExtractElementType, ExtractRenditionsElementType, TableStructureType, ExtractPDFJob, ExtractPDFResult
+    } = adobe();
+    // 创建提取参数
+    const params = new ExtractPDFParams({
+      elementsToExtract: [ExtractElementType.TEXT, ExtractElementType.TABLES],
+      elementsToExtractRenditions: [ExtractRenditionsElementType.FIGURES, ExtractRenditionsElementType.TABLES],
+      getStylingInfo: true,
+      addCharInfo: true,
+      tableStructureType: TableStructureType.CSV
+    });
+
+    // 创建并提交任务
+    const job = new ExtractPDFJob({ inputAsset, params });
+    const pollingURL = await deadline.race(this.step('submit', 'extract', () => this.pdfServices.submit({ job })), 'Adobe Extract 提交');
+    
+    // SDK 内部轮询无法取消，超过截止时间就不再等待结果
+    const pdfServicesResponse = await deadline.race(this.step('poll', 'extract', () => this.pdfServices.getJobResult({
+      pollingURL,
+      resultType: ExtractPDFResult
+    })), 'Adobe Extract 轮询');
+
+    // 获取结果并保存 ZIP 文件：下载耗时包含取流和写入
+    const resultAsset = pdfServicesResponse.result.resource;
+    return this.step('download', 'extract', async () => {
+      const streamAsset = await deadline.race(this.pdfServices.getContent({ asset: resultAsset }), 'Adobe 下载');
 
-      // 保存 ZIP 文件
       const tempZipPath = path.join(__dirname, '../temp', `extract-${uuidv4()}.zip`);
       await fs.ensureDir(path.dirname(tempZipPath));
       
@@ -80,23 +202,108 @@ class PDFService {
           .on('finish', resolve)
           .on('error', reject);
       });
+      return tempZipPath;
+    });
+  }
 
-      // 解压并处理内容
-      const result = await this.processExtractResult(tempZipPath);
-      
-      // 清理临时文件
-      await fs.unlink(tempZipPath);
-      
-      return result;
-      
-    } catch (err) {
-      this.handleError(err);
-    } finally {
-      readStream?.destroy();
+  /**
+   * 提交 OCR 任务，返回 Adobe 端的结果资产（可直接用作下一个任务的输入）
+   */
+  async runOCR(inputAsset, options = {}) {
+    const { OCRParams, OCRSupportedLocale, OCRSupportedType, OCRJob, OCRResult } = adobe();
+    const params = new OCRParams({
+      ocrLocale: options.locale || OCRSupportedLocale.EN_US,
+      ocrType: options.type || OCRSupportedType.SEARCHABLE_IMAGE_EXACT
+    });
+
+    const deadline = options.deadline || deadlineService.none();
+    const job = new OCRJob({ inputAsset, params });
+    const pollingURL = await deadline.race(this.step('submit', 'ocr', () => this.pdfServices.submit({ job })), 'Adobe OCR 提交');
+    
+    const pdfServicesResponse = await deadline.race(this.step('poll', 'ocr', () => this.pdfServices.getJobResult({
+      pollingURL,
+      resultType: OCRResult
+    })), 'Adobe OCR 轮询');
+
+    return pdfServicesResponse.result.asset;
+  }
+
+  /**
+   * 论文 id：PDF 内容哈希的前 16 位，同一篇论文重复上传得到同一个 id
+   * 图片和表格带着它写入缓存索引，缓存列表可以按论文筛选
+   */
+  async paperId(filePath) {
+    const hash = crypto.createHash('sha256');
+    for await (const chunk of fs.createReadStream(filePath)) hash.update(chunk);
+    return hash.digest('hex').slice(0, 16);
+  }
+
+  /**
+   * 根据 PDF 文件结构粗略判断是否需要 OCR
+   * 返回 verdict: 'yes' | 'no' | 'unknown'
+   */
+  async detectOCRNeed(filePath) {
+    const buffer = await fs.readFile(filePath);
+    const count = (token) => {
+      let n = 0;
+      let i = buffer.indexOf(token);
+      while (i !== -1) {
+        n++;
+        i = buffer.indexOf(token, i + token.length);
+      }
+      return n;
+    };
+
+    const fonts = count('/Font');
+    const images = count('/Subtype/Image') + count('/Subtype /Image');
+    const objectStreams = count('/ObjStm');
+
+    if (fonts > 0 && images === 0) {
+      return { verdict: 'no', reason: 'font-resources', fonts, images };
     }
+    if (fonts > 0) {
+      // 扫描件常带有文字的封面、arXiv/出版社水印或 OCR 页眉，有字体不代表正文有文本层，交给 Extract 后的每页字符数判断
+      return { verdict: 'unknown', reason: 'fonts-and-images', fonts, images };
+    }
+    if (images > 0 && objectStreams === 0) {
+      return { verdict: 'yes', reason: 'images-without-fonts', fonts, images };
+    }
+    // 对象流被压缩时字典不可见，交给 Extract 结果判断
+    return { verdict: 'unknown', reason: objectStreams > 0 ? 'object-streams' : 'no-resources', fonts, images };
   }
 
-  async processExtractResult(zipPath) {
+  /**
+   * 检查 Extract 结果的文本层是否足够（按每页字符数）
+   */
+  assessTextLayer(zipPath) {
+    const minCharsPerPage = parseInt(process.env.OCR_MIN_CHARS_PER_PAGE, 10) || 200;
+    const zip = new AdmZip(zipPath);
+    const dataEntry = zip.getEntry('structuredData.json');
+    if (!dataEntry) {
+      return { sufficient: false, charsPerPage: 0, minCharsPerPage };
+    }
+
+    const structuredData = JSON.parse(dataEntry.getData().toString('utf8'));
+    let chars = 0;
+    let pageCount = 1;
+    for (const element of structuredData.elements || []) {
+      if (element.Text) chars += element.Text.trim().length;
+      pageCount = Math.max(pageCount, (element.Page && element.Page[0]) || 1);
+    }
+
+    const charsPerPage = Math.round(chars / pageCount);
+    return { sufficient: charsPerPage >= minCharsPerPage, charsPerPage, minCharsPerPage };
+  }
+
+  async processExtractResult(zipPath, paperId = null) {
+    return tracingService.withSpan('pdf.zip', {}, async (span) => {
+      const result = await metricsService.zipProcess.time({}, this.readExtractZip(zipPath, paperId));
+      span.setAttributes({ elements: result.metadata.totalElements, images: result.metadata.imageElements, tables: result.metadata.tableElements });
+      return result;
+    });
+  }
+
+  async readExtractZip(zipPath, paperId) {
     const zip = new AdmZip(zipPath);
     const zipEntries = zip.getEntries();
     
@@ -122,7 +329,7 @@ class PDFService {
           // 处理图片
           const imageKey = uuidv4();
           const imageBuffer = entry.getData();
-          const imagePath = await cacheService.saveImage(imageKey, imageBuffer);
+          const imagePath = await cacheService.saveImage(imageKey, imageBuffer, undefined, { kind: 'figure', paper: paperId });
           
           imageReferences.push({
             key: imageKey,
@@ -145,7 +352,7 @@ class PDFService {
           const tableKey = uuidv4();
           const tableBuffer = entry.getData();
           const isCSV = element.Path.endsWith('.csv');
-          const tablePath = await cacheService.saveTable(tableKey, tableBuffer, isCSV);
+          const tablePath = await cacheService.saveTable(tableKey, tableBuffer, isCSV, { paper: paperId });
           
           tableReferences.push({
             key: tableKey,
@@ -169,6 +376,7 @@ class PDFService {
           processedElements.push({
             type: 'text',
             text: element.Text || '',
+            path: element.Path,
             page: element.Page?.[0] || 1,
             bounds: element.Bounds,
             fontSize: element.FontSize?.[0],
@@ -200,6 +408,7 @@ class PDFService {
       },
       elements: processedElements,
       metadata: {
+        paperId,
         totalElements: processedElements.length,
         textElements: processedElements.filter(e => e.type === 'text').length,
         imageElements: processedElements.filter(e => e.type === 'image').length,
@@ -213,51 +422,21 @@ class PDFService {
     try {
       // 上传 PDF 文件
       readStream = fs.createReadStream(filePath);
-      const inputAsset = await this.pdfServices.upload({
-        readStream,
-        mimeType: MimeType.PDF
-      });
-
-      // 创建 OCR 参数
-      const params = new OCRParams({
-        ocrLocale: options.locale || OCRSupportedLocale.EN_US,
-        ocrType: options.type || OCRSupportedType.SEARCHABLE_IMAGE_EXACT
-      });
+      const inputAsset = await this.upload(readStream);
 
-      // 创建并提交 OCR 任务
-      const job = new OCRJob({ inputAsset, params });
-      const pollingURL = await this.pdfServices.submit({ job });
-      
-      const pdfServicesResponse = await this.pdfServices.getJobResult({
-        pollingURL,
-        resultType: OCRResult
-      });
-
-      // 获取结果
-      const resultAsset = pdfServicesResponse.result.asset;
-      const streamAsset = await this.pdfServices.getContent({ asset: resultAsset });
-
-      // 保存 OCR 后的 PDF
-      const ocrPdfPath = path.join(__dirname, '../temp', `ocr-${uuidv4()}.pdf`);
-      await fs.ensureDir(path.dirname(ocrPdfPath));
-      
-      const writeStream = fs.createWriteStream(ocrPdfPath);
-      await new Promise((resolve, reject) => {
-        streamAsset.readStream.pipe(writeStream)
-          .on('finish', resolve)
-          .on('error', reject);
-      });
-
-      // 读取 OCR 后的文本
-      const extractResult = await this.extractPDF(ocrPdfPath);
-      
-      // 清理临时文件
-      await fs.unlink(ocrPdfPath);
+      // OCR 结果资产直接交给 Extract，避免下载后再次上传
+      const ocrAsset = await this.runOCR(inputAsset, options);
+      const zipPath = await this.runExtract(ocrAsset);
+      let extractResult;
+      try {
+        extractResult = await this.processExtractResult(zipPath);
+      } finally {
+        await fs.remove(zipPath);
+      }
       
       return {
         success: true,
         message: 'OCR 处理完成',
-        ocrPdfPath: ocrPdfPath,
         extractedText: extractResult
       };
       
@@ -269,11 +448,15 @@ class PDFService {
   }
 
   handleError(err) {
-    if (err instanceof SDKError || err instanceof ServiceUsageError || err instanceof ServiceApiError) {
-      console.error("Adobe PDF Services 错误:", err);
+    // 截止时间错误原样抛出，路由据此返回 504
+    if (err.code === 'DEADLINE_EXCEEDED') throw err;
+    const { SDKError, ServiceUsageError, ServiceApiError } = adobeSdk || {};
+    if (adobeSdk && (err instanceof SDKError || err instanceof ServiceUsageError || err instanceof ServiceApiError)) {
+      metricsService.upstreamErrors.inc({ endpoint: 'adobe', reason: err.statusCode || err.constructor.name });
+      logger.error("❌ Adobe PDF Services 错误", err);
       throw new Error(`PDF 处理失败: ${err.message}`);
     } else {
-      console.error("处理错误:", err);
+      logger.error("❌ 处理错误", err);
       throw new Error(`处理失败: ${err.message}`);
     }
   }
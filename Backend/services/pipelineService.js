@@ -0,0 +1,128 @@
+const pdfService = require('./pdfService');
+const aiService = require('./aiService');
+const generationService = require('./generationService');
+const tracingService = require('./tracingService');
+
+/**
+ * 论文处理流水线：PDF → 提取 → 流式分析 → 生图
+ * 各阶段按数据依赖尽量重叠：Prompt 段一结束就开始生图，图片与 Authors/Keywords 并行产出
+ */
+class PipelineService {
+  /**
+   * 从提取结果拼出送给 AI 的全文
+   */
+  collectPaperText(result) {
+    let fullText = "";
+    if (result.elements && Array.isArray(result.elements)) {
+      fullText = result.elements
+        .filter(el => el.Text || el.text)
+        .map(el => el.Text || el.text)
+        .join('\n');
+    }
+    return fullText.length > 100 ? fullText : (result.text || "");
+  }
+
+  /**
+   * 运行流水线，emit(event, data) 推送类型化事件：
+   * stage / metadata / summary / prompt / authors / keywords，
+   * includeImages 为 true 时还有 analysis / queue / image / error，直到生图结束
+   * scheduling: { clientId, priority } 交给生图调度器
+   * generation: { candidates, modality, hedge } 生图参数
+   * signal: 客户端断开时中止，停止后续阶段并取消已启动的生图
+   * deadline: 请求截止时间，各阶段超时收缩到剩余预算
+   * 返回分析结果（与 /api/extract 的 JSON 相同，另含 generationId、imageCount）
+   */
+  async run(filePath, options, emit) {
+    const { ocr, fileName, includeImages = false, scheduling = {}, generation = {}, signal, deadline } = options;
+    const throwIfAborted = (stage) => {
+      if (deadline) deadline.check(stage);
+      if (signal?.aborted) throw new Error('客户端已断开，流水线中止');
+    };
+
+    // 生图在分析流的回调里启动，显式挂回请求 span，不算在 llm.stream 下面
+    const requestSpan = tracingService.current();
+
+    emit('stage', { stage: 'ingest' });
+    const result = await tracingService.withSpan('pipeline.ingest', { ocr: ocr || 'auto' }, () => pdfService.ingestPDF(filePath, { ocr, deadline }));
+    throwIfAborted('ingest');
+    const title = result.metadata?.title || fileName;
+    emit('metadata', { ...result.metadata, title, pageCount: result.document?.pageCount });
+
+    const textForAI = this.collectPaperText(result);
+    let analysis = aiService.parseAnalysis('');
+    let generationId = null;
+    let imageCount = 0;
+    let generationDone = null;
+
+    const startGeneration = (prompt) => {
+      // 不带图片时由客户端稍后订阅（/api/generate/stream），截止时间由那次请求决定
+      generationId = tracingService.run(requestSpan, () => generationService.start(prompt, {
+        ...scheduling,
+        ...generation,
+        paper: result.metadata?.paperId,
+        ...(includeImages ? { deadline } : {}),
+        detached: !includeImages
+      }));
+      if (includeImages) {
+        emit('stage', { stage: 'generation' });
+        generationDone = generationService.attach(generationId, (chunk) => {
+          if (chunk.type === 'image') {
+            imageCount++;
+            emit('image', { key: chunk.key, url: `/api/cache/image/${chunk.key}` });
+          } else if (chunk.type === 'queue') {
+            emit('queue', { waiting: chunk.waiting, position: chunk.position, etaMs: chunk.etaMs });
+          } else if (chunk.type === 'error') {
+            emit('error', { error: chunk.error });
+          }
+        }, { signal });
+      }
+    };
+
+    if (textForAI && textForAI.length > 0) {
+      emit('stage', { stage: 'analysis' });
+      const aiRawResponse = await aiService.streamAcademicAnalysis({
+        elements: result.elements,
+        text: textForAI
+      }, (event) => {
+        if (event.type === 'section-delta' && event.section === 'summary') {
+          emit('summary', { content: event.content });
+        } else if (event.type === 'section' && event.section === 'prompt') {
+          // Prompt 段一结束就开始生图，不等 Authors/Keywords
+          if (event.content) startGeneration(event.content);
+          emit('prompt', { prompt: event.content, generationId });
+        } else if (event.type === 'section' && (event.section === 'authors' || event.section === 'keywords')) {
+          emit(event.section, { [event.section]: aiService.splitList(event.content) });
+        }
+      }, { signal, deadline }).catch(error => {
+        // 分析中途断开：已提前启动、还没人订阅的生图也一起取消
+        if (generationId && !includeImages) generationService.cancel(generationId);
+        throw error;
+      });
+      analysis = aiService.parseAnalysis(aiRawResponse);
+
+      // 模型把 Prompt 放在最后一段时，只能在流结束后开始
+      if (!generationId && analysis.prompt) startGeneration(analysis.prompt);
+    }
+
+    const response = {
+      text: analysis.summary,
+      generatedPrompt: analysis.prompt,
+      generationId,
+      metadata: {
+        ...result.metadata,
+        title,
+        authors: analysis.authors,
+        keywords: analysis.keywords
+      }
+    };
+
+    if (generationDone) {
+      emit('analysis', response);
+      await generationDone;
+    }
+
+    return { ...response, imageCount };
+  }
+}
+
+module.exports = new PipelineService();
@@ -0,0 +1,62 @@
+const logger = require('./logger');
+
+/**
+ * 启动就绪状态
+ * 各项启动工作（索引加载、模块预加载、连接预热）登记为检查项，/api/ready 据此返回 200 或 503
+ * required 为 false 的检查项失败时只报告，不阻止就绪（例如上游暂时连不上）
+ */
+class ReadinessService {
+  constructor() {
+    // 从进程启动算起，包含模块加载时间
+    this.startedAt = Math.round(Date.now() - process.uptime() * 1000);
+    this.readyAt = null;
+    this.checks = new Map();
+  }
+
+  /**
+   * 登记一项检查，promise 完成即通过
+   */
+  track(name, promise, { required = true } = {}) {
+    const check = { status: 'pending', required, ms: null, error: null };
+    this.checks.set(name, check);
+    Promise.resolve(promise).then(
+      () => {
+        check.status = 'ready';
+        check.ms = Date.now() - this.startedAt;
+        this.update();
+      },
+      (error) => {
+        check.status = 'failed';
+        check.ms = Date.now() - this.startedAt;
+        check.error = error.message;
+        logger.warn(`⚠️ 启动检查 ${name} 失败: ${error.message}`, { check: name });
+        this.update();
+      }
+    );
+    return promise;
+  }
+
+  update() {
+    if (this.readyAt || !this.isReady()) return;
+    this.readyAt = Date.now();
+    logger.info(`✅ 服务就绪 (${this.readyAt - this.startedAt}ms)`);
+  }
+
+  isReady() {
+    for (const check of this.checks.values()) {
+      if (check.required && check.status !== 'ready') return false;
+    }
+    return true;
+  }
+
+  getStatus() {
+    return {
+      ready: this.isReady(),
+      uptimeMs: Date.now() - this.startedAt,
+      readyAfterMs: this.readyAt ? this.readyAt - this.startedAt : null,
+      checks: Object.fromEntries(this.checks)
+    };
+  }
+}
+
+module.exports = new ReadinessService();
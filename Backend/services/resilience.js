@@ -0,0 +1,238 @@
+const metricsService = require('./metricsService');
+const logger = require('./logger');
+
+// 单次调用最多尝试次数（含首次）
+const RETRY_MAX_ATTEMPTS = parseInt(process.env.RETRY_MAX_ATTEMPTS, 10) || 3;
+const RETRY_BASE_DELAY_MS = parseInt(process.env.RETRY_BASE_DELAY_MS, 10) || 500;
+const RETRY_MAX_DELAY_MS = parseInt(process.env.RETRY_MAX_DELAY_MS, 10) || 8000;
+// 重试预算：每个请求存入 ratio 个令牌，每次重试消耗 1 个，上限 RETRY_BUDGET_MAX_TOKENS
+// 上游整体故障时重试量被限制在正常流量的 ratio 倍以内，不会放大故障
+const RETRY_BUDGET_RATIO = parseFloat(process.env.RETRY_BUDGET_RATIO) || 0.2;
+const RETRY_BUDGET_MAX_TOKENS = parseInt(process.env.RETRY_BUDGET_MAX_TOKENS, 10) || 10;
+
+// 熔断器：窗口内请求数达到下限且错误率超过阈值时打开，冷却后放一个探测请求
+const BREAKER_WINDOW_MS = parseInt(process.env.BREAKER_WINDOW_MS, 10) || 30000;
+const BREAKER_MIN_REQUESTS = parseInt(process.env.BREAKER_MIN_REQUESTS, 10) || 10;
+const BREAKER_ERROR_RATE = parseFloat(process.env.BREAKER_ERROR_RATE) || 0.5;
+const BREAKER_COOLDOWN_MS = parseInt(process.env.BREAKER_COOLDOWN_MS, 10) || 30000;
+
+const RETRYABLE_STATUS = new Set([408, 429, 500, 502, 503, 504]);
+const RETRYABLE_CODES = new Set(['ECONNRESET', 'ECONNREFUSED', 'ETIMEDOUT', 'ECONNABORTED', 'EPIPE', 'EAI_AGAIN', 'ENOTFOUND', 'ERR_SOCKET_CONNECTION_TIMEOUT']);
+
+class CircuitOpenError extends Error {
+  constructor(endpoint, retryAfterMs) {
+    super(`上游服务 ${endpoint} 暂时不可用（熔断中），请稍后重试`);
+    this.code = 'CIRCUIT_OPEN';
+    this.endpoint = endpoint;
+    this.retryAfterMs = retryAfterMs;
+  }
+}
+
+/**
+ * 上游调用的弹性层
+ * 按端点（llm / image 等）分别维护重试预算和熔断器，只重试可重试的错误
+ */
+class Resilience {
+  constructor() {
+    this.endpoints = new Map();
+  }
+
+  endpoint(name) {
+    if (!this.endpoints.has(name)) {
+      this.endpoints.set(name, {
+        name,
+        state: 'closed',
+        openedAt: null,
+        probing: false,
+        outcomes: [],
+        budget: RETRY_BUDGET_MAX_TOKENS,
+        stats: { calls: 0, attempts: 0, successes: 0, failures: 0, retries: 0, retriesDenied: 0, rejected: 0, opened: 0 }
+      });
+    }
+    return this.endpoints.get(name);
+  }
+
+  /**
+   * 是否值得重试：网络错误、超时、408/429/5xx；取消和其他 4xx 不重试
+   */
+  isRetryable(error) {
+    if (!error || error.code === 'ERR_CANCELED' || error.name === 'CanceledError') return false;
+    const status = error.response?.status;
+    if (status) return RETRYABLE_STATUS.has(status);
+    return RETRYABLE_CODES.has(error.code);
+  }
+
+  /**
+   * 通过熔断器和重试预算执行 fn(attempt)
+   * options.signal 中止时不再重试，退避等待也会立即结束；退避会越过 options.deadline 时不再重试
+   */
+  async execute(name, fn, { signal, deadline } = {}) {
+    const endpoint = this.endpoint(name);
+    endpoint.stats.calls++;
+    endpoint.budget = Math.min(RETRY_BUDGET_MAX_TOKENS, endpoint.budget + RETRY_BUDGET_RATIO);
+
+    for (let attempt = 1; ; attempt++) {
+      this.admit(endpoint);
+      endpoint.stats.attempts++;
+      try {
+        const result = await fn(attempt);
+        this.record(endpoint, true);
+        return result;
+      } catch (error) {
+        const retryable = this.isRetryable(error);
+        if (!signal?.aborted) {
+          metricsService.upstreamErrors.inc({ endpoint: name, reason: error.response?.status || error.code || 'error' });
+        }
+        // 只有上游故障计入熔断错误率，参数错误和取消不算
+        if (retryable) this.record(endpoint, false);
+        else if (endpoint.probing) endpoint.probing = false;
+
+        if (!retryable || signal?.aborted || attempt >= RETRY_MAX_ATTEMPTS) throw error;
+        const delay = this.backoffDelay(attempt, error);
+        if (deadline && delay >= deadline.remaining()) throw error;
+        if (endpoint.budget < 1) {
+          endpoint.stats.retriesDenied++;
+          throw error;
+        }
+        endpoint.budget -= 1;
+        endpoint.stats.retries++;
+
+        logger.warn(`🔁 [${name}] 第 ${attempt} 次调用失败 (${error.response?.status || error.code || error.message})，${delay}ms 后重试`, { endpoint: name, attempt, delay });
+        await this.sleep(delay, signal);
+        if (signal?.aborted) throw error;
+      }
+    }
+  }
+
+  /**
+   * 熔断检查：打开状态直接拒绝；冷却结束后只放行一个探测请求
+   */
+  admit(endpoint) {
+    if (endpoint.state === 'open') {
+      const elapsed = Date.now() - endpoint.openedAt;
+      if (elapsed < BREAKER_COOLDOWN_MS) {
+        endpoint.stats.rejected++;
+        metricsService.upstreamErrors.inc({ endpoint: endpoint.name, reason: 'CIRCUIT_OPEN' });
+        throw new CircuitOpenError(endpoint.name, BREAKER_COOLDOWN_MS - elapsed);
+      }
+      endpoint.state = 'half-open';
+    }
+    if (endpoint.state === 'half-open') {
+      if (endpoint.probing) {
+        endpoint.stats.rejected++;
+        throw new CircuitOpenError(endpoint.name, RETRY_BASE_DELAY_MS);
+      }
+      endpoint.probing = true;
+    }
+  }
+
+  record(endpoint, ok) {
+    const now = Date.now();
+    if (ok) endpoint.stats.successes++;
+    else endpoint.stats.failures++;
+
+    if (endpoint.state === 'half-open') {
+      endpoint.probing = false;
+      if (ok) {
+        logger.info(`✅ [${endpoint.name}] 探测成功，熔断器关闭`, { endpoint: endpoint.name });
+        endpoint.state = 'closed';
+        endpoint.outcomes = [];
+      } else {
+        this.open(endpoint);
+      }
+      return;
+    }
+
+    endpoint.outcomes.push({ at: now, ok });
+    this.prune(endpoint, now);
+    const { requests, errorRate } = this.windowStats(endpoint);
+    if (endpoint.state === 'closed' && requests >= BREAKER_MIN_REQUESTS && errorRate >= BREAKER_ERROR_RATE) {
+      this.open(endpoint);
+    }
+  }
+
+  open(endpoint) {
+    endpoint.state = 'open';
+    endpoint.openedAt = Date.now();
+    endpoint.stats.opened++;
+    logger.warn(`⛔ [${endpoint.name}] 错误率过高，熔断 ${BREAKER_COOLDOWN_MS}ms`, { endpoint: endpoint.name });
+  }
+
+  prune(endpoint, now) {
+    while (endpoint.outcomes.length && now - endpoint.outcomes[0].at > BREAKER_WINDOW_MS) {
+      endpoint.outcomes.shift();
+    }
+  }
+
+  windowStats(endpoint) {
+    const requests = endpoint.outcomes.length;
+    const errors = endpoint.outcomes.filter(o => !o.ok).length;
+    return { requests, errors, errorRate: requests ? errors / requests : 0 };
+  }
+
+  /**
+   * 全抖动指数退避；上游给了 Retry-After 时取两者较大值（不超过上限）
+   */
+  backoffDelay(attempt, error) {
+    const cap = Math.min(RETRY_MAX_DELAY_MS, RETRY_BASE_DELAY_MS * 2 ** (attempt - 1));
+    let delay = Math.round(Math.random() * cap);
+    const retryAfter = parseFloat(error.response?.headers?.['retry-after']);
+    if (!Number.isNaN(retryAfter)) delay = Math.max(delay, Math.min(RETRY_MAX_DELAY_MS, retryAfter * 1000));
+    return delay;
+  }
+
+  sleep(ms, signal) {
+    return new Promise(resolve => {
+      const timer = setTimeout(done, ms);
+      function done() {
+        clearTimeout(timer);
+        if (signal) signal.removeEventListener('abort', done);
+        resolve();
+      }
+      if (signal) signal.addEventListener('abort', done, { once: true });
+    });
+  }
+
+  /**
+   * 熔断器处于打开状态时返回剩余冷却时间，否则返回 0
+   */
+  openFor(name) {
+    const endpoint = this.endpoints.get(name);
+    if (!endpoint || endpoint.state !== 'open') return 0;
+    return Math.max(0, BREAKER_COOLDOWN_MS - (Date.now() - endpoint.openedAt));
+  }
+
+  getStats() {
+    const now = Date.now();
+    const endpoints = {};
+    for (const endpoint of this.endpoints.values()) {
+      this.prune(endpoint, now);
+      const { requests, errorRate } = this.windowStats(endpoint);
+      endpoints[endpoint.name] = {
+        state: endpoint.state,
+        openedAt: endpoint.openedAt ? new Date(endpoint.openedAt).toISOString() : null,
+        retryInMs: endpoint.state === 'open' ? Math.max(0, BREAKER_COOLDOWN_MS - (now - endpoint.openedAt)) : 0,
+        windowRequests: requests,
+        windowErrorRate: errorRate,
+        retryBudget: Math.floor(endpoint.budget * 100) / 100,
+        ...endpoint.stats
+      };
+    }
+    return {
+      maxAttempts: RETRY_MAX_ATTEMPTS,
+      budgetRatio: RETRY_BUDGET_RATIO,
+      breaker: {
+        windowMs: BREAKER_WINDOW_MS,
+        minRequests: BREAKER_MIN_REQUESTS,
+        errorRate: BREAKER_ERROR_RATE,
+        cooldownMs: BREAKER_COOLDOWN_MS
+      },
+      endpoints
+    };
+  }
+}
+
+const resilience = new Resilience();
+resilience.CircuitOpenError = CircuitOpenError;
+
+module.exports = resilience;
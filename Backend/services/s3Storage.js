@@ -0,0 +1,168 @@
+const crypto = require('crypto');
+const httpClient = require('./httpClient');
+
+const EMPTY_SHA256 = crypto.createHash('sha256').update('').digest('hex');
+
+// RFC 3986 编码，SigV4 规范请求要求的编码方式
+const encode = (value) => encodeURIComponent(value).replace(/[!'()*]/g, c => `%${c.charCodeAt(0).toString(16).toUpperCase()}`);
+const encodePath = (value) => value.split('/').map(encode).join('/');
+const hmac = (key, data) => crypto.createHmac('sha256', key).update(data).digest();
+const sha256 = (data) => crypto.createHash('sha256').update(data).digest('hex');
+
+const xmlValues = (xml, tag) => [...xml.matchAll(new RegExp(`<${tag}>([\\s\\S]*?)</${tag}>`, 'g'))].map(m => m[1]);
+const xmlDecode = (value) => value
+  .replace(/&lt;/g, '<').replace(/&gt;/g, '>').replace(/&quot;/g, '"').replace(/&apos;/g, "'").replace(/&amp;/g, '&');
+
+/**
+ * S3 兼容对象存储（AWS S3 / MinIO 等），接口与 FsStorage 相同
+ * 只用到 PUT / GET(Range) / HEAD / DELETE / ListObjectsV2，请求用 SigV4 签名并走 httpClient 连接池
+ */
+class S3Storage {
+  constructor({ endpoint, bucket, region = 'us-east-1', accessKeyId, secretAccessKey, prefix = '', pathStyle = true }) {
+    if (!bucket || !accessKeyId || !secretAccessKey) {
+      throw new Error('S3 存储需要配置 S3_BUCKET、S3_ACCESS_KEY_ID、S3_SECRET_ACCESS_KEY');
+    }
+    this.endpoint = new URL(endpoint || `https://s3.${region}.amazonaws.com`);
+    this.bucket = bucket;
+    this.region = region;
+    this.accessKeyId = accessKeyId;
+    this.secretAccessKey = secretAccessKey;
+    this.prefix = prefix;
+    this.pathStyle = pathStyle;
+    this.name = 's3';
+  }
+
+  describe() {
+    return { backend: this.name, endpoint: this.endpoint.origin, bucket: this.bucket, prefix: this.prefix };
+  }
+
+  objectKey(name) {
+    return `${this.prefix}${name}`;
+  }
+
+  /**
+   * 构造 URL 并签名，返回 httpClient.request 的配置
+   */
+  signedRequest(method, objectKey, { query = {}, headers = {}, body, payloadHash } = {}) {
+    const host = this.pathStyle ? this.endpoint.host : `${this.bucket}.${this.endpoint.host}`;
+    const basePath = this.endpoint.pathname.replace(/\/$/, '');
+    const canonicalPath = this.pathStyle
+      ? `${basePath}/${encode(this.bucket)}${objectKey === null ? '' : `/${encodePath(objectKey)}`}`
+      : `${basePath}/${objectKey === null ? '' : encodePath(objectKey)}`;
+    const canonicalQuery = Object.keys(query).sort()
+      .map(key => `${encode(key)}=${encode(String(query[key]))}`)
+      .join('&');
+
+    const amzDate = new Date().toISOString().replace(/[:-]|\.\d{3}/g, '');
+    const date = amzDate.slice(0, 8);
+    const contentHash = payloadHash || (body ? sha256(body) : EMPTY_SHA256);
+    const signedHeaders = {
+      ...Object.fromEntries(Object.entries(headers).map(([k, v]) => [k.toLowerCase(), String(v).trim()])),
+      host,
+      'x-amz-content-sha256': contentHash,
+      'x-amz-date': amzDate
+    };
+    const headerNames = Object.keys(signedHeaders).sort();
+    const canonicalRequest = [
+      method,
+      canonicalPath,
+      canonicalQuery,
+      headerNames.map(name => `${name}:${signedHeaders[name]}\n`).join(''),
+      headerNames.join(';'),
+      contentHash
+    ].join('\n');
+
+    const scope = `${date}/${this.region}/s3/aws4_request`;
+    const stringToSign = ['AWS4-HMAC-SHA256', amzDate, scope, sha256(canonicalRequest)].join('\n');
+    const signingKey = hmac(hmac(hmac(hmac(`AWS4${this.secretAccessKey}`, date), this.region), 's3'), 'aws4_request');
+    const signature = crypto.createHmac('sha256', signingKey).update(stringToSign).digest('hex');
+
+    const { host: _host, ...sendHeaders } = signedHeaders;
+    return {
+      method,
+      url: `${this.endpoint.protocol}//${host}${canonicalPath}${canonicalQuery ? `?${canonicalQuery}` : ''}`,
+      headers: {
+        ...sendHeaders,
+        Authorization: `AWS4-HMAC-SHA256 Credential=${this.accessKeyId}/${scope}, SignedHeaders=${headerNames.join(';')}, Signature=${signature}`
+      },
+      data: body,
+      // 404 由调用方处理，其余非 2xx 抛出
+      validateStatus: status => (status >= 200 && status < 300) || status === 404,
+      maxBodyLength: Infinity,
+      maxContentLength: Infinity
+    };
+  }
+
+  async put(name, buffer, { contentType = 'application/octet-stream' } = {}) {
+    await httpClient.request(this.signedRequest('PUT', this.objectKey(name), {
+      headers: { 'content-type': contentType, 'content-length': buffer.length },
+      body: buffer
+    }));
+    return { size: buffer.length };
+  }
+
+  async stat(name) {
+    const response = await httpClient.request(this.signedRequest('HEAD', this.objectKey(name)));
+    if (response.status === 404) return null;
+    const mtimeMs = Date.parse(response.headers['last-modified']) || Date.now();
+    return {
+      size: parseInt(response.headers['content-length'], 10) || 0,
+      mtimeMs,
+      birthtimeMs: mtimeMs,
+      contentType: response.headers['content-type']
+    };
+  }
+
+  /**
+   * 打开对象读取流；start/end 为闭区间字节范围，不存在时返回 null
+   */
+  async open(name, { start, end } = {}) {
+    const headers = {};
+    if (start !== undefined) headers.range = `bytes=${start}-${end === undefined ? '' : end}`;
+    const config = this.signedRequest('GET', this.objectKey(name), { headers });
+    const response = await httpClient.request({ ...config, responseType: 'stream' });
+    if (response.status === 404) {
+      response.data.resume();
+      return null;
+    }
+    const range = /\/(\d+)$/.exec(response.headers['content-range'] || '');
+    const mtimeMs = Date.parse(response.headers['last-modified']) || Date.now();
+    return {
+      stream: response.data,
+      size: range ? parseInt(range[1], 10) : parseInt(response.headers['content-length'], 10),
+      mtimeMs,
+      contentType: response.headers['content-type']
+    };
+  }
+
+  async delete(name) {
+    await httpClient.request(this.signedRequest('DELETE', this.objectKey(name)));
+  }
+
+  /**
+   * 列出前缀下的全部对象（ListObjectsV2 分页）
+   */
+  async list(prefix) {
+    const entries = [];
+    let token = null;
+    do {
+      const query = { 'list-type': 2, prefix: this.objectKey(prefix) };
+      if (token) query['continuation-token'] = token;
+      const response = await httpClient.request({ ...this.signedRequest('GET', null, { query }), responseType: 'text' });
+      const xml = String(response.data);
+      for (const block of xmlValues(xml, 'Contents')) {
+        const mtimeMs = Date.parse(xmlValues(block, 'LastModified')[0]) || 0;
+        entries.push({
+          name: xmlDecode(xmlValues(block, 'Key')[0]).slice(this.prefix.length),
+          size: parseInt(xmlValues(block, 'Size')[0], 10) || 0,
+          mtimeMs,
+          birthtimeMs: mtimeMs
+        });
+      }
+      token = xmlValues(xml, 'IsTruncated')[0] === 'true' ? xmlDecode(xmlValues(xml, 'NextContinuationToken')[0] || '') : null;
+    } while (token);
+    return entries;
+  }
+}
+
+module.exports = S3Storage;
@@ -0,0 +1,300 @@
+/**
+ * 论文章节索引：根据 Extract 结构化元素（路径、页码、字号）识别标题，
+ * 按章节价值在 token 预算内挑选送给 LLM 的正文
+ */
+
+// Adobe Extract 的结构路径，例如 //Document/H1[2]（Title 归入前置部分，不作为章节标题）
+const HEADING_PATH = /\/H\d(\[\d+\])?$/;
+// 编号前缀：1 / 2.3 / 4) / IV. / A.（罗马数字和字母必须带点，避免误删 "A method ..."）
+const NUMBERING = /^((\d+(\.\d+)*[.)]?)|([IVX]+\.)|([A-H]\.))\s+/;
+
+// priority 越小越优先；skip 的章节不送给 LLM
+const SECTION_RULES = [
+  { kind: 'abstract', pattern: /^(abstract|摘\s*要)/i, priority: 1 },
+  { kind: 'introduction', pattern: /^(introduction|引\s*言|绪\s*论|前\s*言)/i, priority: 2 },
+  { kind: 'conclusion', pattern: /^(conclusions?|concluding remarks|discussion|summary|结\s*论|总\s*结|讨\s*论)/i, priority: 3 },
+  { kind: 'method', pattern: /^(methods?|methodology|approach|proposed|our (method|approach|model)|model|framework|architecture|方\s*法|模\s*型)/i, priority: 4 },
+  { kind: 'results', pattern: /^(results?|experiments?|experimental|evaluation|实\s*验|结\s*果)/i, priority: 5 },
+  { kind: 'related', pattern: /^(related work|background|preliminar|相关工作|背\s*景)/i, priority: 7 },
+  { kind: 'references', pattern: /^(references|bibliography|works cited|参考文献)/i, skip: true },
+  { kind: 'appendix', pattern: /^(appendix|appendices|supplementary|附\s*录)/i, skip: true },
+  { kind: 'acknowledgments', pattern: /^(acknowledge?ments?|致\s*谢)/i, skip: true }
+];
+
+const FRONT_PRIORITY = 0; // 标题、作者、单位，Authors 字段依赖这一段
+const OTHER_PRIORITY = 6;
+const MAX_HEADING_LENGTH = 120;
+
+function countCjk(text) {
+  return (text.match(/[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]/g) || []).length;
+}
+
+class SectionService {
+  /**
+   * 估算 token 数：CJK 字符约 1 token/字，其余约 4 字符/token
+   */
+  estimateTokens(text) {
+    if (!text) return 0;
+    const cjk = countCjk(text);
+    return cjk + Math.ceil((text.length - cjk) / 4);
+  }
+
+  /**
+   * 根据标题文本判断章节类型
+   */
+  classifyHeading(heading) {
+    const title = heading.replace(NUMBERING, '').trim();
+    for (const rule of SECTION_RULES) {
+      if (rule.pattern.test(title)) {
+        return { kind: rule.kind, priority: rule.skip ? Infinity : rule.priority, skip: !!rule.skip };
+      }
+    }
+    return { kind: 'other', priority: OTHER_PRIORITY, skip: false };
+  }
+
+  /**
+   * 从 processExtractResult 的 elements 构建章节索引
+   */
+  buildSectionIndex(elements) {
+    const texts = (elements || []).filter(el => el.type === 'text' && el.text && el.text.trim());
+    const bodySize = this.bodyFontSize(texts);
+
+    const isHeading = (el) => {
+      const text = el.text.trim();
+      if (text.length > MAX_HEADING_LENGTH) return false;
+      if (el.path && HEADING_PATH.test(el.path)) return true;
+      const known = this.classifyHeading(text).kind !== 'other';
+      if (known && text.split(/\s+/).length <= 6) return true;
+      // 没有结构路径时，用字号和编号格式兜底
+      const larger = bodySize && el.fontSize && el.fontSize >= bodySize * 1.15;
+      return !!(larger && NUMBERING.test(text) && !/[.。]$/.test(text));
+    };
+
+    return this.buildIndex(texts.map(el => ({
+      text: el.text.trim(),
+      page: el.page || 1,
+      heading: isHeading(el)
+    })));
+  }
+
+  /**
+   * 只有纯文本时按行识别常见章节标题
+   */
+  buildSectionIndexFromText(text) {
+    const lines = (text || '').split('\n').map(l => l.trim()).filter(Boolean);
+    return this.buildIndex(lines.map(line => ({
+      text: line,
+      page: null,
+      heading: line.length <= MAX_HEADING_LENGTH &&
+        line.split(/\s+/).length <= 6 &&
+        this.classifyHeading(line).kind !== 'other'
+    })));
+  }
+
+  buildIndex(blocks) {
+    const sections = [];
+    let current = {
+      heading: '',
+      kind: 'front',
+      priority: FRONT_PRIORITY,
+      skip: false,
+      pageStart: blocks[0]?.page || 1,
+      parts: []
+    };
+    // 参考文献之后的章节（附录等）一律跳过
+    let afterReferences = false;
+
+    for (const block of blocks) {
+      if (block.heading) {
+        sections.push(current);
+        const cls = this.classifyHeading(block.text);
+        if (cls.kind === 'references') afterReferences = true;
+        current = {
+          heading: block.text,
+          kind: cls.kind,
+          priority: afterReferences ? Infinity : cls.priority,
+          skip: afterReferences || cls.skip,
+          pageStart: block.page,
+          parts: []
+        };
+      } else {
+        current.parts.push(block.text);
+      }
+    }
+    sections.push(current);
+
+    const index = sections
+      .filter(s => s.heading || s.parts.length)
+      .map((s, order) => {
+        const text = s.parts.join('\n');
+        return {
+          order,
+          heading: s.heading,
+          kind: s.kind,
+          priority: s.priority,
+          skip: s.skip,
+          pageStart: s.pageStart,
+          text,
+          tokens: this.estimateTokens(s.heading) + this.estimateTokens(text)
+        };
+      });
+
+    return {
+      sections: index,
+      totalTokens: index.reduce((sum, s) => sum + s.tokens, 0),
+      usefulTokens: index.filter(s => !s.skip).reduce((sum, s) => sum + s.tokens, 0)
+    };
+  }
+
+  /**
+   * 按优先级在预算内挑选章节，保持原文顺序输出
+   * 单个章节超出剩余预算时截取开头部分
+   */
+  selectSections(index, budgetTokens) {
+    const candidates = index.sections
+      .filter(s => !s.skip)
+      .sort((a, b) => a.priority - b.priority || a.order - b.order);
+
+    const chosen = [];
+    let remaining = budgetTokens;
+    for (const section of candidates) {
+      if (remaining <= 0) break;
+      if (section.tokens <= remaining) {
+        chosen.push(section);
+        remaining -= section.tokens;
+      } else if (remaining >= 200) {
+        const ratio = remaining / section.tokens;
+        chosen.push({ ...section, text: section.text.substring(0, Math.floor(section.text.length * ratio)), truncated: true });
+        remaining = 0;
+      }
+    }
+
+    return chosen.sort((a, b) => a.order - b.order);
+  }
+
+  /**
+   * 把章节渲染成带标题的正文
+   */
+  renderSections(sections) {
+    return sections
+      .map(s => (s.heading ? `## ${s.heading}\n${s.text}` : s.text))
+      .join('\n\n');
+  }
+
+  /**
+   * 把章节从开头起按段落拆成两段：前一段不超过 headTokens，其余作为普通正文章节
+   * 整篇识别不出章节标题时，前置部分就是全文，用它把标题/作者之后的内容分出来
+   */
+  splitSection(section, headTokens) {
+    const head = [];
+    const rest = [];
+    let used = this.estimateTokens(section.heading);
+    for (const paragraph of section.text.split('\n')) {
+      for (const piece of this.splitParagraph(paragraph, headTokens)) {
+        const tokens = this.estimateTokens(piece);
+        if (!rest.length && used + tokens <= headTokens) {
+          head.push(piece);
+          used += tokens;
+        } else {
+          rest.push(piece);
+        }
+      }
+    }
+    const part = (extra, parts) => {
+      const text = parts.join('\n');
+      return { ...section, ...extra, text, tokens: this.estimateTokens(extra.heading ?? section.heading) + this.estimateTokens(text) };
+    };
+    return {
+      head: part({}, head),
+      rest: rest.length ? part({ heading: '', kind: 'other', priority: OTHER_PRIORITY, skip: false }, rest) : null
+    };
+  }
+
+  /**
+   * 把超过 maxTokens 的段落按句子切开；单句仍然超长时按词切，没有空格的长串（如中文）按字符切
+   */
+  splitParagraph(paragraph, maxTokens) {
+    if (this.estimateTokens(paragraph) <= maxTokens) return [paragraph];
+
+    // 逐段累加字符数和 CJK 字符数，按整段估算 token，不会因逐段取整而切得过碎
+    const pieces = [];
+    let current = '';
+    let cjk = 0;
+    const add = (part) => {
+      const partCjk = countCjk(part);
+      const total = cjk + partCjk;
+      if (current && total + Math.ceil((current.length + part.length - total) / 4) > maxTokens) {
+        pieces.push(current.trim());
+        current = '';
+        cjk = 0;
+      }
+      current += part;
+      cjk += partCjk;
+    };
+
+    for (const sentence of paragraph.match(/[^.!?。！？]+[.!?。！？]*\s*|[.!?。！？]+\s*/g) || [paragraph]) {
+      if (this.estimateTokens(sentence) <= maxTokens) {
+        add(sentence);
+        continue;
+      }
+      for (const word of sentence.match(/\S+\s*|\s+/g)) {
+        if (this.estimateTokens(word) <= maxTokens) {
+          add(word);
+        } else {
+          // 每个字符至多 1 token，maxTokens 个字符一段一定不超
+          for (let i = 0; i < word.length; i += maxTokens) add(word.slice(i, i + maxTokens));
+        }
+      }
+    }
+    if (current.trim()) pieces.push(current.trim());
+    return pieces;
+  }
+
+  /**
+   * 将章节切分为不超过 chunkTokens 的块（章节边界优先，超长章节按段落切，超长段落按句子切）
+   */
+  chunkSections(sections, chunkTokens) {
+    const chunks = [];
+    let current = [];
+    let currentTokens = 0;
+
+    const flush = () => {
+      if (current.length) chunks.push(current.join('\n\n'));
+      current = [];
+      currentTokens = 0;
+    };
+
+    for (const section of sections) {
+      const paragraphs = [section.heading ? `## ${section.heading}` : '', ...section.text.split('\n')]
+        .filter(Boolean)
+        .flatMap(paragraph => this.splitParagraph(paragraph, chunkTokens));
+      for (const paragraph of paragraphs) {
+        // 段落之间的空行按 1 token 计，块拼接后仍不超过 chunkTokens
+        const tokens = this.estimateTokens(paragraph) + (current.length ? 1 : 0);
+        if (currentTokens + tokens > chunkTokens && current.length) flush();
+        current.push(paragraph);
+        currentTokens += tokens;
+      }
+    }
+    flush();
+
+    return chunks;
+  }
+
+  bodyFontSize(texts) {
+    // 按文本长度加权的字号中位数即正文字号
+    const sizes = texts
+      .filter(el => el.fontSize)
+      .map(el => ({ size: el.fontSize, weight: el.text.length }))
+      .sort((a, b) => a.size - b.size);
+    const total = sizes.reduce((sum, s) => sum + s.weight, 0);
+    let acc = 0;
+    for (const s of sizes) {
+      acc += s.weight;
+      if (acc >= total / 2) return s.size;
+    }
+    return null;
+  }
+}
+
+module.exports = new SectionService();
@@ -0,0 +1,240 @@
+const fs = require('fs-extra');
+const path = require('path');
+const { PassThrough } = require('stream');
+const { v4: uuidv4 } = require('uuid');
+const S3Storage = require('./s3Storage');
+
+// 缓存对象存放位置：fs（本地 CACHE_DIR，默认）或 s3（S3 兼容对象存储，多节点部署时使用）
+const STORAGE_BACKEND = process.env.STORAGE_BACKEND || 'fs';
+// s3 模式下本地读穿透层的容量上限，按最近访问淘汰
+const STORAGE_LOCAL_TIER_MAX_BYTES = parseInt(process.env.STORAGE_LOCAL_TIER_MAX_BYTES, 10) || 1024 * 1024 * 1024;
+
+const CONTENT_TYPES = {
+  '.png': 'image/png',
+  '.jpg': 'image/jpeg',
+  '.jpeg': 'image/jpeg',
+  '.gif': 'image/gif',
+  '.webp': 'image/webp',
+  '.avif': 'image/avif',
+  '.csv': 'text/csv',
+  '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+};
+
+// 参数可以是对象名或扩展名
+const contentTypeFor = (name) => CONTENT_TYPES[(name.startsWith('.') ? name : path.extname(name)).toLowerCase()] || 'application/octet-stream';
+
+/**
+ * 本地文件系统存储，对象名即 root 下的相对路径
+ * 所有存储实现提供相同的异步接口：put / stat / open / delete / list
+ * list 返回的条目可能不带 size / mtimeMs（stat: false），调用方需要时再 stat
+ */
+class FsStorage {
+  constructor(root) {
+    this.root = root;
+    this.name = 'fs';
+  }
+
+  describe() {
+    return { backend: this.name, root: this.root };
+  }
+
+  resolve(name) {
+    const filePath = path.resolve(this.root, name);
+    // 对象名来自 URL 参数拼接，拒绝跳出根目录
+    if (!filePath.startsWith(path.resolve(this.root) + path.sep)) throw new Error(`非法的对象名: ${name}`);
+    return filePath;
+  }
+
+  async put(name, buffer) {
+    const filePath = this.resolve(name);
+    await fs.ensureDir(path.dirname(filePath));
+    await fs.writeFile(filePath, buffer);
+    return { size: buffer.length };
+  }
+
+  async stat(name) {
+    const stats = await fs.stat(this.resolve(name)).catch(() => null);
+    if (!stats || !stats.isFile()) return null;
+    return { size: stats.size, mtimeMs: stats.mtimeMs, birthtimeMs: stats.birthtimeMs, contentType: contentTypeFor(name) };
+  }
+
+  /**
+   * 打开读取流；start/end 为闭区间字节范围，不存在时返回 null
+   */
+  async open(name, { start, end } = {}) {
+    const filePath = this.resolve(name);
+    const stats = await this.stat(name);
+    if (!stats) return null;
+    return {
+      stream: fs.createReadStream(filePath, { start, end }),
+      size: stats.size,
+      mtimeMs: stats.mtimeMs,
+      contentType: stats.contentType
+    };
+  }
+
+  async delete(name) {
+    await fs.remove(this.resolve(name));
+  }
+
+  /**
+   * 列出前缀下的对象；stat 为 false 时只返回对象名（大目录下省去逐个 stat）
+   */
+  async list(prefix, { stat = true } = {}) {
+    const dir = this.resolve(prefix || '.');
+    const files = await fs.readdir(dir).catch(() => []);
+    const entries = [];
+    for (const file of files) {
+      const name = path.posix.join(prefix, file);
+      if (!stat) {
+        entries.push({ name });
+        continue;
+      }
+      const stats = await this.stat(name);
+      if (stats) entries.push({ name, size: stats.size, mtimeMs: stats.mtimeMs, birthtimeMs: stats.birthtimeMs });
+    }
+    return entries;
+  }
+}
+
+/**
+ * 远程存储 + 本地读穿透层
+ * 写入同时落本地；读取先查本地，未命中时从远程边读边返回，同时写入本地供下次使用
+ * 远程是唯一可信来源：stat / list 走远程，其他节点写入的对象也能找到
+ */
+class TieredStorage {
+  constructor(remote, local, maxBytes) {
+    this.remote = remote;
+    this.local = local;
+    this.maxBytes = maxBytes;
+    this.name = `${remote.name}+tier`;
+    // 本地层条目：对象名 -> 字节数，Map 的顺序即最近访问顺序
+    this.entries = new Map();
+    this.localBytes = 0;
+    this.stats = { hits: 0, misses: 0, evictions: 0 };
+    this.ready = this.loadLocal();
+  }
+
+  describe() {
+    return {
+      ...this.remote.describe(),
+      localTier: { root: this.local.root, maxBytes: this.maxBytes, bytes: this.localBytes, entries: this.entries.size, ...this.stats }
+    };
+  }
+
+  async loadLocal() {
+    const prefixes = await fs.readdir(this.local.root).catch(() => []);
+    for (const prefix of prefixes) {
+      for (const entry of await this.local.list(prefix)) {
+        // 上次进程退出时没写完的临时文件
+        if (entry.name.endsWith('.tmp')) await this.local.delete(entry.name).catch(() => {});
+        else this.track(entry.name, entry.size);
+      }
+    }
+    await this.evict();
+  }
+
+  track(name, size) {
+    this.localBytes -= this.entries.get(name) || 0;
+    this.entries.delete(name);
+    this.entries.set(name, size);
+    this.localBytes += size;
+  }
+
+  async evict() {
+    for (const [name, size] of this.entries) {
+      if (this.localBytes <= this.maxBytes) break;
+      this.entries.delete(name);
+      this.localBytes -= size;
+      this.stats.evictions++;
+      await this.local.delete(name).catch(() => {});
+    }
+  }
+
+  async put(name, buffer, options) {
+    const result = await this.remote.put(name, buffer, options);
+    await this.local.put(name, buffer);
+    this.track(name, buffer.length);
+    await this.evict();
+    return result;
+  }
+
+  stat(name) {
+    return this.remote.stat(name);
+  }
+
+  async open(name, range = {}) {
+    if (this.entries.has(name)) {
+      const hit = await this.local.open(name, range);
+      if (hit) {
+        this.stats.hits++;
+        this.track(name, hit.size);
+        return hit;
+      }
+      this.entries.delete(name);
+    }
+
+    this.stats.misses++;
+    const object = await this.remote.open(name, range);
+    // 只有完整读取才写入本地层，范围请求直接透传
+    if (!object || range.start !== undefined) return object;
+
+    // 同一份远程流同时写给调用方和本地临时文件，客户端中途断开时本地层仍会写完
+    const filePath = this.local.resolve(name);
+    const tmpPath = `${filePath}.${uuidv4()}.tmp`;
+    await fs.ensureDir(path.dirname(filePath));
+    const body = new PassThrough();
+    const file = fs.createWriteStream(tmpPath);
+    object.stream.pipe(body);
+    object.stream.pipe(file);
+    object.stream.on('error', (error) => {
+      body.destroy(error);
+      file.destroy();
+    });
+    file.on('error', () => fs.remove(tmpPath).catch(() => {}));
+    file.on('close', async () => {
+      if (!object.stream.readableEnded || file.bytesWritten !== object.size) return fs.remove(tmpPath).catch(() => {});
+      await fs.rename(tmpPath, filePath).catch(() => {});
+      this.track(name, file.bytesWritten);
+      await this.evict();
+    });
+    return { ...object, stream: body };
+  }
+
+  async delete(name) {
+    await this.remote.delete(name);
+    if (this.entries.has(name)) {
+      this.localBytes -= this.entries.get(name);
+      this.entries.delete(name);
+    }
+    await this.local.delete(name).catch(() => {});
+  }
+
+  list(prefix, options) {
+    return this.remote.list(prefix, options);
+  }
+}
+
+/**
+ * 按 STORAGE_BACKEND 创建存储
+ * s3 模式下 cacheDir 用作本地读穿透层
+ */
+function createStorage(cacheDir) {
+  const local = new FsStorage(cacheDir);
+  if (STORAGE_BACKEND === 'fs') return local;
+  if (STORAGE_BACKEND !== 's3') throw new Error(`未知的 STORAGE_BACKEND: ${STORAGE_BACKEND}`);
+
+  const remote = new S3Storage({
+    endpoint: process.env.S3_ENDPOINT,
+    bucket: process.env.S3_BUCKET,
+    region: process.env.S3_REGION || 'us-east-1',
+    accessKeyId: process.env.S3_ACCESS_KEY_ID,
+    secretAccessKey: process.env.S3_SECRET_ACCESS_KEY,
+    prefix: process.env.S3_PREFIX || '',
+    // 自建 MinIO 等通常只支持路径风格
+    pathStyle: process.env.S3_FORCE_PATH_STYLE ? process.env.S3_FORCE_PATH_STYLE === 'true' : Boolean(process.env.S3_ENDPOINT)
+  });
+  return new TieredStorage(remote, local, STORAGE_LOCAL_TIER_MAX_BYTES);
+}
+
+module.exports = { createStorage, contentTypeFor, FsStorage, TieredStorage, S3Storage };
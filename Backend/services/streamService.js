@@ -1,6 +1,26 @@
 const { Transform } = require('stream');
+const metricsService = require('./metricsService');
+const logger = require('./logger');
+
+// SSE 心跳间隔：空闲超过这个时间发送一条注释行
+const SSE_HEARTBEAT_MS = parseInt(process.env.SSE_HEARTBEAT_MS, 10) || 15000;
+// 合并窗口：窗口内的事件一次写出
+const SSE_FLUSH_MS = parseInt(process.env.SSE_FLUSH_MS, 10) || 20;
+// 单连接最多积压的字节数，超过即视为慢客户端断开
+// SSE 事件都很小（图片只推 URL），正常客户端远达不到这个量
+const SSE_MAX_BUFFER_BYTES = parseInt(process.env.SSE_MAX_BUFFER_BYTES, 10) || 256 * 1024;
 
 class StreamService {
+  constructor() {
+    // res -> { pendingBytes(), heartbeat() }
+    this.sseConnections = new Map();
+    // 所有连接共用一个心跳定时器
+    this.heartbeatTimer = null;
+    this.sseStats = { opened: 0, events: 0, writes: 0, bytes: 0, coalesced: 0, heartbeats: 0, drainWaits: 0, slowConsumersDropped: 0 };
+
+    metricsService.gauge('sse_connections_open', '当前打开的 SSE 连接数', [], () => this.sseConnections.size);
+  }
+
   /**
    * 创建NDJSON解析流
    */
@@ -22,7 +42,7 @@ class StreamService {
               const data = JSON.parse(line);
               this.push(data);
             } catch (error) {
-              console.error('NDJSON parse error:', error, 'Line:', line);
+              logger.error('❌ NDJSON 解析失败', { error, line: line.slice(0, 200) });
             }
           }
         }
@@ -36,7 +56,7 @@ class StreamService {
             const data = JSON.parse(buffer);
             this.push(data);
           } catch (error) {
-            console.error('Final buffer parse error:', error);
+            logger.error('❌ NDJSON 残留数据解析失败', error);
           }
         }
         callback();
@@ -55,7 +75,7 @@ class StreamService {
           const event = this.formatEvent(data);
           this.push(event);
         } catch (error) {
-          console.error('Event transform error:', error);
+          logger.error('❌ 事件转换失败', error);
         }
         callback();
       }
@@ -90,47 +110,183 @@ class StreamService {
 
   /**
    * 创建SSE响应流
+   * - 同一刷新窗口内的事件合并成一次 write；replace 为 true 的事件（如排队状态）只保留最新一条
+   * - write 返回 false 时等待 drain 再写；积压超过 maxBufferBytes 的慢客户端直接断开
+   * - 长时间没有输出时发送注释心跳，避免代理掐断空闲连接
+   * options: { flushMs, maxBufferBytes }
    */
-  createSSEResponse(res) {
+  createSSEResponse(res, options = {}) {
+    const {
+      flushMs = SSE_FLUSH_MS,
+      maxBufferBytes = SSE_MAX_BUFFER_BYTES
+    } = options;
+
     res.setHeader('Content-Type', 'text/event-stream');
     res.setHeader('Cache-Control', 'no-cache');
     res.setHeader('Connection', 'keep-alive');
     res.setHeader('X-Accel-Buffering', 'no');
     res.flushHeaders();
-    
+
+    const stats = this.sseStats;
+    stats.opened++;
+
+    // 待写出的事件：{ event, text, size }，replaceable 记录可替换事件在 pending 中的位置
+    let pending = [];
+    let pendingBytes = 0;
+    const replaceable = new Map();
+    let flushTimer = null;
+    let waitingDrain = false;
+    let closed = false;
+    let lastWrite = Date.now();
+
+    const cleanup = () => {
+      if (closed) return;
+      closed = true;
+      clearTimeout(flushTimer);
+      pending = [];
+      pendingBytes = 0;
+      this.sseConnections.delete(res);
+      if (this.sseConnections.size === 0) {
+        clearInterval(this.heartbeatTimer);
+        this.heartbeatTimer = null;
+      }
+    };
+
+    const flush = () => {
+      flushTimer = null;
+      if (closed || waitingDrain || pending.length === 0) return;
+
+      const chunk = pending.map(item => item.text).join('');
+      stats.writes++;
+      stats.bytes += pendingBytes;
+      pending = [];
+      pendingBytes = 0;
+      replaceable.clear();
+      lastWrite = Date.now();
+
+      if (!res.write(chunk)) {
+        waitingDrain = true;
+        stats.drainWaits++;
+        res.once('drain', () => {
+          waitingDrain = false;
+          flush();
+        });
+      }
+    };
+
+    const scheduleFlush = () => {
+      if (flushTimer || waitingDrain) return;
+      flushTimer = flushMs > 0 ? setTimeout(flush, flushMs) : setImmediate(flush);
+    };
+
+    const enqueue = (event, text, replace) => {
+      if (closed || res.writableEnded) return false;
+
+      const size = Buffer.byteLength(text);
+      if (replace && replaceable.has(event)) {
+        const item = pending[replaceable.get(event)];
+        pendingBytes += size - item.size;
+        Object.assign(item, { text, size });
+        stats.coalesced++;
+      } else {
+        if (replace) replaceable.set(event, pending.length);
+        pending.push({ event, text, size });
+        pendingBytes += size;
+      }
+      stats.events++;
+
+      // 内核缓冲 + 待写事件超过上限：客户端读得太慢，断开它（会触发上游取消）
+      if (pendingBytes + res.writableLength > maxBufferBytes) {
+        stats.slowConsumersDropped++;
+        logger.warn(`🐢 SSE 客户端积压 ${pendingBytes + res.writableLength} 字节，断开连接`, { pendingBytes: pendingBytes + res.writableLength });
+        cleanup();
+        res.destroy();
+        return false;
+      }
+      scheduleFlush();
+      return true;
+    };
+
+    this.sseConnections.set(res, {
+      pendingBytes: () => pendingBytes,
+      heartbeat: (now) => {
+        if (closed || waitingDrain || pending.length) return;
+        if (now - lastWrite < SSE_HEARTBEAT_MS) return;
+        stats.heartbeats++;
+        pending.push({ event: null, text: ': ping\n\n', size: 8 });
+        flush();
+      }
+    });
+    if (!this.heartbeatTimer) {
+      // 每半个心跳周期检查一次，空闲最久 1.5 个周期就会收到心跳
+      this.heartbeatTimer = setInterval(() => {
+        const now = Date.now();
+        for (const connection of this.sseConnections.values()) connection.heartbeat(now);
+      }, SSE_HEARTBEAT_MS / 2);
+      this.heartbeatTimer.unref();
+    }
+
+    res.on('close', cleanup);
+
+    const send = (event, data, { replace = false } = {}) =>
+      enqueue(event, `event: ${event}\ndata: ${JSON.stringify(data)}\n\n`, replace);
+
+    const end = () => {
+      if (closed) return;
+      clearTimeout(flushTimer);
+      // 结束时不再等待 drain，剩余数据交给 res.end 一并写出
+      const rest = pending.map(item => item.text).join('');
+      cleanup();
+      res.end(rest || undefined);
+    };
+
     return {
-      send: (event, data) => {
-        res.write(`event: ${event}\ndata: ${JSON.stringify(data)}\n\n`);
-      },
-      
-      sendText: (text) => {
-        res.write(`event: text\ndata: ${JSON.stringify({ text })}\n\n`);
-      },
-      
-      sendImage: (key, metadata = {}) => {
-        res.write(`event: image\ndata: ${JSON.stringify({
-          key,
-          url: `/api/cache/image/${key}`,
-          ...metadata,
-          timestamp: new Date().toISOString()
-        })}\n\n`);
-      },
-      
-      sendError: (error) => {
-        res.write(`event: error\ndata: ${JSON.stringify({
-          error: error.message,
-          timestamp: new Date().toISOString()
-        })}\n\n`);
+      send,
+
+      get closed() {
+        return closed;
       },
-      
+
+      sendText: (text) => send('text', { text }),
+
+      sendImage: (key, metadata = {}) => send('image', {
+        key,
+        url: `/api/cache/image/${key}`,
+        ...metadata,
+        timestamp: new Date().toISOString()
+      }),
+
+      sendError: (error) => send('error', {
+        error: error.message,
+        timestamp: new Date().toISOString()
+      }),
+
       complete: (data = {}) => {
-        res.write(`event: complete\ndata: ${JSON.stringify({
+        send('complete', {
           status: 'complete',
           timestamp: new Date().toISOString(),
           ...data
-        })}\n\n`);
-        res.end();
-      }
+        });
+        end();
+      },
+
+      end
+    };
+  }
+
+  /**
+   * SSE 连接统计：当前连接数、积压字节、合并/心跳/慢客户端断开次数
+   */
+  getSSEStats() {
+    let buffered = 0;
+    for (const [res, connection] of this.sseConnections) buffered += res.writableLength + connection.pendingBytes();
+    return {
+      open: this.sseConnections.size,
+      bufferedBytes: buffered,
+      heartbeatMs: SSE_HEARTBEAT_MS,
+      flushMs: SSE_FLUSH_MS,
+      maxBufferBytes: SSE_MAX_BUFFER_BYTES,
+      ...this.sseStats
     };
   }
 
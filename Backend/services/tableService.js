@@ -0,0 +1,396 @@
+const AdmZip = require('adm-zip');
+const path = require('path');
+const cacheService = require('./cacheService');
+const metricsService = require('./metricsService');
+const logger = require('./logger');
+
+// 行索引每隔多少行记一个字节偏移：读任意窗口最多多解析这么多行
+const TABLE_INDEX_INTERVAL = parseInt(process.env.TABLE_INDEX_INTERVAL, 10) || 256;
+// 内存里保留多少个表格的行索引
+const TABLE_INDEX_CACHE_SIZE = parseInt(process.env.TABLE_INDEX_CACHE_SIZE, 10) || 500;
+// 预览窗口默认行数和上限
+const TABLE_PREVIEW_ROWS = parseInt(process.env.TABLE_PREVIEW_ROWS, 10) || 50;
+const TABLE_PREVIEW_MAX_ROWS = parseInt(process.env.TABLE_PREVIEW_MAX_ROWS, 10) || 1000;
+const INDEX_VERSION = 2;
+
+const QUOTE = 0x22;
+const COMMA = 0x2c;
+const CR = 0x0d;
+const LF = 0x0a;
+
+/**
+ * 按字节解析 CSV（RFC 4180：双引号包裹的字段里可以有逗号、换行，"" 表示一个引号）
+ * 分隔符和引号都是 ASCII，按字节切分不会切坏 UTF-8 字符；每条记录带上它在文件里的起始字节偏移，
+ * 行索引据此记录检查点。values 为 false 时只数记录不取值（建索引时扫全文件用）；空行跳过
+ */
+class CsvParser {
+  constructor({ offset = 0, values = true } = {}) {
+    this.values = values;
+    this.position = offset;
+    this.recordStart = offset;
+    this.field = Buffer.alloc(256);
+    this.length = 0;
+    this.fields = [];
+    this.quoted = false;
+    // 引号字段里遇到引号：下一个字节是引号则为转义，否则字段结束
+    this.quoteSeen = false;
+    this.fieldStarted = false;
+    this.skipLF = false;
+  }
+
+  *push(chunk) {
+    for (let i = 0; i < chunk.length; i++, this.position++) {
+      const byte = chunk[i];
+      if (this.skipLF) {
+        this.skipLF = false;
+        if (byte === LF) {
+          this.recordStart = this.position + 1;
+          continue;
+        }
+      }
+      if (this.quoted) {
+        if (this.quoteSeen) {
+          this.quoteSeen = false;
+          if (byte === QUOTE) {
+            this.append(byte);
+            continue;
+          }
+          this.quoted = false;
+        } else {
+          if (byte === QUOTE) this.quoteSeen = true;
+          else this.append(byte);
+          continue;
+        }
+      }
+
+      if (byte === COMMA) {
+        this.endField();
+      } else if (byte === LF || byte === CR) {
+        const record = this.endRecord();
+        if (record) yield record;
+        this.recordStart = this.position + 1;
+        this.skipLF = byte === CR;
+      } else if (byte === QUOTE && !this.fieldStarted) {
+        this.quoted = true;
+        this.fieldStarted = true;
+      } else {
+        this.fieldStarted = true;
+        this.append(byte);
+      }
+    }
+  }
+
+  /**
+   * 文件结束：最后一行没有换行时在这里产出
+   */
+  *end() {
+    this.quoted = false;
+    this.quoteSeen = false;
+    const record = this.endRecord();
+    if (record) yield record;
+  }
+
+  append(byte) {
+    if (!this.values) return;
+    if (this.length === this.field.length) {
+      const grown = Buffer.alloc(this.field.length * 2);
+      this.field.copy(grown);
+      this.field = grown;
+    }
+    this.field[this.length++] = byte;
+  }
+
+  endField() {
+    this.fields.push(this.values ? this.field.toString('utf8', 0, this.length) : null);
+    this.length = 0;
+    this.fieldStarted = false;
+  }
+
+  endRecord() {
+    // 空行（两个换行之间什么都没有）不算记录
+    if (!this.fields.length && !this.fieldStarted && !this.quoted) return null;
+    this.endField();
+    const record = { start: this.recordStart, width: this.fields.length, fields: this.values ? this.fields : null };
+    this.fields = [];
+    return record;
+  }
+}
+
+function csvField(value) {
+  return /[",\r\n]/.test(value) ? `"${value.replace(/"/g, '""')}"` : value;
+}
+
+function decodeXml(text) {
+  return text.replace(/&(lt|gt|amp|quot|apos|#\d+|#x[0-9a-fA-F]+);/g, (_, entity) => {
+    if (entity[0] === '#') {
+      return String.fromCodePoint(entity[1] === 'x' ? parseInt(entity.slice(2), 16) : parseInt(entity.slice(1), 10));
+    }
+    return { lt: '<', gt: '>', amp: '&', quot: '"', apos: "'" }[entity];
+  });
+}
+
+// <si> / <is> 里可能是多段富文本（<r><t>..</t></r>），拼起来；<rPh> 是注音，跳过
+function xmlText(fragment) {
+  return [...fragment.replace(/<rPh\b[\s\S]*?<\/rPh>/g, '').matchAll(/<t\b[^>]*?(?:\/>|>([\s\S]*?)<\/t>)/g)]
+    .map(match => decodeXml(match[1] || '')).join('');
+}
+
+function xmlAttribute(attributes, name) {
+  const match = attributes.match(new RegExp(`\\b${name}="([^"]*)"`));
+  return match ? match[1] : null;
+}
+
+// A1 引用里的列字母 -> 从 0 开始的列号
+function columnNumber(reference) {
+  const letters = reference.match(/^[A-Z]+/)?.[0] || '';
+  return [...letters].reduce((n, letter) => n * 26 + letter.charCodeAt(0) - 64, 0) - 1;
+}
+
+/**
+ * XLSX 第一个工作表转成 CSV：共享字符串、内联字符串、布尔值按显示文本输出，数字和日期保留单元格里的原始值
+ * （日期是序列号，单元格格式不解析）；缺失的单元格补空，缺失的行和空行写成全是空字段的记录（工作表有多宽就有几个字段），
+ * 不会被 CsvParser 当成空行跳过，行号和列号与 Excel 里一致
+ */
+function xlsxToCsv(buffer) {
+  const zip = new AdmZip(buffer);
+  const sheets = zip.getEntries()
+    .map(entry => entry.entryName)
+    .filter(name => /^xl\/worksheets\/sheet\d+\.xml$/.test(name))
+    .sort((a, b) => parseInt(a.match(/\d+/)[0], 10) - parseInt(b.match(/\d+/)[0], 10));
+  if (!sheets.length) throw Object.assign(new Error('XLSX 里没有工作表'), { code: 'TABLE_UNREADABLE' });
+
+  const shared = zip.getEntry('xl/sharedStrings.xml');
+  const strings = shared
+    ? [...shared.getData().toString('utf8').matchAll(/<si\b[^>]*>([\s\S]*?)<\/si>/g)].map(match => xmlText(match[1]))
+    : [];
+
+  const sheet = zip.getEntry(sheets[0]).getData().toString('utf8');
+  const rows = [];
+  let width = 1;
+  for (const row of sheet.matchAll(/<row\b([^>]*?)(?:\/>|>([\s\S]*?)<\/row>)/g)) {
+    const number = parseInt(xmlAttribute(row[1], 'r'), 10) || rows.length + 1;
+    while (rows.length < number - 1) rows.push([]);
+    const cells = [];
+    for (const cell of (row[2] || '').matchAll(/<c\b([^>]*?)(?:\/>|>([\s\S]*?)<\/c>)/g)) {
+      const reference = xmlAttribute(cell[1], 'r');
+      const column = reference ? columnNumber(reference) : cells.length;
+      const type = xmlAttribute(cell[1], 't');
+      const raw = cell[2]?.match(/<v\b[^>]*>([\s\S]*?)<\/v>/)?.[1];
+      let value;
+      if (type === 'inlineStr') value = xmlText(cell[2] || '');
+      else if (raw === undefined) value = '';
+      else if (type === 's') value = strings[parseInt(raw, 10)] ?? '';
+      else if (type === 'b') value = raw === '1' ? 'TRUE' : 'FALSE';
+      else value = decodeXml(raw);
+      while (cells.length < column) cells.push('');
+      cells[column] = value;
+    }
+    rows.push(cells);
+    width = Math.max(width, cells.length);
+  }
+  // 只有一列时空记录写成 ""，否则整行为空会被当成空行
+  const empty = width === 1 ? '""' : ','.repeat(width - 1);
+  const lines = rows.map(cells => (cells.some(value => value !== '')
+    ? cells.map(csvField).join(',') + ','.repeat(width - cells.length)
+    : empty));
+  return Buffer.from(lines.length ? `${lines.join('\n')}\n` : '', 'utf8');
+}
+
+/**
+ * 表格预览：从存储里的表格按行窗口（offset / limit）和列投影读取，不把整个文件读进内存
+ * 每个表格第一次预览时建行索引：第一行作为列名，之后每 TABLE_INDEX_INTERVAL 行记一个字节偏移，
+ * 读窗口时从最近的检查点按 Range 打开对象往后解析；XLSX 在这时一次性转成 CSV，之后和 CSV 一样按行读
+ * 行索引和转换结果写在 derived/ 下，按 blob 命名，内容相同的表格共用，其他节点直接复用；删除 blob 时一并删除
+ */
+class TableService {
+  constructor() {
+    // id -> 行索引，按使用顺序淘汰
+    this.indexes = new Map();
+    // 正在建的索引，同一表格的并发预览共用一次
+    this.building = new Map();
+    this.stats = { previews: 0, rowsServed: 0, indexHits: 0, indexesBuilt: 0, xlsxConverted: 0, buildErrors: 0 };
+  }
+
+  /**
+   * 读取一个行窗口，返回 { key, format, columns, totalRows, offset, limit, rows, nextOffset } 或 null（表格不存在）
+   * rows 是异步迭代器，按行产出投影后的字符串数组；调用方不读完（客户端断开）时底层读取流随之关闭
+   * columns 为列名或列号（字符串数组），找不到的列抛 INVALID_COLUMNS
+   */
+  async preview(key, { offset = 0, limit = TABLE_PREVIEW_ROWS, columns = null } = {}) {
+    offset = Number(offset);
+    limit = Number(limit);
+    if (!Number.isInteger(offset) || offset < 0 || !Number.isInteger(limit) || limit < 1) {
+      throw Object.assign(new Error('offset 需为非负整数，limit 需为正整数'), { code: 'INVALID_WINDOW' });
+    }
+    limit = Math.min(limit, TABLE_PREVIEW_MAX_ROWS);
+
+    const entry = await cacheService.findTable(key);
+    if (!entry) return null;
+    let index = await this.indexFor(key, entry);
+    const projection = index && this.project(index.columns, columns);
+    const count = index ? Math.max(Math.min(limit, index.rows - offset), 0) : 0;
+    // 先打开对象再返回，表格不存在或读不了时调用方还能回错误状态码
+    let object = count ? await this.openAt(index, offset) : null;
+    if (count && !object) {
+      // blob 删除后又以同样内容写回时，内存里的索引可能指向已删除的转换结果，重建一次
+      this.indexes.delete(cacheService.tableDerivedId(key, entry));
+      index = await this.indexFor(key, entry);
+      object = index && await this.openAt(index, offset);
+      if (!object) return null;
+    }
+    if (!index) return null;
+    this.stats.previews++;
+    return {
+      key,
+      format: index.format,
+      columns: projection.map(i => index.columns[i]),
+      totalRows: index.rows,
+      offset,
+      limit,
+      nextOffset: offset + count < index.rows ? offset + count : null,
+      rows: this.readRows(object, index, offset, count, projection)
+    };
+  }
+
+  /**
+   * 从 offset 所在的检查点按 Range 打开表格对象
+   */
+  openAt(index, offset) {
+    const start = index.checkpoints[Math.floor(offset / index.interval)];
+    return cacheService.storage.open(index.object, { start });
+  }
+
+  /**
+   * 列投影：不指定时返回全部列；列名优先，纯数字且不是列名时按列号（从 0 开始）
+   */
+  project(names, columns) {
+    if (!columns || !columns.length) return names.map((_, i) => i);
+    return columns.map(column => {
+      const byName = names.indexOf(column);
+      if (byName !== -1) return byName;
+      if (/^\d+$/.test(column) && Number(column) < names.length) return Number(column);
+      throw Object.assign(new Error(`表格里没有列 ${column}`), { code: 'INVALID_COLUMNS', columns: names });
+    });
+  }
+
+  async *readRows(object, index, offset, count, projection) {
+    if (!object) return;
+    const checkpoint = Math.floor(offset / index.interval);
+    let skip = offset - checkpoint * index.interval;
+    const parser = new CsvParser({ offset: index.checkpoints[checkpoint] });
+    let served = 0;
+    const take = function* (records) {
+      for (const record of records) {
+        if (skip > 0) { skip--; continue; }
+        yield projection.map(i => record.fields[i] ?? '');
+        if (++served === count) return;
+      }
+    };
+    try {
+      for await (const chunk of object.stream) {
+        yield* take(parser.push(chunk));
+        if (served === count) return;
+      }
+      yield* take(parser.end());
+    } finally {
+      this.stats.rowsServed += served;
+      object.stream.destroy();
+    }
+  }
+
+  /**
+   * 行索引：内存 -> derived/<id>.rows.json -> 新建；原文件大小对不上（旧布局的表格被覆盖）时重建
+   */
+  async indexFor(key, entry) {
+    const id = cacheService.tableDerivedId(key, entry);
+    const cached = this.indexes.get(id);
+    if (cached && cached.sourceSize === entry.size) {
+      this.indexes.delete(id);
+      this.indexes.set(id, cached);
+      this.stats.indexHits++;
+      return cached;
+    }
+
+    let pending = this.building.get(id);
+    if (!pending) {
+      pending = (async () => {
+        const stored = await cacheService.readObject(`derived/${id}.rows.json`).catch(() => null);
+        let index = null;
+        try {
+          index = stored && JSON.parse(stored.toString('utf8'));
+        } catch {
+          logger.warn('⚠️ 表格行索引无法解析，重建', { key, id });
+        }
+        if (!index || index.version !== INDEX_VERSION || index.sourceSize !== entry.size) index = await this.buildIndex(key, entry, id);
+        if (index) this.remember(id, index);
+        return index;
+      })().finally(() => this.building.delete(id));
+      this.building.set(id, pending);
+    }
+    return pending;
+  }
+
+  async buildIndex(key, entry, id) {
+    const startedAt = Date.now();
+    const format = path.extname(entry.file).slice(1).toLowerCase();
+    let object = cacheService.tableObject(entry);
+    try {
+      if (format === 'xlsx') {
+        const buffer = await cacheService.readObject(object);
+        if (!buffer) return null;
+        const csv = xlsxToCsv(buffer);
+        object = `derived/${id}.csv`;
+        await metricsService.cacheWrite.time({ kind: 'derived' }, cacheService.storage.put(object, csv, { contentType: 'text/csv' }));
+        this.stats.xlsxConverted++;
+      }
+
+      const source = await cacheService.storage.open(object);
+      if (!source) return null;
+      const parser = new CsvParser({ values: true });
+      const checkpoints = [];
+      let columns = null;
+      let width = 0;
+      let rows = 0;
+      const count = (records) => {
+        for (const record of records) {
+          if (!columns) {
+            // 第一行是列名，之后只数行不取值
+            columns = record.fields.map((name, i) => (i === 0 ? name.replace(/^\uFEFF/, '') : name).trim());
+            parser.values = false;
+          } else {
+            if (rows % TABLE_INDEX_INTERVAL === 0) checkpoints.push(record.start);
+            rows++;
+          }
+          width = Math.max(width, record.width);
+        }
+      };
+      for await (const chunk of source.stream) count(parser.push(chunk));
+      count(parser.end());
+
+      // 比列名长的行，多出的列没有名字，用列号补上
+      columns = columns || [];
+      for (let i = columns.length; i < width; i++) columns.push(String(i));
+      const index = { version: INDEX_VERSION, format, object, sourceSize: entry.size, columns, rows, interval: TABLE_INDEX_INTERVAL, checkpoints };
+      await cacheService.storage.put(`derived/${id}.rows.json`, Buffer.from(JSON.stringify(index)), { contentType: 'application/json' });
+      this.stats.indexesBuilt++;
+      logger.debug('📑 表格行索引已建立', { key, format, rows, columns: columns.length, elapsedMs: Date.now() - startedAt });
+      return index;
+    } catch (error) {
+      this.stats.buildErrors++;
+      if (error.code) throw error;
+      throw Object.assign(new Error(`表格无法解析: ${error.message}`), { code: 'TABLE_UNREADABLE' });
+    }
+  }
+
+  remember(id, index) {
+    this.indexes.delete(id);
+    this.indexes.set(id, index);
+    if (this.indexes.size > TABLE_INDEX_CACHE_SIZE) this.indexes.delete(this.indexes.keys().next().value);
+  }
+
+  getStats() {
+    return { ...this.stats, indexesCached: this.indexes.size };
+  }
+}
+
+module.exports = new TableService();
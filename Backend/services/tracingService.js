@@ -0,0 +1,317 @@
+const crypto = require('crypto');
+const fs = require('fs-extra');
+const path = require('path');
+const { AsyncLocalStorage, AsyncResource } = require('async_hooks');
+const { performance } = require('perf_hooks');
+const clusterService = require('./clusterService');
+
+// 导出方式：file（默认，每条链路一个 NDJSON 文件）| otlp（OTLP/HTTP JSON 发往本地采集器）| none（只留在内存）
+// off 表示不记录任何 span，traceparent 仍然照常传递
+const TRACE_EXPORT = process.env.TRACE_EXPORT || 'file';
+const TRACE_DIR = process.env.TRACE_DIR || './traces';
+const TRACE_OTLP_ENDPOINT = process.env.TRACE_OTLP_ENDPOINT || 'http://localhost:4318/v1/traces';
+// 没有上游 traceparent 时新建链路的采样率
+const TRACE_SAMPLE_RATE = process.env.TRACE_SAMPLE_RATE === undefined ? 1 : parseFloat(process.env.TRACE_SAMPLE_RATE);
+// 已结束的 span 攒一批再写出
+const TRACE_FLUSH_MS = parseInt(process.env.TRACE_FLUSH_MS, 10) || 1000;
+// 内存里保留最近多少条链路，供 /api/traces/:traceId 查询
+const TRACE_MEMORY_TRACES = parseInt(process.env.TRACE_MEMORY_TRACES, 10) || 200;
+const SERVICE_NAME = 'micro-tomato-backend';
+
+const TRACEPARENT = /^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$/;
+const randomId = (bytes) => crypto.randomBytes(bytes).toString('hex');
+
+/**
+ * 一个 span：起止时间用进程单调时钟换算成墙钟，避免系统时间跳变导致负耗时
+ */
+class Span {
+  constructor(tracer, name, { traceId, parentSpanId = null, sampled = true, attributes = {} }) {
+    this.tracer = tracer;
+    this.traceId = traceId;
+    this.spanId = randomId(8);
+    this.parentSpanId = parentSpanId;
+    this.sampled = sampled;
+    this.name = name;
+    this.attributes = { ...attributes };
+    this.events = [];
+    this.status = 'ok';
+    this.error = null;
+    this.startTime = tracer.now();
+    this.endTime = null;
+  }
+
+  setAttributes(attributes) {
+    Object.assign(this.attributes, attributes);
+    return this;
+  }
+
+  addEvent(name, attributes = {}) {
+    if (this.sampled && this.endTime === null) this.events.push({ name, time: this.tracer.now(), attributes });
+    return this;
+  }
+
+  fail(error) {
+    this.status = 'error';
+    this.error = error?.message || String(error);
+    return this;
+  }
+
+  end(attributes) {
+    if (this.endTime !== null) return;
+    if (attributes) this.setAttributes(attributes);
+    this.endTime = this.tracer.now();
+    if (this.sampled) this.tracer.record(this);
+  }
+
+  /**
+   * 传给下游的 traceparent（本 span 作为父 span）
+   */
+  get traceparent() {
+    return `00-${this.traceId}-${this.spanId}-${this.sampled ? '01' : '00'}`;
+  }
+
+  toJSON() {
+    return {
+      traceId: this.traceId,
+      spanId: this.spanId,
+      parentSpanId: this.parentSpanId,
+      name: this.name,
+      startTime: this.startTime,
+      endTime: this.endTime,
+      durationMs: this.endTime === null ? null : Math.round((this.endTime - this.startTime) * 1000) / 1000,
+      status: this.status,
+      error: this.error,
+      attributes: this.attributes,
+      events: this.events,
+      service: SERVICE_NAME,
+      worker: clusterService.workerId
+    };
+  }
+}
+
+/**
+ * 分布式追踪：W3C traceparent 传播 + AsyncLocalStorage 维护当前 span
+ * 入站请求沿用客户端（paper_demo.py）给出的 trace id，出站上游请求带上当前 span 的 traceparent
+ * 已结束的 span 批量导出到 JSON 文件或 OTLP 采集器
+ */
+class TracingService {
+  constructor() {
+    this.enabled = TRACE_EXPORT !== 'off';
+    this.storage = new AsyncLocalStorage();
+    // 单调时钟与墙钟的对应关系（毫秒，带小数）
+    this.timeOrigin = performance.timeOrigin;
+    // 待导出的 span 与最近链路：traceId -> span JSON 数组，Map 的顺序即新旧顺序
+    this.buffer = [];
+    this.traces = new Map();
+    this.flushTimer = null;
+    this.flushing = Promise.resolve();
+    this.stats = { spans: 0, exported: 0, exportErrors: 0, dropped: 0 };
+    if (TRACE_EXPORT === 'file') fs.ensureDirSync(TRACE_DIR);
+  }
+
+  now() {
+    return this.timeOrigin + performance.now();
+  }
+
+  current() {
+    return this.storage.getStore() || null;
+  }
+
+  /**
+   * 解析 traceparent 请求头，格式不对返回 null
+   */
+  parse(header) {
+    const match = TRACEPARENT.exec((header || '').trim().toLowerCase());
+    if (!match || /^0+$/.test(match[1]) || /^0+$/.test(match[2])) return null;
+    return { traceId: match[1], parentSpanId: match[2], sampled: (parseInt(match[3], 16) & 1) === 1 };
+  }
+
+  /**
+   * 新建 span，默认以当前 span 为父；没有父 span 时开始一条新链路
+   * parent 可以是 Span，也可以是 parse() 得到的远端上下文
+   */
+  startSpan(name, attributes = {}, { parent = this.current() } = {}) {
+    if (parent instanceof Span) {
+      return new Span(this, name, { traceId: parent.traceId, parentSpanId: parent.spanId, sampled: parent.sampled, attributes });
+    }
+    if (parent) return new Span(this, name, { ...parent, sampled: this.enabled && parent.sampled, attributes });
+    return new Span(this, name, { traceId: randomId(16), sampled: this.enabled && Math.random() < TRACE_SAMPLE_RATE, attributes });
+  }
+
+  /**
+   * 在新 span 里运行 fn(span)，fn 内部（含异步调用）新建的 span 都以它为父；完成或失败时结束 span
+   */
+  async withSpan(name, attributes, fn) {
+    const span = this.startSpan(name, attributes);
+    try {
+      return await this.storage.run(span, () => fn(span));
+    } catch (error) {
+      span.fail(error);
+      throw error;
+    } finally {
+      span.end();
+    }
+  }
+
+  /**
+   * 以指定 span 为当前 span 运行 fn
+   */
+  run(span, fn) {
+    return this.storage.run(span, fn);
+  }
+
+  /**
+   * 把回调绑定到当前上下文：multer 等在流事件里回调的库会丢失 AsyncLocalStorage 上下文
+   */
+  bind(fn) {
+    return AsyncResource.bind(fn);
+  }
+
+  /**
+   * Express 中间件：每个请求一个 span，父 span 来自请求头 traceparent
+   * 响应头带回 traceparent 和 X-Trace-Id，客户端据此查询整条链路
+   */
+  middleware() {
+    return (req, res, next) => {
+      const span = this.startSpan(`${req.method} ${req.path}`, {
+        'http.method': req.method,
+        'http.route': req.path,
+        'http.client_id': req.get('X-Client-Id') || undefined
+      }, { parent: this.parse(req.get('traceparent')) });
+      req.span = span;
+      res.set({ traceparent: span.traceparent, 'X-Trace-Id': span.traceId });
+      res.on('close', () => {
+        if (!res.writableFinished) span.addEvent('client_disconnected');
+        if (res.statusCode >= 500) span.status = 'error';
+        span.end({ 'http.status_code': res.statusCode });
+      });
+      this.storage.run(span, next);
+    };
+  }
+
+  record(span) {
+    const json = span.toJSON();
+    this.stats.spans++;
+    let spans = this.traces.get(span.traceId);
+    if (!spans) {
+      spans = [];
+      this.traces.set(span.traceId, spans);
+      if (this.traces.size > TRACE_MEMORY_TRACES) this.traces.delete(this.traces.keys().next().value);
+    }
+    spans.push(json);
+
+    if (TRACE_EXPORT === 'none' || TRACE_EXPORT === 'off') return;
+    this.buffer.push(json);
+    if (!this.flushTimer) {
+      this.flushTimer = setTimeout(() => this.flush(), TRACE_FLUSH_MS);
+      this.flushTimer.unref();
+    }
+  }
+
+  /**
+   * 导出缓冲区里的 span；导出串行进行，失败时丢弃这一批（只计数，不影响业务）
+   */
+  flush() {
+    clearTimeout(this.flushTimer);
+    this.flushTimer = null;
+    const batch = this.buffer;
+    this.buffer = [];
+    if (!batch.length) return this.flushing;
+    this.flushing = this.flushing
+      .then(() => (TRACE_EXPORT === 'otlp' ? this.exportOtlp(batch) : this.exportFiles(batch)))
+      .then(() => { this.stats.exported += batch.length; })
+      .catch((error) => {
+        this.stats.exportErrors++;
+        this.stats.dropped += batch.length;
+        // 延迟加载：logger 依赖本服务取当前 trace id
+        require('./logger').warn(`⚠️ 链路导出失败 (${batch.length} 个 span): ${error.message}`, { spans: batch.length });
+      });
+    return this.flushing;
+  }
+
+  traceFile(traceId) {
+    return path.join(TRACE_DIR, `${traceId}.ndjson`);
+  }
+
+  /**
+   * 每条链路一个 NDJSON 文件，追加写入；多进程同时追加整行也不会交错
+   */
+  async exportFiles(batch) {
+    const byTrace = new Map();
+    for (const span of batch) {
+      if (!byTrace.has(span.traceId)) byTrace.set(span.traceId, []);
+      byTrace.get(span.traceId).push(JSON.stringify(span));
+    }
+    for (const [traceId, lines] of byTrace) {
+      await fs.appendFile(this.traceFile(traceId), `${lines.join('\n')}\n`);
+    }
+  }
+
+  /**
+   * OTLP/HTTP JSON（/v1/traces），Jaeger、Tempo、OpenTelemetry Collector 都能直接接收
+   */
+  async exportOtlp(batch) {
+    // 延迟加载：httpClient 的拦截器会用到本服务
+    const httpClient = require('./httpClient');
+    const nanos = (ms) => (BigInt(Math.floor(ms * 1000)) * 1000n).toString();
+    const attributes = (object) => Object.entries(object)
+      .filter(([, value]) => value !== undefined && value !== null)
+      .map(([key, value]) => ({
+        key,
+        value: typeof value === 'boolean' ? { boolValue: value }
+          : Number.isInteger(value) ? { intValue: String(value) }
+            : typeof value === 'number' ? { doubleValue: value }
+              : { stringValue: String(value) }
+      }));
+
+    await httpClient.post(TRACE_OTLP_ENDPOINT, {
+      resourceSpans: [{
+        resource: { attributes: attributes({ 'service.name': SERVICE_NAME, 'process.pid': process.pid }) },
+        scopeSpans: [{
+          scope: { name: 'micro-tomato' },
+          spans: batch.map(span => ({
+            traceId: span.traceId,
+            spanId: span.spanId,
+            parentSpanId: span.parentSpanId || undefined,
+            name: span.name,
+            kind: span.parentSpanId ? 1 : 2,
+            startTimeUnixNano: nanos(span.startTime),
+            endTimeUnixNano: nanos(span.endTime),
+            attributes: attributes(span.attributes),
+            events: span.events.map(event => ({ name: event.name, timeUnixNano: nanos(event.time), attributes: attributes(event.attributes) })),
+            status: span.status === 'error' ? { code: 2, message: span.error || '' } : { code: 1 }
+          }))
+        }]
+      }]
+    }, { timeout: 5000, tracing: false });
+  }
+
+  /**
+   * 查询一条链路的全部 span：文件导出时读文件（包含其他工作进程写入的 span），否则取内存
+   */
+  async getTrace(traceId) {
+    if (!/^[0-9a-f]{32}$/.test(traceId)) return null;
+    if (TRACE_EXPORT === 'file') {
+      await this.flush();
+      const content = await fs.readFile(this.traceFile(traceId), 'utf8').catch(() => null);
+      if (content !== null) return content.split('\n').filter(Boolean).map(line => JSON.parse(line));
+    }
+    return this.traces.get(traceId) || null;
+  }
+
+  getStats() {
+    return {
+      export: TRACE_EXPORT,
+      target: TRACE_EXPORT === 'otlp' ? TRACE_OTLP_ENDPOINT : TRACE_EXPORT === 'file' ? path.resolve(TRACE_DIR) : null,
+      sampleRate: TRACE_SAMPLE_RATE,
+      tracesInMemory: this.traces.size,
+      pending: this.buffer.length,
+      ...this.stats
+    };
+  }
+}
+
+const tracingService = new TracingService();
+tracingService.Span = Span;
+
+module.exports = tracingService;
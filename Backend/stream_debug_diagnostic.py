@@ -3,41 +3,119 @@
 详细的流式响应诊断脚本
 专门检查图片生成成功但前端接收失败的问题
 """
+import asyncio
 import requests
 import time
 import json
 import os
-from pathlib import Path
+import sys
+import tempfile
+import zipfile
+
+import cache_verifier
+
+# 导出下载和前端共用 Frontend/paper_demo.py 里的客户端实现
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Frontend'))
+from paper_demo import download_export
 
 API_BASE_URL = "http://localhost:2983"
+# 缓存列表每页条数
+CACHE_PAGE_SIZE = 200
+# 诊断开始时间（毫秒时间戳），只拉取这之后的后端日志
+DIAGNOSIS_STARTED_MS = int(time.time() * 1000)
 
 def print_section(title):
     print(f"\n{'='*60}")
     print(f"🔍 {title}")
     print(f"{'='*60}")
 
-def check_cache_files():
-    """检查缓存文件夹中的图片文件"""
+def fetch_backend_logs(level=None, request_id=None, since_ms=None, limit=200):
+    """从后端 /api/debug/logs 拉取最近的结构化日志，失败时返回 None"""
+    params = {'limit': limit}
+    if level:
+        params['level'] = level
+    if request_id:
+        params['requestId'] = request_id
+    if since_ms:
+        params['since'] = since_ms
+    try:
+        response = requests.get(f"{API_BASE_URL}/api/debug/logs", params=params, timeout=5)
+        if response.status_code != 200:
+            print(f"⚠️  日志接口返回 HTTP {response.status_code}")
+            return None
+        return response.json().get('entries', [])
+    except Exception as e:
+        print(f"⚠️  无法获取后端日志: {e}")
+        return None
+
+def print_log_entries(entries):
+    level_icons = {'debug': '🔹', 'info': 'ℹ️ ', 'warn': '⚠️ ', 'error': '❌'}
+    for entry in entries:
+        clock = entry.get('time', '')[11:23]
+        tag = f"[{entry.get('requestId')}] " if entry.get('requestId') else ''
+        print(f"   {level_icons.get(entry.get('level'), '  ')} {clock} {tag}{entry.get('msg')}")
+        error = entry.get('error')
+        if isinstance(error, dict):
+            status = f" (HTTP {error.get('status')})" if error.get('status') else ''
+            print(f"        ↳ {error.get('message')}{status}")
+
+def iter_cache_entries(page_size=CACHE_PAGE_SIZE, **filters):
+    """逐页遍历 /api/cache/entries，按需请求下一页，不一次性拉取全部条目
+    filters: kind / paper / minAge / maxAge / minSize / maxSize / order，与接口查询参数相同
+    """
+    params = {k: v for k, v in filters.items() if v is not None}
+    params['limit'] = page_size
+    params['summary'] = 'false'
+    while True:
+        response = requests.get(f"{API_BASE_URL}/api/cache/entries", params=params, timeout=10)
+        response.raise_for_status()
+        page = response.json()
+        yield from page.get('items', [])
+        if not page.get('nextCursor'):
+            return
+        params['cursor'] = page['nextCursor']
+
+def fetch_cache_summary(**filters):
+    """只取汇总（第一页只要 1 条），失败时返回 None"""
+    params = {k: v for k, v in filters.items() if v is not None}
+    params.update(limit=1, summary='true')
+    try:
+        response = requests.get(f"{API_BASE_URL}/api/cache/entries", params=params, timeout=5)
+        if response.status_code != 200:
+            print(f"⚠️  缓存列表接口返回 HTTP {response.status_code}")
+            return None
+        return response.json().get('summary')
+    except Exception as e:
+        print(f"⚠️  无法获取缓存汇总: {e}")
+        return None
+
+def check_cache_files(show=20):
+    """通过缓存列表接口检查缓存中的图片，后端用 S3 等远端存储时同样适用"""
     print_section("缓存文件检查")
     
-    cache_dir = Path("./cache/images")
-    
-    if not cache_dir.exists():
-        print("❌ 缓存目录不存在: ./cache/images")
+    summary = fetch_cache_summary(kind='image')
+    if summary is None:
         return False
     
-    files = list(cache_dir.glob("*"))
-    print(f"✅ 缓存目录存在: {cache_dir.absolute()}")
-    print(f"📁 文件数量: {len(files)}")
+    print(f"✅ 缓存列表接口正常")
+    print(f"📁 图片数量: {summary['count']} ({summary['bytes'] / 1024 / 1024:.1f}MB, 涉及 {summary['papers']} 篇论文)")
+    for kind, bucket in summary.get('byKind', {}).items():
+        print(f"   {kind}: {bucket['count']} 个, {bucket['bytes'] / 1024:.1f}KB")
     
-    if files:
-        print("\n📋 现有图片文件:")
-        for file in files:
-            size_kb = file.stat().st_size / 1024
-            modified = time.ctime(file.stat().st_mtime)
-            print(f"   📄 {file.name} ({size_kb:.1f}KB, {modified})")
-    else:
-        print("⚠️  缓存目录为空")
+    if not summary['count']:
+        print("⚠️  缓存中没有图片")
+        return True
+    
+    print(f"\n📋 最新的图片 (最多 {show} 个):")
+    try:
+        for i, entry in enumerate(iter_cache_entries(kind='image', page_size=show)):
+            if i >= show:
+                print(f"   ... 还有 {summary['count'] - show} 个")
+                break
+            print(f"   📄 {entry['file']} ({entry['size'] / 1024:.1f}KB, {entry['kind']}, {entry['createdAt']})")
+    except Exception as e:
+        print(f"❌ 遍历缓存列表失败: {e}")
+        return False
     
     return True
 
@@ -58,11 +136,12 @@ def test_stream_response_detailed():
             timeout=90
         )
         
+        request_id = response.headers.get('X-Request-Id')
         if response.status_code != 200:
             print(f"❌ 请求失败: HTTP {response.status_code}")
             return False
         
-        print(f"✅ 请求成功，开始接收流式数据...")
+        print(f"✅ 请求成功，开始接收流式数据... (请求 ID: {request_id})")
         
         # 详细分析流式响应
         raw_data_chunks = []
@@ -149,13 +228,12 @@ def test_stream_response_detailed():
             for i, img_event in enumerate(image_events, 1):
                 print(f"   图片 {i}: Key={img_event['data'].get('key')}, URL={img_event['data'].get('url')}")
                 
-                # 验证图片文件是否存在
+                # 验证缓存里是否有这张图片
                 key = img_event['data'].get('key')
                 if key:
-                    cache_dir = Path("./cache/images")
-                    image_files = list(cache_dir.glob(f"{key}*"))
-                    if image_files:
-                        print(f"      ✅ 对应文件存在: {image_files[0].name}")
+                    info = requests.get(f"{API_BASE_URL}/api/cache/info/{key}", timeout=5)
+                    if info.status_code == 200:
+                        print(f"      ✅ 对应文件存在: {info.json().get('path')}")
                     else:
                         print(f"      ❌ 对应文件不存在，key={key}")
         
@@ -171,6 +249,11 @@ def test_stream_response_detailed():
             print(f"\n✅ 流式响应分析完成 - 图片传输正常")
         else:
             print(f"\n❌ 流式响应分析完成 - 发现问题")
+            # 直接拉取这次请求在后端的日志，不用再去翻后端终端输出
+            entries = fetch_backend_logs(level='debug', request_id=request_id) if request_id else None
+            if entries:
+                print(f"\n📜 本次请求的后端日志 ({len(entries)} 条):")
+                print_log_entries(entries)
             
         return success
         
@@ -182,48 +265,64 @@ def test_stream_response_detailed():
         return False
 
 def test_manual_image_access():
-    """手动测试图片访问"""
-    print_section("手动图片访问测试")
-    
-    cache_dir = Path("./cache/images")
-    if not cache_dir.exists():
-        print("❌ 缓存目录不存在")
-        return False
+    """并发校验缓存中的全部图片（原图、文件头、Content-Type、缩略图），详见 cache_verifier.py"""
+    print_section("图片访问校验")
     
-    image_files = list(cache_dir.glob("*.png")) + list(cache_dir.glob("*.jpg")) + list(cache_dir.glob("*.jpeg"))
-    
-    if not image_files:
-        print("❌ 没有找到图片文件")
+    try:
+        report = asyncio.run(cache_verifier.verify(API_BASE_URL, progress=False))
+    except Exception as e:
+        print(f"❌ 缓存校验失败: {e}")
         return False
     
-    print(f"📁 找到 {len(image_files)} 个图片文件，测试访问...")
-    
-    success_count = 0
-    for img_file in image_files:
-        # 提取key（假设key是文件名去掉扩展名）
-        key = img_file.stem
-        
-        # 构造URL
-        test_url = f"{API_BASE_URL}/api/cache/image/{key}"
-        
+    cache_verifier.print_report(report, show=10)
+    if report['problems']:
+        print("\n💡 可运行 python cache_verifier.py --repair 修复丢失的条目和缺失的缩略图")
+    return not report['problems']
+
+def test_export():
+    """取最近一次生图（没有则取最近的论文）打包导出，检查 ZIP 完整、文件数与 metadata.json 一致"""
+    print_section("打包导出")
+
+    target = None
+    for entry in iter_cache_entries(page_size=50):
+        if entry.get('generation'):
+            target = {'generation': entry['generation']}
+            break
+        if entry.get('paper') and target is None:
+            target = {'paper': entry['paper']}
+    if target is None:
+        print("⚠️  缓存里没有带论文或生图任务 id 的条目，跳过")
+        return True
+
+    name, value = next(iter(target.items()))
+    with tempfile.TemporaryDirectory() as tmp:
+        dest = os.path.join(tmp, 'export.zip')
         try:
-            response = requests.head(test_url, timeout=5)
-            size_kb = img_file.stat().st_size / 1024
-            
-            if response.status_code == 200:
-                print(f"  ✅ {img_file.name} ({size_kb:.1f}KB) - 可访问")
-                success_count += 1
-            else:
-                print(f"  ❌ {img_file.name} ({size_kb:.1f}KB) - 状态码: {response.status_code}")
-                
+            started = time.perf_counter()
+            result = download_export(dest, **target)
+            elapsed = time.perf_counter() - started
         except Exception as e:
-            print(f"  ❌ {img_file.name} - 访问失败: {e}")
-    
-    print(f"\n📊 手动访问测试结果: {success_count}/{len(image_files)} 成功")
-    return success_count == len(image_files)
+            print(f"❌ 导出 {name}={value} 失败: {e}")
+            return False
+        print(f"📦 {name}={value}: {result['bytes'] / 1024:.0f} KB，用时 {elapsed:.2f}s")
+
+        with zipfile.ZipFile(dest) as archive:
+            broken = archive.testzip()
+            metadata = json.loads(archive.read('metadata.json'))
+            names = set(archive.namelist()) - {'metadata.json'}
+        listed = {item['path'] for item in metadata['files']}
+        print(f"   文件: {len(names)}（{', '.join(sorted({n.split('/')[0] for n in names}))}）")
+        if broken:
+            print(f"❌ ZIP 内文件校验失败: {broken}")
+            return False
+        if names != listed:
+            print(f"❌ ZIP 内容与 metadata.json 不一致: 多 {sorted(names - listed)[:5]}，缺 {sorted(listed - names)[:5]}")
+            return False
+    print("✅ ZIP 完整，内容与 metadata.json 一致")
+    return True
 
 def check_backend_logs():
-    """检查后端启动日志（模拟）"""
+    """检查后端服务状态，并拉取诊断期间的警告和错误日志"""
     print_section("后端服务检查")
     
     try:
@@ -255,6 +354,15 @@ def check_backend_logs():
         print(f"❌ 缓存调试接口访问失败: {e}")
         return False
     
+    entries = fetch_backend_logs(level='warn', since_ms=DIAGNOSIS_STARTED_MS)
+    if entries is None:
+        return True
+    if entries:
+        print(f"\n📜 诊断期间后端警告/错误日志 ({len(entries)} 条):")
+        print_log_entries(entries)
+    else:
+        print("✅ 诊断期间后端没有警告或错误日志")
+    
     return True
 
 def generate_diagnosis_report(results):
@@ -279,12 +387,16 @@ def generate_diagnosis_report(results):
         print("   3. 前端解析流式数据失败")
         print("   解决方案: 检查aiService.js中的流式响应逻辑")
         
-    elif not results.get("手动图片访问", True):
-        print("\n❌ 问题分析: 图片文件存在但无法通过API访问")
+    elif not results.get("图片访问校验", True):
+        print("\n❌ 问题分析: 缓存索引与存储不一致，或图片/缩略图损坏")
         print("   可能原因:")
-        print("   1. 图片key映射错误")
-        print("   2. 缓存服务getImagePath方法有问题")
-        print("   解决方案: 检查cacheService.js的getImagePath方法")
+        print("   1. 存储中的对象被外部删除或写入不完整")
+        print("   2. 缩略图生成失败")
+        print("   解决方案: 运行 python cache_verifier.py --repair")
+        
+    elif not results.get("打包导出", True):
+        print("\n❌ 问题分析: 打包导出失败或 ZIP 不完整")
+        print("   解决方案: 查看后端日志中的「导出中断」，运行 python cache_verifier.py 检查缓存对象")
         
     elif not results.get("后端服务检查", True):
         print("\n❌ 问题分析: 后端服务或API接口异常")
@@ -303,7 +415,8 @@ def main():
         ("缓存文件检查", check_cache_files),
         ("后端服务检查", check_backend_logs),
         ("流式响应分析", test_stream_response_detailed),
-        ("手动图片访问", test_manual_image_access),
+        ("图片访问校验", test_manual_image_access),
+        ("打包导出", test_export),
     ]
     
     results = {}
@@ -0,0 +1,142 @@
+/**
+ * aiService 长论文 map-reduce：有分块摘要失败时，分析结果不按全文缓存
+ * 对冲生图：先少发任务，前面的任务凑够图片时不再补发
+ * chatCompletion / streamGenerateContent 替换为本地函数，不请求上游
+ */
+const { test, before, after, afterEach } = require('node:test');
+const assert = require('node:assert');
+const fs = require('fs-extra');
+const os = require('os');
+const path = require('path');
+
+process.env.CACHE_DIR = fs.mkdtempSync(path.join(os.tmpdir(), 'ai-test-'));
+process.env.STORAGE_BACKEND = 'fs';
+process.env.TRACE_EXPORT = 'none';
+process.env.LOG_LEVEL = process.env.LOG_LEVEL || 'error';
+process.env.AIHUBMIX_API_KEY = process.env.AIHUBMIX_API_KEY || 'test-key';
+
+const aiService = require('../services/aiService');
+const llmCacheService = require('../services/llmCacheService');
+const sectionService = require('../services/sectionService');
+
+const ANALYSIS = 'Summary: 摘要###Prompt: A clean scientific diagram###Authors: A, B###Keywords: a, b, c, d, e';
+const originalChatCompletion = aiService.chatCompletion;
+const originalStreamGenerateContent = aiService.streamGenerateContent;
+
+// 超过 ANALYSIS_TOKEN_BUDGET 的长论文，走分块摘要
+function longPaper(seed) {
+  const paragraph = (i) => `Paragraph ${seed}-${i}: ${'we measure the effect of the method on the benchmark and report results '.repeat(12)}`;
+  return [
+    `Paper ${seed}`,
+    'Introduction', ...Array.from({ length: 60 }, (_, i) => paragraph(`intro-${i}`)),
+    'Method', ...Array.from({ length: 60 }, (_, i) => paragraph(`method-${i}`)),
+    'Results', ...Array.from({ length: 60 }, (_, i) => paragraph(`results-${i}`))
+  ].join('\n');
+}
+
+/**
+ * 替换 chatCompletion：map 调用（带 maxTokens）按 failMap 决定第几次失败，reduce 调用返回完整分析
+ */
+function stubLlm({ failMap = -1 } = {}) {
+  const calls = { map: 0, reduce: 0 };
+  aiService.chatCompletion = async (messages, options = {}) => {
+    if (options.maxTokens) {
+      if (calls.map++ === failMap) throw new Error('upstream 502');
+      return `要点 ${calls.map}`;
+    }
+    calls.reduce++;
+    return ANALYSIS;
+  };
+  return calls;
+}
+
+before(() => llmCacheService.ready);
+
+afterEach(() => {
+  aiService.chatCompletion = originalChatCompletion;
+  aiService.streamGenerateContent = originalStreamGenerateContent;
+});
+
+after(async () => {
+  await fs.remove(process.env.CACHE_DIR);
+});
+
+test('所有分块摘要成功：结果按全文缓存', async () => {
+  const paper = longPaper('ok');
+  const calls = stubLlm();
+  assert.strictEqual(await aiService.generateAcademicPrompt(paper), ANALYSIS);
+  assert.ok(calls.map > 1, '长论文应分块摘要');
+  assert.strictEqual(await llmCacheService.get(aiService.analysisCacheKey(paper)), ANALYSIS);
+});
+
+test('有一块摘要失败：返回基于其余分块的结果，但不缓存', async () => {
+  const paper = longPaper('partial');
+  const calls = stubLlm({ failMap: 1 });
+  assert.strictEqual(await aiService.generateAcademicPrompt(paper), ANALYSIS);
+  assert.strictEqual(calls.reduce, 1);
+  assert.strictEqual(await llmCacheService.get(aiService.analysisCacheKey(paper)), null);
+});
+
+test('没有章节标题的长论文：开头作为前置部分，其余分块摘要，每块不超过块大小', async () => {
+  const lines = Array.from({ length: 2000 }, (_, i) => `Line ${i}: ${'we measure the effect of the method on the benchmark and report results. '.repeat(3)}`);
+  const mapInputs = [];
+  aiService.chatCompletion = async (messages, options = {}) => {
+    if (options.maxTokens) {
+      mapInputs.push(messages[1].content);
+      return `要点 ${mapInputs.length}`;
+    }
+    return ANALYSIS;
+  };
+
+  const { content, partial } = await aiService.prepareAnalysisInput(lines.join('\n'));
+  assert.strictEqual(partial, false);
+  assert.ok(mapInputs.length > 1, '正文应分块摘要');
+  for (const chunk of mapInputs) assert.ok(sectionService.estimateTokens(chunk) <= 6000);
+  assert.ok(content.startsWith('Line 0:'), '开头保留为前置部分');
+  assert.ok(!mapInputs[0].includes('Line 0:'), '前置部分不再重复送去摘要');
+  assert.strictEqual(await aiService.generateAcademicPrompt(lines.join('\n')), ANALYSIS);
+});
+
+test('prepareAnalysisInput 标记部分结果：流式分析据此跳过缓存', async () => {
+  stubLlm({ failMap: 0 });
+  assert.strictEqual((await aiService.prepareAnalysisInput(longPaper('flag-partial'))).partial, true);
+  stubLlm();
+  assert.strictEqual((await aiService.prepareAnalysisInput(longPaper('flag-full'))).partial, false);
+  assert.strictEqual((await aiService.prepareAnalysisInput('Short paper\nIntroduction\nA short text.')).partial, false);
+});
+
+/**
+ * 替换 streamGenerateContent：每次上游调用返回 images 张图，failCall 指定第几次调用失败
+ */
+function stubImages({ images = 1, failCall = -1 } = {}) {
+  const calls = { count: 0 };
+  aiService.streamGenerateContent = async (options, onChunk) => {
+    const n = calls.count++;
+    await new Promise(resolve => setTimeout(resolve, 10));
+    if (n === failCall) throw new Error('upstream 502');
+    for (let k = 0; k < images; k++) onChunk({ type: 'image', key: `img-${n}-${k}` });
+    return { success: true };
+  };
+  return calls;
+}
+
+test('对冲模式：一次返回多张图时，少发的任务不再发出', async () => {
+  const calls = stubImages({ images: 2 });
+  const heldBack = aiService.hedgeStats.callsHeldBack;
+  const result = await aiService.generateFromPaper('prompt', () => {}, { candidates: 3, hedge: true });
+  assert.strictEqual(result.cacheKeys.length, 3);
+  assert.strictEqual(calls.count, 2);
+  assert.strictEqual(aiService.hedgeStats.callsHeldBack, heldBack + 1);
+});
+
+test('对冲模式：每次一张图时补发少发的任务，失败的任务另行补发', async () => {
+  let calls = stubImages();
+  let result = await aiService.generateFromPaper('prompt', () => {}, { candidates: 3, hedge: true });
+  assert.strictEqual(result.cacheKeys.length, 3);
+  assert.strictEqual(calls.count, 3);
+
+  calls = stubImages({ failCall: 0 });
+  result = await aiService.generateFromPaper('prompt', () => {}, { candidates: 3, hedge: true });
+  assert.strictEqual(result.cacheKeys.length, 3);
+  assert.strictEqual(calls.count, 4);
+});
@@ -0,0 +1,119 @@
+/**
+ * cacheService 多进程模式：两个工作进程各有一份索引、共用同一个缓存目录，
+ * 一个进程删除、另一个进程保存同样内容时，新保存的 key 仍然可读
+ * 本文件同时是工作进程的入口：cluster.fork 以工作进程身份再次运行它
+ */
+const cluster = require('cluster');
+const fs = require('fs-extra');
+const os = require('os');
+const path = require('path');
+
+process.env.STORAGE_BACKEND = 'fs';
+process.env.TRACE_EXPORT = 'none';
+process.env.LOG_LEVEL = process.env.LOG_LEVEL || 'error';
+if (cluster.isPrimary) process.env.CACHE_DIR = fs.mkdtempSync(path.join(os.tmpdir(), 'cache-cluster-test-'));
+
+// 1x1 的 PNG
+const png = Buffer.from('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==', 'base64');
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+if (cluster.isWorker) {
+  // 工作进程：按指令保存 / 删除 / 读取；pause 让写引用或删 blob 停一会儿，把两个进程的操作交错起来
+  const cacheService = require('../services/cacheService');
+  const { storage } = cacheService;
+  const report = (event, data = {}) => process.send({ test: event, ...data });
+  const pauseOn = (method, match, ms) => {
+    const original = storage[method].bind(storage);
+    storage[method] = async (name, ...args) => {
+      if (match(name)) {
+        storage[method] = original;
+        report('paused');
+        await sleep(ms);
+      }
+      return original(name, ...args);
+    };
+  };
+
+  process.on('message', async (message) => {
+    const { test, key, pause } = message || {};
+    if (test === 'save') {
+      if (pause) pauseOn('put', name => name === `refs/${key}.json`, pause);
+      await cacheService.saveImage(key, png, 'image/png');
+      report('saved', { key });
+    } else if (test === 'delete') {
+      if (pause) pauseOn('delete', name => name.startsWith('blobs/') && !name.includes('_thumb'), pause);
+      const { deleted } = await cacheService.deleteImage(key);
+      report('deleted', { key, deleted });
+    } else if (test === 'read') {
+      const object = await cacheService.openImage(key);
+      object?.stream.destroy();
+      report('read', { key, found: Boolean(object) });
+    }
+  });
+  cacheService.ready.then(() => report('ready'));
+} else {
+  const { test, before, after } = require('node:test');
+  const assert = require('node:assert');
+  const clusterService = require('../services/clusterService');
+
+  const inbox = [];
+  cluster.on('message', (worker, message) => {
+    if (message?.test) inbox.push({ worker: worker.id, ...message });
+  });
+  const waitFor = async (worker, event, key) => {
+    const deadline = Date.now() + 10000;
+    for (;;) {
+      const index = inbox.findIndex(m => m.worker === worker.id && m.test === event && (key === undefined || m.key === key));
+      if (index !== -1) return inbox.splice(index, 1)[0];
+      if (Date.now() > deadline) throw new Error(`等待超时: ${event} ${JSON.stringify(inbox)}`);
+      await sleep(10);
+    }
+  };
+  const call = (worker, message) => {
+    worker.send(message);
+    return waitFor(worker, message.test === 'save' ? 'saved' : message.test === 'delete' ? 'deleted' : 'read', message.key);
+  };
+  const readable = async (worker, key) => (await call(worker, { test: 'read', key })).found;
+
+  let a;
+  let b;
+  before(async () => {
+    cluster.setupPrimary({ exec: __filename, execArgv: [], silent: true });
+    clusterService.startPrimary(2);
+    [a, b] = Object.values(cluster.workers);
+    await Promise.all([waitFor(a, 'ready'), waitFor(b, 'ready')]);
+  });
+
+  after(async () => {
+    for (const worker of Object.values(cluster.workers)) {
+      worker.disconnect();
+      worker.process.kill();
+    }
+    await fs.remove(process.env.CACHE_DIR);
+  });
+
+  test('B 已判定 blob 存在、还没写进索引时 A 删除最后一个引用：blob 保留', async () => {
+    await call(a, { test: 'save', key: 'a1' });
+    // B 写引用前停住：此时 B 已占用 blob，A 的索引里还没有 b1
+    b.send({ test: 'save', key: 'b1', pause: 300 });
+    await waitFor(b, 'paused');
+    const { deleted } = await call(a, { test: 'delete', key: 'a1' });
+    assert.deepStrictEqual(deleted, ['reference']);
+    await waitFor(b, 'saved', 'b1');
+
+    assert.strictEqual(await readable(b, 'b1'), true);
+    assert.strictEqual(await readable(a, 'b1'), true);
+  });
+
+  test('A 删除 blob 途中 B 保存同样内容：B 等 A 删完再写，新 key 可读', async () => {
+    // A 删除最后一个引用，删 blob 前停住（已在锁里判定没有引用）
+    a.send({ test: 'delete', key: 'b1', pause: 300 });
+    await waitFor(a, 'paused');
+    const saved = call(b, { test: 'save', key: 'b2' });
+    await waitFor(a, 'deleted', 'b1');
+    await saved;
+
+    assert.strictEqual(await readable(b, 'b2'), true);
+    assert.strictEqual(await readable(a, 'b2'), true);
+  });
+}
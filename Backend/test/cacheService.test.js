@@ -0,0 +1,61 @@
+/**
+ * cacheService 按内容存储的并发场景：删除和保存同样内容同时发生时，新保存的 key 仍然可读
+ * 用法: npm test（使用临时缓存目录，不影响正在使用的缓存）
+ */
+const { test, before, after } = require('node:test');
+const assert = require('node:assert');
+const fs = require('fs-extra');
+const os = require('os');
+const path = require('path');
+
+process.env.CACHE_DIR = fs.mkdtempSync(path.join(os.tmpdir(), 'cache-test-'));
+process.env.STORAGE_BACKEND = 'fs';
+process.env.TRACE_EXPORT = 'none';
+process.env.LOG_LEVEL = process.env.LOG_LEVEL || 'warn';
+
+const cacheService = require('../services/cacheService');
+
+// 1x1 的 PNG
+const png = Buffer.from('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==', 'base64');
+
+before(() => cacheService.ready);
+
+after(async () => {
+  await fs.remove(process.env.CACHE_DIR);
+});
+
+async function readAll(object) {
+  const chunks = [];
+  for await (const chunk of object.stream) chunks.push(chunk);
+  return Buffer.concat(chunks);
+}
+
+for (const order of ['delete-first', 'save-first']) {
+  test(`同时删除和保存同样内容的图片（${order}）：新 key 的原图和缩略图都还在`, async () => {
+    const [oldKey, newKey] = [`a-${order}`, `b-${order}`];
+    await cacheService.saveImage(oldKey, png, 'image/png');
+
+    const remove = () => cacheService.deleteImage(oldKey);
+    const save = () => cacheService.saveImage(newKey, png, 'image/png');
+    await Promise.all(order === 'delete-first' ? [remove(), save()] : [save(), remove()]);
+
+    const entry = cacheService.images.get(newKey);
+    assert.ok(entry, '新 key 已写入索引');
+    assert.ok(await cacheService.storage.stat(cacheService.imageObject(entry)), 'blob 仍存在');
+    assert.ok(await cacheService.storage.stat(cacheService.imageObject(entry, entry.thumb)), '缩略图仍存在');
+    assert.deepStrictEqual(await readAll(await cacheService.openImage(newKey)), png);
+    assert.strictEqual(cacheService.blobRefs(entry.original), 1);
+
+    await cacheService.deleteImage(newKey);
+    assert.strictEqual(await cacheService.storage.stat(cacheService.imageObject(entry)), null, '最后一个引用删除后 blob 被删除');
+  });
+}
+
+test('同时删除和保存同样内容的表格：新 key 仍可读取', async () => {
+  const csv = Buffer.from('a,b\n1,2\n');
+  await cacheService.saveTable('t-old', csv, true);
+  const old = cacheService.tables.get('t-old');
+  cacheService.unindexTable('t-old');
+  await Promise.all([cacheService.releaseTable('t-old', old), cacheService.saveTable('t-new', csv, true)]);
+  assert.deepStrictEqual(await readAll(await cacheService.openTable('t-new')), csv);
+});
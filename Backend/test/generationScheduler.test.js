@@ -0,0 +1,102 @@
+/**
+ * generationScheduler 多进程模式：槽位由主进程统一分配，并发上限、排队上限是全局的，不随工作进程数放大
+ * 本文件同时是工作进程的入口：cluster.fork 以工作进程身份再次运行它
+ */
+const cluster = require('cluster');
+
+process.env.GENERATION_CONCURRENCY = '2';
+process.env.GENERATION_MAX_QUEUE = '3';
+process.env.TRACE_EXPORT = 'none';
+process.env.LOG_LEVEL = process.env.LOG_LEVEL || 'error';
+
+if (cluster.isWorker) {
+  // 工作进程：按主进程的指令申请 / 归还槽位，并把结果报回去
+  const generationScheduler = require('../services/generationScheduler');
+  const held = [];
+  const report = (event) => process.send({ test: event });
+  process.on('message', (message) => {
+    if (message?.test === 'acquire') {
+      let queued = false;
+      generationScheduler.acquire({
+        clientId: `client-${cluster.worker.id}`,
+        onQueue: () => {
+          if (!queued) report('queued');
+          queued = true;
+        }
+      }).then((release) => {
+        held.push(release);
+        report('granted');
+      }, (error) => report(error.code));
+    } else if (message?.test === 'release') {
+      held.shift()?.();
+    }
+  });
+  report('ready');
+} else {
+  const { test, after } = require('node:test');
+  const assert = require('node:assert');
+  const clusterService = require('../services/clusterService');
+
+  const events = new Map();
+  const count = (worker, event) => events.get(worker.id)?.[event] || 0;
+  const total = (event) => [...events.values()].reduce((sum, counts) => sum + (counts[event] || 0), 0);
+  cluster.on('message', (worker, message) => {
+    if (!message?.test) return;
+    const counts = events.get(worker.id) || {};
+    counts[message.test] = (counts[message.test] || 0) + 1;
+    events.set(worker.id, counts);
+  });
+
+  const waitFor = async (predicate, what, timeoutMs = 10000) => {
+    const deadline = Date.now() + timeoutMs;
+    while (!predicate()) {
+      if (Date.now() > deadline) throw new Error(`等待超时: ${what} ${JSON.stringify([...events])}`);
+      await new Promise(resolve => setTimeout(resolve, 20));
+    }
+  };
+  const settle = () => new Promise(resolve => setTimeout(resolve, 300));
+
+  // 先 disconnect 再结束进程：startPrimary 不会重启主动停掉的工作进程
+  const stop = (worker) => {
+    worker.disconnect();
+    worker.process.kill();
+  };
+
+  after(() => {
+    for (const worker of Object.values(cluster.workers)) stop(worker);
+  });
+
+  test('3 个工作进程共用 2 个槽位和 3 个排队位；归还或进程退出后排队的请求按全局顺序拿到槽位', async () => {
+    cluster.setupPrimary({ exec: __filename, execArgv: [], silent: true });
+    assert.strictEqual(clusterService.startPrimary(3), true);
+    const workers = () => Object.values(cluster.workers);
+    await waitFor(() => workers().length === 3 && workers().every(worker => count(worker, 'ready')), '工作进程就绪');
+
+    // 每个进程申请 2 个：共 6 个请求，全局只能有 2 个占用、3 个排队，多出的 1 个被拒绝
+    for (const worker of workers()) {
+      worker.send({ test: 'acquire' });
+      worker.send({ test: 'acquire' });
+    }
+    await waitFor(() => total('granted') + total('queued') + total('QUEUE_FULL') === 6, '6 个请求都有结果');
+    await settle();
+    assert.strictEqual(total('granted'), 2);
+    assert.strictEqual(total('queued'), 3);
+    assert.strictEqual(total('QUEUE_FULL'), 1);
+
+    // 归还一个槽位：排队的请求拿到它，总占用仍是 2
+    const holder = workers().find(worker => count(worker, 'granted') > 0);
+    holder.send({ test: 'release' });
+    await waitFor(() => total('granted') === 3, '归还后分配给排队的请求');
+    await settle();
+    assert.strictEqual(total('granted'), 3);
+
+    // 占用槽位的进程退出：主进程回收它的槽位和排队。还有 2 个排队的请求，退出的进程最多占其中 1 个，
+    // 所以其他进程一定有请求拿到回收的槽位
+    const held = (worker) => count(worker, 'granted') - (worker === holder ? 1 : 0);
+    const victim = workers().find(worker => held(worker) > 0);
+    const others = workers().filter(worker => worker !== victim);
+    const before = others.reduce((sum, worker) => sum + count(worker, 'granted'), 0);
+    stop(victim);
+    await waitFor(() => others.reduce((sum, worker) => sum + count(worker, 'granted'), 0) > before, '进程退出后槽位被回收');
+  });
+}
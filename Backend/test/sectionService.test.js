@@ -0,0 +1,30 @@
+/**
+ * sectionService 分块：超长段落按句子切开，每块都不超过 chunkTokens
+ */
+const { test } = require('node:test');
+const assert = require('node:assert');
+
+const sectionService = require('../services/sectionService');
+
+test('单段超过块大小：按句子切开，块大小不超过上限且内容不丢', () => {
+  const sentences = Array.from({ length: 3000 }, (_, i) => `Sentence ${i} reports one measured result.`);
+  const sections = [
+    { heading: 'Method', text: 'A short paragraph.' },
+    { heading: '', text: sentences.join(' ') }
+  ];
+  const chunks = sectionService.chunkSections(sections, 2000);
+
+  assert.ok(chunks.length > 2, '超长段落应切成多块');
+  for (const chunk of chunks) assert.ok(sectionService.estimateTokens(chunk) <= 2000, `块大小 ${sectionService.estimateTokens(chunk)} 超过上限`);
+  const joined = chunks.join(' ');
+  for (const i of [0, 1500, 2999]) assert.ok(joined.includes(`Sentence ${i} reports`), `缺少第 ${i} 句`);
+});
+
+test('没有句号的长串：按词或按字符切开', () => {
+  const chunks = sectionService.chunkSections([
+    { heading: '', text: 'token '.repeat(20000) },
+    { heading: '', text: '中'.repeat(5000) }
+  ], 1000);
+  for (const chunk of chunks) assert.ok(sectionService.estimateTokens(chunk) <= 1000);
+  assert.strictEqual(chunks.join('').replace(/\s/g, '').length, 'token'.length * 20000 + 5000);
+});
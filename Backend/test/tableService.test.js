@@ -0,0 +1,74 @@
+/**
+ * tableService 表格预览：XLSX 中间有缺失行时，行号不错位
+ * 用法: npm test（使用临时缓存目录，不影响正在使用的缓存）
+ */
+const { test, before, after } = require('node:test');
+const assert = require('node:assert');
+const AdmZip = require('adm-zip');
+const fs = require('fs-extra');
+const os = require('os');
+const path = require('path');
+
+process.env.CACHE_DIR = fs.mkdtempSync(path.join(os.tmpdir(), 'table-test-'));
+process.env.STORAGE_BACKEND = 'fs';
+process.env.TRACE_EXPORT = 'none';
+process.env.LOG_LEVEL = process.env.LOG_LEVEL || 'warn';
+// 检查点密一些，窗口从缺失行之后的检查点开始读
+process.env.TABLE_INDEX_INTERVAL = '2';
+
+const cacheService = require('../services/cacheService');
+const tableService = require('../services/tableService');
+
+/**
+ * 只有第一个工作表的最小 XLSX；rows 为 { 行号: [单元格文本] }，没列出的行号在工作表里不存在
+ */
+function xlsx(rows) {
+  const column = (i) => String.fromCharCode(65 + i);
+  const sheetRows = Object.entries(rows).map(([r, cells]) => `<row r="${r}">${cells.map((value, i) => (
+    `<c r="${column(i)}${r}" t="inlineStr"><is><t>${value}</t></is></c>`
+  )).join('')}</row>`);
+  const zip = new AdmZip();
+  zip.addFile('xl/worksheets/sheet1.xml', Buffer.from(
+    `<?xml version="1.0" encoding="UTF-8"?><worksheet><sheetData>${sheetRows.join('')}</sheetData></worksheet>`
+  ));
+  return zip.toBuffer();
+}
+
+async function previewRows(key, options) {
+  const preview = await tableService.preview(key, options);
+  const rows = [];
+  for await (const row of preview.rows) rows.push(row);
+  return { ...preview, rows };
+}
+
+before(() => cacheService.ready);
+
+after(async () => {
+  await fs.remove(process.env.CACHE_DIR);
+});
+
+test('XLSX 行之间有缺失行：补成空记录，后面的行不前移', async () => {
+  await cacheService.saveTable('gap', xlsx({
+    1: ['name', 'value'],
+    2: ['a', '1'],
+    5: ['b', '2'],
+    6: ['c', '3']
+  }), false);
+
+  const all = await previewRows('gap', { offset: 0, limit: 10 });
+  assert.deepStrictEqual(all.columns, ['name', 'value']);
+  assert.strictEqual(all.totalRows, 5);
+  assert.deepStrictEqual(all.rows, [['a', '1'], ['', ''], ['', ''], ['b', '2'], ['c', '3']]);
+
+  const window = await previewRows('gap', { offset: 3, limit: 2 });
+  assert.deepStrictEqual(window.rows, [['b', '2'], ['c', '3']]);
+  assert.strictEqual(window.nextOffset, null);
+});
+
+test('只有一列的 XLSX 有缺失行：空记录同样保留', async () => {
+  await cacheService.saveTable('gap-single', xlsx({ 1: ['name'], 2: ['a'], 4: ['b'] }), false);
+
+  const all = await previewRows('gap-single', { offset: 0, limit: 10 });
+  assert.strictEqual(all.totalRows, 3);
+  assert.deepStrictEqual(all.rows, [['a'], [''], ['b']]);
+});
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+链路瀑布图：按 trace id 取出一次分析的全部 span，打印各阶段的起止时间和耗时
+trace id 来自 paper_demo.py 完成后显示的链路 ID，或响应头 X-Trace-Id
+
+用法:
+    python trace_waterfall.py <trace_id>                    # 从后端 /api/traces/<trace_id> 获取
+    python trace_waterfall.py <trace_id> --file traces/<trace_id>.ndjson
+    python trace_waterfall.py <trace_id> --api http://localhost:2983
+"""
+import argparse
+import json
+import sys
+from collections import defaultdict
+
+import requests
+
+API_BASE_URL = "http://localhost:2983"
+BAR_WIDTH = 60
+
+def print_section(title):
+    print(f"\n{'='*60}")
+    print(f"🔍 {title}")
+    print(f"{'='*60}")
+
+def load_spans(trace_id, api_base, file_path):
+    """从 NDJSON 文件或后端接口读取 span 列表"""
+    if file_path:
+        with open(file_path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    response = requests.get(f"{api_base}/api/traces/{trace_id}", timeout=10)
+    if response.status_code == 404:
+        return []
+    response.raise_for_status()
+    return response.json().get('spans', [])
+
+def build_tree(spans):
+    """按 parentSpanId 建树；父 span 不在本链路里的（如客户端侧的父 span）当作根"""
+    by_id = {span['spanId']: span for span in spans}
+    children = defaultdict(list)
+    roots = []
+    for span in spans:
+        parent = span.get('parentSpanId')
+        if parent in by_id:
+            children[parent].append(span)
+        else:
+            roots.append(span)
+    for items in children.values():
+        items.sort(key=lambda s: s['startTime'])
+    roots.sort(key=lambda s: s['startTime'])
+    return roots, children
+
+def span_label(span):
+    attrs = span.get('attributes') or {}
+    marks = []
+    if span.get('status') == 'error':
+        marks.append(f"❌ {span.get('error') or 'error'}")
+    if attrs.get('cancelled') or attrs.get('outcome') == 'cancelled':
+        marks.append('⏹️ cancelled')
+    if span.get('endTime') is None:
+        marks.append('⏳ 未结束')
+    return f"  {' '.join(marks)}" if marks else ''
+
+def print_waterfall(roots, children, origin, total_ms):
+    scale = BAR_WIDTH / total_ms if total_ms > 0 else 0
+    print(f"{'span':<44} {'起始(ms)':>10} {'耗时(ms)':>10}  时间轴")
+
+    def walk(span, depth):
+        offset = span['startTime'] - origin
+        duration = (span.get('durationMs') or 0)
+        start_col = min(BAR_WIDTH - 1, int(offset * scale))
+        width = max(1, int(duration * scale))
+        bar = ' ' * start_col + '█' * min(width, BAR_WIDTH - start_col)
+        name = f"{'  ' * depth}{span['name']}"
+        if len(name) > 44:
+            name = name[:41] + '...'
+        print(f"{name:<44} {offset:>10.1f} {duration:>10.1f}  |{bar:<{BAR_WIDTH}}|{span_label(span)}")
+        for event in span.get('events') or []:
+            if event['name'] in ('first_byte', 'client_disconnected', 'analysis_cache_hit'):
+                print(f"{'  ' * (depth + 1)}· {event['name']} @ {event['time'] - origin:.1f}ms")
+        for child in children.get(span['spanId'], []):
+            walk(child, depth + 1)
+
+    for root in roots:
+        walk(root, 0)
+
+def print_summary(spans):
+    """按 span 名称汇总：次数、总耗时、最长一次、失败次数"""
+    stats = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0, 'errors': 0})
+    for span in spans:
+        item = stats[span['name']]
+        duration = span.get('durationMs') or 0
+        item['count'] += 1
+        item['total'] += duration
+        item['max'] = max(item['max'], duration)
+        if span.get('status') == 'error':
+            item['errors'] += 1
+    print(f"{'span':<36} {'次数':>6} {'合计(ms)':>12} {'最长(ms)':>12} {'失败':>6}")
+    for name, item in sorted(stats.items(), key=lambda kv: -kv[1]['total']):
+        print(f"{name[:36]:<36} {item['count']:>6} {item['total']:>12.1f} {item['max']:>12.1f} {item['errors']:>6}")
+
+def main():
+    parser = argparse.ArgumentParser(description="打印一条链路的瀑布图")
+    parser.add_argument('trace_id', help="32 位十六进制 trace id")
+    parser.add_argument('--api', default=API_BASE_URL, help="后端地址")
+    parser.add_argument('--file', help="直接读取 TRACE_DIR 下的 NDJSON 文件")
+    args = parser.parse_args()
+
+    try:
+        spans = load_spans(args.trace_id.lower(), args.api, args.file)
+    except Exception as e:
+        print(f"❌ 读取链路失败: {e}")
+        return 1
+    if not spans:
+        print(f"❌ 没有找到链路 {args.trace_id}（可能未被采样，或 TRACE_EXPORT=none 且已被挤出内存）")
+        return 1
+
+    origin = min(span['startTime'] for span in spans)
+    end = max((span.get('endTime') or span['startTime']) for span in spans)
+    total_ms = end - origin
+    roots, children = build_tree(spans)
+    workers = sorted({str(span.get('worker')) for span in spans})
+
+    print_section(f"链路 {args.trace_id}")
+    print(f"📊 {len(spans)} 个 span，{len(roots)} 个入口请求，总跨度 {total_ms:.1f}ms，工作进程 {', '.join(workers)}")
+    errors = [span for span in spans if span.get('status') == 'error']
+    if errors:
+        print(f"⚠️  {len(errors)} 个 span 失败")
+
+    print_section("瀑布图")
+    print_waterfall(roots, children, origin, total_ms)
+
+    print_section("各阶段汇总")
+    print_summary(spans)
+
+    print_section("入口请求")
+    for root in roots:
+        attrs = root.get('attributes') or {}
+        print(f"   {root['name']:<40} {root.get('durationMs') or 0:>10.1f}ms  HTTP {attrs.get('http.status_code', '-')}{span_label(root)}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+会话内存基准：同时打开多个已完成分析的会话，统计 Streamlit 进程每个会话占用的内存
+    - inline: 原图字节放进 st.download_button，展示图经进程下载（改动前的方式，缓存不设上限）
+    - proxy:  下载走后端链接，展示图经进程下载，进程缓存受 MICRO_TOMATO_MEDIA_BUDGET_MB 限制
+    - link:   下载和展示都是后端链接，进程不经手图片字节
+每种方式在新的子进程里用 streamlit.testing 跑 --sessions 个会话，会话对象全部保持存活（模拟同时在线），
+每个会话有 --candidates 张各不相同的候选图
+
+图片来源：默认在本地起一个合成图片服务（原图 --original-kb，展示版本约为原图的 1/12）；
+--api 指定后端地址时从 /api/cache/entries 取真实图片（需要缓存里至少有 sessions × candidates 张）
+
+用法: python bench_session_memory.py [--sessions 20] [--candidates 4] [--original-kb 1024] [--budget-mb 64] [--api http://localhost:2983]
+"""
+
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import threading
+import tracemalloc
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from PIL import Image
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "paper_demo.py")
+MODES = {
+    "inline": {"MICRO_TOMATO_DOWNLOAD_MODE": "inline", "MICRO_TOMATO_IMAGE_DELIVERY": "proxy", "MICRO_TOMATO_MEDIA_BUDGET_MB": "1000000"},
+    "proxy": {"MICRO_TOMATO_DOWNLOAD_MODE": "link", "MICRO_TOMATO_IMAGE_DELIVERY": "proxy"},
+    "link": {"MICRO_TOMATO_DOWNLOAD_MODE": "link", "MICRO_TOMATO_IMAGE_DELIVERY": "link"},
+}
+
+def noise_png(size_kb):
+    """随机噪点 PNG，几乎不可压缩，文件大小接近 size_kb"""
+    side = max(8, int((size_kb * 1024 / 3) ** 0.5))
+    buffer = BytesIO()
+    Image.frombytes('RGB', (side, side), os.urandom(side * side * 3)).save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+def start_synthetic_server(original_kb):
+    """合成图片服务：每个 key 返回固定的原图，带 width 参数时返回约 1/12 大小的展示版本"""
+    blobs = {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            key = url.path.rsplit('/', 1)[-1]
+            display = 'width' in parse_qs(url.query)
+            with lock:
+                if (key, display) not in blobs:
+                    blobs[key, display] = noise_png(original_kb // 12 if display else original_kb)
+                data = blobs[key, display]
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+def real_image_urls(api, count):
+    urls, cursor = [], None
+    while len(urls) < count:
+        params = {"kind": "image", "limit": 200, **({"cursor": cursor} if cursor else {})}
+        page = requests.get(f"{api}/api/cache/entries", params=params, timeout=30).json()
+        urls += [item['originalUrl'] for item in page['items'] if item.get('originalUrl')]
+        cursor = page.get('nextCursor')
+        if not cursor:
+            break
+    if len(urls) < count:
+        sys.exit(f"❌ 缓存里只有 {len(urls)} 张图片，需要 {count} 张")
+    return urls[:count]
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# ---------------- 子进程：打开多个会话并测量 ----------------
+def run_child(args, urls):
+    from streamlit.testing.v1 import AppTest
+
+    def open_session(i):
+        app = AppTest.from_file(APP_PATH, default_timeout=60)
+        app.session_state.stage = "completed"
+        app.session_state.trace_id = f"{i:032x}"
+        app.session_state.candidates = [
+            {'id': f"{i:04d}{j:04d}", 'style_tag': f"方案 {j + 1}", 'image_url': url}
+            for j, url in enumerate(urls[i * args.candidates:(i + 1) * args.candidates])
+        ]
+        app.run()
+        if app.exception:
+            raise RuntimeError(app.exception[0].message)
+        return app
+
+    # 先用最后一组图片跑一个会话预热（导入、编译脚本），不计入
+    open_session(args.sessions)
+    gc.collect()
+    tracemalloc.start()
+    baseline_rss = rss_mb()
+    sessions = [open_session(i) for i in range(args.sessions)]
+    # 每个会话再重绘一次：改动前每次重绘都会重新下载
+    for app in sessions:
+        app.run()
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    print(json.dumps({
+        "perSessionKb": current / args.sessions / 1024,
+        "totalMb": current / 1024 / 1024,
+        "peakMb": peak / 1024 / 1024,
+        "rssGrowthMb": rss_mb() - baseline_rss,
+        "sessions": len(sessions)
+    }))
+
+# ---------------- 主进程 ----------------
+def main():
+    parser = argparse.ArgumentParser(description="Streamlit 会话内存基准")
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--candidates', type=int, default=4)
+    parser.add_argument('--original-kb', type=int, default=1024)
+    parser.add_argument('--budget-mb', type=int, default=64)
+    parser.add_argument('--api', default=None, help="使用真实后端的缓存图片")
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--urls', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args, json.loads(args.urls))
+        return
+
+    total = (args.sessions + 1) * args.candidates
+    if args.api:
+        api = args.api.rstrip('/')
+        urls = real_image_urls(api, total)
+        source = f"后端 {api}"
+    else:
+        api = start_synthetic_server(args.original_kb)
+        urls = [f"/api/cache/image/{i:08x}-0000-4000-8000-000000000000" for i in range(total)]
+        source = f"合成图片（原图 {args.original_kb}KB）"
+    print(f"会话内存基准: {args.sessions} 个会话 × {args.candidates} 张候选图，{source}，进程缓存上限 {args.budget_mb}MB\n")
+
+    results = []
+    for mode, env in MODES.items():
+        child_env = {**os.environ, "MICRO_TOMATO_API_URL": api, "MICRO_TOMATO_MEDIA_BUDGET_MB": str(args.budget_mb), **env}
+        output = subprocess.run(
+            [sys.executable, __file__, '--child', mode, '--urls', json.dumps(urls),
+             '--sessions', str(args.sessions), '--candidates', str(args.candidates)],
+            env=child_env, capture_output=True, text=True
+        )
+        if output.returncode != 0:
+            sys.exit(f"❌ {mode} 失败:\n{output.stderr[-2000:]}")
+        results.append((mode, json.loads(output.stdout.strip().splitlines()[-1])))
+
+    print("方式       每会话(KB)   Python 堆合计(MB)   峰值(MB)   RSS 增长(MB)")
+    for mode, r in results:
+        print(f"{mode:<8} {r['perSessionKb']:>12.0f} {r['totalMb']:>19.1f} {r['peakMb']:>10.1f} {r['rssGrowthMb']:>14.1f}")
+
+if __name__ == "__main__":
+    main()
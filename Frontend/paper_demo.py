@@ -1,14 +1,49 @@
 import streamlit as st
-import time
+import pandas as pd
 import requests
 import json
 import uuid
+import html
+import os
+import secrets
+import threading
+from collections import OrderedDict
 from io import BytesIO
+from itertools import islice
+from urllib.parse import urlencode
 
 # ==========================================
 # 配置区域
 # ==========================================
-API_BASE_URL = "http://localhost:2983" 
+API_BASE_URL = os.environ.get("MICRO_TOMATO_API_URL", "http://localhost:2983")
+# 流程模式："single" 一个请求跑完整条流水线（/api/pipeline）；"staged" 先解析再生图两次请求
+PIPELINE_MODE = os.environ.get("MICRO_TOMATO_PIPELINE", "single")
+# 各请求的总时长预算（秒），同时通过 X-Request-Timeout-Ms 告诉后端，超时后后端不再继续干活
+REQUEST_TIMEOUTS = {"extract": 120, "generate": 180, "pipeline": 300}
+# 生图参数：候选图数量；对冲模式下慢任务会被补发、凑够数量后取消其余任务
+GENERATION_OPTIONS = {
+    "candidates": int(os.environ.get("MICRO_TOMATO_CANDIDATES", "4")),
+    "modality": os.environ.get("MICRO_TOMATO_MODALITY", "IMAGE"),
+    "hedge": os.environ.get("MICRO_TOMATO_HEDGE", "false").lower() == "true",
+}
+# 页面展示用压缩版本：后端按 Accept 生成 WebP 派生图并缓存复用（宽度、质量会取到后端的档位）；下载按钮仍取原图
+DISPLAY_IMAGE_PARAMS = {
+    "width": int(os.environ.get("MICRO_TOMATO_IMAGE_WIDTH", "768")),
+    "quality": os.environ.get("MICRO_TOMATO_IMAGE_QUALITY", "medium"),
+}
+DISPLAY_IMAGE_ACCEPT = os.environ.get("MICRO_TOMATO_IMAGE_ACCEPT", "image/webp")
+# 浏览器访问后端用的地址（图片链接、下载链接），后端不在同一台机器时改成对外地址
+PUBLIC_API_BASE_URL = os.environ.get("MICRO_TOMATO_PUBLIC_API_URL", API_BASE_URL)
+# 展示图片的方式："proxy" 由 Streamlit 进程取图后下发（浏览器访问不到后端时用）；"link" 浏览器直接从后端加载，进程里不留字节
+IMAGE_DELIVERY = os.environ.get("MICRO_TOMATO_IMAGE_DELIVERY", "proxy")
+# 下载原图的方式："link" 后端链接（?download=，浏览器直接下载）；"inline" 字节放进 st.download_button（旧方式，每个会话都持有原图）
+DOWNLOAD_MODE = os.environ.get("MICRO_TOMATO_DOWNLOAD_MODE", "link")
+# proxy 模式下整个进程缓存图片字节的上限（MB），所有会话共用，超出时淘汰最久未用的
+MEDIA_BUDGET_MB = int(os.environ.get("MICRO_TOMATO_MEDIA_BUDGET_MB", "64"))
+# 论文表格预览每页行数（后端上限 1000）：先显示第一页，「显示更多」时再往后取
+TABLE_PAGE_ROWS = int(os.environ.get("MICRO_TOMATO_TABLE_PAGE_ROWS", "50"))
+# 打包导出下载时每次写盘的块大小；断线时最多丢掉一块，续传从已写盘的位置开始
+EXPORT_CHUNK_SIZE = 64 * 1024
 
 # ==========================================
 # CSS 样式 (精简且完整版)
@@ -50,59 +85,353 @@ h1, h2, h3, h4 { color: #6b904b; font-weight: 600; text-shadow: 2px 2px 4px rgba
 # 核心 API 逻辑
 # ==========================================
 
-def upload_paper_api(file_obj):
+def client_headers():
+    """会话级客户端标识，后端按它公平排队"""
+    if 'client_id' not in st.session_state:
+        st.session_state.client_id = str(uuid.uuid4())
+    return {'X-Client-Id': st.session_state.client_id}
+
+def trace_headers():
+    """W3C traceparent：一次分析（上传、流式请求、取图）共用一个 trace id，每个请求一个新的父 span id"""
+    if not st.session_state.get('trace_id'):
+        st.session_state.trace_id = uuid.uuid4().hex
+    return {'traceparent': f"00-{st.session_state.trace_id}-{secrets.token_hex(8)}-01"}
+
+def http_error_message(response):
+    if response.status_code == 429:
+        return f"生图队列已满，请 {response.headers.get('Retry-After', '?')} 秒后重试"
+    if response.status_code == 503:
+        return f"生图服务暂时不可用，请 {response.headers.get('Retry-After', '?')} 秒后重试"
+    return f"HTTP {response.status_code}"
+
+def queue_status_text(chunk):
+    """把 queue 事件转成排队提示；已开始生成时返回 None"""
+    if not chunk.get('waiting'):
+        return None
+    eta = max(1, round(chunk.get('etaMs', 0) / 1000))
+    return f"排队中：前面还有 {chunk.get('position', 0)} 个任务，预计约 {eta} 秒"
+
+def form_generation_options():
+    """multipart 表单只能传字符串"""
+    return {key: str(value).lower() if isinstance(value, bool) else str(value) for key, value in GENERATION_OPTIONS.items()}
+
+def open_stream(url, timeout, **kwargs):
+    """发起流式请求并登记为当前会话的活动流；同一会话只保留一条"""
+    close_active_stream()
+    headers = {**client_headers(), **trace_headers(), 'X-Request-Timeout-Ms': str(int(timeout * 1000))}
+    response = requests.post(url, headers=headers, stream=True, timeout=timeout, **kwargs)
+    st.session_state.active_stream = response
+    return response
+
+def close_active_stream():
+    """主动断开活动流，后端据此取消仍在进行的上游生图"""
+    response = st.session_state.get('active_stream')
+    if response is not None:
+        try:
+            response.close()
+        except Exception:
+            pass
+        st.session_state.active_stream = None
+
+def iter_sse(response):
+    """逐条解析 SSE 响应，事件名写入 chunk['type']"""
+    current_event = None
+    for line in response.iter_lines():
+        if line:
+            decoded_line = line.decode('utf-8')
+            if decoded_line.startswith('event: '):
+                current_event = decoded_line[7:].strip()
+            elif decoded_line.startswith('data: '):
+                try:
+                    chunk = json.loads(decoded_line[6:])
+                    if 'type' not in chunk and current_event:
+                        chunk['type'] = current_event
+                    yield chunk
+                except:
+                    continue
+
+def upload_paper_api(file_obj, on_event=None):
+    """流式上传解析：摘要增量、Prompt 等事件通过 on_event 回调实时交给界面"""
     try:
         files = {'pdf': (file_obj.name, file_obj, 'application/pdf')}
-        response = requests.post(f"{API_BASE_URL}/api/extract", files=files, timeout=120)
-        if response.status_code == 200:
-            data = response.json()
-            return {
-                'success': True, 
-                'summary': data.get('text', '摘要生成中...'), 
-                'prompt': data.get('generatedPrompt', ''),
-                'metadata': data.get('metadata', {})
-            }
-        return {'success': False, 'error': f"HTTP {response.status_code}"}
+        response = open_stream(f"{API_BASE_URL}/api/extract", files=files, data={'stream': 'true', **form_generation_options()}, timeout=REQUEST_TIMEOUTS["extract"])
+        if response.status_code != 200:
+            return {'success': False, 'error': http_error_message(response)}
+        for chunk in iter_sse(response):
+            if on_event:
+                on_event(chunk)
+            if chunk.get('type') == 'complete':
+                return {
+                    'success': True, 
+                    'summary': chunk.get('text', '摘要生成中...'), 
+                    'prompt': chunk.get('generatedPrompt', ''),
+                    'generation_id': chunk.get('generationId'),
+                    'metadata': chunk.get('metadata', {})
+                }
+            if chunk.get('type') == 'error':
+                return {'success': False, 'error': chunk.get('error')}
+        return {'success': False, 'error': '解析流意外结束'}
     except Exception as e:
         return {'success': False, 'error': str(e)}
 
-def generate_stream_api(prompt):
+def generate_stream_api(prompt, generation_id=None):
+    """生图流；有 generation_id 时订阅解析阶段已提前启动的任务"""
     try:
-        payload = {"paperText": prompt}
-        response = requests.post(f"{API_BASE_URL}/api/generate/stream", json=payload, stream=True, timeout=180)
-        current_event = None
-        for line in response.iter_lines():
-            if line:
-                decoded_line = line.decode('utf-8')
-                if decoded_line.startswith('event: '):
-                    current_event = decoded_line[7:].strip()
-                elif decoded_line.startswith('data: '):
-                    try:
-                        chunk = json.loads(decoded_line[6:])
-                        if 'type' not in chunk and current_event:
-                            chunk['type'] = current_event
-                        yield chunk
-                    except:
-                        continue
+        payload = {"paperText": prompt, **GENERATION_OPTIONS}
+        if generation_id:
+            payload["generationId"] = generation_id
+        response = open_stream(f"{API_BASE_URL}/api/generate/stream", json=payload, timeout=REQUEST_TIMEOUTS["generate"])
+        if response.status_code != 200:
+            yield {"type": "error", "error": http_error_message(response)}
+            return
+        yield from iter_sse(response)
     except Exception as e:
         yield {"type": "error", "error": str(e)}
 
-def render_safe_image(url_path, caption):
+def pipeline_stream_api(file_obj):
+    """单请求流水线：上传 PDF，按事件类型流式返回元数据、摘要、Prompt 和每张图片"""
+    try:
+        files = {'pdf': (file_obj.name, file_obj, 'application/pdf')}
+        response = open_stream(f"{API_BASE_URL}/api/pipeline", files=files, data=form_generation_options(), timeout=REQUEST_TIMEOUTS["pipeline"])
+        if response.status_code != 200:
+            yield {"type": "error", "error": http_error_message(response), "fatal": True}
+            return
+        yield from iter_sse(response)
+    except Exception as e:
+        yield {"type": "error", "error": str(e), "fatal": True}
+
+def download_export(dest_path, paper=None, generation=None, chunk_size=EXPORT_CHUNK_SIZE, timeout=60):
+    """把 /api/export 的 ZIP 边收边写到 dest_path，内存里只有一个块
+    先写到 dest_path + '.part'，中断后再次调用会带 Range / If-Range 续传；服务端内容变了则从头下载
+    返回 {'path', 'bytes', 'resumed', 'etag'}
+    """
+    params = {k: v for k, v in {'paper': paper, 'generation': generation}.items() if v}
+    if not params:
+        raise ValueError("需要 paper 或 generation")
+    part_path = f"{dest_path}.part"
+    etag_path = f"{part_path}.etag"
+
+    headers = {}
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset and os.path.exists(etag_path):
+        with open(etag_path) as f:
+            headers = {'Range': f"bytes={offset}-", 'If-Range': f.read().strip()}
+    else:
+        offset = 0
+
+    with requests.get(f"{API_BASE_URL}/api/export", params=params, headers=headers, stream=True, timeout=timeout) as response:
+        # 上次已经收完，只是没来得及改名
+        if response.status_code == 416 and response.headers.get('Content-Range') == f"bytes */{offset}":
+            total, resumed, etag = offset, True, headers['If-Range']
+        else:
+            response.raise_for_status()
+            resumed = response.status_code == 206
+            etag = response.headers.get('ETag')
+            if etag:
+                with open(etag_path, 'w') as f:
+                    f.write(etag)
+            content_range = response.headers.get('Content-Range', '')
+            total = int(content_range.rsplit('/', 1)[1]) if resumed else int(response.headers.get('Content-Length', -1))
+            with open(part_path, 'ab' if resumed else 'wb') as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+
+    size = os.path.getsize(part_path)
+    if total >= 0 and size != total:
+        raise IOError(f"导出不完整: {size}/{total} 字节，再次调用可续传")
+    os.replace(part_path, dest_path)
+    if os.path.exists(etag_path):
+        os.remove(etag_path)
+    return {'path': dest_path, 'bytes': size, 'resumed': resumed, 'etag': etag}
+
+class MediaCache:
+    """进程内图片字节缓存：所有会话共用，按字节数设上限，超出时淘汰最久未用的
+    图片 key 对应的内容不会变，不同会话取同一张图直接复用"""
+
+    def __init__(self, budget_bytes):
+        self.budget = budget_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        # 单张超过上限的不缓存，下次重新取
+        if len(data) > self.budget:
+            return
+        with self.lock:
+            if key in self.items:
+                self.size -= len(self.items.pop(key))
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.budget:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {"items": len(self.items), "bytes": self.size, "budget": self.budget,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+@st.cache_resource
+def media_cache():
+    return MediaCache(MEDIA_BUDGET_MB * 1024 * 1024)
+
+def public_url(url_path, **params):
+    """浏览器可以直接访问的后端地址"""
+    url = f"{PUBLIC_API_BASE_URL}{url_path}" if not url_path.startswith('http') else url_path
+    return f"{url}?{urlencode(params)}" if params else url
+
+def fetch_image(url_path, display=False):
+    """取图片字节；进程内按 URL 和版本缓存（见 MediaCache），页面重绘时不再重复下载。display=True 取展示用压缩版本"""
     full_url = f"{API_BASE_URL}{url_path}" if not url_path.startswith('http') else url_path
+    cache_key = f"{'display' if display else 'original'}:{full_url}"
+    cache = media_cache()
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+    headers = trace_headers()
+    if display:
+        headers['Accept'] = DISPLAY_IMAGE_ACCEPT
     try:
-        r = requests.get(full_url, params={'t': int(time.time())}, timeout=10)
-        if r.status_code == 200:
-            st.image(r.content, use_container_width=True, caption=caption)
-            return r.content 
+        r = requests.get(full_url, params=DISPLAY_IMAGE_PARAMS if display else None, headers=headers, timeout=10)
+    except requests.RequestException:
         return None
-    except:
+    if r.status_code != 200:
         return None
+    cache.put(cache_key, r.content)
+    # 本次分析经 Streamlit 进程下载的图片字节数，完成后显示在左侧
+    st.session_state.image_bytes = st.session_state.get('image_bytes', 0) + len(r.content)
+    return r.content
+
+def render_safe_image(url_path, caption):
+    """展示候选图，返回是否展示成功；link 模式下由浏览器按自己的 Accept 协商格式"""
+    if IMAGE_DELIVERY == "link":
+        st.image(public_url(url_path, format="auto", **DISPLAY_IMAGE_PARAMS), use_container_width=True, caption=caption)
+        return True
+    data = fetch_image(url_path, display=True)
+    if data:
+        st.image(data, use_container_width=True, caption=caption)
+    return bool(data)
+
+def render_download(cand):
+    """原图下载：默认给后端的附件链接，会话里不持有原图字节"""
+    if DOWNLOAD_MODE == "inline":
+        original = fetch_image(cand['image_url'])
+        if original:
+            st.download_button(label="Download ⬇️", data=original, file_name=f"plot_{cand['id']}.png", key=f"dl_{cand['id']}")
+        return
+    st.link_button("Download ⬇️", public_url(cand['image_url'], download=f"plot_{cand['id']}"))
+
+@st.cache_data(ttl=600, max_entries=256, show_spinner=False)
+def fetch_table_page(key, offset, limit, columns=None):
+    """取表格的一个行窗口；同一 key 的表格内容不变，进程内缓存，页面重绘时不重复请求"""
+    params = {"offset": offset, "limit": limit}
+    if columns:
+        params["columns"] = list(columns)
+    r = requests.get(f"{API_BASE_URL}/api/cache/table/{key}/rows", params=params, headers=trace_headers(), timeout=30)
+    if r.status_code != 200:
+        raise requests.HTTPError(http_error_message(r), response=r)
+    return r.json()
+
+class TableReader:
+    """表格的惰性读取：迭代时一页一页地向后端取行窗口，用到哪页取哪页，大表格也能马上拿到前几行
+    columns / total_rows 在第一次访问时随第一页取得；columns 参数做列投影（列名或列号）"""
+
+    def __init__(self, key, columns=None, page_size=TABLE_PAGE_ROWS):
+        self.key = key
+        self.projection = tuple(columns) if columns else None
+        self.page_size = page_size
+        self._first = None
+
+    def page(self, offset):
+        return fetch_table_page(self.key, offset, self.page_size, self.projection)
+
+    def first_page(self):
+        if self._first is None:
+            self._first = self.page(0)
+        return self._first
+
+    @property
+    def columns(self):
+        return self.first_page()['columns']
+
+    @property
+    def total_rows(self):
+        return self.first_page()['totalRows']
+
+    def __iter__(self):
+        page = self.first_page()
+        while True:
+            yield from page['rows']
+            if page.get('nextOffset') is None:
+                return
+            page = self.page(page['nextOffset'])
+
+    def head(self, n):
+        return list(islice(self, n))
+
+@st.cache_data(ttl=60, show_spinner=False)
+def list_paper_tables(paper_id):
+    """论文里抽取出的表格，按在论文里出现的顺序"""
+    params = {"kind": "table", "paper": paper_id, "order": "asc", "limit": 50, "summary": "false"}
+    r = requests.get(f"{API_BASE_URL}/api/cache/entries", params=params, headers=trace_headers(), timeout=10)
+    if r.status_code != 200:
+        raise requests.HTTPError(http_error_message(r), response=r)
+    return r.json().get('items', [])
+
+def render_paper_tables(paper_id):
+    """论文表格预览：每个表格先显示第一页，整张表不经过 Streamlit 进程；原表格从后端直接下载"""
+    try:
+        tables = list_paper_tables(paper_id)
+    except requests.RequestException as e:
+        st.caption(f"表格列表获取失败: {e}")
+        return
+    if not tables:
+        return
+    st.markdown("#### 论文表格")
+    for i, table in enumerate(tables, 1):
+        key = table['key']
+        shown_key = f"table_rows_{key}"
+        shown = st.session_state.get(shown_key, TABLE_PAGE_ROWS)
+        with st.expander(f"表格 {i}（{os.path.splitext(table['file'])[1].lstrip('.').upper()}）", expanded=(i == 1)):
+            try:
+                reader = TableReader(key)
+                rows = reader.head(shown)
+            except requests.RequestException as e:
+                st.caption(f"预览失败: {e}")
+                st.link_button("下载原表格", public_url(table['url']))
+                continue
+            st.dataframe(pd.DataFrame(rows, columns=reader.columns), hide_index=True, use_container_width=True)
+            st.caption(f"共 {reader.total_rows} 行 × {len(reader.columns)} 列，显示前 {len(rows)} 行")
+            cols = st.columns(2)
+            if len(rows) < reader.total_rows and cols[0].button("显示更多", key=f"more_{key}"):
+                st.session_state[shown_key] = shown + TABLE_PAGE_ROWS
+                st.rerun()
+            cols[1].link_button("下载原表格", public_url(table['url']))
 
 def reset_app():
+    close_active_stream()
     st.session_state.stage = "idle"
     st.session_state.paper_info = {}
     st.session_state.candidates = []
     st.session_state.generated_prompt = ""
+    st.session_state.generation_id = None
+    st.session_state.trace_id = None
+    st.session_state.image_bytes = 0
     st.session_state.uploader_key = str(uuid.uuid4())
 
 # ==========================================
@@ -118,6 +447,7 @@ def main():
     if 'paper_info' not in st.session_state: st.session_state.paper_info = {}
     if 'candidates' not in st.session_state: st.session_state.candidates = []
     if 'generated_prompt' not in st.session_state: st.session_state.generated_prompt = ""
+    if 'generation_id' not in st.session_state: st.session_state.generation_id = None
     if 'uploader_key' not in st.session_state: st.session_state.uploader_key = "pdf_upload_init"
 
     st.markdown('<div style="text-align: center; margin-bottom: 30px; padding: 20px;"><h1 style="font-size: 3em; margin: 0;">Micro Tomato 🍅 学术论文图解助手</h1></div>', unsafe_allow_html=True)
@@ -130,44 +460,66 @@ def main():
             st.markdown('<div class="upload-anchor"></div><div style="font-size: 3em; margin-bottom: 20px; color: #d4a574; text-align: center;">📁</div>', unsafe_allow_html=True)
             uploaded_file = st.file_uploader("选择PDF文件", type=['pdf'], key=st.session_state.uploader_key)
             
-            is_processing = st.session_state.stage in ["parsing", "visualizing"]
+            is_processing = st.session_state.stage in ["parsing", "visualizing", "pipeline"]
             btn_label = "📤 确认上传" if st.session_state.stage != "completed" else "🔄 重新分析"
             
             if st.button(btn_label, key="confirm_upload", use_container_width=True, disabled=(uploaded_file is None or is_processing)):
                 if st.session_state.stage == "completed":
                     st.session_state.candidates = []
-                st.session_state.stage = "parsing"
+                # 每次分析一条新链路，后端的 span 都挂在这个 trace id 下
+                st.session_state.trace_id = uuid.uuid4().hex
+                st.session_state.image_bytes = 0
+                st.session_state.stage = "pipeline" if PIPELINE_MODE == "single" else "parsing"
                 st.rerun()
 
-            if st.session_state.stage == "completed":
+            # 处理中也可以清空，断开流即取消后端生图
+            if st.session_state.stage == "completed" or is_processing:
                 st.markdown("<br>", unsafe_allow_html=True)
                 if st.button("🧹 清空会话", key="clear_all", use_container_width=True):
                     reset_app()
                     st.rerun()
 
+            if st.session_state.stage == "completed" and st.session_state.get('trace_id'):
+                st.caption(f"链路 ID: `{st.session_state.trace_id}`（python Backend/trace_waterfall.py {st.session_state.trace_id} 查看耗时分布）")
+                st.caption(f"本次分析图片下载: {st.session_state.get('image_bytes', 0) / 1024:.0f} KB")
+                if IMAGE_DELIVERY == "proxy":
+                    media = media_cache().stats()
+                    st.caption(f"进程图片缓存: {media['bytes'] / 1024 / 1024:.1f} / {media['budget'] / 1024 / 1024:.0f} MB（{media['items']} 张，淘汰 {media['evictions']}）")
+
     # 2. 中间：信息 (修复关键词展示)
     with col_center:
         with st.container(height=680):
             st.markdown('<div class="card-anchor"></div>', unsafe_allow_html=True)
-            if not st.session_state.paper_info:
-                st.markdown('<div class="waiting-container"><div class="waiting-emoji">🍅</div><div>等待您的投喂...</div></div>', unsafe_allow_html=True)
-            else:
-                info = st.session_state.paper_info
-                st.markdown("### 论文解析")
-                st.markdown(f"**标题:** {info.get('paper_title')}")
-                st.markdown(f"**作者:** {', '.join(info.get('authors', []))}")
-                
-                # --- 核心修复：补充关键词 Tag 展示 ---
-                st.markdown("#### 关键词")
-                keywords = info.get('keywords', [])
-                if keywords:
-                    keywords_html = "".join([f'<span class="keyword-tag">{k}</span>' for k in keywords])
-                    st.markdown(f'<div style="line-height: 1.8; margin-bottom: 15px;">{keywords_html}</div>', unsafe_allow_html=True)
-                else:
-                    st.markdown("*无关键词数据*")
-                
-                st.markdown("#### AI 摘要")
-                st.markdown(f'<div style="background: rgba(255, 255, 255, 0.9); border: 1px solid #e8dcc6; border-radius: 10px; padding: 15px; color: #4a6a3a; line-height: 1.6;">{info.get("summary")}</div>', unsafe_allow_html=True)
+            info_area = st.empty()
+
+            def render_paper_info():
+                with info_area.container():
+                    if not st.session_state.paper_info:
+                        st.markdown('<div class="waiting-container"><div class="waiting-emoji">🍅</div><div>等待您的投喂...</div></div>', unsafe_allow_html=True)
+                        return
+                    info = st.session_state.paper_info
+                    st.markdown("### 论文解析")
+                    st.markdown(f"**标题:** {info.get('paper_title')}")
+                    st.markdown(f"**作者:** {', '.join(info.get('authors', []))}")
+                    
+                    # --- 核心修复：补充关键词 Tag 展示 ---
+                    st.markdown("#### 关键词")
+                    keywords = info.get('keywords', [])
+                    if keywords:
+                        keywords_html = "".join([f'<span class="keyword-tag">{html.escape(k)}</span>' for k in keywords])
+                        st.markdown(f'<div style="line-height: 1.8; margin-bottom: 15px;">{keywords_html}</div>', unsafe_allow_html=True)
+                    else:
+                        st.markdown("*无关键词数据*")
+                    
+                    st.markdown("#### AI 摘要")
+                    # 摘要是模型输出（流水线模式下逐段追加、可能停在半个标签上），转义后再放进 HTML 容器
+                    summary = html.escape(info.get("summary") or "")
+                    st.markdown(f'<div style="background: rgba(255, 255, 255, 0.9); border: 1px solid #e8dcc6; border-radius: 10px; padding: 15px; color: #4a6a3a; line-height: 1.6;">{summary}</div>', unsafe_allow_html=True)
+
+            render_paper_info()
+            # 表格在解析阶段就已写入缓存，完成后按论文列出并预览
+            if st.session_state.stage == "completed" and st.session_state.paper_info.get('paper_id'):
+                render_paper_tables(st.session_state.paper_info['paper_id'])
 
     # 3. 右侧：图解区域
     with col_right:
@@ -182,16 +534,15 @@ def main():
                     
                     if st.session_state.candidates:
                         st.markdown("### 🎨 并列视觉方案")
+                        # 候选图、论文插图和表格打成一个 ZIP，浏览器直接从后端下载，支持断点续传
+                        if st.session_state.stage == "completed" and st.session_state.get('generation_id'):
+                            st.link_button("📦 打包下载全部 (ZIP)", public_url("/api/export", generation=st.session_state.generation_id))
                         for cand in reversed(st.session_state.candidates):
                             st.markdown(f"**{cand['style_tag']}**")
-                            img_data = render_safe_image(cand['image_url'], cand['style_tag'])
-                            if st.session_state.stage == "completed" and img_data:
-                                st.download_button(
-                                    label="Download ⬇️", 
-                                    data=img_data, 
-                                    file_name=f"plot_{cand['id']}.png", 
-                                    key=f"dl_{cand['id']}"
-                                )
+                            shown = render_safe_image(cand['image_url'], cand['style_tag'])
+                            # 下载给原图，只在完成后出现
+                            if st.session_state.stage == "completed" and shown:
+                                render_download(cand)
                             st.markdown("---")
                     elif not status_msg:
                         st.markdown('<div class="waiting-container"><div class="waiting-emoji">🎨</div><div>等待解析完成...</div></div>', unsafe_allow_html=True)
@@ -200,9 +551,16 @@ def main():
                 prompt = st.session_state.generated_prompt
                 if prompt:
                     display_all_candidates("AI 画师正在构思...")
-                    stream_gen = generate_stream_api(prompt)
+                    stream_gen = generate_stream_api(prompt, st.session_state.generation_id)
                     for chunk in stream_gen:
-                        if chunk.get('type') == 'image':
+                        if chunk.get('type') == 'queue':
+                            display_all_candidates(queue_status_text(chunk) or "AI 画师正在构思...")
+                        elif chunk.get('type') == 'error' and not st.session_state.candidates:
+                            st.warning(chunk.get('error'))
+                        elif chunk.get('type') == 'complete' and chunk.get('generationId'):
+                            # 直接生图时任务 id 由后端在完成时分配，用于打包下载
+                            st.session_state.generation_id = chunk.get('generationId')
+                        elif chunk.get('type') == 'image':
                             img_url = chunk.get('url')
                             if img_url:
                                 st.session_state.candidates.append({
@@ -214,24 +572,41 @@ def main():
                     st.session_state.stage = "completed"
                     st.rerun()
             else:
-                if st.session_state.stage == "parsing":
+                if st.session_state.stage in ["parsing", "pipeline"]:
                     output_area.markdown('<div class="waiting-container"><div class="waiting-emoji">📄</div><div>正在阅读论文...</div></div>', unsafe_allow_html=True)
                 else:
                     display_all_candidates()
 
     # --- 后台解析流转 ---
     if st.session_state.stage == "parsing":
-        st.markdown(f"""<div class="loading-overlay"><div class="loading-tomato">🍅</div><div class="loading-text">正在深度阅读论文...</div><div class="progress-container"><div class="progress-bar"></div></div></div>""", unsafe_allow_html=True)
-        result = upload_paper_api(uploaded_file)
+        overlay = st.empty()
+
+        def show_loading(text):
+            overlay.markdown(f"""<div class="loading-overlay"><div class="loading-tomato">🍅</div><div class="loading-text">{text}</div><div class="progress-container"><div class="progress-bar"></div></div></div>""", unsafe_allow_html=True)
+
+        show_loading("正在深度阅读论文...")
+        live_summary = []
+
+        def on_parse_event(chunk):
+            # 摘要边生成边显示；Prompt 一出来生图就已在后台开始
+            if chunk.get('type') == 'summary':
+                live_summary.append(chunk.get('content', ''))
+                show_loading(html.escape("".join(live_summary)[-400:]))
+            elif chunk.get('type') == 'prompt' and chunk.get('generationId'):
+                show_loading(html.escape("".join(live_summary)[-400:]) + "<br>🎨 AI 画师已开工...")
+
+        result = upload_paper_api(uploaded_file, on_event=on_parse_event)
         if result['success']:
             meta = result['metadata']
             st.session_state.paper_info = {
                 'paper_title': meta.get('title', uploaded_file.name),
                 'authors': meta.get('authors', ['科研团队']),
                 'keywords': meta.get('keywords', []),
-                'summary': result['summary']
+                'summary': result['summary'],
+                'paper_id': meta.get('paperId')
             }
             st.session_state.generated_prompt = result['prompt']
+            st.session_state.generation_id = result.get('generation_id')
             st.session_state.stage = "visualizing" 
             st.rerun()
         else:
@@ -239,6 +614,61 @@ def main():
             st.session_state.stage = "idle"
             st.rerun()
 
+    # --- 单请求流水线：同一条流里更新论文信息和图片，中途不 rerun ---
+    if st.session_state.stage == "pipeline":
+        st.session_state.paper_info = {
+            'paper_title': uploaded_file.name,
+            'authors': [],
+            'keywords': [],
+            'summary': ''
+        }
+        info = st.session_state.paper_info
+        render_paper_info()
+
+        for chunk in pipeline_stream_api(uploaded_file):
+            kind = chunk.get('type')
+            if kind == 'metadata':
+                info['paper_title'] = chunk.get('title') or info['paper_title']
+                info['paper_id'] = chunk.get('paperId')
+                render_paper_info()
+            elif kind == 'summary':
+                info['summary'] += chunk.get('content', '')
+                render_paper_info()
+            elif kind in ('authors', 'keywords'):
+                info[kind] = chunk.get(kind, [])
+                render_paper_info()
+            elif kind == 'prompt':
+                st.session_state.generated_prompt = chunk.get('prompt', '')
+                st.session_state.generation_id = chunk.get('generationId')
+                display_all_candidates("AI 画师正在构思...")
+            elif kind == 'analysis':
+                meta = chunk.get('metadata', {})
+                info.update({
+                    'paper_title': meta.get('title', info['paper_title']),
+                    'authors': meta.get('authors', info['authors']),
+                    'keywords': meta.get('keywords', info['keywords']),
+                    'summary': chunk.get('text', info['summary'])
+                })
+                render_paper_info()
+            elif kind == 'queue':
+                display_all_candidates(queue_status_text(chunk) or "AI 画师正在构思...")
+            elif kind == 'image' and chunk.get('url'):
+                st.session_state.candidates.append({
+                    'id': str(uuid.uuid4())[:8],
+                    'style_tag': f"方案 {len(st.session_state.candidates) + 1}",
+                    'image_url': chunk.get('url')
+                })
+                display_all_candidates("正在绘制更多方案...")
+            elif kind == 'error' and chunk.get('fatal'):
+                st.error(f"解析失败: {chunk.get('error')}")
+                st.session_state.stage = "idle"
+                st.rerun()
+            elif kind == 'error' and not st.session_state.candidates:
+                st.warning(chunk.get('error'))
+
+        st.session_state.stage = "completed"
+        st.rerun()
+
     st.markdown('<div style="text-align: center; padding: 30px 0; margin-top: 40px; color: #7b6345; font-style: italic;">"在数据的森林中，寻找知识的绿洲"</div>', unsafe_allow_html=True)
 
 if __name__ == "__main__":